@@ -1,11 +1,39 @@
-import tensorflow as tf
-import h5py
-import os
+"""
+Convert the AgileX HDF5 episodes into sharded TFRecord files:
+
+    python -m data.agilex.hdf5totfrecords --root_dir data/datasets/agilex/rdt_data/ \
+        --out_dir data/datasets/agilex/tfrecords/ [--n_workers 16 --shard_size_mb 1024]
+
+The episodes are packed into shards of about `--shard_size_mb` each and
+`index.json` (see data/tfrecord_index.py) records where each episode
+starts, which is how data/preprocess_scripts/agilex.py reads them.
+The steps of an episode are read from HDF5 in slices of `--chunk_size`.
+An episode that fails to convert is logged to error_log.txt and left out
+of its shard.
+
+The assignment of the episodes to the shards and the finished shards are
+kept in `manifest.json`, so an interrupted run resumes from the unfinished
+shards, and episodes added later are packed into new shards. The record
+count of every shard is verified before it is marked as finished.
+"""
+import argparse
 import fnmatch
+import json
+import os
 import shutil
-from tqdm import tqdm
 from multiprocessing import Pool
+
+import h5py
 import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from data.tfrecord_index import count_records, fill_episode_starts, record_size, save_index
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+INSTRUCTION_FILE_NAME = "expanded_instruction_gpt-4-turbo.json"
+CAMERA_NAMES = ['cam_high', 'cam_left_wrist', 'cam_right_wrist']
 
 
 def _bytes_feature(value):
@@ -36,79 +64,229 @@ def serialize_example(action, base_action, qpos, qvel, cam_high, cam_left_wrist,
     return example_proto.SerializeToString()
 
 
-def process_hdf5_file(args):
-    filepath, root_dir, out_dir = args
-    output_dir = os.path.join(out_dir, os.path.relpath(os.path.dirname(filepath), root_dir))
-    os.makedirs(output_dir, exist_ok=True)
-    filename = os.path.basename(filepath)
-    tfrecord_path = os.path.join(output_dir, filename.replace('.hdf5', '.tfrecord'))
+def get_first_idx(qpos):
+    """
+    Get the idx of the first qpos whose delta exceeds the threshold,
+    to remove the first few still steps.
+    """
+    EPS = 1e-2
+    qpos_delta = np.abs(qpos - qpos[0:1])
+    indices = np.where(np.any(qpos_delta > EPS, axis=1))[0]
+    if len(indices) == 0:
+        raise ValueError("Found no qpos that exceeds the threshold.")
+    return indices[0]
 
-    if os.path.exists(tfrecord_path) and os.path.getsize(tfrecord_path) > 0:
-        return f"TFRecords already exist at {tfrecord_path}"
+
+def iter_hdf5_examples(filepath, chunk_size):
+    """
+    Yield the serialized steps of an episode, reading the HDF5 file in slices.
+    """
+    with h5py.File(filepath, 'r') as f:
+        num_steps = f['action'].shape[0]
+        qpos = f['observations']['qpos'][:]
+        start = max(get_first_idx(qpos) - 1, 0)
+        qpos = qpos[start:]
+        action = f['action'][start:]
+        base_action = f['base_action'][start:]
+        qvel = f['observations']['qvel'][start:]
+        instruction = f['instruction'][()]
+        for chunk_start in range(start, num_steps, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, num_steps)
+            images = {
+                cam: f['observations']['images'][cam][chunk_start:chunk_end]
+                for cam in CAMERA_NAMES
+            }
+            for i in range(chunk_start, chunk_end):
+                j, k = i - start, i - chunk_start
+                yield serialize_example(
+                    action[j], base_action[j], qpos[j], qvel[j],
+                    images['cam_high'][k], images['cam_left_wrist'][k], images['cam_right_wrist'][k],
+                    instruction, i == num_steps - 1)
+
+
+def process_shard(args):
+    """
+    Write the episodes of a shard, verify the record count and return its index.
+    """
+    shard_name, rel_paths, root_dir, out_dir, chunk_size = args
+    shard_path = os.path.join(out_dir, shard_name)
+    tmp_path = f"{shard_path}.tmp"
+    # Every episode is written to its own file first and appended to the
+    # shard once it is complete, so an episode that fails midway is dropped
+    # without buffering its steps in memory
+    episode_path = f"{shard_path}.episode.tmp"
+    episodes, errors = [], []
+    offset, total_records = 0, 0
     try:
-        with h5py.File(filepath, 'r') as f, tf.io.TFRecordWriter(tfrecord_path) as writer:
-            num_episodes = f['action'].shape[0]
-            # Remove the first few still steps
-            EPS = 1e-2
-            qpos = f['observations']['qpos'][:]
-            # Get the idx of the first qpos whose delta exceeds the threshold
-            qpos_delta = np.abs(qpos - qpos[0:1])
-            indices = np.where(np.any(qpos_delta > EPS, axis=1))[0]
-            if len(indices) > 0:
-                first_idx = indices[0]
-            else:
-                raise ValueError("Found no qpos that exceeds the threshold.")
-            
-            for i in range(first_idx-1, num_episodes):
-                action = f['action'][i]
-                base_action = f['base_action'][i]
-                qpos = f['observations']['qpos'][i]
-                qvel = f['observations']['qvel'][i]
-                cam_high = f['observations']['images']['cam_high'][i]
-                cam_left_wrist = f['observations']['images']['cam_left_wrist'][i]
-                cam_right_wrist = f['observations']['images']['cam_right_wrist'][i]
-                instruction  = f['instruction'][()]
-                terminate_episode = i == num_episodes - 1
-                serialized_example = serialize_example(action, base_action, qpos, qvel, cam_high, cam_left_wrist, cam_right_wrist, instruction, terminate_episode)
-                writer.write(serialized_example)
-    except Exception as e:
-        with open("error_log.txt", "a") as f:
-            f.write(f"{filepath}\n")
-        print(f"error at {filepath}: {e}")        
-    return f"TFRecords written to {tfrecord_path}"
+        with open(tmp_path, 'wb') as shard_file:
+            for rel_path in rel_paths:
+                filepath = os.path.join(root_dir, rel_path)
+                num_records, num_bytes = 0, 0
+                try:
+                    with tf.io.TFRecordWriter(episode_path) as writer:
+                        for example in iter_hdf5_examples(filepath, chunk_size):
+                            writer.write(example)
+                            num_bytes += record_size(example)
+                            num_records += 1
+                except Exception as e:
+                    errors.append(f"{filepath}: {e}")
+                    continue
+                with open(episode_path, 'rb') as episode_file:
+                    shutil.copyfileobj(episode_file, shard_file)
+                episodes.append({
+                    "name": rel_path,
+                    "shard": shard_name,
+                    "start": total_records,
+                    "num_records": num_records,
+                    "instruction_dir": os.path.dirname(rel_path),
+                })
+                offset += num_bytes
+                total_records += num_records
+        if os.path.exists(episode_path):
+            os.remove(episode_path)
 
+        if count_records(tmp_path) != total_records or os.path.getsize(tmp_path) != offset:
+            raise ValueError(f"Record count mismatch in {tmp_path}.")
+        os.replace(tmp_path, shard_path)
+    except Exception as e:
+        return shard_name, None, errors + [f"{shard_name}: {e}"]
+    return shard_name, {
+        "num_records": total_records, "num_bytes": offset, "episodes": episodes
+    }, errors
 
-def write_tfrecords(root_dir, out_dir):
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
 
-    hdf5_files = []
+def copy_instructions(root_dir, out_dir):
     for root, dirs, files in os.walk(root_dir):
-        if os.path.exists(os.path.join(root,"expanded_instruction_gpt-4-turbo.json")):
-            # copy the instruction file
-            target_path = os.path.join(out_dir, os.path.relpath(root, root_dir))
+        target_path = os.path.join(out_dir, os.path.relpath(root, root_dir))
+        if os.path.exists(os.path.join(root, INSTRUCTION_FILE_NAME)):
             os.makedirs(target_path, exist_ok=True)
-            shutil.copy(os.path.join(root,"expanded_instruction_gpt-4-turbo.json"), target_path)
-        elif os.path.exists(os.path.join(root,"expanded_instruction.json")):
+            shutil.copy(os.path.join(root, INSTRUCTION_FILE_NAME), target_path)
+        elif os.path.exists(os.path.join(root, "expanded_instruction.json")):
             print(root)
-            target_path = os.path.join(out_dir, os.path.relpath(root, root_dir))
             os.makedirs(target_path, exist_ok=True)
-            shutil.copy(os.path.join(root,"expanded_instruction.json"), target_path)
-            # rename into expanded_instruction_gpt-4-turbo.json
-            os.rename(os.path.join(out_dir, os.path.relpath(root, root_dir), "expanded_instruction.json"), os.path.join(out_dir, os.path.relpath(root, root_dir), "expanded_instruction_gpt-4-turbo.json"))
+            # Rename into expanded_instruction_gpt-4-turbo.json
+            shutil.copy(os.path.join(root, "expanded_instruction.json"),
+                        os.path.join(target_path, INSTRUCTION_FILE_NAME))
+
+
+def find_hdf5_files(root_dir):
+    rel_paths = []
+    for root, dirs, files in os.walk(root_dir):
         for filename in fnmatch.filter(files, '*.hdf5'):
-            filepath = os.path.join(root, filename)
-            hdf5_files.append((filepath, root_dir, out_dir))
+            rel_paths.append(os.path.relpath(os.path.join(root, filename), root_dir))
+    return sorted(rel_paths)
+
+
+def load_manifest(out_dir):
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {"shards": {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE_NAME)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
 
-    with Pool(16) as pool:
-        max_count = len(hdf5_files)
-        with tqdm(total=max_count) as pbar:
-            for _ in pool.imap_unordered(process_hdf5_file, hdf5_files):
+def plan_shards(manifest, root_dir, shard_size):
+    """
+    Pack the episodes that are in no shard yet into new shards of about
+    `shard_size` bytes, estimated from the sizes of the HDF5 files.
+    The existing shards are kept so that their files stay valid.
+    """
+    planned = set()
+    for shard in manifest["shards"].values():
+        planned.update(shard["sources"])
+    new_paths = [p for p in find_hdf5_files(root_dir) if p not in planned]
+
+    shard_idx = len(manifest["shards"])
+    sources, size = [], 0
+    def add_shard():
+        nonlocal shard_idx
+        manifest["shards"][f"shard-{shard_idx:05d}.tfrecord"] = {
+            "sources": sources, "done": False}
+        shard_idx += 1
+    for rel_path in new_paths:
+        file_size = os.path.getsize(os.path.join(root_dir, rel_path))
+        if len(sources) > 0 and size + file_size > shard_size:
+            add_shard()
+            sources, size = [], 0
+        sources.append(rel_path)
+        size += file_size
+    if len(sources) > 0:
+        add_shard()
+    return len(new_paths)
+
+
+def write_index(out_dir, manifest):
+    shards, episodes = {}, []
+    for shard_name, shard in sorted(manifest["shards"].items()):
+        if not shard["done"]:
+            continue
+        shards[shard_name] = {
+            "num_records": shard["num_records"], "num_bytes": shard["num_bytes"]}
+        episodes.extend(shard["episodes"])
+    # The shards finished by older versions have no episode starts
+    fill_episode_starts(episodes)
+    save_index(out_dir, shards, episodes)
+    return len(episodes)
+
+
+def write_tfrecords(root_dir, out_dir, n_workers=16, shard_size_mb=1024, chunk_size=128):
+    os.makedirs(out_dir, exist_ok=True)
+    copy_instructions(root_dir, out_dir)
+
+    manifest = load_manifest(out_dir)
+    num_new = plan_shards(manifest, root_dir, shard_size_mb * 1024 * 1024)
+    save_manifest(out_dir, manifest)
+
+    tasks = [
+        (shard_name, shard["sources"], root_dir, out_dir, chunk_size)
+        for shard_name, shard in sorted(manifest["shards"].items())
+        if not shard["done"]
+    ]
+    print(f"{num_new} new episodes, {len(tasks)}/{len(manifest['shards'])} shards to write.")
+
+    failed = 0
+    with Pool(n_workers) as pool:
+        with tqdm(total=len(tasks)) as pbar:
+            for shard_name, result, errors in pool.imap_unordered(process_shard, tasks):
+                for error in errors:
+                    with open("error_log.txt", "a") as f:
+                        f.write(f"{error}\n")
+                    print(f"error at {error}")
+                if result is None:
+                    failed += 1
+                else:
+                    manifest["shards"][shard_name].update(result, done=True)
+                    # Save the progress after each shard (for resume)
+                    save_manifest(out_dir, manifest)
                 pbar.update(1)
 
-    print(f"TFRecords written to {out_dir}")
+    num_episodes = write_index(out_dir, manifest)
+    print(f"TFRecords of {num_episodes} episodes written to {out_dir}")
+    if failed > 0:
+        print(f"{failed} shards failed, rerun to retry them.")
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_dir', type=str, default="data/datasets/agilex/rdt_data/",
+                        help="Directory of the HDF5 episodes.")
+    parser.add_argument('--out_dir', type=str, default="data/datasets/agilex/tfrecords/",
+                        help="Directory to write the TFRecord shards.")
+    parser.add_argument('--n_workers', type=int, default=16,
+                        help="Number of parallel workers.")
+    parser.add_argument('--shard_size_mb', type=int, default=1024,
+                        help="Approximate size of each shard in MB.")
+    parser.add_argument('--chunk_size', type=int, default=128,
+                        help="Number of steps read from HDF5 at once.")
+    args = parser.parse_args()
 
-root_dir = "../datasets/agilex/rdt_data/"
-out_dir = "../datasets/agilex/tfrecords/"
-write_tfrecords(root_dir, out_dir)
+    write_tfrecords(args.root_dir, args.out_dir, args.n_workers,
+                    args.shard_size_mb, args.chunk_size)
@@ -0,0 +1,276 @@
+"""
+A single-file, memory-mapped storage for the samples of a buffer chunk.
+
+Each chunk directory holds one `samples.bin` file instead of one JSON
+file and one npz file (plus their lock files) per sample:
+
+    [file header | slot 0 | slot 1 | ... | slot N-1]
+
+Slot `i` starts at `header_size + i * slot_size`. Every slot is
+self-describing:
+
+    [slot header | field table | JSON content | field data (64B aligned)]
+
+The field table records the name, dtype, shape, offset and size of each
+array, so a reader can expose the arrays as `np.frombuffer` views on
+the memory map without any copy or parsing. The file is created sparse,
+so unused bytes at the end of each slot do not take disk space.
+
+Readers and writers coordinate with POSIX byte-range locks on the slot,
+which replaces the per-sample `.lock` files.
+
+A chunk is in this format if it has a `samples.bin` file, otherwise it
+is in the legacy npz format (see `is_chunk_buffer`), so both formats can
+coexist in one buffer.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+
+CHUNK_FILE_NAME = "samples.bin"
+
+FILE_MAGIC = b"RDTCHUNK"
+FILE_VERSION = 1
+# magic, version, num_slots, slot_size, header_size
+FILE_HEADER = struct.Struct("<8sIIQQ")
+FILE_HEADER_SIZE = 4096
+
+SLOT_MAGIC = b"RDTSLOT\0"
+# magic, num_fields, json_len, used bytes
+SLOT_HEADER = struct.Struct("<8sIIQ")
+MAX_NDIM = 6
+# name, dtype, ndim, shape, offset, nbytes
+FIELD_ENTRY = struct.Struct(f"<32s8sI{MAX_NDIM}QQQ")
+DATA_ALIGNMENT = 64
+
+# The arrays of a sample, in the same order as in the legacy npz files
+SAMPLE_KEYS = [
+    "step_id",
+    "state_chunk",
+    "state_chunk_time_mask",
+    "action_chunk",
+    "action_chunk_time_mask",
+    "state_vec_mask",
+    "past_frames_0",
+    "past_frames_0_time_mask",
+    "past_frames_1",
+    "past_frames_1_time_mask",
+    "past_frames_2",
+    "past_frames_2_time_mask",
+    "past_frames_3",
+    "past_frames_3_time_mask",
+    "state_std",
+    "state_mean",
+    "state_norm",
+]
+
+
+def _align(offset, alignment=DATA_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def is_chunk_buffer(chunk_dir):
+    """
+    Whether the chunk is stored in a chunk file rather than npz files.
+    """
+    return os.path.exists(os.path.join(chunk_dir, CHUNK_FILE_NAME))
+
+
+class ChunkBuffer:
+    """
+    The memory-mapped sample file of one chunk.
+    """
+    def __init__(self, chunk_dir, writable=False):
+        self.file_path = os.path.join(chunk_dir, CHUNK_FILE_NAME)
+        self.writable = writable
+        self.fd, self.mm = None, None
+        self.fd = os.open(self.file_path, os.O_RDWR if writable else os.O_RDONLY)
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self.mm = mmap.mmap(self.fd, 0, access=access)
+        self.inode = os.fstat(self.fd).st_ino
+
+        magic, version, num_slots, slot_size, header_size = \
+            FILE_HEADER.unpack_from(self.mm, 0)
+        if magic != FILE_MAGIC:
+            raise ValueError(f"{self.file_path} is not a chunk buffer file.")
+        if version != FILE_VERSION:
+            raise ValueError(f"Unsupported chunk buffer version: {version}")
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.header_size = header_size
+
+    @classmethod
+    def create(cls, chunk_dir, num_slots, slot_size):
+        """
+        Create an empty (sparse) chunk file and open it for writing.
+        If a compatible file already exists, it is reused.
+
+        A new file is written aside and renamed over the old one, so the
+        processes that still map the old file never see it truncated
+        (which would raise SIGBUS). They reopen it when `is_replaced`.
+        """
+        os.makedirs(chunk_dir, exist_ok=True)
+        file_path = os.path.join(chunk_dir, CHUNK_FILE_NAME)
+        slot_size = _align(slot_size)
+        if os.path.exists(file_path):
+            try:
+                buffer = cls(chunk_dir, writable=True)
+                if buffer.num_slots == num_slots and buffer.slot_size == slot_size:
+                    return buffer
+                buffer.close()
+            except ValueError:
+                pass
+
+        tmp_path = f"{file_path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as file:
+            file.write(FILE_HEADER.pack(
+                FILE_MAGIC, FILE_VERSION, num_slots, slot_size, FILE_HEADER_SIZE))
+            file.truncate(FILE_HEADER_SIZE + num_slots * slot_size)
+        os.replace(tmp_path, file_path)
+        return cls(chunk_dir, writable=True)
+
+    def is_replaced(self):
+        """
+        Whether the chunk file has been replaced or removed since it was opened.
+        """
+        try:
+            return os.stat(self.file_path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def close(self):
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # Some zero-copy views are still alive,
+                # the map will be released with them
+                pass
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def slot_offset(self, idx):
+        if not 0 <= idx < self.num_slots:
+            raise IndexError(f"Slot {idx} out of range [0, {self.num_slots}).")
+        return self.header_size + idx * self.slot_size
+
+    def _lock(self, idx, exclusive):
+        flag = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        fcntl.lockf(self.fd, flag | fcntl.LOCK_NB,
+                    self.slot_size, self.slot_offset(idx), os.SEEK_SET)
+
+    def _unlock(self, idx):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN,
+                    self.slot_size, self.slot_offset(idx), os.SEEK_SET)
+
+    def _with_lock(self, idx, exclusive, fn, timeout=10.0):
+        # If the slot is locked by others, retry
+        time_stmp = time.time()
+        while True:
+            try:
+                self._lock(idx, exclusive)
+                break
+            except (BlockingIOError, PermissionError):
+                if time.time() - time_stmp > timeout:
+                    raise TimeoutError(f"Failed to lock slot {idx} of {self.file_path}.")
+                time.sleep(0.001)
+        try:
+            return fn()
+        finally:
+            self._unlock(idx)
+
+    def _write(self, idx, json_content, arrays):
+        base = self.slot_offset(idx)
+        json_bytes = json.dumps(json_content).encode("utf-8")
+        table_size = FIELD_ENTRY.size * len(arrays)
+        data_offset = _align(SLOT_HEADER.size + table_size + len(json_bytes))
+
+        entries = []
+        offset = data_offset
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if not array.flags.c_contiguous:
+                array = array.copy(order='C')
+            if array.ndim > MAX_NDIM:
+                raise ValueError(f"Field {name} has more than {MAX_NDIM} dims.")
+            shape = tuple(array.shape) + (0,) * (MAX_NDIM - array.ndim)
+            entries.append((name, array, shape, offset))
+            offset = _align(offset + array.nbytes)
+        if offset > self.slot_size:
+            raise ValueError(
+                f"Sample of {offset} bytes does not fit in the slot of {self.slot_size} bytes.")
+
+        # Invalidate the slot first so that a crash never leaves a half-written sample
+        self.mm[base:base + SLOT_HEADER.size] = bytes(SLOT_HEADER.size)
+        table = bytearray()
+        for name, array, shape, field_offset in entries:
+            table += FIELD_ENTRY.pack(
+                name.encode("utf-8"), array.dtype.str.encode("ascii"),
+                array.ndim, *shape, field_offset, array.nbytes)
+            dst = np.frombuffer(self.mm, dtype=np.uint8, count=array.nbytes,
+                                offset=base + field_offset)
+            dst[:] = array.reshape(-1).view(np.uint8)
+        start = base + SLOT_HEADER.size
+        self.mm[start:start + len(table)] = table
+        start += len(table)
+        self.mm[start:start + len(json_bytes)] = json_bytes
+        self.mm[base:base + SLOT_HEADER.size] = SLOT_HEADER.pack(
+            SLOT_MAGIC, len(entries), len(json_bytes), offset)
+
+    def _read(self, idx, copy):
+        base = self.slot_offset(idx)
+        magic, num_fields, json_len, _ = SLOT_HEADER.unpack_from(self.mm, base)
+        if magic != SLOT_MAGIC:
+            raise ValueError(f"Slot {idx} of {self.file_path} is empty.")
+
+        arrays = {}
+        start = base + SLOT_HEADER.size
+        for i in range(num_fields):
+            name, dtype, ndim, *rest = FIELD_ENTRY.unpack_from(
+                self.mm, start + i * FIELD_ENTRY.size)
+            shape, (field_offset, nbytes) = tuple(rest[:ndim]), rest[MAX_NDIM:]
+            dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+            array = np.frombuffer(
+                self.mm, dtype=dtype, count=nbytes // dtype.itemsize,
+                offset=base + field_offset).reshape(shape)
+            arrays[name.rstrip(b"\0").decode("utf-8")] = array.copy() if copy else array
+        start += num_fields * FIELD_ENTRY.size
+        json_content = json.loads(self.mm[start:start + json_len])
+        return json_content, arrays
+
+    def write_sample(self, idx, json_content, arrays):
+        """
+        Write a sample into slot `idx` in place.
+
+        Args:
+            json_content: a JSON-serializable dict
+            arrays: an ordered dict of numpy arrays
+        """
+        if not self.writable:
+            raise PermissionError(f"{self.file_path} is opened read-only.")
+        self._with_lock(idx, True, lambda: self._write(idx, json_content, arrays))
+
+    def read_sample(self, idx, copy=True):
+        """
+        Read the sample in slot `idx`.
+
+        If `copy` is False, the arrays are zero-copy views on the memory map.
+        They stay valid only until the producer overwrites the slot,
+        so the caller must not keep them across buffer refreshes.
+
+        Returns:
+            json_content: a dict
+            arrays: a dict of numpy arrays, in the order they were written
+        """
+        return self._with_lock(idx, False, lambda: self._read(idx, copy))
+
+    def __del__(self):
+        self.close()
@@ -1,240 +1,215 @@
 """
-This file will compute the min, max, mean, and standard deviation of each datasets 
-in `pretrain_datasets.json` or `pretrain_datasets.json`.
+This file will compute the min, max, mean, and standard deviation of each datasets
+in `pretrain_datasets.json` or `finetune_datasets.json`.
+
+The episodes of each dataset are split into `--num_shards` shards, which are
+processed by `--n_workers` parallel processes. Only the states are parsed and
+the images of the Open X-Embodiment datasets are not decoded. The moments of
+each finished shard are saved in `--ckpt_dir`, so an interrupted run resumes
+from the unfinished shards. The shards are merged with `StateMoments`.
 """
 
 import json
 import argparse
+import multiprocessing
 import os
-# from multiprocessing import Pool, Manager
 
 import tensorflow as tf
-import numpy as np
-from tqdm import tqdm
+import tensorflow_datasets as tfds
 
-from data.vla_dataset import VLADataset
+from data.vla_dataset import DATASET_NAMES_NOOPENX, load_raw_dataset
 from data.hdf5_vla_dataset import HDF5VLADataset
 from data.preprocess import generate_json_state
+from data.state_stat import StateMoments
+
+
+MAX_EPISODES = 100000
+# For debugging
+# MAX_EPISODES = 10
+
+# The HDF5 dataset of this process, if any
+_hdf5_dataset = None
+
+
+def _init_worker(hdf5_dataset):
+    global _hdf5_dataset
+    _hdf5_dataset = hdf5_dataset
+    # Workers do not need GPU
+    tf.config.set_visible_devices([], 'GPU')
+
+
+def load_shard(dataset_name, shard_idx, num_shards):
+    """
+    Load the episodes in a shard of the dataset, without decoding the images if possible.
+    """
+    if dataset_name in DATASET_NAMES_NOOPENX:
+        dataset = load_raw_dataset(dataset_name, seed=0)
+        return dataset.shard(num_shards, shard_idx)
+    # Only read the files of this shard
+    split = tfds.even_splits('all', n=num_shards)[shard_idx]
+    return load_raw_dataset(
+        dataset_name, seed=0, split=split, skip_image_decoding=True)
 
 
-# Process each dataset to get the statistics
+# Process a shard of a dataset to get the statistics
 @tf.autograph.experimental.do_not_convert
-def process_dataset(name_dataset_pair):
-    # print(f"PID {os.getpid()} processing {name_dataset_pair[0]}")
-    dataset_iter = name_dataset_pair[1]
-    
-    MAX_EPISODES = 100000
-    EPS = 1e-8
-    # For debugging
-    # MAX_EPISODES = 10
+def process_shard(dataset_name, shard_idx, num_shards):
+    moments = StateMoments()
+    if _hdf5_dataset is not None and dataset_name == _hdf5_dataset.get_dataset_name():
+        for i in range(shard_idx, len(_hdf5_dataset), num_shards):
+            episode = _hdf5_dataset.get_item(i, state_only=True)
+            moments.update(episode['state'])
+        return moments
+
+    max_episodes = -(-MAX_EPISODES // num_shards)
     episode_cnt = 0
-    state_sum = 0
-    state_sum_sq = 0
-    z_state_sum = 0
-    z_state_sum_sq = 0
-    state_cnt = 0
-    nz_state_cnt = None
-    state_max = None
-    state_min = None
-    for episode in dataset_iter:
+    for episode in load_shard(dataset_name, shard_idx, num_shards):
         episode_cnt += 1
         if episode_cnt % 1000 == 0:
-            print(f"Processing episodes {episode_cnt}/{MAX_EPISODES}")
-        if episode_cnt > MAX_EPISODES:
+            print(f"{dataset_name} shard {shard_idx}: processing episodes {episode_cnt}/{max_episodes}")
+        if episode_cnt > max_episodes:
             break
-        episode_dict = episode['episode_dict']
-        dataset_name = episode['dataset_name']
-        
-        res_tup = generate_json_state(
-            episode_dict, dataset_name
-        )
+        res_tup = generate_json_state(episode, dataset_name)
         states = res_tup[1]
-        
-        # Convert to numpy
-        states = states.numpy()
-        
-        # Zero the values that are close to zero
-        z_states = states.copy()
-        z_states[np.abs(states) <= EPS] = 0
-        # Compute the non-zero count
-        if nz_state_cnt is None:
-            nz_state_cnt = np.zeros(states.shape[1])
-        nz_state_cnt += np.sum(np.abs(states) > EPS, axis=0)
-        
-        # Update statistics
-        state_sum += np.sum(states, axis=0)
-        state_sum_sq += np.sum(states**2, axis=0)
-        z_state_sum += np.sum(z_states, axis=0)
-        z_state_sum_sq += np.sum(z_states**2, axis=0)
-        state_cnt += states.shape[0]
-        if state_max is None:
-            state_max = np.max(states, axis=0)
-            state_min = np.min(states, axis=0)
-        else:
-            state_max = np.maximum(state_max, np.max(states, axis=0))
-            state_min = np.minimum(state_min, np.min(states, axis=0))
-    
-    # Add one to avoid division by zero
-    nz_state_cnt = np.maximum(nz_state_cnt, np.ones_like(nz_state_cnt))
-    
-    result = {
-        "dataset_name": name_dataset_pair[0],
-        "state_mean": (state_sum / state_cnt).tolist(),
-        "state_std": np.sqrt(
-            np.maximum(
-                (z_state_sum_sq / nz_state_cnt) - (z_state_sum / state_cnt)**2 * (state_cnt / nz_state_cnt),
-                np.zeros_like(state_sum_sq)
-            )
-        ).tolist(),
-        "state_min": state_min.tolist(),
-        "state_max": state_max.tolist(),
-    }
-
-    return result
-
-
-def process_hdf5_dataset(vla_dataset):
-    EPS = 1e-8
-    episode_cnt = 0
-    state_sum = 0
-    state_sum_sq = 0
-    z_state_sum = 0
-    z_state_sum_sq = 0
-    state_cnt = 0
-    nz_state_cnt = None
-    state_max = None
-    state_min = None
-    for i in tqdm(range(len(vla_dataset))):
-        episode = vla_dataset.get_item(i, state_only=True)
-        episode_cnt += 1
-        
-        states = episode['state']
-        
-        # Zero the values that are close to zero
-        z_states = states.copy()
-        z_states[np.abs(states) <= EPS] = 0
-        # Compute the non-zero count
-        if nz_state_cnt is None:
-            nz_state_cnt = np.zeros(states.shape[1])
-        nz_state_cnt += np.sum(np.abs(states) > EPS, axis=0)
-        
-        # Update statistics
-        state_sum += np.sum(states, axis=0)
-        state_sum_sq += np.sum(states**2, axis=0)
-        z_state_sum += np.sum(z_states, axis=0)
-        z_state_sum_sq += np.sum(z_states**2, axis=0)
-        state_cnt += states.shape[0]
-        if state_max is None:
-            state_max = np.max(states, axis=0)
-            state_min = np.min(states, axis=0)
-        else:
-            state_max = np.maximum(state_max, np.max(states, axis=0))
-            state_min = np.minimum(state_min, np.min(states, axis=0))
-    
-    # Add one to avoid division by zero
-    nz_state_cnt = np.maximum(nz_state_cnt, np.ones_like(nz_state_cnt))
-    
-    result = {
-        "dataset_name": vla_dataset.get_dataset_name(),
-        "state_mean": (state_sum / state_cnt).tolist(),
-        "state_std": np.sqrt(
-            np.maximum(
-                (z_state_sum_sq / nz_state_cnt) - (z_state_sum / state_cnt)**2 * (state_cnt / nz_state_cnt),
-                np.zeros_like(state_sum_sq)
-            )
-        ).tolist(),
-        "state_min": state_min.tolist(),
-        "state_max": state_max.tolist(),
-    }
-
-    return result
+        moments.update(states.numpy())
+    return moments
+
+
+def get_shard_path(ckpt_dir, dataset_name, shard_idx, num_shards):
+    return os.path.join(ckpt_dir, dataset_name, f"shard_{shard_idx}_of_{num_shards}.json")
+
+
+def load_shard_moments(ckpt_dir, dataset_name, shard_idx, num_shards):
+    """
+    Load the checkpointed moments of a shard, or None if it is not finished.
+    """
+    shard_path = get_shard_path(ckpt_dir, dataset_name, shard_idx, num_shards)
+    if not os.path.exists(shard_path):
+        return None
+    with open(shard_path, 'r') as f:
+        return StateMoments.from_state_dict(json.load(f))
+
+
+def save_shard_moments(ckpt_dir, dataset_name, shard_idx, num_shards, moments):
+    shard_path = get_shard_path(ckpt_dir, dataset_name, shard_idx, num_shards)
+    os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+    # Write to a temporary file and rename it to never leave a partial checkpoint
+    tmp_path = f"{shard_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(moments.state_dict(), f)
+    os.replace(tmp_path, shard_path)
+
+
+def _process_shard(task):
+    dataset_name, shard_idx, num_shards, ckpt_dir = task
+    try:
+        moments = process_shard(dataset_name, shard_idx, num_shards)
+        save_shard_moments(ckpt_dir, dataset_name, shard_idx, num_shards, moments)
+        return dataset_name, shard_idx, None
+    except BaseException as e:
+        return dataset_name, shard_idx, repr(e)
+
+
+def merge_shards(ckpt_dir, dataset_name, num_shards):
+    """
+    Merge the moments of all the shards, or return None if some are not finished.
+    """
+    merged = StateMoments()
+    for shard_idx in range(num_shards):
+        moments = load_shard_moments(ckpt_dir, dataset_name, shard_idx, num_shards)
+        if moments is None:
+            return None
+        merged.merge(moments)
+    return merged.result(dataset_name)
+
+
+def save_result(save_path, result):
+    try:
+        with open(save_path, 'r') as f:
+            results = json.load(f)
+    except FileNotFoundError:
+        results = {}
+    results[result["dataset_name"]] = result
+    with open(save_path, 'w') as f:
+        json.dump(results, f, indent=4)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    # Multiprocessing currently with bugs
-    # parser.add_argument('--n_workers', type=int, default=1, 
-    #                     help="Number of parallel workers.")
-    parser.add_argument('--dataset_type', type=str, 
-                        default="pretrain", 
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help="Number of parallel workers.")
+    parser.add_argument('--num_shards', type=int, default=None,
+                        help="Number of shards of each dataset. Default is `n_workers`.")
+    parser.add_argument('--dataset_type', type=str,
+                        default="pretrain",
                         help="Whether to load the pretrain dataset or finetune dataset.")
-    parser.add_argument('--save_path', type=str, 
-                        default="configs/dataset_stat.json", 
+    parser.add_argument('--save_path', type=str,
+                        default="configs/dataset_stat.json",
                         help="JSON file path to save the dataset statistics.")
-    parser.add_argument('--skip_exist', action='store_true', 
+    parser.add_argument('--ckpt_dir', type=str,
+                        default="data/datasets/stat_ckpt",
+                        help="Directory to save the statistics of the finished shards (for resume).")
+    parser.add_argument('--skip_exist', action='store_true',
                         help="Whether to skip the existing dataset statistics.")
     parser.add_argument('--hdf5_dataset', action='store_true',
                         help="Whether to load the dataset from the HDF5 files.")
     args = parser.parse_args()
-    
+    num_shards = args.num_shards or args.n_workers
+
+    hdf5_dataset = None
     if args.hdf5_dataset:
-        vla_dataset = HDF5VLADataset()
-        dataset_name = vla_dataset.get_dataset_name()
-        
-        try:
-            with open(args.save_path, 'r') as f:
-                results = json.load(f)
-        except FileNotFoundError:
-            results = {}
+        hdf5_dataset = HDF5VLADataset()
+        dataset_names = [hdf5_dataset.get_dataset_name()]
+    else:
+        dataset_names_cfg = 'configs/pretrain_datasets.json' \
+            if args.dataset_type == 'pretrain' else 'configs/finetune_datasets.json'
+        with open(dataset_names_cfg, 'r') as file:
+            dataset_names = json.load(file)
+
+    try:
+        with open(args.save_path, 'r') as f:
+            results = json.load(f)
+    except FileNotFoundError:
+        results = {}
+
+    tasks = []
+    remaining_shards = {}
+    for dataset_name in dataset_names:
         if args.skip_exist and dataset_name in results:
             print(f"Skipping existed {dataset_name} dataset statistics")
-        else:
-            print(f"Processing {dataset_name} dataset")
-            result = process_hdf5_dataset(vla_dataset)
-            results[result["dataset_name"]] = result
-            with open(args.save_path, 'w') as f:
-                json.dump(results, f, indent=4)
-        print("All datasets have been processed.")
-        os._exit(0)
-        
-    vla_dataset = VLADataset(
-        seed=0, dataset_type=args.dataset_type, repeat=False)
-    name_dataset_pairs = vla_dataset.name2dataset.items()
-    # num_workers = args.n_workers
-    
-    for name_dataset_pair in tqdm(name_dataset_pairs):
-        try:
-            with open(args.save_path, 'r') as f:
-                results = json.load(f)
-        except FileNotFoundError:
-            results = {}
-        
-        if args.skip_exist and name_dataset_pair[0] in results:
-            print(f"Skipping existed {name_dataset_pair[0]} dataset statistics")
             continue
-        print(f"Processing {name_dataset_pair[0]} dataset")
-            
-        result = process_dataset(name_dataset_pair)
-                
-        results[result["dataset_name"]] = result
-    
-        # Save the results in the json file after each dataset (for resume)
-        with open(args.save_path, 'w') as f:
-            json.dump(results, f, indent=4)
-
-    print("All datasets have been processed.")
-    
-    # with Manager() as manager:
-    #     # Create shared dictionary and lock through the manager, accessible by all processes
-    #     progress = manager.dict(processed=0, results={})
-    #     progress_lock = manager.Lock()
-        
-    #     # Callback function to update progress
-    #     def update_progress(result):
-    #         with progress_lock:
-    #             progress['processed'] += 1
-    #             print(f"{result['dataset_name']} - {progress['processed']}/{len(name_dataset_pairs)} datasets have been processed")
-    #             # Append the result to the shared dictionary
-    #             progress['results'][result["dataset_name"]] = result
-
-    #     with Pool(num_workers) as p:
-    #         for name_dataset_pair in name_dataset_pairs:
-    #             p.apply_async(process_dataset, args=(name_dataset_pair,), callback=update_progress)
-
-    #         # Close the pool and wait for the work to finish
-    #         p.close()
-    #         p.join()
-
-        # # Save the results in the json file
-        # with open(args.save_path, 'w') as f:
-        #     json.dump(progress['results'], f, indent=4)
+        remaining_shards[dataset_name] = set()
+        for shard_idx in range(num_shards):
+            if os.path.exists(get_shard_path(args.ckpt_dir, dataset_name, shard_idx, num_shards)):
+                continue
+            remaining_shards[dataset_name].add(shard_idx)
+            tasks.append((dataset_name, shard_idx, num_shards, args.ckpt_dir))
+    print(f"Processing {len(remaining_shards)} datasets, {len(tasks)} shards remaining.")
+
+    # Merge the datasets whose shards are all finished in the previous runs
+    for dataset_name, shards in remaining_shards.items():
+        if len(shards) == 0:
+            save_result(args.save_path, merge_shards(args.ckpt_dir, dataset_name, num_shards))
+            print(f"{dataset_name} dataset has been processed.")
+
+    # Fork after TensorFlow is initialized is unsafe, so we spawn the workers
+    with multiprocessing.get_context('spawn').Pool(
+            args.n_workers, initializer=_init_worker, initargs=(hdf5_dataset,)) as pool:
+        failed = []
+        for i, (dataset_name, shard_idx, error) in enumerate(
+                pool.imap_unordered(_process_shard, tasks)):
+            if error is not None:
+                print(f"Failed to process shard {shard_idx} of {dataset_name}: {error}")
+                failed.append((dataset_name, shard_idx))
+                continue
+            print(f"{dataset_name} shard {shard_idx} has been processed, {i+1}/{len(tasks)} shards done.")
+            remaining_shards[dataset_name].discard(shard_idx)
+            # Save the results in the json file after each dataset (for resume)
+            if len(remaining_shards[dataset_name]) == 0:
+                save_result(args.save_path, merge_shards(args.ckpt_dir, dataset_name, num_shards))
+                print(f"{dataset_name} dataset has been processed.")
+
+    if len(failed) > 0:
+        print(f"{len(failed)} shards failed, rerun to retry them.")
+    else:
+        print("All datasets have been processed.")
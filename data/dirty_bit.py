@@ -0,0 +1,124 @@
+"""
+Shared-memory dirty bits for the producer/consumer buffer.
+
+The `dirty_bit` file of a chunk keeps one byte per sample slot. Instead of
+rewriting the whole file under a file lock, every process maps it into
+memory and updates single slots in place:
+    - a single-byte store never tears and never touches the other slots;
+    - a state transition that may race with other processes is a
+      compare-and-set guarded by a POSIX record lock on that one byte,
+      so processes working on different slots never wait for each other.
+
+Slot states:
+    CLEAN:   filled by the producer and not yet read
+    DIRTY:   read by a consumer, may be replaced by the producer
+    READING: claimed by a consumer that is loading it
+    WRITING: claimed by the producer that is replacing it
+
+A consumer claims CLEAN -> READING and releases READING -> DIRTY,
+a producer claims DIRTY -> WRITING and releases WRITING -> CLEAN.
+Thus a sample is never served twice nor overwritten before it is read.
+The legacy files (0 for clean, 1 for dirty) can be used as they are.
+"""
+import fcntl
+import mmap
+import os
+
+import numpy as np
+
+
+DIRTY_BIT_FILE_NAME = "dirty_bit"
+
+CLEAN = 0
+DIRTY = 1
+READING = 2
+WRITING = 3
+
+
+class DirtyBitmap:
+    """
+    The memory-mapped dirty bits of one chunk.
+
+    Note that record locks are held per process, so one instance must
+    not be shared by several threads that claim slots concurrently.
+    """
+    def __init__(self, chunk_dir):
+        self.file_path = os.path.join(chunk_dir, DIRTY_BIT_FILE_NAME)
+        self.fd, self.mm, self.bits = None, None, None
+        self.fd = os.open(self.file_path, os.O_RDWR)
+        self.mm = mmap.mmap(self.fd, 0)
+        self.bits = np.frombuffer(self.mm, dtype=np.uint8)
+
+    @classmethod
+    def create(cls, chunk_dir, chunk_size, state=CLEAN):
+        """
+        Create the dirty bits of a chunk with all the slots set to `state`.
+        An existing file of the right size is reset in place, so that the
+        other processes that have mapped it see the new states.
+        """
+        file_path = os.path.join(chunk_dir, DIRTY_BIT_FILE_NAME)
+        if os.path.exists(file_path) and os.path.getsize(file_path) == chunk_size:
+            bitmap = cls(chunk_dir)
+            bitmap.fill(state)
+            return bitmap
+
+        # Write to a temporary file and rename it to never expose a partial file
+        tmp_path = f"{file_path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as file:
+            file.write(np.full(chunk_size, state, dtype=np.uint8).tobytes())
+        os.replace(tmp_path, file_path)
+        return cls(chunk_dir)
+
+    def close(self):
+        self.bits = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __len__(self):
+        return len(self.bits)
+
+    def get_items(self, state):
+        """
+        Get indexes of the slots in the given state.
+        """
+        return np.where(self.bits == state)[0].tolist()
+
+    def get_clean_item(self):
+        return self.get_items(CLEAN)
+
+    def get_dirty_item(self):
+        return self.get_items(DIRTY)
+
+    def compare_and_set(self, idx, expected, state):
+        """
+        Atomically set slot `idx` to `state` if it is in the `expected` state.
+        Return True if the slot is changed.
+        """
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, idx, os.SEEK_SET)
+        try:
+            if self.bits[idx] != expected:
+                return False
+            self.bits[idx] = state
+            return True
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, idx, os.SEEK_SET)
+
+    def set(self, idx, state):
+        """
+        Set slot `idx` to `state`. Only the process that has claimed
+        the slot (READING or WRITING) should call this to release it.
+        """
+        self.bits[idx] = state
+
+    def fill(self, state):
+        """
+        Set all the slots to `state`, e.g., to refresh the whole chunk.
+        """
+        self.bits[:] = state
+
+    def __del__(self):
+        self.close()
@@ -18,6 +18,39 @@ if ACTION_CHUNK_SIZE < 1:
     raise ValueError("Config `action_chunk_size` must be at least 1.")
 
 
+def window_indices(num_steps, window_size, offset):
+    """
+    Compute the indices of a sliding window over the steps of an episode.
+    The window of step i covers steps [i + offset, i + offset + window_size),
+    clipped into the episode, i.e., padded with the first or the last step.
+
+    Returns:
+        index: (num_steps, window_size) int32 tensor, to be used with `tf.gather`
+        time_mask: (num_steps, window_size) bool tensor, False for the padding
+    """
+    index = tf.range(num_steps)[:, None] + tf.range(window_size)[None, :] + offset
+    time_mask = tf.logical_and(index >= 0, index < num_steps)
+    return tf.clip_by_value(index, 0, num_steps - 1), time_mask
+
+
+class LazyFramesStep(dict):
+    """
+    A step of a flattened episode. Its past frames are gathered from
+    the frames of the episode only when they are accessed, so a flattened
+    episode never holds the windows of all its steps at the same time.
+    """
+    def __init__(self, step, frames, frames_index):
+        super().__init__(step)
+        # key -> (num_steps, height, width, channels) frames of the episode
+        self.frames = frames
+        self.frames_index = frames_index
+
+    def __missing__(self, key):
+        if key in self.frames:
+            return tf.gather(self.frames[key], self.frames_index)
+        raise KeyError(key)
+
+
 @tf.function
 def process_episode(epsd: dict, dataset_name: str, 
                     image_keys: list, image_mask: list) -> dict:
@@ -60,84 +93,17 @@ def process_episode(epsd: dict, dataset_name: str,
             ))
     
 
-    # Calculate the past_frames_0 for each step
-    # Each step has a window of previous frames with size IMG_HISTORY_SIZE
-    # Use the first state to pad the frames
-    # past_frames_0 will have shape (num_steps, IMG_HISTORY_SIZE, height, width, channels)
+    # The windows of previous frames are not materialized here, since
+    # (num_steps, IMG_HISTORY_SIZE, height, width, channels) frames per camera
+    # take gigabytes for long episodes. Instead, we keep the frames once and
+    # the indices of the window of each step, which are shared by all cameras.
+    # The window is padded with the first frame.
     frames_0 = frames_0.stack()
-    first_frame = tf.expand_dims(frames_0[0], axis=0)
-    first_frame = tf.repeat(first_frame, IMG_HISTORY_SIZE-1, axis=0)
-    padded_frames_0 = tf.concat([first_frame, frames_0], axis=0)
-    indices = tf.range(IMG_HISTORY_SIZE, tf.shape(frames_0)[0] + IMG_HISTORY_SIZE)
-    past_frames_0 = tf.map_fn(
-        lambda i: padded_frames_0[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.uint8
-    )
-    frames_0_time_mask = tf.ones([tf.shape(frames_0)[0]], dtype=tf.bool)
-    padded_frames_0_time_mask = tf.pad(frames_0_time_mask, [[IMG_HISTORY_SIZE-1, 0]], "CONSTANT", constant_values=False)
-    past_frames_0_time_mask = tf.map_fn(
-        lambda i: padded_frames_0_time_mask[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.bool
-    )
-
-    # For past_frames_1
     frames_1 = frames_1.stack()
-    first_frame = tf.expand_dims(frames_1[0], axis=0)
-    first_frame = tf.repeat(first_frame, IMG_HISTORY_SIZE-1, axis=0)
-    padded_frames_1 = tf.concat([first_frame, frames_1], axis=0)
-    indices = tf.range(IMG_HISTORY_SIZE, tf.shape(frames_1)[0] + IMG_HISTORY_SIZE)
-    past_frames_1 = tf.map_fn(
-        lambda i: padded_frames_1[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.uint8
-    )
-    frames_1_time_mask = tf.ones([tf.shape(frames_1)[0]], dtype=tf.bool)
-    padded_frames_1_time_mask = tf.pad(frames_1_time_mask, [[IMG_HISTORY_SIZE-1, 0]], "CONSTANT", constant_values=False)
-    past_frames_1_time_mask = tf.map_fn(
-        lambda i: padded_frames_1_time_mask[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.bool
-    )
-
-    # For past_frames_2
     frames_2 = frames_2.stack()
-    first_frame = tf.expand_dims(frames_2[0], axis=0)
-    first_frame = tf.repeat(first_frame, IMG_HISTORY_SIZE-1, axis=0)
-    padded_frames_2 = tf.concat([first_frame, frames_2], axis=0)
-    indices = tf.range(IMG_HISTORY_SIZE, tf.shape(frames_2)[0] + IMG_HISTORY_SIZE)
-    past_frames_2 = tf.map_fn(
-        lambda i: padded_frames_2[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.uint8
-    )
-    frames_2_time_mask = tf.ones([tf.shape(frames_2)[0]], dtype=tf.bool)
-    padded_frames_2_time_mask = tf.pad(frames_2_time_mask, [[IMG_HISTORY_SIZE-1, 0]], "CONSTANT", constant_values=False)
-    past_frames_2_time_mask = tf.map_fn(
-        lambda i: padded_frames_2_time_mask[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.bool
-    )
-
-    # For past_frames_3
     frames_3 = frames_3.stack()
-    first_frame = tf.expand_dims(frames_3[0], axis=0)
-    first_frame = tf.repeat(first_frame, IMG_HISTORY_SIZE-1, axis=0)
-    padded_frames_3 = tf.concat([first_frame, frames_3], axis=0)
-    indices = tf.range(IMG_HISTORY_SIZE, tf.shape(frames_3)[0] + IMG_HISTORY_SIZE)
-    past_frames_3 = tf.map_fn(
-        lambda i: padded_frames_3[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.uint8
-    )
-    frames_3_time_mask = tf.ones([tf.shape(frames_3)[0]], dtype=tf.bool)
-    padded_frames_3_time_mask = tf.pad(frames_3_time_mask, [[IMG_HISTORY_SIZE-1, 0]], "CONSTANT", constant_values=False)
-    past_frames_3_time_mask = tf.map_fn(
-        lambda i: padded_frames_3_time_mask[i - IMG_HISTORY_SIZE:i],
-        indices,
-        dtype=tf.bool
-    )
+    past_frames_index, past_frames_time_mask = window_indices(
+        tf.shape(frames_0)[0], IMG_HISTORY_SIZE, -(IMG_HISTORY_SIZE - 1))
 
     # Creat the ids for each step
     step_id = tf.range(0, tf.shape(frames_0)[0])
@@ -146,14 +112,12 @@ def process_episode(epsd: dict, dataset_name: str,
         'dataset_name': dataset_name,
         'episode_dict': epsd,
         'step_id': step_id,
-        'past_frames_0': past_frames_0,
-        'past_frames_0_time_mask': past_frames_0_time_mask,
-        'past_frames_1': past_frames_1,
-        'past_frames_1_time_mask': past_frames_1_time_mask,
-        'past_frames_2': past_frames_2,
-        'past_frames_2_time_mask': past_frames_2_time_mask,
-        'past_frames_3': past_frames_3,
-        'past_frames_3_time_mask': past_frames_3_time_mask,
+        'frames_0': frames_0,
+        'frames_1': frames_1,
+        'frames_2': frames_2,
+        'frames_3': frames_3,
+        'past_frames_index': past_frames_index,
+        'past_frames_time_mask': past_frames_time_mask,
     }
 
 
@@ -162,63 +126,17 @@ def bgr_to_rgb(epsd: dict):
     """
     Convert BGR images to RGB images.
     """
-    past_frames_0 = epsd['past_frames_0']
-    past_frames_0 = tf.cond(
-        tf.equal(tf.shape(past_frames_0)[-1], 3),
-        lambda: tf.stack([
-            past_frames_0[..., 2],
-            past_frames_0[..., 1],
-            past_frames_0[..., 0]
-        ], axis=-1),
-        lambda: past_frames_0
-    )
-    
-    past_frames_1 = epsd['past_frames_1']
-    past_frames_1 = tf.cond(
-        tf.equal(tf.shape(past_frames_1)[-1], 3),
-        lambda: tf.stack([
-            past_frames_1[..., 2],
-            past_frames_1[..., 1],
-            past_frames_1[..., 0]
-        ], axis=-1),
-        lambda: past_frames_1
-    )
-    
-    past_frames_2 = epsd['past_frames_2']
-    past_frames_2 = tf.cond(
-        tf.equal(tf.shape(past_frames_2)[-1], 3),
-        lambda: tf.stack([
-            past_frames_2[..., 2],
-            past_frames_2[..., 1],
-            past_frames_2[..., 0]
-        ], axis=-1),
-        lambda: past_frames_2
-    )
-    
-    past_frames_3 = epsd['past_frames_3']
-    past_frames_3 = tf.cond(
-        tf.equal(tf.shape(past_frames_3)[-1], 3),
-        lambda: tf.stack([
-            past_frames_3[..., 2],
-            past_frames_3[..., 1],
-            past_frames_3[..., 0]
-        ], axis=-1),
-        lambda: past_frames_3
-    )
+    def convert(frames):
+        return tf.cond(
+            tf.equal(tf.shape(frames)[-1], 3),
+            lambda: tf.reverse(frames, axis=[-1]),
+            lambda: frames
+        )
     
-    return {
-        'dataset_name': epsd['dataset_name'],
-        'episode_dict': epsd['episode_dict'],
-        'step_id': epsd['step_id'],
-        'past_frames_0': past_frames_0,
-        'past_frames_0_time_mask': epsd['past_frames_0_time_mask'],
-        'past_frames_1': past_frames_1,
-        'past_frames_1_time_mask': epsd['past_frames_1_time_mask'],
-        'past_frames_2': past_frames_2,
-        'past_frames_2_time_mask': epsd['past_frames_2_time_mask'],
-        'past_frames_3': past_frames_3,
-        'past_frames_3_time_mask': epsd['past_frames_3_time_mask'],
-    }
+    epsd = dict(epsd)
+    for key in ('frames_0', 'frames_1', 'frames_2', 'frames_3'):
+        epsd[key] = convert(epsd[key])
+    return epsd
 
 
 def flatten_episode(episode: dict) -> tf.data.Dataset:
@@ -232,47 +150,20 @@ def flatten_episode(episode: dict) -> tf.data.Dataset:
         episode_dict, dataset_name
     )
 
-    # Calculate the past_states for each step
     # Each step has a window of previous states with size ACTION_CHUNK_SIZE
     # Use the first state to pad the states
     # past_states will have shape (num_steps, ACTION_CHUNK_SIZE, state_dim)
-    first_state = tf.expand_dims(states[0], axis=0)
-    first_state = tf.repeat(first_state, ACTION_CHUNK_SIZE-1, axis=0)
-    padded_states = tf.concat([first_state, states], axis=0)
-    indices = tf.range(ACTION_CHUNK_SIZE, tf.shape(states)[0] + ACTION_CHUNK_SIZE)
-    past_states = tf.map_fn(
-        lambda i: padded_states[i - ACTION_CHUNK_SIZE:i],
-        indices,
-        dtype=tf.float32
-    )
-    states_time_mask = tf.ones([tf.shape(states)[0]], dtype=tf.bool)
-    padded_states_time_mask = tf.pad(states_time_mask, [[ACTION_CHUNK_SIZE-1, 0]], "CONSTANT", constant_values=False)
-    past_states_time_mask = tf.map_fn(
-        lambda i: padded_states_time_mask[i - ACTION_CHUNK_SIZE:i],
-        indices,
-        dtype=tf.bool
-    )
+    num_steps = tf.shape(states)[0]
+    past_index, past_states_time_mask = window_indices(
+        num_steps, ACTION_CHUNK_SIZE, -(ACTION_CHUNK_SIZE - 1))
+    past_states = tf.gather(states, past_index)
 
-    # Calculate the future_states for each step
     # Each step has a window of future states with size ACTION_CHUNK_SIZE
     # Use the last state to pad the states
     # future_states will have shape (num_steps, ACTION_CHUNK_SIZE, state_dim)
-    last_state = tf.expand_dims(states[-1], axis=0)
-    last_state = tf.repeat(last_state, ACTION_CHUNK_SIZE, axis=0)
-    padded_states = tf.concat([states, last_state], axis=0)
-    indices = tf.range(1, tf.shape(states)[0] + 1)
-    future_states = tf.map_fn(
-        lambda i: padded_states[i:i + ACTION_CHUNK_SIZE],
-        indices,
-        dtype=tf.float32
-    )
-    states_time_mask = tf.ones([tf.shape(states)[0]], dtype=tf.bool)
-    padded_states_time_mask = tf.pad(states_time_mask, [[0, ACTION_CHUNK_SIZE]], "CONSTANT", constant_values=False)
-    future_states_time_mask = tf.map_fn(
-        lambda i: padded_states_time_mask[i:i + ACTION_CHUNK_SIZE],
-        indices,
-        dtype=tf.bool
-    )
+    future_index, future_states_time_mask = window_indices(
+        num_steps, ACTION_CHUNK_SIZE, 1)
+    future_states = tf.gather(states, future_index)
 
     # Calculate the mean and std for state
     state_std = tf.math.reduce_std(states, axis=0, keepdims=True)
@@ -285,10 +176,17 @@ def flatten_episode(episode: dict) -> tf.data.Dataset:
     state_norm = tf.math.sqrt(state_norm)
     state_norm = tf.repeat(state_norm, tf.shape(states)[0], axis=0)
 
-    # Create a list of steps
+    # Create a list of steps, whose past frames are gathered when accessed
+    frames = {
+        'past_frames_0': episode['frames_0'],
+        'past_frames_1': episode['frames_1'],
+        'past_frames_2': episode['frames_2'],
+        'past_frames_3': episode['frames_3'],
+    }
+    past_frames_time_mask = episode['past_frames_time_mask']
     step_data = []
     for i in range(tf.shape(states)[0]):
-        step_data.append({
+        step_data.append(LazyFramesStep({
             'step_id': episode['step_id'][i],
             'json_content': json_content,
             'state_chunk': past_states[i],
@@ -296,18 +194,14 @@ def flatten_episode(episode: dict) -> tf.data.Dataset:
             'action_chunk': future_states[i],
             'action_chunk_time_mask': future_states_time_mask[i],
             'state_vec_mask': masks[i],
-            'past_frames_0': episode['past_frames_0'][i],
-            'past_frames_0_time_mask': episode['past_frames_0_time_mask'][i],
-            'past_frames_1': episode['past_frames_1'][i],
-            'past_frames_1_time_mask': episode['past_frames_1_time_mask'][i],
-            'past_frames_2': episode['past_frames_2'][i],
-            'past_frames_2_time_mask': episode['past_frames_2_time_mask'][i],
-            'past_frames_3': episode['past_frames_3'][i],
-            'past_frames_3_time_mask': episode['past_frames_3_time_mask'][i],
+            'past_frames_0_time_mask': past_frames_time_mask[i],
+            'past_frames_1_time_mask': past_frames_time_mask[i],
+            'past_frames_2_time_mask': past_frames_time_mask[i],
+            'past_frames_3_time_mask': past_frames_time_mask[i],
             'state_std': state_std[i],
             'state_mean': state_mean[i],
             'state_norm': state_norm[i],
-        })
+        }, frames, episode['past_frames_index'][i]))
     
     return step_data
 
@@ -323,49 +217,22 @@ def flatten_episode_agilex(episode: dict) -> tf.data.Dataset:
         episode_dict, dataset_name
     )
 
-    # Calculate the past_states for each step
     # Each step has a window of previous states with size ACTION_CHUNK_SIZE
     # Use the first state to pad the states
     # past_states will have shape (num_steps, ACTION_CHUNK_SIZE, state_dim)
-    first_state = tf.expand_dims(states[0], axis=0)
-    first_state = tf.repeat(first_state, ACTION_CHUNK_SIZE-1, axis=0)
-    padded_states = tf.concat([first_state, states], axis=0)
-    indices = tf.range(ACTION_CHUNK_SIZE, tf.shape(states)[0] + ACTION_CHUNK_SIZE)
-    past_states = tf.map_fn(
-        lambda i: padded_states[i - ACTION_CHUNK_SIZE:i],
-        indices,
-        dtype=tf.float32
-    )
-    states_time_mask = tf.ones([tf.shape(states)[0]], dtype=tf.bool)
-    padded_states_time_mask = tf.pad(states_time_mask, [[ACTION_CHUNK_SIZE-1, 0]], "CONSTANT", constant_values=False)
-    past_states_time_mask = tf.map_fn(
-        lambda i: padded_states_time_mask[i - ACTION_CHUNK_SIZE:i],
-        indices,
-        dtype=tf.bool
-    )
+    num_steps = tf.shape(states)[0]
+    past_index, past_states_time_mask = window_indices(
+        num_steps, ACTION_CHUNK_SIZE, -(ACTION_CHUNK_SIZE - 1))
+    past_states = tf.gather(states, past_index)
 
     # NOTE bg the future states shall be actions
-    # Calculate the future_states for each step
+    # NOTE time 0 action = time 1 state
     # Each step has a window of future states with size ACTION_CHUNK_SIZE
     # Use the last action to pad the states
     # future_states will have shape (num_steps, ACTION_CHUNK_SIZE, state_dim)
-    last_act = tf.expand_dims(acts[-1], axis=0)
-    last_act = tf.repeat(last_act, ACTION_CHUNK_SIZE, axis=0)
-    padded_states = tf.concat([acts, last_act], axis=0)
-    # indices = tf.range(1, tf.shape(states)[0] + 1)
-    indices = tf.range(0, tf.shape(acts)[0]) # NOTE time 0 action = time 1 state
-    future_states = tf.map_fn(
-        lambda i: padded_states[i:i + ACTION_CHUNK_SIZE],
-        indices,
-        dtype=tf.float32
-    )
-    states_time_mask = tf.ones([tf.shape(acts)[0]], dtype=tf.bool)
-    padded_states_time_mask = tf.pad(states_time_mask, [[0, ACTION_CHUNK_SIZE]], "CONSTANT", constant_values=False)
-    future_states_time_mask = tf.map_fn(
-        lambda i: padded_states_time_mask[i:i + ACTION_CHUNK_SIZE],
-        indices,
-        dtype=tf.bool
-    )
+    future_index, future_states_time_mask = window_indices(
+        num_steps, ACTION_CHUNK_SIZE, 0)
+    future_states = tf.gather(acts, future_index)
 
     # Calculate the std and mean for state
     state_std = tf.math.reduce_std(states, axis=0, keepdims=True)
@@ -378,10 +245,17 @@ def flatten_episode_agilex(episode: dict) -> tf.data.Dataset:
     state_norm = tf.math.sqrt(state_norm)
     state_norm = tf.repeat(state_norm, tf.shape(states)[0], axis=0)
 
-    # Create a list of steps
+    # Create a list of steps, whose past frames are gathered when accessed
+    frames = {
+        'past_frames_0': episode['frames_0'],
+        'past_frames_1': episode['frames_1'],
+        'past_frames_2': episode['frames_2'],
+        'past_frames_3': episode['frames_3'],
+    }
+    past_frames_time_mask = episode['past_frames_time_mask']
     step_data = []
     for i in range(tf.shape(states)[0]):
-        step_data.append({
+        step_data.append(LazyFramesStep({
             'step_id': episode['step_id'][i],
             'json_content': json_content,
             'state_chunk': past_states[i],
@@ -389,17 +263,13 @@ def flatten_episode_agilex(episode: dict) -> tf.data.Dataset:
             'action_chunk': future_states[i],
             'action_chunk_time_mask': future_states_time_mask[i],
             'state_vec_mask': masks[i],
-            'past_frames_0': episode['past_frames_0'][i],
-            'past_frames_0_time_mask': episode['past_frames_0_time_mask'][i],
-            'past_frames_1': episode['past_frames_1'][i],
-            'past_frames_1_time_mask': episode['past_frames_1_time_mask'][i],
-            'past_frames_2': episode['past_frames_2'][i],
-            'past_frames_2_time_mask': episode['past_frames_2_time_mask'][i],
-            'past_frames_3': episode['past_frames_3'][i],
-            'past_frames_3_time_mask': episode['past_frames_3_time_mask'][i],
+            'past_frames_0_time_mask': past_frames_time_mask[i],
+            'past_frames_1_time_mask': past_frames_time_mask[i],
+            'past_frames_2_time_mask': past_frames_time_mask[i],
+            'past_frames_3_time_mask': past_frames_time_mask[i],
             'state_std': state_std[i],
             'state_mean': state_mean[i],
             'state_norm': state_norm[i],
-        })
+        }, frames, episode['past_frames_index'][i]))
     
     return step_data
@@ -1,6 +1,7 @@
 import os
 import fnmatch
 import json
+from collections import OrderedDict
 
 import h5py
 import yaml
@@ -10,45 +11,231 @@ import numpy as np
 from configs.state_vec import STATE_VEC_IDX_MAPPING
 
 
+# The sidecar file in the HDF5 directory that caches the episode metadata
+EPISODE_INDEX_FILE_NAME = "episode_index.json"
+EPISODE_INDEX_VERSION = 2
+# The instructions of the episodes, next to their HDF5 files
+INSTRUCTION_FILE_NAME = "expanded_instruction_gpt-4-turbo.json"
+
+
 class HDF5VLADataset:
     """
     This class is used to sample episodes from the embododiment dataset
     stored in HDF5.
+
+    The metadata of each episode (length, first moving step, state
+    statistics and instructions) is parsed once and cached in a sidecar
+    file, so that a sample only reads the steps it needs. The HDF5 files
+    are kept open in an LRU cache of each process.
     """
+    # The maximum number of HDF5 files kept open by each process
+    MAX_OPEN_FILES = 32
+
     def __init__(self) -> None:
         # [Modify] The path to the HDF5 dataset directory
         # Each HDF5 file contains one episode
         HDF5_DIR = "data/datasets/agilex/rdt_data/"
+        self.HDF5_DIR = HDF5_DIR
         self.DATASET_NAME = "agilex"
-        
+        # [Modify] The cameras, in the order expected by the consumer
+        self.CAMERA_NAMES = ['cam_high', 'cam_right_wrist', 'cam_left_wrist']
+
         self.file_paths = []
         for root, _, files in os.walk(HDF5_DIR):
             for filename in fnmatch.filter(files, '*.hdf5'):
                 file_path = os.path.join(root, filename)
                 self.file_paths.append(file_path)
-                
+
         # Load the config
         with open('configs/base.yaml', 'r') as file:
             config = yaml.safe_load(file)
         self.CHUNK_SIZE = config['common']['action_chunk_size']
         self.IMG_HISORY_SIZE = config['common']['img_history_size']
         self.STATE_DIM = config['common']['state_dim']
-    
-        # Get each episode's len
+
+        self._open_files = OrderedDict()
+        self._open_files_pid = os.getpid()
+
+        # Get each episode's metadata and len
+        self.episode_metas = self.load_episode_index()
         episode_lens = []
         for file_path in self.file_paths:
-            valid, res = self.parse_hdf5_file_state_only(file_path)
-            _len = res['state'].shape[0] if valid else 0
+            meta = self.episode_metas[self.get_episode_key(file_path)]
+            _len = meta['num_steps'] - meta['first_idx'] + 1 if meta['valid'] else 0
             episode_lens.append(_len)
         self.episode_sample_weights = np.array(episode_lens) / np.sum(episode_lens)
-    
+
     def __len__(self):
         return len(self.file_paths)
-    
+
+    def __getstate__(self):
+        # The open files cannot be pickled
+        state = self.__dict__.copy()
+        state['_open_files'] = OrderedDict()
+        return state
+
     def get_dataset_name(self):
         return self.DATASET_NAME
-    
-    def get_item(self, index: int=None, state_only=False):
+
+    def get_episode_key(self, file_path):
+        """The key of an episode in the episode index and the image embedding store."""
+        return os.path.relpath(file_path, self.HDF5_DIR)
+
+    def get_file(self, file_path):
+        """
+        Get the opened HDF5 file, and close the least recently used one
+        if too many files are open.
+        """
+        # Do not share the files opened by the parent process
+        if self._open_files_pid != os.getpid():
+            self._open_files = OrderedDict()
+            self._open_files_pid = os.getpid()
+        if file_path in self._open_files:
+            self._open_files.move_to_end(file_path)
+            return self._open_files[file_path]
+        f = h5py.File(file_path, 'r')
+        self._open_files[file_path] = f
+        while len(self._open_files) > self.MAX_OPEN_FILES:
+            _, old_f = self._open_files.popitem(last=False)
+            old_f.close()
+        return f
+
+    @staticmethod
+    def _file_signature(file_path):
+        """
+        The size and modification time of the HDF5 file and of its
+        instruction file (None if missing), which are both parsed into
+        the episode metadata.
+        """
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        instruction_path = os.path.join(os.path.dirname(file_path), INSTRUCTION_FILE_NAME)
+        try:
+            stat = os.stat(instruction_path)
+            signature += [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            signature += [None, None]
+        return signature
+
+    def load_episode_index(self):
+        """
+        Load the metadata of all the episodes from the sidecar file.
+        The missing or modified episodes are parsed and the file is updated.
+        """
+        index_path = os.path.join(self.HDF5_DIR, EPISODE_INDEX_FILE_NAME)
+        episode_metas = {}
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == EPISODE_INDEX_VERSION:
+                episode_metas = index['episodes']
+
+        updated = False
+        for file_path in self.file_paths:
+            key = self.get_episode_key(file_path)
+            signature = self._file_signature(file_path)
+            if key in episode_metas and episode_metas[key]['signature'] == signature:
+                continue
+            meta = self.parse_hdf5_file_meta(file_path)
+            meta['signature'] = signature
+            episode_metas[key] = meta
+            updated = True
+
+        if updated:
+            # Write to a temporary file and rename it to never expose a partial file
+            tmp_path = f"{index_path}.tmp{os.getpid()}"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': EPISODE_INDEX_VERSION, 'episodes': episode_metas}, f)
+                os.replace(tmp_path, index_path)
+            except OSError as e:
+                print(f"Failed to save the episode index to {index_path}:", e)
+        return episode_metas
+
+    def fill_in_state(self, values):
+        """[Modify] Fill the state/action into the unified vector."""
+        # Target indices corresponding to your state space
+        # In this example: 6 joints + 1 gripper for each arm
+        UNI_STATE_INDICES = [
+            STATE_VEC_IDX_MAPPING[f"left_arm_joint_{i}_pos"] for i in range(6)
+        ] + [
+            STATE_VEC_IDX_MAPPING["left_gripper_open"]
+        ] + [
+            STATE_VEC_IDX_MAPPING[f"right_arm_joint_{i}_pos"] for i in range(6)
+        ] + [
+            STATE_VEC_IDX_MAPPING["right_gripper_open"]
+        ]
+        uni_vec = np.zeros(values.shape[:-1] + (self.STATE_DIM,))
+        uni_vec[..., UNI_STATE_INDICES] = values
+        return uni_vec
+
+    def rescale_qpos(self, qpos):
+        """[Modify] Rescale the gripper of the states to [0, 1]."""
+        return qpos / np.array(
+           [[1, 1, 1, 1, 1, 1, 4.7908, 1, 1, 1, 1, 1, 1, 4.7888]]
+        )
+
+    def rescale_action(self, action):
+        """[Modify] Rescale the gripper of the actions to [0, 1]."""
+        return action / np.array(
+           [[1, 1, 1, 1, 1, 1, 11.8997, 1, 1, 1, 1, 1, 1, 13.9231]]
+        )
+
+    def parse_hdf5_file_meta(self, file_path):
+        """[Modify] Parse the metadata of a hdf5 file, which is cached in
+            the episode index.
+
+        Args:
+            file_path (str): the path to the hdf5 file
+
+        Returns:
+            dict: a JSON-serializable dictionary,
+                {
+                    "valid": bool,              # whether the episode is valid, which is useful for filtering.
+                                                # If False, this episode will be dropped.
+                    "num_steps": int,           # the number of steps in the episode.
+                    "first_idx": int,           # the index of the first step that moves.
+                    "state_std": list,          # std(state[:]), (14,).
+                    "state_mean": list,         # mean(state[:]), (14,).
+                    "state_norm": list,         # norm(state[:]), (14,).
+                    "instructions": dict,       # the instruction variants of the episode.
+                }
+        """
+        with h5py.File(file_path, 'r') as f:
+            qpos = f['observations']['qpos'][:]
+        num_steps = qpos.shape[0]
+        meta = {"valid": False, "num_steps": num_steps}
+        # [Optional] We drop too-short episode
+        if num_steps < 128:
+            return meta
+
+        # [Optional] We skip the first few still steps
+        EPS = 1e-2
+        # Get the idx of the first qpos whose delta exceeds the threshold
+        qpos_delta = np.abs(qpos - qpos[0:1])
+        indices = np.where(np.any(qpos_delta > EPS, axis=1))[0]
+        if len(indices) > 0:
+            first_idx = indices[0]
+        else:
+            raise ValueError(f"Found no qpos that exceeds the threshold in {file_path}.")
+
+        # Load the instruction
+        dir_path = os.path.dirname(file_path)
+        with open(os.path.join(dir_path, INSTRUCTION_FILE_NAME), 'r') as f_instr:
+            instruction_dict = json.load(f_instr)
+
+        qpos = self.rescale_qpos(qpos)
+        meta.update({
+            "valid": True,
+            "first_idx": int(first_idx),
+            "state_std": np.std(qpos, axis=0).tolist(),
+            "state_mean": np.mean(qpos, axis=0).tolist(),
+            "state_norm": np.sqrt(np.mean(qpos**2, axis=0)).tolist(),
+            "instructions": instruction_dict,
+        })
+        return meta
+
+    def get_item(self, index: int=None, state_only=False, load_images=True):
         """Get a training sample at a random timestep.
 
         Args:
@@ -57,6 +244,10 @@ class HDF5VLADataset:
             state_only (bool, optional): Whether to return only the state.
                 In this way, the sample will contain a complete trajectory rather
                 than a single timestep. Defaults to False.
+            load_images (bool, optional): Whether to decode the images.
+                If False, the image arrays are None and only their masks are
+                returned, e.g., when the precomputed image embeddings are used.
+                Defaults to True.
 
         Returns:
            sample (dict): a dictionary containing the training sample.
@@ -66,20 +257,21 @@ class HDF5VLADataset:
                 file_path = np.random.choice(self.file_paths, p=self.episode_sample_weights)
             else:
                 file_path = self.file_paths[index]
-            valid, sample = self.parse_hdf5_file(file_path) \
+            valid, sample = self.parse_hdf5_file(file_path, load_images) \
                 if not state_only else self.parse_hdf5_file_state_only(file_path)
             if valid:
                 return sample
             else:
                 index = np.random.randint(0, len(self.file_paths))
-    
-    def parse_hdf5_file(self, file_path):
+
+    def parse_hdf5_file(self, file_path, load_images=True):
         """[Modify] Parse a hdf5 file to generate a training sample at
             a random timestep.
 
         Args:
             file_path (str): the path to the hdf5 file
-        
+            load_images (bool): whether to decode the images
+
         Returns:
             valid (bool): whether the episode is valid, which is useful for filtering.
                 If False, this episode will be dropped.
@@ -87,10 +279,11 @@ class HDF5VLADataset:
                 {
                     "meta": {
                         "dataset_name": str,    # the name of your dataset.
+                        "episode": str,         # the key of the episode, see `get_episode_key`.
                         "#steps": int,          # the number of steps in the episode,
                                                 # also the total timesteps.
                         "instruction": str      # the language instruction for this episode.
-                    },                           
+                    },
                     "step_id": int,             # the index of the sampled step,
                                                 # also the timestep t.
                     "state": ndarray,           # state[t], (1, STATE_DIM).
@@ -112,147 +305,137 @@ class HDF5VLADataset:
                     "cam_right_wrist_mask": ndarray
                 } or None if the episode is invalid.
         """
-        with h5py.File(file_path, 'r') as f:
-            qpos = f['observations']['qpos'][:]
-            num_steps = qpos.shape[0]
-            # [Optional] We drop too-short episode
-            if num_steps < 128:
-                return False, None
-            
-            # [Optional] We skip the first few still steps
-            EPS = 1e-2
-            # Get the idx of the first qpos whose delta exceeds the threshold
-            qpos_delta = np.abs(qpos - qpos[0:1])
-            indices = np.where(np.any(qpos_delta > EPS, axis=1))[0]
-            if len(indices) > 0:
-                first_idx = indices[0]
-            else:
-                raise ValueError("Found no qpos that exceeds the threshold.")
-            
-            # We randomly sample a timestep
-            step_id = np.random.randint(first_idx-1, num_steps)
-            
-            # Load the instruction
-            dir_path = os.path.dirname(file_path)
-            with open(os.path.join(dir_path, 'expanded_instruction_gpt-4-turbo.json'), 'r') as f_instr:
-                instruction_dict = json.load(f_instr)
-            # We have 1/3 prob to use original instruction, 
-            # 1/3 to use simplified instruction,
-            # and 1/3 to use expanded instruction.
-            instruction_type = np.random.choice([
-                'instruction', 'simplified_instruction', 'expanded_instruction'])
-            instruction = instruction_dict[instruction_type]
-            if isinstance(instruction, list):
-                instruction = np.random.choice(instruction)
-            # You can also use precomputed language embeddings (recommended)
-            # instruction = "path/to/lang_embed.pt"
-            
-            # Assemble the meta
-            meta = {
-                "dataset_name": self.DATASET_NAME,
-                "#steps": num_steps,
-                "step_id": step_id,
-                "instruction": instruction
-            }
-            
-            # Rescale gripper to [0, 1]
-            qpos = qpos / np.array(
-               [[1, 1, 1, 1, 1, 1, 4.7908, 1, 1, 1, 1, 1, 1, 4.7888]] 
-            )
-            target_qpos = f['action'][step_id:step_id+self.CHUNK_SIZE] / np.array(
-               [[1, 1, 1, 1, 1, 1, 11.8997, 1, 1, 1, 1, 1, 1, 13.9231]] 
-            )
-            
-            # Parse the state and action
-            state = qpos[step_id:step_id+1]
-            state_std = np.std(qpos, axis=0)
-            state_mean = np.mean(qpos, axis=0)
-            state_norm = np.sqrt(np.mean(qpos**2, axis=0))
-            actions = target_qpos
-            if actions.shape[0] < self.CHUNK_SIZE:
-                # Pad the actions using the last action
-                actions = np.concatenate([
-                    actions,
-                    np.tile(actions[-1:], (self.CHUNK_SIZE-actions.shape[0], 1))
+        episode_meta = self.episode_metas[self.get_episode_key(file_path)]
+        if not episode_meta['valid']:
+            return False, None
+        num_steps = episode_meta['num_steps']
+        first_idx = episode_meta['first_idx']
+
+        # We randomly sample a timestep
+        step_id = np.random.randint(first_idx-1, num_steps)
+
+        # We have 1/3 prob to use original instruction,
+        # 1/3 to use simplified instruction,
+        # and 1/3 to use expanded instruction.
+        instruction_dict = episode_meta['instructions']
+        instruction_type = np.random.choice([
+            'instruction', 'simplified_instruction', 'expanded_instruction'])
+        instruction = instruction_dict[instruction_type]
+        if isinstance(instruction, list):
+            instruction = np.random.choice(instruction)
+        # You can also use precomputed language embeddings (recommended)
+        # instruction = "path/to/lang_embed.pt"
+
+        # Assemble the meta
+        meta = {
+            "dataset_name": self.DATASET_NAME,
+            "episode": self.get_episode_key(file_path),
+            "#steps": num_steps,
+            "step_id": step_id,
+            "instruction": instruction
+        }
+
+        # Only read the steps we need
+        f = self.get_file(file_path)
+        state = self.rescale_qpos(f['observations']['qpos'][step_id:step_id+1])
+        actions = self.rescale_action(f['action'][step_id:step_id+self.CHUNK_SIZE])
+
+        # Parse the state and action
+        state_std = np.array(episode_meta['state_std'])
+        state_mean = np.array(episode_meta['state_mean'])
+        state_norm = np.array(episode_meta['state_norm'])
+        if actions.shape[0] < self.CHUNK_SIZE:
+            # Pad the actions using the last action
+            actions = np.concatenate([
+                actions,
+                np.tile(actions[-1:], (self.CHUNK_SIZE-actions.shape[0], 1))
+            ], axis=0)
+
+        # Fill the state/action into the unified vector
+        state = self.fill_in_state(state)
+        state_indicator = self.fill_in_state(np.ones_like(state_std))
+        state_std = self.fill_in_state(state_std)
+        state_mean = self.fill_in_state(state_mean)
+        state_norm = self.fill_in_state(state_norm)
+        # If action's format is different from state's,
+        # you may implement fill_in_action()
+        actions = self.fill_in_state(actions)
+
+        # Parse the images
+        def parse_img(key):
+            if not load_images:
+                return None
+            start = max(step_id-self.IMG_HISORY_SIZE+1, 0)
+            imgs = [
+                cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+                for img in f['observations']['images'][key][start:step_id+1]
+            ]
+            imgs = np.stack(imgs)
+            if imgs.shape[0] < self.IMG_HISORY_SIZE:
+                # Pad the images using the first image
+                imgs = np.concatenate([
+                    np.tile(imgs[:1], (self.IMG_HISORY_SIZE-imgs.shape[0], 1, 1, 1)),
+                    imgs
                 ], axis=0)
-            
-            # Fill the state/action into the unified vector
-            def fill_in_state(values):
-                # Target indices corresponding to your state space
-                # In this example: 6 joints + 1 gripper for each arm
-                UNI_STATE_INDICES = [
-                    STATE_VEC_IDX_MAPPING[f"left_arm_joint_{i}_pos"] for i in range(6)
-                ] + [
-                    STATE_VEC_IDX_MAPPING["left_gripper_open"]
-                ] + [
-                    STATE_VEC_IDX_MAPPING[f"right_arm_joint_{i}_pos"] for i in range(6)
-                ] + [
-                    STATE_VEC_IDX_MAPPING["right_gripper_open"]
-                ]
-                uni_vec = np.zeros(values.shape[:-1] + (self.STATE_DIM,))
-                uni_vec[..., UNI_STATE_INDICES] = values
-                return uni_vec
-            state = fill_in_state(state)
-            state_indicator = fill_in_state(np.ones_like(state_std))
-            state_std = fill_in_state(state_std)
-            state_mean = fill_in_state(state_mean)
-            state_norm = fill_in_state(state_norm)
-            # If action's format is different from state's,
-            # you may implement fill_in_action()
-            actions = fill_in_state(actions)
-            
-            # Parse the images
-            def parse_img(key):
-                imgs = []
-                for i in range(max(step_id-self.IMG_HISORY_SIZE+1, 0), step_id+1):
-                    img = f['observations']['images'][key][i]
-                    imgs.append(cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR))
-                imgs = np.stack(imgs)
-                if imgs.shape[0] < self.IMG_HISORY_SIZE:
-                    # Pad the images using the first image
-                    imgs = np.concatenate([
-                        np.tile(imgs[:1], (self.IMG_HISORY_SIZE-imgs.shape[0], 1, 1, 1)),
-                        imgs
-                    ], axis=0)
-                return imgs
-            # `cam_high` is the external camera image
-            cam_high = parse_img('cam_high')
-            # For step_id = first_idx - 1, the valid_len should be one
-            valid_len = min(step_id - (first_idx - 1) + 1, self.IMG_HISORY_SIZE)
-            cam_high_mask = np.array(
-                [False] * (self.IMG_HISORY_SIZE - valid_len) + [True] * valid_len
-            )
-            cam_left_wrist = parse_img('cam_left_wrist')
-            cam_left_wrist_mask = cam_high_mask.copy()
-            cam_right_wrist = parse_img('cam_right_wrist')
-            cam_right_wrist_mask = cam_high_mask.copy()
-            
-            # Return the resulting sample
-            # For unavailable images, return zero-shape arrays, i.e., (IMG_HISORY_SIZE, 0, 0, 0)
-            # E.g., return np.zeros((self.IMG_HISORY_SIZE, 0, 0, 0)) for the key "cam_left_wrist",
-            # if the left-wrist camera is unavailable on your robot
-            return True, {
-                "meta": meta,
-                "state": state,
-                "state_std": state_std,
-                "state_mean": state_mean,
-                "state_norm": state_norm,
-                "actions": actions,
-                "state_indicator": state_indicator,
-                "cam_high": cam_high,
-                "cam_high_mask": cam_high_mask,
-                "cam_left_wrist": cam_left_wrist,
-                "cam_left_wrist_mask": cam_left_wrist_mask,
-                "cam_right_wrist": cam_right_wrist,
-                "cam_right_wrist_mask": cam_right_wrist_mask
-            }
+            return imgs
+        # `cam_high` is the external camera image
+        cam_high = parse_img('cam_high')
+        # For step_id = first_idx - 1, the valid_len should be one
+        valid_len = min(step_id - (first_idx - 1) + 1, self.IMG_HISORY_SIZE)
+        cam_high_mask = np.array(
+            [False] * (self.IMG_HISORY_SIZE - valid_len) + [True] * valid_len
+        )
+        cam_left_wrist = parse_img('cam_left_wrist')
+        cam_left_wrist_mask = cam_high_mask.copy()
+        cam_right_wrist = parse_img('cam_right_wrist')
+        cam_right_wrist_mask = cam_high_mask.copy()
+
+        # Return the resulting sample
+        # For unavailable images, return zero-shape arrays, i.e., (IMG_HISORY_SIZE, 0, 0, 0)
+        # E.g., return np.zeros((self.IMG_HISORY_SIZE, 0, 0, 0)) for the key "cam_left_wrist",
+        # if the left-wrist camera is unavailable on your robot
+        return True, {
+            "meta": meta,
+            "state": state,
+            "state_std": state_std,
+            "state_mean": state_mean,
+            "state_norm": state_norm,
+            "actions": actions,
+            "state_indicator": state_indicator,
+            "cam_high": cam_high,
+            "cam_high_mask": cam_high_mask,
+            "cam_left_wrist": cam_left_wrist,
+            "cam_left_wrist_mask": cam_left_wrist_mask,
+            "cam_right_wrist": cam_right_wrist,
+            "cam_right_wrist_mask": cam_right_wrist_mask
+        }
+
+    def iter_hdf5_file_frames(self, file_path):
+        """[Modify] Iterate over all the frames of a hdf5 file, decoded
+            in the same way as in `parse_hdf5_file`.
+
+        Args:
+            file_path (str): the path to the hdf5 file
+
+        Yields:
+            step_id (int): the timestep of the frames.
+            frames (dict): camera name -> (H, W, 3) image.
+        """
+        with h5py.File(file_path, 'r') as f:
+            num_steps = f['observations']['qpos'].shape[0]
+            for step_id in range(num_steps):
+                yield step_id, {
+                    key: cv2.imdecode(np.frombuffer(
+                        f['observations']['images'][key][step_id], np.uint8), cv2.IMREAD_COLOR)
+                    for key in self.CAMERA_NAMES
+                }
 
     def parse_hdf5_file_state_only(self, file_path):
         """[Modify] Parse a hdf5 file to generate a state trajectory.
 
         Args:
             file_path (str): the path to the hdf5 file
-        
+
         Returns:
             valid (bool): whether the episode is valid, which is useful for filtering.
                 If False, this episode will be dropped.
@@ -262,59 +445,25 @@ class HDF5VLADataset:
                     "action": ndarray,          # action[:], (T, STATE_DIM).
                 } or None if the episode is invalid.
         """
-        with h5py.File(file_path, 'r') as f:
-            qpos = f['observations']['qpos'][:]
-            num_steps = qpos.shape[0]
-            # [Optional] We drop too-short episode
-            if num_steps < 128:
-                return False, None
-            
-            # [Optional] We skip the first few still steps
-            EPS = 1e-2
-            # Get the idx of the first qpos whose delta exceeds the threshold
-            qpos_delta = np.abs(qpos - qpos[0:1])
-            indices = np.where(np.any(qpos_delta > EPS, axis=1))[0]
-            if len(indices) > 0:
-                first_idx = indices[0]
-            else:
-                raise ValueError("Found no qpos that exceeds the threshold.")
-            # 需要修改
-            # Rescale gripper to [0, 1]
-            qpos = qpos / np.array(
-               [[1, 1, 1, 1, 1, 1, 4.7908, 1, 1, 1, 1, 1, 1, 4.7888]] 
-            )
-            target_qpos = f['action'][:] / np.array(
-               [[1, 1, 1, 1, 1, 1, 11.8997, 1, 1, 1, 1, 1, 1, 13.9231]] 
-            )
-            
-            # Parse the state and action
-            state = qpos[first_idx-1:]
-            action = target_qpos[first_idx-1:]
-            
-            # Fill the state/action into the unified vector
-            def fill_in_state(values):
-                # Target indices corresponding to your state space
-                # In this example: 6 joints + 1 gripper for each arm
-                UNI_STATE_INDICES = [
-                    STATE_VEC_IDX_MAPPING[f"left_arm_joint_{i}_pos"] for i in range(6)
-                ] + [
-                    STATE_VEC_IDX_MAPPING["left_gripper_open"]
-                ] + [
-                    STATE_VEC_IDX_MAPPING[f"right_arm_joint_{i}_pos"] for i in range(6)
-                ] + [
-                    STATE_VEC_IDX_MAPPING["right_gripper_open"]
-                ]
-                uni_vec = np.zeros(values.shape[:-1] + (self.STATE_DIM,))
-                uni_vec[..., UNI_STATE_INDICES] = values
-                return uni_vec
-            state = fill_in_state(state)
-            action = fill_in_state(action)
-            
-            # Return the resulting sample
-            return True, {
-                "state": state,
-                "action": action
-            }
+        episode_meta = self.episode_metas[self.get_episode_key(file_path)]
+        if not episode_meta['valid']:
+            return False, None
+        first_idx = episode_meta['first_idx']
+
+        # Only read the steps after the first few still steps
+        f = self.get_file(file_path)
+        state = self.rescale_qpos(f['observations']['qpos'][first_idx-1:])
+        action = self.rescale_action(f['action'][first_idx-1:])
+
+        # Fill the state/action into the unified vector
+        state = self.fill_in_state(state)
+        action = self.fill_in_state(action)
+
+        # Return the resulting sample
+        return True, {
+            "state": state,
+            "action": action
+        }
 
 if __name__ == "__main__":
     ds = HDF5VLADataset()
@@ -0,0 +1,205 @@
+"""
+A sharded, memory-mapped store of precomputed vision-encoder embeddings.
+
+The vision encoder is frozen during training, so the patch embeddings
+of every frame can be computed once offline (see
+`scripts/encode_image_embeds.py`) and read back instead of running the
+encoder on every batch. The store is keyed by (episode, step, camera):
+
+    <store_dir>/
+        meta.json               # encoder, preprocessing, dtype, embedding shape
+        background.npy          # (P, D) float32, embedding of the background image
+        shard_<k>/
+            embeds.npy          # (N, P, D) float16 or int8
+            scales.npy          # (N, P) float32, only for int8
+            keys.json           # N entries of [episode, step, camera]
+
+`keys.json` is written last, so a shard without it is incomplete and
+is encoded again when the offline pass is resumed.
+
+The int8 format uses symmetric per-token quantization:
+`embed = int8_value * scale`, which halves the size of the store
+compared with float16.
+"""
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+
+
+META_FILE_NAME = "meta.json"
+BACKGROUND_FILE_NAME = "background.npy"
+KEYS_FILE_NAME = "keys.json"
+EMBEDS_FILE_NAME = "embeds.npy"
+SCALES_FILE_NAME = "scales.npy"
+
+STORE_DTYPES = ("float16", "int8")
+
+# The image preprocessing settings recorded in the metadata, with the
+# values of the stores written before they were recorded
+PREPROCESS_DEFAULTS = {
+    "image_aspect_ratio": "pad",
+    "image_size": None,
+    "auto_adjust_image_brightness": False,
+}
+
+
+def quantize_int8(embeds):
+    """
+    Quantize (..., D) float embeddings into int8 with a per-token scale.
+
+    Returns:
+        values: (..., D) int8 array
+        scales: (...,) float32 array
+    """
+    embeds = np.asarray(embeds, dtype=np.float32)
+    scales = np.abs(embeds).max(axis=-1) / 127.0
+    scales = np.maximum(scales, np.finfo(np.float32).tiny)
+    values = np.clip(np.rint(embeds / scales[..., None]), -127, 127).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+
+def shard_dir_name(shard_idx):
+    return f"shard_{shard_idx}"
+
+
+class ImageEmbedShardWriter:
+    """
+    Write the embeddings of a group of episodes into one shard.
+    """
+    def __init__(self, store_dir, shard_idx, num_frames, num_patches, hidden_size, dtype):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unknown store dtype: {dtype}, available: {STORE_DTYPES}")
+        self.shard_dir = os.path.join(store_dir, shard_dir_name(shard_idx))
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.dtype = dtype
+        self.keys = []
+        self.embeds = np.lib.format.open_memmap(
+            os.path.join(self.shard_dir, EMBEDS_FILE_NAME), mode='w+',
+            dtype=np.int8 if dtype == "int8" else np.float16,
+            shape=(num_frames, num_patches, hidden_size))
+        self.scales = None
+        if dtype == "int8":
+            self.scales = np.lib.format.open_memmap(
+                os.path.join(self.shard_dir, SCALES_FILE_NAME), mode='w+',
+                dtype=np.float32, shape=(num_frames, num_patches))
+
+    def write(self, keys, embeds):
+        """
+        Append a batch of embeddings.
+
+        Args:
+            keys: a list of (episode, step, camera)
+            embeds: (len(keys), P, D) float array
+        """
+        start, end = len(self.keys), len(self.keys) + len(keys)
+        if end > self.embeds.shape[0]:
+            raise ValueError(f"Shard {self.shard_dir} is full.")
+        if self.dtype == "int8":
+            self.embeds[start:end], self.scales[start:end] = quantize_int8(embeds)
+        else:
+            self.embeds[start:end] = embeds
+        self.keys.extend([str(episode), int(step), str(camera)]
+                         for episode, step, camera in keys)
+
+    def close(self):
+        if len(self.keys) != self.embeds.shape[0]:
+            raise ValueError(
+                f"Shard {self.shard_dir} expects {self.embeds.shape[0]} frames "
+                f"but got {len(self.keys)}.")
+        self.embeds.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        # Mark the shard as complete
+        tmp_path = os.path.join(self.shard_dir, f"{KEYS_FILE_NAME}.tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump(self.keys, file)
+        os.replace(tmp_path, os.path.join(self.shard_dir, KEYS_FILE_NAME))
+        self.embeds, self.scales = None, None
+
+
+def is_shard_complete(store_dir, shard_idx):
+    return os.path.exists(os.path.join(
+        store_dir, shard_dir_name(shard_idx), KEYS_FILE_NAME))
+
+
+class ImageEmbedStore:
+    """
+    Read the embeddings of a store.
+
+    The shards are mapped lazily, so an instance can be created in the
+    main process and used in the dataloader workers after forking.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE_NAME), 'r') as file:
+            self.meta = json.load(file)
+        self.dtype = self.meta["dtype"]
+        self.num_patches = self.meta["num_patches"]
+        self.hidden_size = self.meta["hidden_size"]
+        self.background = torch.from_numpy(
+            np.load(os.path.join(store_dir, BACKGROUND_FILE_NAME)).astype(np.float32))
+
+        # (episode, step, camera) -> (shard index, row)
+        self.index = {}
+        shard_dirs = glob.glob(os.path.join(store_dir, "shard_*"))
+        for shard_dir in shard_dirs:
+            keys_path = os.path.join(shard_dir, KEYS_FILE_NAME)
+            if not os.path.exists(keys_path):
+                continue
+            shard_idx = int(shard_dir.rsplit('_', 1)[-1])
+            with open(keys_path, 'r') as file:
+                keys = json.load(file)
+            for row, (episode, step, camera) in enumerate(keys):
+                self.index[(episode, step, camera)] = (shard_idx, row)
+        # The shards mapped by this process
+        self.shards = {}
+
+    def check_preprocessing(self, **settings):
+        """
+        Raise ValueError if the embeddings were computed with image
+        preprocessing settings (see `PREPROCESS_DEFAULTS`) other than the given ones.
+        """
+        mismatches = []
+        for name, value in settings.items():
+            stored = self.meta.get(name, PREPROCESS_DEFAULTS[name])
+            if isinstance(value, tuple):
+                value = list(value)
+            if stored != value:
+                mismatches.append(f"{name}={stored!r} (expected {value!r})")
+        if len(mismatches) > 0:
+            raise ValueError(
+                f"The image embedding store {self.store_dir} was computed with "
+                f"different preprocessing: {', '.join(mismatches)}.")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return tuple(key) in self.index
+
+    def _get_shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            shard_dir = os.path.join(self.store_dir, shard_dir_name(shard_idx))
+            embeds = np.load(os.path.join(shard_dir, EMBEDS_FILE_NAME), mmap_mode='r')
+            scales = np.load(os.path.join(shard_dir, SCALES_FILE_NAME), mmap_mode='r') \
+                if self.dtype == "int8" else None
+            self.shards[shard_idx] = (embeds, scales)
+        return self.shards[shard_idx]
+
+    def get(self, episode, step, camera):
+        """
+        Get the (P, D) float32 embedding of a frame.
+        Raise KeyError if the frame is not in the store.
+        """
+        key = (str(episode), int(step), str(camera))
+        if key not in self.index:
+            raise KeyError(f"Frame {key} is not in the image embedding store {self.store_dir}.")
+        shard_idx, row = self.index[key]
+        embeds, scales = self._get_shard(shard_idx)
+        embed = torch.from_numpy(np.array(embeds[row], dtype=np.float32))
+        if scales is not None:
+            embed *= torch.from_numpy(np.array(scales[row]))[:, None]
+        return embed
@@ -0,0 +1,82 @@
+"""
+JPEG-encoded frames in the buffer.
+
+With `buf_image_format: jpeg`, the producer stores the past frames of a
+camera as one packed uint8 array instead of the raw (T, H, W, 3) frames:
+
+    [uint32 T | uint32 size of frame 0 | ... | uint32 size of frame T-1 |
+     JPEG of frame 0 | ... | JPEG of frame T-1]
+
+so the samples keep the same fields in both buffer formats, and the
+consumer tells the packed frames from the raw ones by their number of dims.
+A missing frame (of shape (0, 0, 0)) is stored with size 0.
+
+The consumer decodes the frames with PIL's draft mode, which lets libjpeg
+scale the DCT by 1/2, 1/4 or 1/8 while decoding, so a frame is never
+decoded at a much larger size than the preprocessing keeps.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+
+JPEG_QUALITY = 95
+_HEADER_DTYPE = np.dtype('<u4')
+
+
+def encode_jpeg(frame, quality=JPEG_QUALITY):
+    """
+    Encode an (H, W, C) uint8 frame into JPEG bytes, or b'' if it is empty.
+    """
+    frame = np.asarray(frame)
+    if frame.size == 0:
+        return b''
+    if frame.ndim == 3 and frame.shape[-1] == 1:
+        frame = frame[..., 0]
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def pack_jpeg_frames(frames, quality=JPEG_QUALITY):
+    """
+    Encode (T, H, W, C) uint8 frames into one packed uint8 array.
+    """
+    encoded = [encode_jpeg(frame, quality) for frame in frames]
+    header = np.array([len(encoded)] + [len(data) for data in encoded], dtype=_HEADER_DTYPE)
+    return np.frombuffer(header.tobytes() + b''.join(encoded), dtype=np.uint8)
+
+
+def is_packed(frames):
+    return frames.ndim == 1
+
+
+def unpack_jpeg_frames(packed):
+    """
+    Split a packed uint8 array into the JPEG bytes of its frames,
+    as zero-copy views on the array.
+    """
+    num_frames = int(packed[:_HEADER_DTYPE.itemsize].view(_HEADER_DTYPE)[0])
+    header_size = (num_frames + 1) * _HEADER_DTYPE.itemsize
+    sizes = packed[_HEADER_DTYPE.itemsize:header_size].view(_HEADER_DTYPE)
+    offsets = header_size + np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+    return [packed[offsets[i]:offsets[i + 1]] for i in range(num_frames)]
+
+
+def decode_jpeg(data, min_size_fn=None):
+    """
+    Decode JPEG bytes into an (H, W, 3) uint8 frame, or a (0, 0, 0) frame if empty.
+
+    Args:
+        data: bytes or a uint8 array of the JPEG
+        min_size_fn: optional (width, height) -> (min width, min height),
+            the smallest size the frame may be decoded at. The frame is
+            decoded at the smallest DCT scale that is at least this size.
+    """
+    if len(data) == 0:
+        return np.zeros((0, 0, 0), dtype=np.uint8)
+    image = Image.open(io.BytesIO(memoryview(data)))
+    if min_size_fn is not None:
+        image.draft('RGB', min_size_fn(*image.size))
+    return np.asarray(image.convert('RGB'))
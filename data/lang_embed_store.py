@@ -0,0 +1,243 @@
+"""
+A memory-mapped store of the precomputed language embeddings.
+
+`scripts/encode_lang_batch.py` saves the T5 embedding of every instruction
+as a `lang_embed_<i>.pt` file next to its instruction json, and the
+producers put the paths of these files in the samples. There are only a
+few hundred distinct files per task, so instead of deserializing one of
+them for every sample, they are consolidated once (see
+`scripts/build_lang_embed_store.py`) into a single array, or encoded
+directly into one by `scripts/encode_lang_batch.py`:
+
+    <store_dir>/
+        meta.json       # root directory of the files, dtype, hidden size
+        embeds.npy      # (T, D) the tokens of all the embeddings, one after another
+        index.json      # {key: [offset, num_tokens]}, keys of identical
+                        # instructions share their tokens
+
+A key is the path of the `.pt` file relative to the root directory, e.g.,
+`agilex/tfrecords/<task>/lang_embed_0.pt`, so the legacy paths in the
+samples are mapped to the keys by `LangEmbedStore.key_of`. bfloat16
+embeddings are stored as their raw 16-bit words, since numpy has no
+bfloat16, and read back unchanged.
+
+`index.json` is written last, so a store without it is incomplete.
+"""
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+META_FILE_NAME = "meta.json"
+EMBEDS_FILE_NAME = "embeds.npy"
+INDEX_FILE_NAME = "index.json"
+
+# Storage numpy dtype of each torch dtype
+STORE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.uint16,
+}
+
+LANG_EMBED_CACHE_SIZE = 1024
+
+
+def dtype_name(dtype):
+    return str(dtype).split('.')[-1]
+
+
+def embed_to_numpy(embed):
+    """
+    Convert a (L, D) torch embedding into its storage array.
+    """
+    embed = embed.detach().cpu()
+    if embed.dtype == torch.bfloat16:
+        return embed.view(torch.int16).numpy().view(np.uint16)
+    return embed.numpy()
+
+
+def embed_from_numpy(array, dtype):
+    """
+    Convert a storage array back into a torch embedding of `dtype`.
+    """
+    array = np.array(array)
+    if dtype == torch.bfloat16:
+        return torch.from_numpy(array.view(np.int16)).view(torch.bfloat16)
+    return torch.from_numpy(array)
+
+
+class LangEmbedStoreWriter:
+    """
+    Write a store of `num_tokens` tokens in total.
+
+    The array is written to a temporary file and the index of the previous
+    store (if any) is removed first, so that the store is only readable
+    once `close` has been called.
+    """
+    def __init__(self, store_dir, root_dir, dtype, hidden_size, num_tokens):
+        if dtype_name(dtype) not in STORE_DTYPES:
+            raise ValueError(f"Unsupported language embedding dtype: {dtype}")
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.root_dir = root_dir
+        index_path = os.path.join(store_dir, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        with open(os.path.join(store_dir, META_FILE_NAME), 'w') as file:
+            json.dump({
+                "root_dir": root_dir,
+                "dtype": dtype_name(dtype),
+                "hidden_size": hidden_size,
+            }, file, indent=4)
+        self.tmp_path = os.path.join(store_dir, f"{EMBEDS_FILE_NAME}.tmp{os.getpid()}")
+        self.embeds = np.lib.format.open_memmap(
+            self.tmp_path, mode='w+',
+            dtype=STORE_DTYPES[dtype_name(dtype)], shape=(num_tokens, hidden_size))
+        self.index = {}
+        self.offset = 0
+
+    def write(self, keys, embed):
+        """
+        Append a (L, D) embedding, which is stored once for all its `keys`.
+        """
+        start, end = self.offset, self.offset + embed.shape[0]
+        if end > self.embeds.shape[0]:
+            raise ValueError(f"The language embedding store {self.store_dir} is full.")
+        self.embeds[start:end] = embed_to_numpy(embed)
+        for key in keys:
+            self.index[os.path.normpath(key)] = [start, embed.shape[0]]
+        self.offset = end
+
+    def close(self):
+        if self.offset != self.embeds.shape[0]:
+            raise ValueError(
+                f"The language embedding store {self.store_dir} expects "
+                f"{self.embeds.shape[0]} tokens but got {self.offset}.")
+        self.embeds.flush()
+        self.embeds = None
+        os.replace(self.tmp_path, os.path.join(self.store_dir, EMBEDS_FILE_NAME))
+        # Mark the store as complete
+        tmp_path = os.path.join(self.store_dir, f"{INDEX_FILE_NAME}.tmp{os.getpid()}")
+        with open(tmp_path, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, os.path.join(self.store_dir, INDEX_FILE_NAME))
+
+
+def write_lang_embed_store(store_dir, root_dir, paths):
+    """
+    Consolidate the embeddings of `paths` (under `root_dir`) into a store.
+    All the embeddings must have the same dtype and hidden size.
+    Return the number of tokens written.
+    """
+    # Read the shapes first to allocate the array
+    shapes, dtype = [], None
+    for path in paths:
+        embed = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        if embed.dim() != 2:
+            raise ValueError(f"Expected a (L, D) embedding in {path}, got {tuple(embed.shape)}.")
+        if dtype is None:
+            dtype, hidden_size = embed.dtype, embed.shape[1]
+        elif (embed.dtype, embed.shape[1]) != (dtype, hidden_size):
+            raise ValueError(
+                f"The embedding in {path} is {embed.dtype} of hidden size {embed.shape[1]}, "
+                f"but the others are {dtype} of hidden size {hidden_size}.")
+        shapes.append(embed.shape)
+    if dtype is None:
+        raise ValueError(f"No language embeddings found under {root_dir}.")
+
+    num_tokens = sum(shape[0] for shape in shapes)
+    writer = LangEmbedStoreWriter(store_dir, root_dir, dtype, hidden_size, num_tokens)
+    for path in paths:
+        embed = torch.load(path, map_location="cpu", weights_only=True)
+        writer.write([os.path.relpath(os.path.normpath(path), os.path.normpath(root_dir))], embed)
+    writer.close()
+    return num_tokens
+
+
+class LangEmbedStore:
+    """
+    Read the embeddings of a store.
+
+    The array is mapped lazily, so an instance can be created in the main
+    process and used in the dataloader workers after forking, where all
+    the workers share the pages of the file.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index_path = os.path.join(store_dir, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            raise ValueError(f"The language embedding store {store_dir} is incomplete.")
+        with open(os.path.join(store_dir, META_FILE_NAME), 'r') as file:
+            self.meta = json.load(file)
+        self.root_dir = os.path.abspath(self.meta["root_dir"])
+        self.dtype = getattr(torch, self.meta["dtype"])
+        self.hidden_size = self.meta["hidden_size"]
+        with open(index_path, 'r') as file:
+            self.index = json.load(file)
+        # The array mapped by this process
+        self.embeds = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return self.key_of(name) in self.index
+
+    def key_of(self, name):
+        """
+        Map a key or a legacy path of a `.pt` file to its key.
+        """
+        name = os.path.normpath(name)
+        if name in self.index:
+            return name
+        return os.path.relpath(os.path.abspath(name), self.root_dir)
+
+    def get(self, name):
+        """
+        Get the (L, D) embedding of a key or a legacy path.
+        Raise KeyError if it is not in the store.
+        """
+        key = self.key_of(name)
+        if key not in self.index:
+            raise KeyError(f"{name} is not in the language embedding store {self.store_dir}.")
+        if self.embeds is None:
+            self.embeds = np.load(
+                os.path.join(self.store_dir, EMBEDS_FILE_NAME), mmap_mode='r')
+        offset, num_tokens = self.index[key]
+        return embed_from_numpy(self.embeds[offset:offset + num_tokens], self.dtype)
+
+
+class LangEmbedCache:
+    """
+    Load the language embeddings with an in-process LRU cache.
+
+    The embeddings missing from the store (or all of them, without a store)
+    are loaded from their `.pt` files, so both the keys and the legacy paths
+    are accepted.
+    """
+    def __init__(self, store=None, max_size=LANG_EMBED_CACHE_SIZE):
+        self.store = store
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, name):
+        embed = self.cache.get(name)
+        if embed is not None:
+            self.cache.move_to_end(name)
+            self.hits += 1
+            return embed
+        self.misses += 1
+        if self.store is not None and name in self.store:
+            embed = self.store.get(name)
+        else:
+            embed = torch.load(name)
+        if self.max_size > 0:
+            self.cache[name] = embed
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return embed
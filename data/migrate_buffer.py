@@ -0,0 +1,108 @@
+"""
+Convert a buffer from the legacy layout (one json file and one npz file
+per sample) into the memory-mapped chunk files (`samples.bin`).
+
+The dirty bits are kept as they are. Run it while no producer or
+consumer is using the buffer:
+
+    python -m data.migrate_buffer --n_workers 8 [--remove_legacy]
+"""
+import argparse
+import glob
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import yaml
+
+from data.chunk_buffer import ChunkBuffer
+
+
+def migrate_chunk(chunk_dir, chunk_size, slot_size, remove_legacy):
+    """
+    Migrate one chunk directory. Return the number of converted samples.
+    """
+    buffer = ChunkBuffer.create(chunk_dir, chunk_size, slot_size)
+    num_samples = 0
+    for chunk_item_idx in range(chunk_size):
+        json_path = os.path.join(chunk_dir, f"json_content_{chunk_item_idx}.json")
+        npz_path = os.path.join(chunk_dir, f"sample_{chunk_item_idx}.npz")
+        if not (os.path.exists(json_path) and os.path.exists(npz_path)):
+            continue
+        with open(json_path, 'r') as file:
+            json_content = json.load(file)
+        with np.load(npz_path) as sample_dict:
+            arrays = {key: sample_dict[key] for key in sample_dict.files}
+        buffer.write_sample(chunk_item_idx, json_content, arrays)
+
+        # Verify the written sample
+        read_content, read_arrays = buffer.read_sample(chunk_item_idx)
+        assert read_content == json_content, f"JSON mismatch in {json_path}"
+        assert list(read_arrays.keys()) == list(arrays.keys())
+        for key, value in arrays.items():
+            assert np.array_equal(read_arrays[key], value) \
+                and read_arrays[key].dtype == value.dtype, \
+                f"Field {key} mismatch in {npz_path}"
+        num_samples += 1
+
+        if remove_legacy:
+            for path in (json_path, npz_path):
+                for file_path in (path, path + '.lock'):
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+    buffer.close()
+    return num_samples
+
+
+def _migrate_chunk(args):
+    chunk_dir = args[0]
+    try:
+        return chunk_dir, migrate_chunk(*args), None
+    except BaseException as e:
+        return chunk_dir, 0, repr(e)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default="configs/base.yaml",
+                        help="Path to the config file.")
+    parser.add_argument('--buf_path', type=str, default=None,
+                        help="Path to the buffer. Default is `buf_path` in the config.")
+    parser.add_argument('--n_workers', type=int, default=4,
+                        help="Number of parallel workers.")
+    parser.add_argument('--remove_legacy', action='store_true',
+                        help="Whether to remove the json/npz/lock files after conversion.")
+    args = parser.parse_args()
+
+    with open(args.config_path, 'r') as file:
+        config = yaml.safe_load(file)
+    buf_path = args.buf_path or config['dataset']['buf_path']
+    chunk_size = config['dataset']['buf_chunk_size']
+    slot_size = int(config['dataset'].get('buf_slot_size_mb', 32) * 1024 * 1024)
+
+    chunk_dirs = sorted(
+        glob.glob(os.path.join(buf_path, "chunk_*")),
+        key=lambda x: int(x.rsplit('_', 1)[-1]))
+    print(f"Migrating {len(chunk_dirs)} chunks in {buf_path}...")
+
+    total_samples = 0
+    failed = []
+    tasks = [(chunk_dir, chunk_size, slot_size, args.remove_legacy)
+             for chunk_dir in chunk_dirs]
+    with Pool(args.n_workers) as pool:
+        for i, (chunk_dir, num_samples, error) in enumerate(
+                pool.imap_unordered(_migrate_chunk, tasks)):
+            if error is not None:
+                print(f"Failed to migrate {chunk_dir}: {error}")
+                failed.append(chunk_dir)
+                continue
+            total_samples += num_samples
+            if i % 10 == 0 or i == len(tasks) - 1:
+                print(f"Migrated {i+1}/{len(tasks)} chunks, {total_samples} samples.")
+
+    print(f"Done. {total_samples} samples migrated, {len(failed)} chunks failed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ import random
 
 import tensorflow as tf
 
+from data.tfrecord_index import load_index
+from data.tfrecord_loader import load_tfrecord_episodes
+
 
 def _parse_function(proto, precomputed_instr_embed_path):
     keys_to_features = {
@@ -63,47 +66,39 @@ def _parse_function(proto, precomputed_instr_embed_path):
     }
 
 
-def dataset_generator_from_tfrecords(seed):
+def _read_indexed_episode(shard_path, start, num_records, instr_path):
+    return tf.data.TFRecordDataset(shard_path).skip(start).take(num_records)
+
+
+def load_dataset(seed):
     tfrecord_path = './data/datasets/agilex/tfrecords/'
+    index = load_index(tfrecord_path)
+    random.seed(seed)
+    if index is not None:
+        # Sharded by data/agilex/hdf5totfrecords.py, read each episode from its start
+        episodes = list(index['episodes'])
+        random.shuffle(episodes)
+        sources = (
+            [os.path.join(tfrecord_path, episode['shard']) for episode in episodes],
+            [episode['start'] for episode in episodes],
+            [episode['num_records'] for episode in episodes],
+            [os.path.join(tfrecord_path, episode['instruction_dir']) for episode in episodes],
+        )
+        return load_tfrecord_episodes(
+            sources, lambda x, *source: _parse_function(x, source[-1]),
+            read_fn=_read_indexed_episode)
+
+    # One episode per file
     filepaths = []
     for root, dirs, files in os.walk(tfrecord_path):
         for filename in fnmatch.filter(files, '*.tfrecord'):
             filepath = os.path.join(root, filename)
             filepaths.append(filepath)
     
-    random.seed(seed)
     random.shuffle(filepaths)
-    for filepath in filepaths:
-        raw_dataset = tf.data.TFRecordDataset(filepath)
-        dataset = raw_dataset.map(lambda x: _parse_function(x, os.path.dirname(filepath)))
-        yield {
-            'steps': dataset
-        }
-
-
-def load_dataset(seed):
-    dataset = tf.data.Dataset.from_generator(
-        lambda: dataset_generator_from_tfrecords(seed),
-        output_signature={
-            'steps': tf.data.DatasetSpec(
-                element_spec={
-                    'action': tf.TensorSpec(shape=(14), dtype=tf.float32),
-                    'base_action': tf.TensorSpec(shape=(2), dtype=tf.float32),
-                    'qpos': tf.TensorSpec(shape=(14), dtype=tf.float32),
-                    'qvel': tf.TensorSpec(shape=(14), dtype=tf.float32),
-                    'observation': {
-                        'cam_high': tf.TensorSpec(shape=(480, 640, 3), dtype=tf.uint8),
-                        'cam_left_wrist': tf.TensorSpec(shape=(480, 640, 3), dtype=tf.uint8),
-                        'cam_right_wrist': tf.TensorSpec(shape=(480, 640, 3), dtype=tf.uint8),
-                    },
-                    'instruction': tf.TensorSpec(shape=(), dtype=tf.string),
-                    'terminate_episode': tf.TensorSpec(shape=(), dtype=tf.int64),
-                }
-            )
-        }
-    )
-
-    return dataset
+    sources = (filepaths, [os.path.dirname(filepath) for filepath in filepaths])
+    return load_tfrecord_episodes(
+        sources, lambda x, filepath, instr_path: _parse_function(x, instr_path))
 
 
 def terminate_act_to_bool(terminate_act: tf.Tensor) -> tf.Tensor:
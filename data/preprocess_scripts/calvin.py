@@ -1,5 +1,6 @@
 import tensorflow as tf
 from data.utils import clean_task_instruction, euler_to_rotation_matrix, rotation_matrix_to_ortho6d
+from data.tfrecord_loader import load_tfrecord_episodes
 import tensorflow as tf
 import os
 import fnmatch
@@ -47,7 +48,7 @@ def _parse_function(proto):
     }
 
 
-def dataset_generator_from_tfrecords(seed):
+def load_dataset(seed):
     tfrecord_path = './data/datasets/calvin/tfrecords/'
     filepaths = []
     for root, dirs, files in os.walk(tfrecord_path):
@@ -57,34 +58,8 @@ def dataset_generator_from_tfrecords(seed):
             
     random.seed(seed)
     random.shuffle(filepaths)
-    for filepath in filepaths:
-        raw_dataset = tf.data.TFRecordDataset(filepath)
-        dataset = raw_dataset.map(_parse_function)
-        yield {
-            'steps': dataset
-        }
-
-
-def load_dataset(seed):
-    dataset = tf.data.Dataset.from_generator(
-        lambda: dataset_generator_from_tfrecords(seed),
-        output_signature={
-            'steps': tf.data.DatasetSpec(
-                element_spec={
-                    'action': tf.TensorSpec(shape=(7,), dtype=tf.float32),
-                    'observation':{
-                        'robot_obs': tf.TensorSpec(shape=(15,), dtype=tf.float32),
-                        'rgb_static': tf.TensorSpec(shape=(200,200,3), dtype=tf.uint8),
-                        'rgb_gripper': tf.TensorSpec(shape=(84,84,3), dtype=tf.uint8),
-                    },
-                    'instruction': tf.TensorSpec(shape=(), dtype=tf.string),
-                    'terminate_episode': tf.TensorSpec(shape=(), dtype=tf.int64),
-                }
-            )
-        }
-    )
-
-    return dataset
+    return load_tfrecord_episodes(
+        (filepaths,), lambda x, filepath: _parse_function(x))
 
 
 def terminate_act_to_bool(terminate_act: tf.Tensor) -> tf.Tensor:
@@ -2,6 +2,7 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 from data.utils import clean_task_instruction, quaternion_to_rotation_matrix_wo_static_check, \
     rotation_matrix_to_ortho6d_1d
+from data.tfrecord_loader import load_tfrecord_episodes
 import tensorflow as tf
 import h5py
 import numpy as np
@@ -64,9 +65,28 @@ def _parse_function(proto):
         'tcp_base': tcp_base,
     }
 
-def dataset_generator_from_tfrecords(seed):
+def _joint_size(proto):
+    joint = tf.io.parse_single_example(
+        proto, {'joint': tf.io.FixedLenFeature([], tf.string)})['joint']
+    return tf.size(tf.io.parse_tensor(joint, out_type=tf.float64))
+
+
+def _is_valid_episode(records, filepath):
+    """
+    Discard the episodes with a single step or with a joint that is not 6- or 7-dim.
+    """
+    def update(state, joint_size):
+        num_steps, valid_joint = state
+        return num_steps + 1, tf.logical_and(
+            valid_joint, tf.logical_or(tf.equal(joint_size, 6), tf.equal(joint_size, 7)))
+
+    num_steps, valid_joint = records.map(_joint_size).reduce(
+        (tf.constant(0, dtype=tf.int64), tf.constant(True)), update)
+    return tf.logical_and(num_steps > 1, valid_joint)
+
+
+def load_dataset(seed):
     tfrecord_path = './data/datasets/rh20t/tfrecords/'
-    datasets = []
     filepaths = []
     for root, dirs, files in os.walk(tfrecord_path):    
         for filename in fnmatch.filter(files, '*.tfrecord'):
@@ -75,21 +95,11 @@ def dataset_generator_from_tfrecords(seed):
 
     random.seed(seed)
     random.shuffle(filepaths)
-    for filepath in filepaths:
-        raw_dataset = tf.data.TFRecordDataset(filepath)
-        dataset = raw_dataset.map(_parse_function)
-        num = 0
-        for data in dataset:
-            num = num + 1
-            if data['joint'].shape != tf.TensorShape((6,)) and data['joint'].shape != tf.TensorShape((7,)):
-                num = 0
-                break
-        if num <= 1: # discard dataset
-            continue
-        yield {
-            'steps': dataset
-        }
-        
+    return load_tfrecord_episodes(
+        (filepaths,), lambda x, filepath: _parse_function(x),
+        episode_filter=_is_valid_episode)
+
+
 def terminate_act_to_bool(terminate_act: tf.Tensor) -> tf.Tensor:
     """
     Convert terminate action to a boolean, where True means terminate.
@@ -97,27 +107,6 @@ def terminate_act_to_bool(terminate_act: tf.Tensor) -> tf.Tensor:
     return tf.where(tf.equal(terminate_act, tf.constant(0.0, dtype=tf.int64)),tf.constant(False),tf.constant(True))
 
 
-def load_dataset(seed):
-    dataset = tf.data.Dataset.from_generator(
-        lambda: dataset_generator_from_tfrecords(seed),
-        output_signature={
-            'steps': tf.data.DatasetSpec(
-                element_spec={
-                    'joint': tf.TensorSpec(shape=(None), dtype=tf.float64),
-                    'observation':{
-                    'image': tf.TensorSpec(shape=(None), dtype=tf.uint8),
-                    },
-                    'instruction': tf.TensorSpec(shape=(), dtype=tf.string),
-                    'terminate_episode': tf.TensorSpec(shape=(), dtype=tf.int64),
-                    'gripper': tf.TensorSpec(shape=(None), dtype=tf.float64),
-                    'tcp_base': tf.TensorSpec(shape=(None), dtype=tf.float64),
-                }
-            )
-        }
-    )
-
-    return dataset
-
 def terminate_act_to_bool(terminate_act: tf.Tensor) -> tf.Tensor:
     """
     Convert terminate action to a boolean, where True means terminate.
@@ -1,6 +1,7 @@
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from data.utils import clean_task_instruction, quaternion_to_euler
+from data.tfrecord_loader import load_tfrecord_episodes
 import tensorflow as tf
 import h5py
 import numpy as np
@@ -186,6 +187,7 @@ path2json = {
 }
 
 image_shape = (240, 424, 3)
+INSTRUCTION_SEP = '\n'
 Dmanus = ['']
 def stash_image_into_observation(step):
     step['observation'] = {'cam_high': [], 'cam_left_wrist': [], 'cam_right_wrist':[]}
@@ -246,7 +248,7 @@ def _parse_function(proto,instruction):
     }
 
 
-def dataset_generator_from_tfrecords(seed):
+def load_dataset(seed):
     tfrecord_path = './data/datasets/roboset/tfrecords/'   
     failure = [f'set_{i}' for i in range(10, 18)]
     filepaths = []
@@ -266,41 +268,17 @@ def dataset_generator_from_tfrecords(seed):
     
     random.seed(seed)
     random.shuffle(filepaths)
+    instructions = []
     for filepath in filepaths:
         for path in path2json:
             if path in filepath:
                 instruction = path2json[path]
-        raw_dataset = tf.data.TFRecordDataset(filepath)
-        dataset = raw_dataset.map(lambda x: _parse_function(x,instruction))
-        yield {
-            'steps': dataset
-        }
-        
-def load_dataset(seed):
-    dataset = tf.data.Dataset.from_generator(
-        lambda: dataset_generator_from_tfrecords(seed),
-        output_signature={
-            'steps': tf.data.DatasetSpec(
-                element_spec={
-                    'action': tf.TensorSpec(shape=(None), dtype=tf.float16),
-                    'action_gripper': tf.TensorSpec(shape=(None), dtype=tf.float16),
-                    'qpos': tf.TensorSpec(shape=(None), dtype=tf.float16),  
-                    'qvel': tf.TensorSpec(shape=(None), dtype=tf.float16), 
-                    'qpos_gripper': tf.TensorSpec(shape=(None), dtype=tf.float16),  
-                    'qvel_gripper': tf.TensorSpec(shape=(None), dtype=tf.float16),  
-                    'observation': {
-                        'rgb_left': tf.TensorSpec(shape=image_shape, dtype=tf.uint8),
-                        'rgb_right': tf.TensorSpec(shape=image_shape, dtype=tf.uint8),
-                        'rgb_top': tf.TensorSpec(shape=image_shape, dtype=tf.uint8),
-                    },
-                    'terminate_episode': tf.TensorSpec(shape=(), dtype=tf.int64),
-                    'instruction': tf.TensorSpec(shape=(None), dtype=tf.string)
-                }
-            )
-        }
-    )
-
-    return dataset
+        # The instructions of an episode are joined as a string tensor
+        instructions.append(INSTRUCTION_SEP.join(instruction))
+    return load_tfrecord_episodes(
+        (filepaths, instructions),
+        lambda x, filepath, instruction: _parse_function(
+            x, tf.strings.split(instruction, INSTRUCTION_SEP)))
 
 
 def terminate_act_to_bool(terminate_act: tf.Tensor) -> tf.Tensor:
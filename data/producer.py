@@ -14,6 +14,10 @@ import yaml
 
 from data.vla_dataset import VLADataset
 from data.filelock import FileLock
+from data.chunk_buffer import (CHUNK_FILE_NAME, SAMPLE_KEYS, ChunkBuffer,
+                               is_chunk_buffer)
+from data.dirty_bit import CLEAN, DIRTY, WRITING, DirtyBitmap
+from data.jpeg_frames import JPEG_QUALITY, pack_jpeg_frames
 
 
 # Producer does not need GPU
@@ -30,78 +34,108 @@ if BUF_NUM_CHUNKS < 1:
 BUF_CHUNK_SIZE = config['dataset']['buf_chunk_size']
 if BUF_CHUNK_SIZE < 1:
     raise ValueError("Config `buf_chunk_size` must be at least 1.")
+BUF_FORMAT = config['dataset'].get('buf_format', 'npz')
+if BUF_FORMAT not in ('npz', 'mmap'):
+    raise ValueError(f"Unknown buffer format: {BUF_FORMAT}")
+BUF_SLOT_SIZE = int(config['dataset'].get('buf_slot_size_mb', 32) * 1024 * 1024)
+BUF_IMAGE_FORMAT = config['dataset'].get('buf_image_format', 'raw')
+if BUF_IMAGE_FORMAT not in ('raw', 'jpeg'):
+    raise ValueError(f"Unknown buffer image format: {BUF_IMAGE_FORMAT}")
+BUF_JPEG_QUALITY = config['dataset'].get('buf_jpeg_quality', JPEG_QUALITY)
+# Interval (in seconds) to print the sampling statistics of the datasets
+STATS_INTERVAL = 300
+
+# The chunk files opened by this process (mmap format only)
+chunk_buffers = {}
+# The dirty bits mapped by this process
+dirty_bitmaps = {}
+
+
+def get_dirty_bitmap(chunk_dir):
+    """
+    Get the mapped dirty bits of the chunk directory.
+    """
+    if chunk_dir not in dirty_bitmaps:
+        dirty_bitmaps[chunk_dir] = DirtyBitmap(chunk_dir)
+    return dirty_bitmaps[chunk_dir]
+
+
+def reset_dirty_bitmap(chunk_dir, state):
+    """
+    Create or reset the dirty bits of the chunk directory.
+    """
+    if chunk_dir in dirty_bitmaps:
+        dirty_bitmaps.pop(chunk_dir).close()
+    dirty_bitmaps[chunk_dir] = DirtyBitmap.create(chunk_dir, BUF_CHUNK_SIZE, state)
+    return dirty_bitmaps[chunk_dir]
 
 
 def get_dirty_item(chunk_dir):
     """
     Get indexes of dirty items in a chunk.
     """
-    dirty_bit = read_dirty_bit(chunk_dir)
-    return np.where(dirty_bit)[0].tolist()
+    return get_dirty_bitmap(chunk_dir).get_dirty_item()
 
 
-def get_clean_item(chunk_dir):
+def get_chunk_buffer(chunk_dir, create=False):
     """
-    Get indexes of clean items in a chunk.
+    Get the opened chunk file of the chunk directory.
     """
-    dirty_bit = read_dirty_bit(chunk_dir)
-    return np.where(1 - dirty_bit)[0].tolist()
+    if chunk_dir in chunk_buffers and chunk_buffers[chunk_dir].is_replaced():
+        # e.g., recreated by another run or migrated
+        chunk_buffers.pop(chunk_dir).close()
+    if create or chunk_dir not in chunk_buffers:
+        if chunk_dir in chunk_buffers:
+            chunk_buffers.pop(chunk_dir).close()
+        if create:
+            chunk_buffers[chunk_dir] = ChunkBuffer.create(
+                chunk_dir, BUF_CHUNK_SIZE, BUF_SLOT_SIZE)
+        else:
+            chunk_buffers[chunk_dir] = ChunkBuffer(chunk_dir, writable=True)
+    return chunk_buffers[chunk_dir]
 
 
-def save_dirty_bit(chunk_dir, dirty_bit):
+def get_sample_arrays(step_dict):
     """
-    Save the dirty bit to the chunk directory.
+    Get the arrays of a sample in the order of `SAMPLE_KEYS`,
+    with the frames encoded if `buf_image_format` is jpeg.
     """
-    time_stmp = time.time()
-    while time.time() - time_stmp < 10.0:
-        try:
-            file_path = os.path.join(chunk_dir, "dirty_bit")
-            lock = FileLock(file_path)
-            lock.acquire_write_lock()
-            with open(file_path, 'wb') as file:
-                file.write(dirty_bit.tobytes())
-            lock.release_lock()
-            return
-        except KeyboardInterrupt:
-            lock.release_lock()
-            raise KeyboardInterrupt
-        except BaseException:
-            lock.release_lock()
-            continue
-    # raise RuntimeError("Failed to save dirty bit.")
-    print("Failed to save dirty bit.")
+    arrays = {}
+    for key in SAMPLE_KEYS:
+        array = step_dict[key].numpy()
+        if BUF_IMAGE_FORMAT == 'jpeg' and key.startswith('past_frames_') \
+            and not key.endswith('_time_mask'):
+            array = pack_jpeg_frames(array, BUF_JPEG_QUALITY)
+        arrays[key] = array
+    return arrays
 
 
-def read_dirty_bit(chunk_dir):
+def save_sample_mmap(step_dict, chunk_dir, chunk_item_idx):
     """
-    Read the dirty bit from the chunk directory.
+    Save a sample to its slot in the chunk file.
+    Return whether the sample is saved.
     """
-    # If error occurs, retry
-    time_stmp = time.time()
-    while time.time() - time_stmp < 10.0:
-        try:
-            file_path = os.path.join(chunk_dir, "dirty_bit")
-            lock = FileLock(file_path)
-            lock.acquire_read_lock()
-            with open(file_path, 'rb') as file:
-                dirty_bit = np.frombuffer(file.read(), dtype=np.uint8).copy()
-            lock.release_lock()
-            assert len(dirty_bit) == BUF_CHUNK_SIZE
-            return dirty_bit
-        except KeyboardInterrupt:
-            lock.release_lock()
-            raise KeyboardInterrupt
-        except BaseException:
-            lock.release_lock()
-            continue
-    # If failed to read the dirty bit, return all ones for robustness
-    return np.ones(BUF_CHUNK_SIZE, dtype=np.uint8)
+    try:
+        get_chunk_buffer(chunk_dir).write_sample(
+            chunk_item_idx, step_dict['json_content'], get_sample_arrays(step_dict))
+        return True
+    except KeyboardInterrupt:
+        raise KeyboardInterrupt
+    except BaseException as e:
+        print("Failed to save sample:", e)
+        return False
 
 
 def save_sample(step_dict, chunk_dir, chunk_item_idx):
     """
-    Save a sample to the chunk directory.
+    Save a sample to the chunk directory, in the format of the chunk.
+    Return whether the sample is saved.
     """
+    if is_chunk_buffer(chunk_dir):
+        return save_sample_mmap(step_dict, chunk_dir, chunk_item_idx)
+    
+    # Encode the frames before taking the locks
+    arrays = get_sample_arrays(step_dict)
     # Save the json content
     time_stmp = time.time()
     while time.time() - time_stmp < 10.0:
@@ -121,28 +155,9 @@ def save_sample(step_dict, chunk_dir, chunk_item_idx):
             locks.append(lock)
             lock.acquire_write_lock()
             with open(file_path, 'wb') as file:
-                np.savez(
-                    file,
-                    step_id=step_dict['step_id'].numpy(),
-                    state_chunk=step_dict['state_chunk'].numpy(),
-                    state_chunk_time_mask=step_dict['state_chunk_time_mask'].numpy(),
-                    action_chunk=step_dict['action_chunk'].numpy(),
-                    action_chunk_time_mask=step_dict['action_chunk_time_mask'].numpy(),
-                    state_vec_mask=step_dict['state_vec_mask'].numpy(),
-                    past_frames_0=step_dict['past_frames_0'].numpy(),
-                    past_frames_0_time_mask=step_dict['past_frames_0_time_mask'].numpy(),
-                    past_frames_1=step_dict['past_frames_1'].numpy(),
-                    past_frames_1_time_mask=step_dict['past_frames_1_time_mask'].numpy(),
-                    past_frames_2=step_dict['past_frames_2'].numpy(),
-                    past_frames_2_time_mask=step_dict['past_frames_2_time_mask'].numpy(),
-                    past_frames_3=step_dict['past_frames_3'].numpy(),
-                    past_frames_3_time_mask=step_dict['past_frames_3_time_mask'].numpy(),
-                    state_std=step_dict['state_std'].numpy(),
-                    state_mean=step_dict['state_mean'].numpy(),
-                    state_norm=step_dict['state_norm'].numpy(),            
-                )
+                np.savez(file, **arrays)
             lock.release_lock()
-            return
+            return True
         except KeyboardInterrupt:
             for lock in locks:
                 lock.release_lock()
@@ -153,6 +168,19 @@ def save_sample(step_dict, chunk_dir, chunk_item_idx):
             continue
     # raise RuntimeError("Failed to save sample.")
     print("Failed to save sample.")
+    return False
+
+
+def print_dataset_stats(vla_dataset, worker_id):
+    stats = vla_dataset.get_stats()
+    if stats is None:
+        return
+    lines = [f"Worker {worker_id}: dataset stats (realized/target weight, episodes/s, starved):"]
+    for name, stat in stats.items():
+        lines.append(
+            f"  {name}: {stat['realized_weight']:.3f}/{stat['target_weight']:.3f}, "
+            f"{stat['episodes_per_sec']:.2f}, {stat['starved']}")
+    print("\n".join(lines))
 
 
 def run_producer(seed, num_workers, worker_id, fill_up, clean_dirty, dataset_type):
@@ -173,8 +201,7 @@ def run_producer(seed, num_workers, worker_id, fill_up, clean_dirty, dataset_typ
         print(f"Worker {worker_id}: Start refreshing the dirty bits...")
         for chunk_idx in range(chunk_start_idx, chunk_end_idx):
             chunk_dir = os.path.join(BUF_PATH, f"chunk_{chunk_idx}")
-            dirty_bit = np.zeros(BUF_CHUNK_SIZE, dtype=np.uint8)
-            save_dirty_bit(chunk_dir, dirty_bit)
+            reset_dirty_bitmap(chunk_dir, CLEAN)
         print(f"Worker {worker_id}: Refreshed the dirty bits.")
 
     fill_chunk_idx = chunk_start_idx
@@ -182,7 +209,12 @@ def run_producer(seed, num_workers, worker_id, fill_up, clean_dirty, dataset_typ
     dirty_chunk_idx = chunk_start_idx
     dirty_chunk_item_idxs = []
     time_stmp = time.time()
+    stats_time_stmp = time.time()
     for episode_steps in vla_dataset:
+        # Print the sampling statistics of the datasets
+        if time.time() - stats_time_stmp > STATS_INTERVAL:
+            print_dataset_stats(vla_dataset, worker_id)
+            stats_time_stmp = time.time()
         for step in episode_steps:
             if fill_up and fill_chunk_idx < chunk_end_idx:
                 # Fill up the buffer
@@ -190,12 +222,20 @@ def run_producer(seed, num_workers, worker_id, fill_up, clean_dirty, dataset_typ
                 if fill_chunk_item_idx == 0:
                     # Create a new chunk
                     os.makedirs(chunk_dir, exist_ok=True)
-                    # Write the dirty bit of size BUF_CHUNK_SIZE
-                    dirty_bit = np.zeros(BUF_CHUNK_SIZE, dtype=np.uint8)
-                    save_dirty_bit(chunk_dir, dirty_bit)
+                    if BUF_FORMAT == 'mmap':
+                        get_chunk_buffer(chunk_dir, create=True)
+                    elif is_chunk_buffer(chunk_dir):
+                        # Switch the chunk back to the npz format
+                        os.remove(os.path.join(chunk_dir, CHUNK_FILE_NAME))
+                    # Write the dirty bit of size BUF_CHUNK_SIZE,
+                    # no slot can be read until it is filled
+                    reset_dirty_bitmap(chunk_dir, WRITING)
                 
-                # Save the sample
-                save_sample(step, chunk_dir, fill_chunk_item_idx)
+                # Save the sample, a slot that failed is left
+                # dirty so that it is replaced later
+                saved = save_sample(step, chunk_dir, fill_chunk_item_idx)
+                get_dirty_bitmap(chunk_dir).set(
+                    fill_chunk_item_idx, CLEAN if saved else DIRTY)
 
                 # print(f"Filled up chunk {fill_chunk_item_idx+1}/{BUF_CHUNK_SIZE} {fill_chunk_idx+1}/{BUF_NUM_CHUNKS}")
                 local_fill_chunk_idx = fill_chunk_idx - chunk_start_idx
@@ -210,39 +250,36 @@ def run_producer(seed, num_workers, worker_id, fill_up, clean_dirty, dataset_typ
                     print(f"Worker {worker_id}: Buffer filled up. Start replacing dirty samples...")
 
             else:
-                # Search for the dirty chunk to replace
-                while len(dirty_chunk_item_idxs) == 0:
-                    dirty_chunk_dir = os.path.join(BUF_PATH, f"chunk_{dirty_chunk_idx}")
-                    dirty_chunk_item_idxs = get_dirty_item(dirty_chunk_dir)
-                    # Print the dirty ratio
-                    if time.time() - time_stmp > 2.0:
-                        dirty_ratio = len(dirty_chunk_item_idxs) / BUF_CHUNK_SIZE
-                        print(f"Worker {worker_id}: Dirty Ratio for Chunk {dirty_chunk_idx}: {dirty_ratio:.2f}")
-                        time_stmp = time.time()
-
-                    if len(dirty_chunk_item_idxs) > 0:
-                        # Lock the chunk
-                        dirty_bit = np.ones(BUF_CHUNK_SIZE, dtype=np.uint8)
-                        save_dirty_bit(dirty_chunk_dir, dirty_bit)
-                    
-                    # Iterate over the chunks
-                    dirty_chunk_idx += 1
-                    if dirty_chunk_idx == chunk_end_idx:
-                        dirty_chunk_idx = chunk_start_idx
-
-                # Replace the dirty item
-                dirty_item_idx = dirty_chunk_item_idxs.pop()
-                chunk_dir = os.path.join(BUF_PATH, f"chunk_{dirty_chunk_idx}")
-                # Save the sample
-                save_sample(step, chunk_dir, dirty_item_idx)
+                # Search for a dirty item to replace
+                dirty_item_idx = None
+                while dirty_item_idx is None:
+                    while len(dirty_chunk_item_idxs) == 0:
+                        dirty_chunk_dir = os.path.join(BUF_PATH, f"chunk_{dirty_chunk_idx}")
+                        dirty_chunk_item_idxs = get_dirty_item(dirty_chunk_dir)
+                        # Print the dirty ratio
+                        if time.time() - time_stmp > 2.0:
+                            dirty_ratio = len(dirty_chunk_item_idxs) / BUF_CHUNK_SIZE
+                            print(f"Worker {worker_id}: Dirty Ratio for Chunk {dirty_chunk_idx}: {dirty_ratio:.2f}")
+                            time_stmp = time.time()
+                        
+                        # Iterate over the chunks
+                        dirty_chunk_idx += 1
+                        if dirty_chunk_idx == chunk_end_idx:
+                            dirty_chunk_idx = chunk_start_idx
+
+                    # Claim the dirty item so that no consumer reads it while it is replaced
+                    item_idx = dirty_chunk_item_idxs.pop()
+                    if get_dirty_bitmap(dirty_chunk_dir).compare_and_set(item_idx, DIRTY, WRITING):
+                        dirty_item_idx = item_idx
+
+                # Replace the dirty item, it stays dirty if the write failed
+                saved = save_sample(step, dirty_chunk_dir, dirty_item_idx)
+                get_dirty_bitmap(dirty_chunk_dir).set(
+                    dirty_item_idx, CLEAN if saved else DIRTY)
 
                 # If we have replaced all dirty items in the chunk
                 if len(dirty_chunk_item_idxs) == 0:
-                    # Unlock the chunk
-                    dirty_bit = np.zeros(BUF_CHUNK_SIZE, dtype=np.uint8)
-                    save_dirty_bit(dirty_chunk_dir, dirty_bit)
-                    print(f"Worker {worker_id}: Replaced dirty chunk {dirty_chunk_idx}.")
-
+                    print(f"Worker {worker_id}: Replaced dirty chunk {dirty_chunk_dir}.")
 
 if __name__ == '__main__':
     # Args: n_workers, fill_up
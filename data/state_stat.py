@@ -0,0 +1,134 @@
+"""
+Streaming statistics of the state vectors of a dataset.
+
+The moments of every episode are computed in one pass and combined
+with the parallel algorithm of Chan et al., so partial results of
+different workers can be merged in any grouping without the
+cancellation of the naive `E[x^2] - E[x]^2` formula.
+"""
+import numpy as np
+
+
+# Values within EPS from zero are treated as unused dimensions
+EPS = 1e-8
+
+
+def _combine_mean_m2(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta ** 2 * (n_a * n_b / n)
+    return mean, m2
+
+
+class StateMoments:
+    """
+    The count, mean, min and max of the states, and the moments of the
+    zeroed states (|x| <= EPS set to 0) from which the std is computed.
+
+    The std follows the definition of `configs/dataset_stat.json`: the
+    sum of squared deviations divided by the number of non-zero entries
+    of each dimension, so that dimensions that are mostly unused are
+    not shrunk towards zero.
+    """
+    def __init__(self, state_dim=None):
+        self.count = 0
+        self.mean = None
+        self.z_mean = None
+        self.z_m2 = None
+        self.nz_count = None
+        self.min = None
+        self.max = None
+        if state_dim is not None:
+            self._init(state_dim)
+
+    def _init(self, state_dim):
+        self.mean = np.zeros(state_dim)
+        self.z_mean = np.zeros(state_dim)
+        self.z_m2 = np.zeros(state_dim)
+        self.nz_count = np.zeros(state_dim)
+        self.min = np.full(state_dim, np.inf)
+        self.max = np.full(state_dim, -np.inf)
+
+    def update(self, states):
+        """
+        Add a (T, D) array of states, e.g., one episode.
+        """
+        states = np.asarray(states, dtype=np.float64)
+        if states.shape[0] == 0:
+            return
+        other = StateMoments(states.shape[1])
+        z_states = np.where(np.abs(states) <= EPS, 0.0, states)
+        other.count = states.shape[0]
+        other.mean = states.mean(axis=0)
+        other.z_mean = z_states.mean(axis=0)
+        other.z_m2 = np.sum((z_states - other.z_mean) ** 2, axis=0)
+        other.nz_count = np.sum(np.abs(states) > EPS, axis=0).astype(np.float64)
+        other.min = states.min(axis=0)
+        other.max = states.max(axis=0)
+        self.merge(other)
+
+    def merge(self, other):
+        """
+        Merge the moments of another set of states into this one.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.mean, self.z_mean, self.z_m2 = \
+                other.mean.copy(), other.z_mean.copy(), other.z_m2.copy()
+            self.nz_count = other.nz_count.copy()
+            self.min, self.max = other.min.copy(), other.max.copy()
+            return self
+        self.mean, _ = _combine_mean_m2(
+            self.count, self.mean, 0.0, other.count, other.mean, 0.0)
+        self.z_mean, self.z_m2 = _combine_mean_m2(
+            self.count, self.z_mean, self.z_m2, other.count, other.z_mean, other.z_m2)
+        self.count += other.count
+        self.nz_count = self.nz_count + other.nz_count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def state_dict(self):
+        """
+        A JSON-serializable dict, e.g., to checkpoint partial results.
+        """
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": int(self.count),
+            "mean": self.mean.tolist(),
+            "z_mean": self.z_mean.tolist(),
+            "z_m2": self.z_m2.tolist(),
+            "nz_count": self.nz_count.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        moments = cls()
+        if state_dict["count"] == 0:
+            return moments
+        moments.count = state_dict["count"]
+        for key in ("mean", "z_mean", "z_m2", "nz_count", "min", "max"):
+            setattr(moments, key, np.array(state_dict[key], dtype=np.float64))
+        return moments
+
+    def result(self, dataset_name):
+        """
+        The statistics in the format of `configs/dataset_stat.json`.
+        """
+        if self.count == 0:
+            raise ValueError(f"No state is found in the dataset {dataset_name}.")
+        # Add one to avoid division by zero
+        nz_count = np.maximum(self.nz_count, 1)
+        return {
+            "dataset_name": dataset_name,
+            "state_mean": self.mean.tolist(),
+            "state_std": np.sqrt(np.maximum(self.z_m2 / nz_count, 0)).tolist(),
+            "state_min": self.min.tolist(),
+            "state_max": self.max.tolist(),
+        }
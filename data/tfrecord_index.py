@@ -0,0 +1,118 @@
+"""
+Episode index of sharded TFRecord files.
+
+A shard stores the steps of several whole episodes one after another.
+`index.json` in the TFRecord directory records where each episode starts:
+
+    {
+        "version": 2,
+        "shards": {"<shard file>": {"num_records": int, "num_bytes": int}, ...},
+        "episodes": [
+            {
+                "name": str,            # the source of the episode
+                "shard": str,           # the shard file, relative to the directory
+                "start": int,           # index of the first record in the shard
+                "num_records": int,     # number of steps
+                "instruction_dir": str  # directory of the instruction files, relative to the directory
+            },
+            ...
+        ]
+    }
+
+An uncompressed TFRecord is a sequence of
+    [uint64 length | uint32 masked crc of length | data | uint32 masked crc of data]
+so the offsets are known while writing, and the records of a shard are
+counted from their headers without reading the data. An episode is read
+with `tf.data.TFRecordDataset(shard).skip(start).take(num_records)`, where
+the skipped records are seeked over rather than read.
+
+The episodes of version 1 have the byte offset of their first record
+instead of "start", which is derived from the order of the episodes in
+their shard when they are loaded.
+"""
+import json
+import os
+import struct
+
+
+INDEX_FILE_NAME = "index.json"
+INDEX_VERSION = 2
+
+# Bytes of the length and the two CRCs around each record
+RECORD_OVERHEAD = 16
+_LENGTH = struct.Struct("<Q")
+
+
+def record_size(data):
+    """
+    Number of bytes a record of `data` takes in an uncompressed TFRecord file.
+    """
+    return len(data) + RECORD_OVERHEAD
+
+
+def count_records(path):
+    """
+    Count the records of a TFRecord file by walking the record headers.
+    Raise ValueError if the file is truncated.
+    """
+    num_records = 0
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            header = f.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                raise ValueError(f"Truncated record header at {offset} in {path}.")
+            length, = _LENGTH.unpack(header)
+            offset += length + RECORD_OVERHEAD
+            if offset > file_size:
+                raise ValueError(f"Truncated record at {offset} in {path}.")
+            f.seek(offset)
+            num_records += 1
+    return num_records
+
+
+def fill_episode_starts(episodes):
+    """
+    Set the missing "start" of the episodes (written before version 2)
+    from the order of their byte offsets in their shards, which hold whole
+    episodes one after another, and drop the offsets. Modified in place.
+    """
+    shard_episodes = {}
+    for episode in episodes:
+        shard_episodes.setdefault(episode['shard'], []).append(episode)
+    for group in shard_episodes.values():
+        if all('start' in episode for episode in group):
+            continue
+        start = 0
+        for episode in sorted(group, key=lambda episode: episode['offset']):
+            episode['start'] = start
+            start += episode['num_records']
+    for episode in episodes:
+        episode.pop('offset', None)
+    return episodes
+
+
+def load_index(tfrecord_dir):
+    """
+    Load the episode index of a TFRecord directory, or None if it has none.
+    """
+    index_path = os.path.join(tfrecord_dir, INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    if index.get('version') == 1:
+        fill_episode_starts(index['episodes'])
+        index['version'] = INDEX_VERSION
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f"Unsupported TFRecord index version: {index.get('version')}")
+    return index
+
+
+def save_index(tfrecord_dir, shards, episodes):
+    index_path = os.path.join(tfrecord_dir, INDEX_FILE_NAME)
+    tmp_path = f"{index_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'shards': shards, 'episodes': episodes}, f, indent=4)
+    os.replace(tmp_path, index_path)
@@ -0,0 +1,46 @@
+"""
+Load the episodes of the TFRecord datasets in data/preprocess_scripts
+as a dataset of `{'steps': dataset of steps}`.
+
+Every episode is a lazy nested dataset: its records are only read when its
+steps are iterated, and they are parsed (and their images decoded) by a
+parallel `map` and prefetched, so an episode is never held in memory as a
+whole. The optional episode filter streams over the serialized records of
+several upcoming episodes in parallel.
+"""
+import tensorflow as tf
+
+
+def _read_tfrecord(path, *args):
+    return tf.data.TFRecordDataset(path)
+
+
+def load_tfrecord_episodes(sources, parse_fn, read_fn=_read_tfrecord,
+                           episode_filter=None,
+                           num_parallel_calls=tf.data.AUTOTUNE):
+    """
+    sources: a tuple of lists with one entry per episode, in the order to load
+        them. The first list is usually the TFRecord file paths and the others
+        are extra arguments of the episodes, e.g., the instruction paths.
+    parse_fn: (serialized step, *source) -> step.
+    read_fn: (*source) -> dataset of the serialized steps of the episode.
+        Default reads the whole file at the first entry of the source.
+    episode_filter: optional (dataset of serialized steps, *source) -> bool
+        tensor, whether to keep the episode, evaluated before parsing the
+        steps (e.g., with `Dataset.reduce`).
+    """
+    def to_episode(*source):
+        steps = read_fn(*source).map(
+            lambda x: parse_fn(x, *source), num_parallel_calls=num_parallel_calls)
+        return {
+            'steps': steps.prefetch(tf.data.AUTOTUNE)
+        }
+
+    episodes = tf.data.Dataset.from_tensor_slices(tuple(sources))
+    if episode_filter is not None:
+        episodes = episodes.map(
+            lambda *source: (source, episode_filter(read_fn(*source), *source)),
+            num_parallel_calls=num_parallel_calls, deterministic=True)
+        episodes = episodes.filter(lambda source, keep: keep).map(
+            lambda source, keep: source)
+    return episodes.map(to_episode).prefetch(1)
@@ -1,5 +1,8 @@
 import json
+import queue
 import random
+import threading
+import time
 
 import numpy as np
 import tensorflow as tf
@@ -32,20 +35,244 @@ with open('configs/base.yaml', 'r') as file:
 # Load some constants from the config
 EPSD_LEN_THRESH_LOW = config['dataset']['epsd_len_thresh_low']
 EPSD_LEN_THRESH_HIGH = config['dataset']['epsd_len_thresh_high']
+EPSD_PREFETCH_SIZE = config['dataset'].get('epsd_prefetch_size', 0)
 # Read the image keys of each dataset
 with open('configs/dataset_img_keys.json', 'r') as file:
     IMAGE_KEYS = json.load(file)
 
 
+def _skip_image_decoders(feature):
+    """
+    Build the tfds decoders that keep all the images of
+    `feature` as encoded bytes, or None if it has no image.
+    """
+    if isinstance(feature, tfds.features.Image):
+        return tfds.decode.SkipDecoding()
+    if isinstance(feature, tfds.features.Dataset):
+        return _skip_image_decoders(feature.feature)
+    if isinstance(feature, tfds.features.FeaturesDict):
+        decoders = {}
+        for key, sub_feature in feature.items():
+            sub_decoders = _skip_image_decoders(sub_feature)
+            if sub_decoders is not None:
+                decoders[key] = sub_decoders
+        return decoders or None
+    return None
+
+
+def load_raw_dataset(dataset_name, seed, openx_dir=OPENX_EMBOD_DIR,
+                     split='all', skip_image_decoding=False):
+    """
+    Load the episodes of a dataset before `process_episode`.
+
+    split: the tfds split to load, e.g., one of `tfds.even_splits('all', n)`.
+        The datasets not in the Open X-Embodiment format are always
+        loaded as a whole.
+    skip_image_decoding: whether to keep the images of the Open X-Embodiment
+        datasets as encoded bytes, e.g., when only the states are needed.
+    """
+    if dataset_name in DATASET_NAMES_NOOPENX:
+        return globals()[dataset_name].load_dataset(seed)
+
+    dataset_path = dataset_to_path(dataset_name, openx_dir)
+    builder = tfds.builder_from_directory(builder_dir=dataset_path)
+    decoders = _skip_image_decoders(builder.info.features) \
+        if skip_image_decoding else None
+    dataset = builder.as_dataset(split=split, shuffle_files=True, decoders=decoders)
+    
+    # You can add filter for other datasets
+    if dataset_name == 'kuka':
+        dataset = dataset.filter(
+            lambda x: x['success'])
+    elif dataset_name == 'bc_z':
+        dataset = dataset.filter(
+            lambda x: tf.math.greater(
+                next(iter(x['steps']))['observation']['episode_success'], 0.5))
+    elif dataset_name == 'ucsd_pick_and_place_dataset_converted_externally_to_rlds':
+        dataset = dataset.filter(
+            lambda x: x['episode_metadata']['success'])
+    elif dataset_name == 'utokyo_xarm_bimanual_converted_externally_to_rlds':
+        # Only preserve the meaningful episodes
+        dataset = dataset.filter(
+            lambda x: tf.math.equal(
+                next(iter(x['steps']))['language_instruction'],
+                tf.constant('Unfold a wrinkled towel.')))
+    return dataset
+
+
+class WeightedEpisodeSampler:
+    """
+    Sample the episodes of several datasets according to their weights,
+    with a background thread per dataset that keeps up to `prefetch_size`
+    processed episodes ready in a queue.
+
+    A dataset is drawn according to the weights. If its queue is empty,
+    the draw is counted as a starvation of that dataset, and the episode
+    is taken from the ready dataset that is furthest below its target share,
+    so that a slow dataset does not stall the others. A dataset is never
+    drawn more than `max_skew` episodes ahead of its share in this way, so
+    the realized mixture stays close to the weights.
+    """
+    def __init__(self, dataset_names, sample_weights, fetch_fns, prefetch_size, max_skew=8):
+        '''
+        dataset_names: the names of the datasets
+        sample_weights: the normalized weights of the datasets
+        fetch_fns: dataset name -> a function that returns the next processed
+            episode of that dataset, or None to skip it, and raises
+            StopIteration when the dataset is exhausted
+        prefetch_size: the maximum number of ready episodes per dataset
+        max_skew: the maximum number of episodes a dataset can be drawn
+            ahead of its share in place of a starved dataset
+        '''
+        self.dataset_names = list(dataset_names)
+        self.sample_weights = np.asarray(sample_weights, dtype=np.float64)
+        self.fetch_fns = fetch_fns
+        self.max_skew = max_skew
+        self.queues = {name: queue.Queue(maxsize=prefetch_size) for name in self.dataset_names}
+        self.ready = threading.Condition()
+        self.stop_event = threading.Event()
+        self.exhausted = set()
+
+        self.stats = {
+            name: {
+                "drawn": 0,         # episodes drawn from this dataset
+                "starved": 0,       # draws that found the queue empty
+                "produced": 0,      # episodes processed by the thread
+                "skipped": 0,       # episodes skipped, e.g., too short
+                "steps": 0,         # steps of the produced episodes
+                "busy_time": 0.0,   # seconds spent in fetching
+            } for name in self.dataset_names
+        }
+        self.start_time = time.time()
+        self.threads = []
+        for name in self.dataset_names:
+            thread = threading.Thread(target=self._worker, args=(name,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _put(self, name, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queues[name].put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            with self.ready:
+                self.ready.notify_all()
+            return True
+        return False
+
+    def _worker(self, name):
+        stats = self.stats[name]
+        while not self.stop_event.is_set():
+            start = time.time()
+            try:
+                episode_steps = self.fetch_fns[name]()
+            except StopIteration:
+                self._put(name, StopIteration())
+                return
+            except BaseException as e:
+                # Raise it in the consumer thread
+                self._put(name, e)
+                return
+            stats["busy_time"] += time.time() - start
+            if episode_steps is None:
+                stats["skipped"] += 1
+                continue
+            stats["produced"] += 1
+            stats["steps"] += len(episode_steps)
+            if not self._put(name, episode_steps):
+                return
+
+    def _pop_ready(self, name):
+        """
+        Pop an episode of the dataset if it is ready, or return None.
+        """
+        try:
+            item = self.queues[name].get_nowait()
+        except queue.Empty:
+            return None
+        if isinstance(item, StopIteration):
+            self.exhausted.add(name)
+            return None
+        if isinstance(item, BaseException):
+            raise item
+        self.stats[name]["drawn"] += 1
+        return item
+
+    def _deficit(self, name):
+        """
+        How many episodes the dataset is drawn behind its share
+        among the datasets that are not exhausted.
+        """
+        active = [n for n in self.dataset_names if n not in self.exhausted]
+        total = sum(self.stats[n]["drawn"] for n in active)
+        weights = {n: w for n, w in zip(self.dataset_names, self.sample_weights)}
+        weight = weights[name] / sum(weights[n] for n in active)
+        return weight * (total + 1) - self.stats[name]["drawn"]
+
+    def sample(self, name):
+        """
+        Get an episode for a draw of the dataset `name`,
+        or None if all the datasets are exhausted.
+        """
+        episode_steps = self._pop_ready(name)
+        if episode_steps is not None:
+            return episode_steps
+        if name not in self.exhausted:
+            self.stats[name]["starved"] += 1
+        while len(self.exhausted) < len(self.dataset_names):
+            candidates = [
+                n for n in self.dataset_names
+                if n not in self.exhausted and not self.queues[n].empty()
+                and (n == name or self._deficit(n) > -self.max_skew)
+            ]
+            # Prefer the drawn dataset, then the one furthest below its share
+            candidates.sort(key=lambda n: (n != name, -self._deficit(n)))
+            for candidate in candidates:
+                episode_steps = self._pop_ready(candidate)
+                if episode_steps is not None:
+                    return episode_steps
+            with self.ready:
+                self.ready.wait(timeout=0.1)
+        return None
+
+    def get_stats(self):
+        """
+        Per-dataset target and realized weights, throughput and starvation counters.
+        """
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        total = max(sum(stats["drawn"] for stats in self.stats.values()), 1)
+        result = {}
+        for name, weight in zip(self.dataset_names, self.sample_weights):
+            stats = self.stats[name]
+            result[name] = {
+                "target_weight": float(weight),
+                "realized_weight": stats["drawn"] / total,
+                "episodes_per_sec": stats["produced"] / elapsed,
+                "steps_per_sec": stats["steps"] / elapsed,
+                "queue_size": self.queues[name].qsize(),
+                "exhausted": name in self.exhausted,
+                **stats,
+            }
+        return result
+
+    def close(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+
+
 class VLADataset:
     """
     This class is used to sample episodes from the embododiment dataset.
     """
-    def __init__(self, seed, dataset_type, repeat=True):
+    def __init__(self, seed, dataset_type, repeat=True, prefetch_size=EPSD_PREFETCH_SIZE):
         '''
         seed: the random seed
         dataset_type: 'pretrain' or 'finetune', which dataset to load
         repeat: whether to repeat to infinite length
+        prefetch_size: the number of processed episodes to prefetch for each
+            dataset by a background thread, 0 to load them synchronously
         '''
         dataset_names_cfg = 'configs/pretrain_datasets.json' \
             if dataset_type == "pretrain" else 'configs/finetune_datasets.json'
@@ -71,30 +298,7 @@ class VLADataset:
 
         self.name2dataset = {}
         for dataset_name in self.dataset_names:
-            if dataset_name in DATASET_NAMES_NOOPENX:
-                dataset = globals()[dataset_name].load_dataset(seed)
-            else:
-                dataset_path = dataset_to_path(dataset_name, self.openx_dir)
-                dataset = tfds.builder_from_directory(builder_dir=dataset_path)
-                dataset = dataset.as_dataset(split='all', shuffle_files=True)
-                
-                # You can add filter for other datasets
-                if dataset_name == 'kuka':
-                    dataset = dataset.filter(
-                        lambda x: x['success'])
-                elif dataset_name == 'bc_z':
-                    dataset = dataset.filter(
-                        lambda x: tf.math.greater(
-                            next(iter(x['steps']))['observation']['episode_success'], 0.5))
-                elif dataset_name == 'ucsd_pick_and_place_dataset_converted_externally_to_rlds':
-                    dataset = dataset.filter(
-                        lambda x: x['episode_metadata']['success'])
-                elif dataset_name == 'utokyo_xarm_bimanual_converted_externally_to_rlds':
-                    # Only preserve the meaningful episodes
-                    dataset = dataset.filter(
-                        lambda x: tf.math.equal(
-                            next(iter(x['steps']))['language_instruction'],
-                            tf.constant('Unfold a wrinkled towel.')))
+            dataset = load_raw_dataset(dataset_name, seed, self.openx_dir)
 
             # Note: use cache() will cause the unexpected crash
             # dataset = dataset.map().cache().shuffle().repeat()
@@ -117,23 +321,53 @@ class VLADataset:
         sample_weights = np.array(sample_weights)
         self.sample_weights = sample_weights / np.sum(sample_weights)
 
+        self.sampler = None
+        if prefetch_size > 0:
+            self.sampler = WeightedEpisodeSampler(
+                self.dataset_names, self.sample_weights,
+                {name: (lambda name=name: self.fetch_episode(name)) for name in self.dataset_names},
+                prefetch_size)
+
+    def fetch_episode(self, dataset_name):
+        '''
+        Load the next episode of a dataset as a list of steps,
+        or None if it is too short.
+        '''
+        episode = next(self.name2dataset[dataset_name])
+        if dataset_name == "agilex":
+            episode_steps = flatten_episode_agilex(episode)
+        else:
+            episode_steps = flatten_episode(episode)
+        # Filter too short
+        if len(episode_steps) < self.epsd_len_thresh_low:
+            return None
+        # Randomly sample too long
+        if len(episode_steps) > self.epsd_len_thresh_high:
+            episode_steps = random.sample(episode_steps, self.epsd_len_thresh_high)
+        return episode_steps
+
+    def get_stats(self):
+        '''
+        Per-dataset sampling statistics, or None without prefetching.
+        '''
+        if self.sampler is None:
+            return None
+        return self.sampler.get_stats()
+
     def __iter__(self):
         '''
         Sample batches of episodes for an epoch.
         '''
         while True:
             dataset_name = np.random.choice(self.dataset_names, p=self.sample_weights)
-            episode = next(self.name2dataset[dataset_name])
-            if dataset_name == "agilex":
-                episode_steps = flatten_episode_agilex(episode)
+            if self.sampler is not None:
+                episode_steps = self.sampler.sample(dataset_name)
+                if episode_steps is None:
+                    return
             else:
-                episode_steps = flatten_episode(episode)
-            # Filter too short
-            if len(episode_steps) < self.epsd_len_thresh_low:
-                continue
-            # Randomly sample too long
-            if len(episode_steps) > self.epsd_len_thresh_high:
-                episode_steps = random.sample(episode_steps, self.epsd_len_thresh_high)
+                episode_steps = self.fetch_episode(dataset_name)
+                if episode_steps is None:
+                    continue
                 
             yield episode_steps
 
@@ -52,3 +52,5 @@ deepspeed --hostfile=hostfile.txt main.py \
     # Use this to load from saved lanuage instruction embeddings,
     # instead of calculating it during training
     # --precomp_lang_embed \
+    # Use this to read them from one file built by scripts/build_lang_embed_store.py
+    # --lang_embed_path="data/datasets/lang_embeds" \
@@ -166,6 +166,25 @@ def parse_args(input_args=None):
         default=False,
         help="Whether or not to use precomputed language embeddings.",
     )
+    parser.add_argument(
+        "--lang_embed_path",
+        type=str,
+        default=None,
+        help=(
+            "Path to the consolidated language embeddings (see scripts/build_lang_embed_store.py), "
+            "which are read instead of the individual .pt files. Requires `--precomp_lang_embed`."
+        ),
+    )
+    parser.add_argument(
+        "--image_embed_path",
+        type=str,
+        default=None,
+        help=(
+            "Path to the precomputed image embeddings (see scripts/encode_image_embeds.py), "
+            "which replace the vision encoder forward passes. Only supported with `--load_from_hdf5`. "
+            "If `--image_aug` is set, the training images are still encoded on the fly."
+        ),
+    )
     parser.add_argument(
         "--scale_lr",
         action="store_true",
@@ -1,5 +1,7 @@
 # Reference: DiffusionPolicy [https://github.com/real-stanford/diffusion_policy]
 
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from torch.nn.modules.batchnorm import _BatchNorm
 
@@ -15,7 +17,9 @@ class EMAModel:
         inv_gamma=1.0,
         power=2 / 3,
         min_value=0.0,
-        max_value=0.9999
+        max_value=0.9999,
+        update_every=1,
+        offload=False
     ):
         """
         @crowsonkb's notes on EMA Warmup:
@@ -27,7 +31,17 @@ class EMAModel:
             inv_gamma (float): Inverse multiplicative factor of EMA warmup. Default: 1.
             power (float): Exponential factor of EMA warmup. Default: 2/3.
             min_value (float): The minimum EMA decay rate. Default: 0.
+            update_every (int): Update the averaged weights every `update_every` steps,
+                with the product of the decays of all these steps. Since the weights
+                of the skipped steps are not seen, this approximates the per-step
+                average, mostly during warmup when the decay changes fast. Default: 1.
+            offload (bool): Keep the averaged model on CPU (in pinned memory if CUDA is
+                available). The weights are copied from the device without blocking and
+                averaged in a background thread, call `synchronize` before reading them.
+                Default: False.
         """
+        if update_every < 1:
+            raise ValueError("`update_every` must be at least 1.")
 
         self.averaged_model = model
         self.averaged_model.eval()
@@ -39,9 +53,22 @@ class EMAModel:
         self.min_value = min_value
         self.max_value = max_value
 
+        self.update_every = update_every
+        self.offload = offload
+
         self.decay = 0.0
         self.optimization_step = 0
 
+        # The flat lists of the parameters, built at the first step
+        self._model_id = None
+        self._params, self._ema_params = [], []
+        # Whether to copy rather than average each parameter
+        self._copy_flags = []
+        # Pinned CPU buffers the weights are copied into (offload only)
+        self._staging = None
+        self._executor = ThreadPoolExecutor(max_workers=1) if offload else None
+        self._pending = None
+
     def get_decay(self, optimization_step):
         """
         Compute the decay factor for the exponential moving average.
@@ -54,36 +81,86 @@ class EMAModel:
 
         return max(self.min_value, min(value, self.max_value))
 
-    @torch.no_grad()
-    def step(self, new_model):
-        self.decay = self.get_decay(self.optimization_step)
-
-        # old_all_dataptrs = set()
-        # for param in new_model.parameters():
-        #     data_ptr = param.data_ptr()
-        #     if data_ptr != 0:
-        #         old_all_dataptrs.add(data_ptr)
-
-        all_dataptrs = set()
-        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):            
+    def _build_param_lists(self, new_model):
+        self._params, self._ema_params, self._copy_flags = [], [], []
+        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):
             for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
                 # iterative over immediate parameters only.
                 if isinstance(param, dict):
                     raise RuntimeError('Dict parameter not supported')
-                
-                # data_ptr = param.data_ptr()
-                # if data_ptr != 0:
-                #     all_dataptrs.add(data_ptr)
-
-                if isinstance(module, _BatchNorm):
-                    # skip batchnorms
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                elif not param.requires_grad:
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - self.decay)
-
-        # verify that iterating over module and then parameters is identical to parameters recursively.
-        # assert old_all_dataptrs == all_dataptrs
+                self._params.append(param)
+                self._ema_params.append(ema_param)
+                # skip batchnorms and frozen parameters
+                self._copy_flags.append(isinstance(module, _BatchNorm) or not param.requires_grad)
+        self._model_id = id(new_model)
+
+        if self.offload:
+            pin = torch.cuda.is_available()
+            for ema_param in self._ema_params:
+                ema_param.data = ema_param.data.to("cpu")
+                if pin and not ema_param.data.is_pinned():
+                    ema_param.data = ema_param.data.pin_memory()
+            self._staging = [
+                torch.empty_like(ema_param, pin_memory=pin) for ema_param in self._ema_params]
+
+    @staticmethod
+    def _update(ema_params, params, copy_flags, decay):
+        avg_ema, avg_new = [], []
+        for ema_param, param, copy in zip(ema_params, params, copy_flags):
+            if copy:
+                ema_param.copy_(param)
+            else:
+                avg_ema.append(ema_param)
+                avg_new.append(param)
+        if len(avg_ema) > 0:
+            # ema = decay * ema + (1 - decay) * new, in the same order as
+            # the per-parameter update so that the results are the same
+            torch._foreach_mul_(avg_ema, decay)
+            torch._foreach_add_(avg_ema, avg_new, alpha=1 - decay)
+
+    def _update_offloaded(self, decay, event):
+        if event is not None:
+            event.synchronize()
+        self._update(self._ema_params, self._staging, self._copy_flags, decay)
+
+    def synchronize(self):
+        """
+        Wait for the pending update of the offloaded weights.
+        """
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    @torch.no_grad()
+    def step(self, new_model):
+        if id(new_model) != self._model_id:
+            self.synchronize()
+            self._build_param_lists(new_model)
+
+        if self.optimization_step % self.update_every == 0:
+            # The decay of the steps since the last update
+            self.decay = 1.0
+            for step in range(self.optimization_step - self.update_every + 1,
+                              self.optimization_step + 1):
+                self.decay *= self.get_decay(step)
+            params = [
+                param.data.to(dtype=ema_param.dtype)
+                for param, ema_param in zip(self._params, self._ema_params)
+            ]
+            if not self.offload:
+                self._update(self._ema_params, params, self._copy_flags, self.decay)
+            else:
+                # The staging buffers are still read by the pending update
+                self.synchronize()
+                for buffer, param in zip(self._staging, params):
+                    buffer.copy_(param, non_blocking=True)
+                event = None
+                if any(param.is_cuda for param in params):
+                    # Recorded after the copies on the current stream, which are
+                    # ordered before the later updates of the parameters
+                    event = torch.cuda.Event()
+                    event.record()
+                self._pending = self._executor.submit(
+                    self._update_offloaded, self.decay, event)
+
         self.optimization_step += 1
@@ -0,0 +1,181 @@
+import math
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from torchvision.transforms import InterpolationMode
+
+
+PIL_RESAMPLE_TO_INTERPOLATION = {
+    0: InterpolationMode.NEAREST,
+    2: InterpolationMode.BILINEAR,
+    3: InterpolationMode.BICUBIC,
+}
+
+
+class BatchImagePreprocessor:
+    """
+    A batched equivalent of the per-image pipeline
+        (resize) -> (brightness adjustment) -> expand2square -> `image_processor.preprocess`
+
+    The frames are converted into uint8 tensors once and every step
+    runs on all the frames of the same shape at the same time.
+    The output matches `SiglipImageProcessor` up to the interpolation
+    differences between torchvision (antialiased) and PIL.
+    """
+    def __init__(self, image_processor, image_size=None,
+                 image_aspect_ratio='pad', auto_adjust_image_brightness=False,
+                 brightness_thresh=0.15, brightness_factor=1.75):
+        self.height = image_processor.size["height"]
+        self.width = image_processor.size["width"]
+        self.interpolation = PIL_RESAMPLE_TO_INTERPOLATION[image_processor.resample]
+        self.rescale_factor = image_processor.rescale_factor
+        self.image_mean = torch.tensor(
+            image_processor.image_mean, dtype=torch.float32).reshape(1, 3, 1, 1)
+        self.image_std = torch.tensor(
+            image_processor.image_std, dtype=torch.float32).reshape(1, 3, 1, 1)
+        self.background_color = tuple(int(x*255) for x in image_processor.image_mean)
+
+        self.image_size = image_size
+        self.image_aspect_ratio = image_aspect_ratio
+        self.auto_adjust_image_brightness = auto_adjust_image_brightness
+        self.brightness_thresh = brightness_thresh
+        self.brightness_factor = brightness_factor
+
+    def background_image(self):
+        """
+        Return the (H, W, 3) uint8 background image used for invalid frames.
+        """
+        return np.broadcast_to(
+            np.array(self.background_color, dtype=np.uint8),
+            (self.height, self.width, 3)).copy()
+
+    def min_frame_size(self, width, height):
+        """
+        The smallest (width, height) that a (width, height) frame can be
+        scaled down to before the pipeline without upsampling it, e.g.,
+        for a reduced-size JPEG decode.
+        """
+        if isinstance(self.image_size, (list, tuple)):
+            # Resized to (height, width)
+            ratio = max(self.image_size[1] / width, self.image_size[0] / height)
+        elif self.image_size is not None:
+            # Resized so that the shorter side is `image_size`
+            ratio = self.image_size / min(width, height)
+        elif self.image_aspect_ratio == 'pad':
+            # Padded to a square and resized to the input size
+            ratio = max(self.height, self.width) / max(width, height)
+        else:
+            ratio = max(self.width / width, self.height / height)
+        ratio = min(ratio, 1.0)
+        return math.ceil(width * ratio), math.ceil(height * ratio)
+
+    @staticmethod
+    def _group_by_shape(images):
+        groups = {}
+        for idx, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(idx)
+        return groups.values()
+
+    @staticmethod
+    def _to_tensor(images, indices):
+        # (N, H, W, 3) uint8 -> (N, 3, H, W) uint8
+        batch = np.stack([images[i] for i in indices], axis=0)
+        return torch.from_numpy(batch).permute(0, 3, 1, 2)
+
+    def _resize(self, images):
+        # The same as `transforms.Resize(self.image_size)` on a PIL image
+        return TF.resize(images, self.image_size, antialias=True)
+
+    def _adjust_brightness(self, images, adjust):
+        # `adjust`: (N,) bool, frames that are allowed to be adjusted
+        brightness = images.float().mean(dim=(1, 2, 3)) / 255.0
+        dark = adjust & (brightness <= self.brightness_thresh)
+        if dark.any():
+            # Same as PIL's ImageEnhance.Brightness (truncated to uint8)
+            images[dark] = (images[dark].float() * self.brightness_factor
+                            ).clamp_(0, 255).to(torch.uint8)
+        return images
+
+    def _expand2square(self, images):
+        N, C, H, W = images.shape
+        if H == W:
+            return images
+        size = max(H, W)
+        result = torch.tensor(
+            self.background_color, dtype=torch.uint8).reshape(1, C, 1, 1).repeat(N, 1, size, size)
+        top, left = (size - H) // 2, (size - W) // 2
+        result[:, :, top:top+H, left:left+W] = images
+        return result
+
+    def adjust(self, images, valid=None):
+        """
+        Resize the frames to `image_size` (if set) and brighten the dark ones.
+
+        Args:
+            images: a list of (H, W, 3) uint8 arrays
+            valid: a list of bools, only valid frames are brightened.
+                Default is all True.
+
+        Returns:
+            a list of (H', W', 3) uint8 arrays
+        """
+        if self.image_size is None and not self.auto_adjust_image_brightness:
+            return list(images)
+        if valid is None:
+            valid = [True] * len(images)
+
+        outputs = [None] * len(images)
+        for indices in self._group_by_shape(images):
+            batch = self._to_tensor(images, indices)
+            if self.image_size is not None:
+                batch = self._resize(batch)
+            if self.auto_adjust_image_brightness:
+                adjust = torch.tensor([bool(valid[i]) for i in indices])
+                batch = self._adjust_brightness(batch, adjust)
+            batch = batch.permute(0, 2, 3, 1).numpy()
+            for i, idx in enumerate(indices):
+                outputs[idx] = batch[i]
+        return outputs
+
+    def finalize(self, images, out=None):
+        """
+        Pad the frames to square, resize them to the input size
+        of the vision encoder, rescale and normalize.
+
+        Args:
+            images: a list of (H, W, 3) uint8 arrays
+            out: optional preallocated (N, 3, height, width) float32 tensor
+                to write the output into, e.g., a pinned buffer
+
+        Returns:
+            pixel_values: (N, 3, height, width) float32 tensor
+        """
+        shape = (len(images), 3, self.height, self.width)
+        if out is None:
+            pixel_values = torch.empty(shape, dtype=torch.float32)
+        elif tuple(out.shape) != shape or out.dtype != torch.float32:
+            raise ValueError(f"`out` must be a float32 tensor of shape {shape}.")
+        else:
+            pixel_values = out
+        for indices in self._group_by_shape(images):
+            batch = self._to_tensor(images, indices)
+            if self.image_aspect_ratio == 'pad':
+                batch = self._expand2square(batch)
+            if tuple(batch.shape[-2:]) != (self.height, self.width):
+                batch = TF.resize(
+                    batch, [self.height, self.width],
+                    interpolation=self.interpolation, antialias=True)
+            pixel_values[list(indices)] = batch.float()
+        pixel_values.mul_(self.rescale_factor)
+        pixel_values.sub_(self.image_mean).div_(self.image_std)
+        return pixel_values
+
+    def __call__(self, images, valid=None, out=None):
+        """
+        Run the full pipeline on a list of (H, W, 3) uint8 arrays.
+
+        Returns:
+            pixel_values: (N, 3, height, width) float32 tensor
+        """
+        return self.finalize(self.adjust(images, valid), out=out)
@@ -1,9 +1,18 @@
+import os
+
 import torch
 from transformers import AutoTokenizer, T5EncoderModel
 
 
 class T5Embedder:
-    available_models = ["google/t5-v1_1-xxl"]
+    available_models = [
+        "google/t5-v1_1-xxl",
+        # Smaller models, e.g., for testing on CPU
+        "google/t5-v1_1-xl",
+        "google/t5-v1_1-large",
+        "google/t5-v1_1-base",
+        "google/t5-v1_1-small",
+    ]
 
     def __init__(
         self,
@@ -70,7 +79,7 @@ class T5Embedder:
         self.use_text_preprocessing = use_text_preprocessing
         self.hf_token = hf_token
 
-        assert from_pretrained in self.available_models
+        assert from_pretrained in self.available_models or os.path.isdir(from_pretrained)
         self.tokenizer = AutoTokenizer.from_pretrained(
             from_pretrained,
             model_max_length=model_max_length,
@@ -0,0 +1,183 @@
+"""
+An opt-in latency profiler of the inference path.
+
+The stages of `RoboticDiffusionTransformerModel.step` (scripts/agilex_model.py)
+and `RDTRunner.predict_action` are wrapped in `profile_region`, which does
+nothing unless a profiler is enabled:
+
+    profiler = LatencyProfiler()
+    with profiler.enable(blocks=policy.policy.model.blocks):
+        policy.step(proprio, images, text_embeds)
+    print(profiler.format_summary())
+    profiler.export_chrome_trace("trace.json")   # open in chrome://tracing or Perfetto
+
+With `blocks`, the attention, cross-attention and FFN of every block are
+timed with forward hooks, which are removed when the profiler is disabled.
+The fused blocks (`fused_blocks: true`) do not call their submodules, so
+only the whole blocks are timed, and a compiled denoising step (see
+`RDTRunner.enable_compiled_sampler`) is only timed as a whole.
+
+By default, the device is synchronized at the start and the end of every
+region, so that each region is charged with its own kernels. This slows
+down the profiled run, mostly with the per-block timings.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+from models.rdt.blocks import FusedRDTBlock
+
+
+_active_profiler = None
+_null_region = contextlib.nullcontext()
+
+
+def get_profiler():
+    return _active_profiler
+
+
+def profile_region(name, **args):
+    """
+    Time the enclosed code as `name` if a profiler is enabled.
+    `args` are shown in the trace (e.g., the index of a denoising step).
+    """
+    profiler = _active_profiler
+    if profiler is None:
+        return _null_region
+    return profiler.region(name, **args)
+
+
+class LatencyProfiler:
+    def __init__(self, sync=True, max_events=100000):
+        """
+        Args:
+            sync: whether to synchronize the CUDA device around every region.
+            max_events: the maximum number of kept events, the oldest
+                ones are dropped first.
+        """
+        self.sync = sync and torch.cuda.is_available()
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin_ns = time.perf_counter_ns()
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter_ns()
+
+    def _add_event(self, name, start_ns, end_ns, args):
+        event = (name, start_ns, end_ns, threading.get_ident(), args)
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def region(self, name, **args):
+        start_ns = self._now()
+        try:
+            yield
+        finally:
+            self._add_event(name, start_ns, self._now(), args)
+
+    def _hook_module(self, module, name, args):
+        def pre_hook(module, inputs):
+            stack = getattr(self.local, "stack", None)
+            if stack is None:
+                stack = self.local.stack = []
+            stack.append(self._now())
+
+        def hook(module, inputs, output):
+            self._add_event(name, self.local.stack.pop(), self._now(), args)
+
+        return [module.register_forward_pre_hook(pre_hook),
+                module.register_forward_hook(hook)]
+
+    @contextlib.contextmanager
+    def enable(self, blocks=None):
+        """
+        Enable the profiler in the enclosed code (in all the threads).
+
+        Args:
+            blocks: optional, the RDT blocks (e.g., `runner.model.blocks`)
+                whose sublayers are timed.
+        """
+        global _active_profiler
+        handles = []
+        for idx, block in enumerate(blocks if blocks is not None else []):
+            handles += self._hook_module(block, "block", {"block": idx})
+            if isinstance(block, FusedRDTBlock):
+                continue
+            for sublayer in ("attn", "cross_attn", "ffn"):
+                handles += self._hook_module(
+                    getattr(block, sublayer), f"block.{sublayer}", {"block": idx})
+        previous, _active_profiler = _active_profiler, self
+        try:
+            yield self
+        finally:
+            _active_profiler = previous
+            for handle in handles:
+                handle.remove()
+
+    def summary(self):
+        """
+        Return {name: {count, total, mean, p50, p90, p99, max}} of the
+        durations in milliseconds, in the order the names first occur.
+        """
+        with self.lock:
+            events = list(self.events)
+        durations = {}
+        for name, start_ns, end_ns, _, _ in events:
+            durations.setdefault(name, []).append((end_ns - start_ns) / 1e6)
+        summary = {}
+        for name, values in durations.items():
+            values = np.array(values)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            summary[name] = {
+                "count": len(values),
+                "total": float(values.sum()),
+                "mean": float(values.mean()),
+                "p50": float(p50),
+                "p90": float(p90),
+                "p99": float(p99),
+                "max": float(values.max()),
+            }
+        return summary
+
+    def format_summary(self):
+        lines = [f"{'region':<24}{'count':>8}{'mean':>10}{'p50':>10}"
+                 f"{'p90':>10}{'p99':>10}{'max':>10}  (ms)"]
+        for name, stats in self.summary().items():
+            lines.append(
+                f"{name:<24}{stats['count']:>8}{stats['mean']:>10.3f}{stats['p50']:>10.3f}"
+                f"{stats['p90']:>10.3f}{stats['p99']:>10.3f}{stats['max']:>10.3f}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """
+        Write the events in the Chrome trace event format.
+        """
+        with self.lock:
+            events = list(self.events)
+        trace_events = [{
+            "name": name,
+            "ph": "X",
+            "ts": (start_ns - self.origin_ns) / 1e3,
+            "dur": (end_ns - start_ns) / 1e3,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args,
+        } for name, start_ns, end_ns, tid, args in events]
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+        os.replace(tmp_path, path)
@@ -12,13 +12,18 @@
 
 
 import math
+import warnings
 from collections import OrderedDict
+from typing import NamedTuple
 
 import numpy as np
+import timm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from packaging.version import Version
 from torch.jit import Final
+from timm.layers import fast_norm
 from timm.models.vision_transformer import Attention, Mlp, RmsNorm, use_fused_attn
 
 
@@ -69,6 +74,83 @@ class TimestepEmbedder(nn.Module):
 #################################################################################
 #                          Cross Attention Layers                               #
 #################################################################################
+class PackedCond(NamedTuple):
+    """
+    Variable-length condition tokens (e.g., language) of a batch packed
+    without the padding, like the `cu_seqlens` of varlen attention kernels.
+    
+    values: (T, ...), the valid tokens of all the samples, T = mask.sum().
+    offsets: (B + 1,), the tokens of sample b are values[offsets[b]:offsets[b+1]].
+    positions: (T,), the position of each token in its (padded) sample.
+    mask: (B, L), the mask of the padded tokens (True for valid).
+    """
+    values: torch.Tensor
+    offsets: torch.Tensor
+    positions: torch.Tensor
+    mask: torch.Tensor
+
+    @classmethod
+    def pack(cls, tokens: torch.Tensor, mask: torch.Tensor) -> "PackedCond":
+        """
+        Pack the (B, L, ...) tokens whose (B, L) mask is True.
+        """
+        offsets = F.pad(mask.sum(dim=1).cumsum(dim=0), (1, 0))
+        positions = mask.nonzero()[:, 1]
+        return cls(tokens[mask], offsets, positions, mask)
+
+    def unpack(self, values: torch.Tensor) -> torch.Tensor:
+        """
+        Scatter the (T, ...) packed values to (B, L, ...) padded with zeros.
+        """
+        padded = values.new_zeros(self.mask.shape + values.shape[1:])
+        padded[self.mask] = values
+        return padded
+
+
+def _nested_sdpa_available():
+    """
+    Whether `scaled_dot_product_attention` supports jagged nested tensors.
+    """
+    try:
+        with torch.no_grad(), warnings.catch_warnings():
+            # The nested tensors may warn about the prototype API
+            warnings.simplefilter("ignore")
+            offsets = torch.tensor([0, 1, 3])
+            x = torch.nested.nested_tensor_from_jagged(
+                torch.zeros(3, 1, 8), offsets).transpose(1, 2)
+            F.scaled_dot_product_attention(x, x, x)
+        return True
+    except Exception:
+        return False
+
+
+NESTED_SDPA = _nested_sdpa_available()
+
+
+def to_jagged(x: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+    """
+    (T, num_heads, head_dim) packed tokens -> (B, num_heads, j, head_dim) jagged tensor.
+    """
+    return torch.nested.nested_tensor_from_jagged(x.contiguous(), offsets).transpose(1, 2)
+
+
+def jagged_cross_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                           dropout_p: float = 0.) -> torch.Tensor:
+    """
+    Attend the queries of each sample to its variable-length keys and values.
+    
+    q: (B, N, num_heads, head_dim), dense queries.
+    k, v: (B, num_heads, j, head_dim), jagged keys and values from `to_jagged`.
+    return: (B, num_heads, N, head_dim)
+    """
+    B, N, H, D = q.shape
+    q_offsets = torch.arange(0, (B + 1) * N, N, device=q.device)
+    q = torch.nested.nested_tensor_from_jagged(
+        q.reshape(B * N, H, D).contiguous(), q_offsets).transpose(1, 2)
+    x = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+    return x.transpose(1, 2).values().view(B, N, H, D).transpose(1, 2)
+
+
 class CrossAttention(nn.Module):
     """
     A cross-attention layer with flash attention.
@@ -99,19 +181,38 @@ class CrossAttention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
     
-    def forward(self, x: torch.Tensor, c: torch.Tensor, 
-                mask: torch.Tensor | None = None) -> torch.Tensor:
-        B, N, C = x.shape
-        _, L, _ = c.shape
-        q = self.q(x).reshape(B, N, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+    def project_kv(self, c: torch.Tensor | PackedCond) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Project the condition tokens to (normalized) keys and values.
+        
+        c: (B, L, C), condition tokens, or `PackedCond` of (T, C) tokens.
+        return: k, v of shape (B, num_heads, L, head_dim). For packed tokens,
+            they are jagged tensors if supported, or padded otherwise
+            (the padding is projected as zeros and masked in `forward`).
+        """
+        if isinstance(c, PackedCond):
+            kv = self.kv(c.values).reshape(-1, 2, self.num_heads, self.head_dim)
+            k, v = kv.unbind(1)
+            k = self.k_norm(k)
+            if NESTED_SDPA:
+                return to_jagged(k, c.offsets), to_jagged(v, c.offsets)
+            return c.unpack(k).transpose(1, 2), c.unpack(v).transpose(1, 2)
+        B, L, _ = c.shape
         kv = self.kv(c).reshape(B, L, 2, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
         k, v = kv.unbind(0)
-        q, k = self.q_norm(q), self.k_norm(k)
+        k = self.k_norm(k)
+        return k, v
+    
+    def _attend(self, q, k, v, mask):
+        """
+        Attend to the padded keys and values with the condition mask.
+        """
+        B, L = q.shape[0], k.shape[2]
 
-        # Prepare attn mask (B, L) to mask the conditioion
+        # Prepare attn mask (B, L) to mask the conditioion,
+        # which is broadcast over the heads and queries
         if mask is not None:
             mask = mask.reshape(B, 1, 1, L)
-            mask = mask.expand(-1, -1, N, -1)
         
         if self.fused_attn:
             x = F.scaled_dot_product_attention(
@@ -130,7 +231,33 @@ class CrossAttention(nn.Module):
             if self.attn_drop.p > 0:
                 attn = self.attn_drop(attn)
             x = attn @ v
-            
+        return x
+
+    def forward(self, x: torch.Tensor, c: torch.Tensor | None, 
+                mask: torch.Tensor | None = None,
+                kv: tuple[torch.Tensor, torch.Tensor] | None = None) -> torch.Tensor:
+        """
+        x: (B, N, C), query tokens.
+        c: (B, L, C), `PackedCond` or None, condition tokens. Ignored if `kv` is given.
+        mask: (B, L), (B, 1, 1, L) or None, condition mask (True for valid).
+            Not needed for jagged keys and values.
+        kv: a precomputed (k, v) pair returned by `project_kv`, or None.
+        """
+        B, N, C = x.shape
+        q = self.q(x).reshape(B, N, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+        q = self.q_norm(q)
+        if kv is None:
+            kv = self.project_kv(c)
+        k, v = kv
+
+        if k.is_nested:
+            # Variable-length conditions without padding
+            x = jagged_cross_attention(
+                q.transpose(1, 2), k, v,
+                dropout_p=self.attn_drop.p if self.training else 0.)
+        else:
+            x = self._attend(q, k, v, mask)
+        
         x = x.permute(0, 2, 1, 3).reshape(B, N, C)
         x = self.proj(x)
         if self.proj_drop.p > 0:
@@ -164,7 +291,7 @@ class RDTBlock(nn.Module):
             act_layer=approx_gelu, drop=0)
         self.norm3 = RmsNorm(hidden_size, eps=1e-6)
 
-    def forward(self, x, c, mask=None):
+    def forward(self, x, c, mask=None, kv=None):
         origin_x = x
         x = self.norm1(x)
         x = self.attn(x)
@@ -172,7 +299,7 @@ class RDTBlock(nn.Module):
         
         origin_x = x
         x = self.norm2(x)
-        x = self.cross_attn(x, c, mask)
+        x = self.cross_attn(x, c, mask, kv=kv)
         x = x + origin_x
                 
         origin_x = x
@@ -183,6 +310,114 @@ class RDTBlock(nn.Module):
         return x
 
 
+def _rms_norm_uses_var():
+    """
+    Whether `RmsNorm` normalizes by the (unbiased) variance rather than the
+    mean square: the fallback `timm.layers.fast_norm.rms_norm` used without
+    apex does before timm 1.0.13.
+    """
+    return Version(timm.__version__) < Version("1.0.13") \
+        and not fast_norm.has_apex_rmsnorm
+
+
+_RMS_NORM_USES_VAR = _rms_norm_uses_var()
+
+
+def rms_scale(x: torch.Tensor, eps: float) -> torch.Tensor:
+    """
+    The per-token scale of `RmsNorm` without the weight, of shape (..., 1).
+    """
+    if _RMS_NORM_USES_VAR:
+        return torch.rsqrt(torch.var(x, dim=-1, keepdim=True) + eps)
+    return torch.rsqrt(x.pow(2).mean(dim=-1, keepdim=True) + eps)
+
+
+class FusedRDTBlock(RDTBlock):
+    """
+    A RDT block with the same parameters as `RDTBlock` (so it loads the same
+    checkpoints) and a fused forward pass:
+    - Each RmsNorm is folded into the following projection: the norm weight
+      is multiplied into the columns of the projection weight, and the
+      per-token scale is applied to the projection output, so the
+      normalized tokens are never materialized.
+    - The packed QKV projection is split into heads with views, and the
+      attention runs as a single `scaled_dot_product_attention` call.
+    - The condition mask is expected in the (B, 1, 1, L) layout prepared
+      once per forward pass by `RDT`, and is broadcast over the queries.
+    In inference, the folded weights are cached until the parameters change
+    or the block is moved or cast, and the cache is dropped in training.
+    """
+    def __init__(self, hidden_size, num_heads, **block_kwargs):
+        super().__init__(hidden_size, num_heads, **block_kwargs)
+        # The name of the linear -> (version of the weights, folded weight)
+        self._folded_weights = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        # `.to()`, `.half()`, etc. replace the parameters
+        self._folded_weights.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _folded_weight(self, name, norm, linear):
+        if torch.is_grad_enabled():
+            self._folded_weights.clear()
+            return linear.weight * norm.weight
+        version = (norm.weight._version, linear.weight._version,
+                   norm.weight.data_ptr(), linear.weight.data_ptr())
+        cached = self._folded_weights.get(name)
+        if cached is None or cached[0] != version:
+            # Drop the stale weight before folding the new one
+            self._folded_weights.pop(name, None)
+            cached = (version, linear.weight * norm.weight)
+            self._folded_weights[name] = cached
+        return cached[1]
+
+    def _norm_linear(self, x, name, norm, linear):
+        """
+        Compute `linear(norm(x))` with the norm folded into the linear.
+        """
+        y = F.linear(x, self._folded_weight(name, norm, linear))
+        scale = rms_scale(x, norm.eps)
+        if linear.bias is None:
+            return y * scale
+        return torch.addcmul(linear.bias, y, scale)
+
+    def forward(self, x, c, mask=None, kv=None):
+        B, N, C = x.shape
+        attn, cross_attn = self.attn, self.cross_attn
+        num_heads, head_dim = attn.num_heads, attn.head_dim
+
+        # Self-attention, (B, N, 3, H, head_dim) -> q, k, v of (B, N, H, head_dim)
+        qkv = self._norm_linear(x, "qkv", self.norm1, attn.qkv).view(B, N, 3, num_heads, head_dim)
+        q, k, v = qkv.unbind(2)
+        q, k = attn.q_norm(q), attn.k_norm(k)
+        h = F.scaled_dot_product_attention(
+            q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2),
+            dropout_p=attn.attn_drop.p if self.training else 0.)
+        x = x + attn.proj_drop(attn.proj(h.transpose(1, 2).reshape(B, N, C)))
+
+        # Cross-attention
+        q = self._norm_linear(x, "q", self.norm2, cross_attn.q).view(B, N, num_heads, head_dim)
+        q = cross_attn.q_norm(q)
+        if kv is None:
+            kv = cross_attn.project_kv(c)
+        k, v = kv
+        dropout_p = cross_attn.attn_drop.p if self.training else 0.
+        if k.is_nested:
+            h = jagged_cross_attention(q, k, v, dropout_p=dropout_p)
+        else:
+            if mask is not None and mask.dim() == 2:
+                mask = mask[:, None, None, :]
+            h = F.scaled_dot_product_attention(
+                q.transpose(1, 2), k, v, attn_mask=mask, dropout_p=dropout_p)
+        x = x + cross_attn.proj_drop(cross_attn.proj(h.transpose(1, 2).reshape(B, N, C)))
+
+        # FFN
+        ffn = self.ffn
+        h = ffn.drop1(ffn.act(self._norm_linear(x, "fc1", self.norm3, ffn.fc1)))
+        x = x + ffn.drop2(ffn.fc2(ffn.norm(h)))
+        return x
+
+
 class FinalLayer(nn.Module):
     """
     The final layer of RDT.
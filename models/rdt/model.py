@@ -14,7 +14,8 @@ from collections import OrderedDict
 import torch
 import torch.nn as nn
 
-from models.rdt.blocks import (FinalLayer, RDTBlock, TimestepEmbedder,
+from models.rdt.blocks import (FinalLayer, FusedRDTBlock, PackedCond, RDTBlock,
+                               TimestepEmbedder,
                                get_1d_sincos_pos_embed_from_grid,
                                get_multimodal_cond_pos_embed)
 
@@ -34,6 +35,7 @@ class RDT(nn.Module):
         img_cond_len=4096,
         lang_pos_embed_config=None,
         img_pos_embed_config=None,
+        fused_blocks=False,
         dtype=torch.bfloat16
     ):
         super().__init__()
@@ -59,8 +61,10 @@ class RDT(nn.Module):
         self.img_cond_pos_embed = nn.Parameter(
             torch.zeros(1, img_cond_len, hidden_size))
 
+        # The fused blocks have the same parameters, see `FusedRDTBlock`
+        block_cls = FusedRDTBlock if fused_blocks else RDTBlock
         self.blocks = nn.ModuleList([
-            RDTBlock(hidden_size, num_heads) for _ in range(depth)
+            block_cls(hidden_size, num_heads) for _ in range(depth)
         ])
         self.final_layer = FinalLayer(hidden_size, output_dim)
         self.initialize_weights()
@@ -123,7 +127,38 @@ class RDT(nn.Module):
         # Move all the params to given data type:
         self.to(self.dtype)
 
-    def forward(self, x, freq, t, lang_c, img_c, lang_mask=None, img_mask=None):
+    def add_lang_pos_embed(self, lang_c):
+        """
+        Add the position embeddings to the (padded or packed) language tokens.
+        """
+        if isinstance(lang_c, PackedCond):
+            return lang_c._replace(
+                values=lang_c.values + self.lang_cond_pos_embed[0, lang_c.positions])
+        return lang_c + self.lang_cond_pos_embed[:, :lang_c.shape[1]]
+
+    def precompute_cond_kv(self, lang_c, img_c):
+        """
+        Precompute the cross-attention keys and values of every block.
+        
+        The conditions do not change across denoising steps, so the 
+        result can be reused by all the `forward` calls of one sampling.
+        
+        lang_c: (B, L_lang, D) or `PackedCond`, language condition tokens.
+        img_c: (B, L_img, D), image condition tokens.
+        
+        return: a list of (k, v) pairs, one for each block.
+        """
+        lang_c = self.add_lang_pos_embed(lang_c)
+        img_c = img_c + self.img_cond_pos_embed
+
+        conds = [lang_c, img_c]
+        cond_kv = []
+        for i, block in enumerate(self.blocks):
+            cond_kv.append(block.cross_attn.project_kv(conds[i%2]))
+        return cond_kv
+
+    def forward(self, x, freq, t, lang_c, img_c, lang_mask=None, img_mask=None,
+                cond_kv=None):
         """
         Forward pass of RDT.
         
@@ -133,10 +168,14 @@ class RDT(nn.Module):
         t: (B,) or (1,), diffusion timesteps.
         lang_c: (B, L_lang, D) or None, language condition tokens (variable length),
             dimension D is assumed to be the same as the hidden size.
+            It can also be a `PackedCond` of the valid tokens only, which
+            are attended without the padding.
         img_c: (B, L_img, D) or None, image condition tokens (fixed length),
             dimension D is assumed to be the same as the hidden size.
         lang_mask: (B, L_lang) or None, language condition mask (True for valid).
         img_mask: (B, L_img) or None, image condition mask (True for valid).
+        cond_kv: a list of (k, v) pairs from `precompute_cond_kv` or None.
+            If given, `lang_c` and `img_c` are ignored.
         """
         t = self.t_embedder(t).unsqueeze(1)             # (B, 1, D) or (1, 1, D)
         freq = self.freq_embedder(freq).unsqueeze(1)    # (B, 1, D)
@@ -147,16 +186,24 @@ class RDT(nn.Module):
         
         # Add multimodal position embeddings
         x = x + self.x_pos_embed
-        # Note the lang is of variable length
-        lang_c = lang_c + self.lang_cond_pos_embed[:, :lang_c.shape[1]]
-        img_c = img_c + self.img_cond_pos_embed
+        if isinstance(lang_c, PackedCond) and lang_mask is None:
+            lang_mask = lang_c.mask
+        if cond_kv is None:
+            # Note the lang is of variable length
+            lang_c = self.add_lang_pos_embed(lang_c)
+            img_c = img_c + self.img_cond_pos_embed
+            conds = [lang_c, img_c]
+        else:
+            conds = [None, None]
 
         # Forward pass
-        conds = [lang_c, img_c]
-        masks = [lang_mask, img_mask]
+        # Prepare the (B, 1, 1, L) masks once for all the blocks
+        masks = [mask[:, None, None, :] if mask is not None else None
+                 for mask in (lang_mask, img_mask)]
         for i, block in enumerate(self.blocks):
             c, mask = conds[i%2], masks[i%2]
-            x = block(x, c, mask)                       # (B, T+1, D)
+            kv = cond_kv[i] if cond_kv is not None else None
+            x = block(x, c, mask, kv=kv)                # (B, T+1, D)
         # Inject the language condition at the final layer
         x = self.final_layer(x)                         # (B, T+1, out_channels)
 
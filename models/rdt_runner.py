@@ -5,11 +5,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
-from diffusers.schedulers.scheduling_dpmsolver_multistep import \
-    DPMSolverMultistepScheduler
 
 from models.hub_mixin import CompatiblePyTorchModelHubMixin
+from models.profiler import profile_region
+from models.rdt.blocks import PackedCond
 from models.rdt.model import RDT
+from models.samplers import SAMPLERS, build_sampler, get_solver_state, new_solver
 
 
 class RDTRunner(
@@ -34,9 +35,14 @@ class RDTRunner(
             img_cond_len=img_cond_len,
             lang_pos_embed_config=lang_pos_embed_config,
             img_pos_embed_config=img_pos_embed_config,
+            fused_blocks=config['rdt'].get('fused_blocks', False),
             dtype=dtype,
         )
 
+        # Whether to pack the valid language tokens without the padding,
+        # see `PackedCond` in `models/rdt/blocks.py`
+        self.pack_lang_cond = config['rdt'].get('pack_lang_cond', False)
+
         # Create adpators for various conditional inputs
         self.lang_adaptor = self.build_condition_adapter(
             config['lang_adaptor'], 
@@ -63,15 +69,19 @@ class RDTRunner(
             prediction_type=noise_scheduler_config['prediction_type'],
             clip_sample=noise_scheduler_config['clip_sample'],
         )
-        self.noise_scheduler_sample = DPMSolverMultistepScheduler(
-            num_train_timesteps=noise_scheduler_config['num_train_timesteps'],
-            beta_schedule=noise_scheduler_config['beta_schedule'],
-            prediction_type=noise_scheduler_config['prediction_type'],
-        )
-
+        self.noise_scheduler_config = noise_scheduler_config
         self.num_train_timesteps = noise_scheduler_config['num_train_timesteps']
         self.num_inference_timesteps = noise_scheduler_config['num_inference_timesteps']
         self.prediction_type = noise_scheduler_config['prediction_type']
+        # The default sampler, which can be overridden at each `predict_action`
+        self.sampler = noise_scheduler_config.get('sampler', 'dpmsolver++')
+        # (sampler, steps) -> (scheduler, its initial solver state, {device: timesteps})
+        self.sampler_cache = {}
+        self.noise_scheduler_sample, _ = self.get_sampler()
+        
+        # The compiled denoising step, see `enable_compiled_sampler`
+        self.compiled_denoise_step = None
+        self.compiled_signature = None
 
         self.pred_horizon = pred_horizon
         self.action_dim = action_dim
@@ -102,24 +112,128 @@ class RDTRunner(
 
         return projector
     
-    def adapt_conditions(self, lang_tokens, img_tokens, state_tokens):
+    def get_sampler(self, sampler=None, num_inference_timesteps=None, device=None):
+        '''
+        Get a scheduler of a sampler. The scheduler and its timestep tables
+        are built once for each (sampler, steps) pair, and every call returns
+        a copy with its own solver state, which is used for one sampling.
+        
+        sampler: the name of a sampler in `models.samplers.SAMPLERS`,
+            default is `self.sampler`.
+        num_inference_timesteps: the number of denoising steps, default is
+            `self.num_inference_timesteps`. Ignored by fixed-step samplers.
+        device: the device to put the timesteps on. 
+        
+        return: (scheduler, timesteps on the `device`)
+        '''
+        sampler = sampler if sampler is not None else self.sampler
+        if sampler not in SAMPLERS:
+            raise ValueError(
+                f"Unknown sampler: {sampler}, available: {list(SAMPLERS.keys())}")
+        num_steps = SAMPLERS[sampler][2] or num_inference_timesteps \
+            or self.num_inference_timesteps
+        
+        key = (sampler, num_steps)
+        if key not in self.sampler_cache:
+            scheduler, _ = build_sampler(sampler, self.noise_scheduler_config)
+            scheduler.set_timesteps(num_steps)
+            self.sampler_cache[key] = (scheduler, get_solver_state(scheduler), {})
+        scheduler, solver_state, device_timesteps = self.sampler_cache[key]
+        if device not in device_timesteps:
+            device_timesteps[device] = scheduler.timesteps.to(device)
+        return new_solver(scheduler, solver_state), device_timesteps[device]
+    
+    def enable_compiled_sampler(self, mode=None, backend="inductor"):
+        '''
+        Compile the denoising step (state adaptor + RDT) used in sampling
+        with static shapes. The shapes of the first sampling call are
+        captured; later calls with other shapes (e.g., another batch size
+        or instruction length) fall back to the eager model.
+        
+        mode: the `torch.compile` mode. Default is "reduce-overhead" on CUDA,
+            which also captures the step into CUDA graphs, and "default" on CPU.
+        backend: the `torch.compile` backend.
+        '''
+        if mode is None:
+            device = next(self.parameters()).device
+            mode = "reduce-overhead" if device.type == "cuda" else "default"
+        self.compiled_denoise_step = torch.compile(
+            self.denoise_step, mode=mode, backend=backend, 
+            dynamic=False, fullgraph=False)
+        self.compiled_signature = None
+    
+    def disable_compiled_sampler(self):
+        self.compiled_denoise_step = None
+        self.compiled_signature = None
+    
+    def denoise_step(self, noisy_action, action_mask, state_traj, ctrl_freqs, t,
+                     lang_cond, img_cond, lang_attn_mask, cond_kv=None):
+        '''
+        Predict the model output of one denoising step.
+        
+        noisy_action: (batch_size, horizon, action_dim), the (scaled) noisy actions.
+        action_mask: (batch_size, horizon, action_dim)
+        t: (1,), the diffusion timestep.
+        Others are the same as `conditional_sample`.
+        
+        return: (batch_size, horizon, action_dim)
+        '''
+        # Prepare state-action trajectory
+        action_traj = torch.cat([noisy_action, action_mask], dim=2)
+        action_traj = self.state_adaptor(action_traj)
+        state_action_traj = torch.cat([state_traj, action_traj], dim=1)
+        
+        # Predict the model output
+        return self.model(state_action_traj, ctrl_freqs, t,
+                          lang_cond, img_cond, lang_mask=lang_attn_mask,
+                          cond_kv=cond_kv)
+    
+    def _select_denoise_step(self, *tensors):
+        # Use the compiled step only for the shapes it was captured with
+        if self.compiled_denoise_step is None:
+            return self.denoise_step, False
+        # The packed conditions have data-dependent shapes
+        if any(isinstance(x, PackedCond) for x in tensors):
+            return self.denoise_step, False
+        signature = tuple(
+            (tuple(x.shape), x.dtype, x.device) if x is not None else None
+            for x in tensors)
+        if self.compiled_signature is None:
+            self.compiled_signature = signature
+        if signature != self.compiled_signature:
+            return self.denoise_step, False
+        return self.compiled_denoise_step, True
+    
+    def adapt_conditions(self, lang_tokens, img_tokens, state_tokens,
+                         lang_attn_mask=None):
         '''
         lang_tokens: (batch_size, lang_len, lang_token_dim)
         img_tokens: (batch_size, img_len, img_token_dim)
         state_tokens: (batch_size, state_len, state_token_dim)
+        lang_attn_mask: (batch_size, lang_len) or None, a mask for valid
+            language tokens. If given and `pack_lang_cond` is set, only the
+            valid language tokens are adapted and returned as a `PackedCond`.
         
         return: adpated (..., hidden_size) for all input tokens
         '''
-        adpated_lang = self.lang_adaptor(lang_tokens)
+        if self.pack_lang_cond and lang_attn_mask is not None:
+            adpated_lang = PackedCond.pack(lang_tokens, lang_attn_mask)
+            adpated_lang = adpated_lang._replace(
+                values=self.lang_adaptor(adpated_lang.values))
+        else:
+            adpated_lang = self.lang_adaptor(lang_tokens)
         adpated_img = self.img_adaptor(img_tokens)
         adpated_state = self.state_adaptor(state_tokens)
 
         return adpated_lang, adpated_img, adpated_state
 
     def conditional_sample(self, lang_cond, lang_attn_mask, img_cond, 
-                           state_traj, action_mask, ctrl_freqs):
+                           state_traj, action_mask, ctrl_freqs,
+                           cache_cond_kv=True, sampler=None,
+                           num_inference_timesteps=None):
         '''
-        lang_cond: language conditional data, (batch_size, lang_len, hidden_size).
+        lang_cond: language conditional data, (batch_size, lang_len, hidden_size),
+            or a `PackedCond` of the valid tokens.
         lang_attn_mask: (batch_size, lang_len), a mask for valid language tokens,
             which should be True-False bool tensor.
         img_cond: image conditional data, (batch_size, img_len, hidden_size).
@@ -127,34 +241,52 @@ class RDTRunner(
         action_mask: (batch_size, 1, action_dim), a 0-1 **float** tensor
             indicating the valid action dimensions.
         ctrl_freqs: (batch_size,), control frequency for each sample.
+        cache_cond_kv: whether to compute the cross-attention keys and values
+            of the conditions once and reuse them for all denoising steps.
+        sampler: the name of the sampler, see `models.samplers.SAMPLERS`.
+            Default is `self.sampler`.
+        num_inference_timesteps: the number of denoising steps. 
+            Default is `self.num_inference_timesteps`.
         
         return: (batch_size, horizon, action_dim)
         '''
         device = state_traj.device
         dtype = state_traj.dtype
+        scheduler, timesteps = self.get_sampler(
+            sampler, num_inference_timesteps, device)
+        
         noisy_action = torch.randn(
             size=(state_traj.shape[0], self.pred_horizon, self.action_dim), 
-            dtype=dtype, device=device)
+            dtype=dtype, device=device) * scheduler.init_noise_sigma
         action_mask = action_mask.expand(-1, self.pred_horizon, -1)
     
-        # Set step values
-        self.noise_scheduler_sample.set_timesteps(self.num_inference_timesteps)
-        
-        for t in self.noise_scheduler_sample.timesteps:
-            # Prepare state-action trajectory
-            action_traj = torch.cat([noisy_action, action_mask], dim=2)
-            action_traj = self.state_adaptor(action_traj)
-            state_action_traj = torch.cat([state_traj, action_traj], dim=1)
-            
-            # Predict the model output
-            model_output = self.model(state_action_traj, ctrl_freqs,
-                                    t.unsqueeze(-1).to(device),
-                                    lang_cond, img_cond, lang_mask=lang_attn_mask)
+        # The conditions are fixed during sampling
+        cond_kv = None
+        if cache_cond_kv:
+            with profile_region("cond_kv"):
+                cond_kv = self.model.precompute_cond_kv(lang_cond, img_cond)
+        
+        denoise_step, compiled = self._select_denoise_step(
+            noisy_action, state_traj, ctrl_freqs, 
+            lang_cond, img_cond, lang_attn_mask)
+        
+        for i, t in enumerate(scheduler.timesteps):
+            with profile_region("denoise_step", step=i, compiled=compiled):
+                model_input = scheduler.scale_model_input(noisy_action, t)
+                model_output = denoise_step(
+                    model_input, action_mask, state_traj, ctrl_freqs,
+                    timesteps[i:i+1], lang_cond, img_cond, lang_attn_mask, 
+                    cond_kv=cond_kv)
+                if compiled:
+                    # The output buffer of a CUDA graph is reused by the next 
+                    # replay, but multistep solvers keep the previous outputs
+                    model_output = model_output.clone()
             
             # Compute previous actions: x_t -> x_t-1
-            noisy_action = self.noise_scheduler_sample.step(
-                model_output, t, noisy_action).prev_sample
-            noisy_action = noisy_action.to(state_traj.dtype)
+            with profile_region("scheduler_step", step=i):
+                noisy_action = scheduler.step(
+                    model_output, t, noisy_action).prev_sample
+                noisy_action = noisy_action.to(state_traj.dtype)
         
         # Finally apply the action mask to mask invalid action dimensions
         noisy_action = noisy_action * action_mask
@@ -201,7 +333,7 @@ class RDTRunner(
         state_action_traj = torch.cat([state_action_traj, action_mask], dim=2)
         # Align the dimension with the hidden size
         lang_cond, img_cond, state_action_traj = self.adapt_conditions(
-            lang_tokens, img_tokens, state_action_traj)
+            lang_tokens, img_tokens, state_action_traj, lang_attn_mask)
         # Predict the denoised result
         pred = self.model(state_action_traj, ctrl_freqs, 
                           timesteps, lang_cond, img_cond, 
@@ -220,7 +352,8 @@ class RDTRunner(
     
     # ========= Inference  ============
     def predict_action(self, lang_tokens, lang_attn_mask, img_tokens, state_tokens,
-                       action_mask, ctrl_freqs):
+                       action_mask, ctrl_freqs, cache_cond_kv=True,
+                       sampler=None, num_inference_timesteps=None):
         '''
         lang_tokens: (batch_size, lang_len, lang_token_dim)
         lang_attn_mask: (batch_size, lang_len), a mask for valid language tokens,
@@ -230,19 +363,32 @@ class RDTRunner(
         action_mask: (batch_size, 1, action_dim),
             which should be a 0-1 **float** tensor.
         ctrl_freqs: (batch_size,), control frequency for each sample.
+        cache_cond_kv: whether to reuse the cross-attention keys and values
+            of the conditions across denoising steps. Set to False to 
+            recompute them at every step.
+        sampler: the name of the sampler, e.g., `dpmsolver++`, `ddim`, 
+            `unipc`, `euler` or `one_step`. See `models.samplers.SAMPLERS`.
+            Default is `model.noise_scheduler.sampler` in the config.
+        num_inference_timesteps: the number of denoising steps. Default is
+            `model.noise_scheduler.num_inference_timesteps` in the config.
         
         return: (batch_size, horizon, action_dim), predicted action sequence
         '''
         # Prepare the state and conditions
         state_tokens = torch.cat([state_tokens, action_mask], dim=2)
-        lang_cond, img_cond, state_traj = self.adapt_conditions(
-            lang_tokens, img_tokens, state_tokens)
+        with profile_region("adaptors"):
+            lang_cond, img_cond, state_traj = self.adapt_conditions(
+                lang_tokens, img_tokens, state_tokens, lang_attn_mask)
         
         # Run sampling
-        action_pred = self.conditional_sample(
-            lang_cond, lang_attn_mask, img_cond, 
-            state_traj, action_mask, ctrl_freqs,
-        )
+        with profile_region("sample"):
+            action_pred = self.conditional_sample(
+                lang_cond, lang_attn_mask, img_cond, 
+                state_traj, action_mask, ctrl_freqs,
+                cache_cond_kv=cache_cond_kv,
+                sampler=sampler,
+                num_inference_timesteps=num_inference_timesteps,
+            )
         
         return action_pred
     
@@ -0,0 +1,92 @@
+import copy
+
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+from diffusers.schedulers.scheduling_dpmsolver_multistep import \
+    DPMSolverMultistepScheduler
+from diffusers.schedulers.scheduling_euler_discrete import \
+    EulerDiscreteScheduler
+from diffusers.schedulers.scheduling_unipc_multistep import \
+    UniPCMultistepScheduler
+
+
+# name -> (scheduler class, extra scheduler kwargs, fixed number of steps or None)
+SAMPLERS = {}
+
+# The attributes of the schedulers that change while sampling. The others
+# (e.g., the timestep and sigma tables) are only read after `set_timesteps`
+SOLVER_STATE_ATTRS = (
+    'model_outputs', 'timestep_list', 'lower_order_nums', 'this_order',
+    'last_sample', '_step_index', '_begin_index', 'is_scale_input_called',
+)
+
+
+def register_sampler(name, scheduler_cls, num_steps=None, **scheduler_kwargs):
+    """
+    Register a sampler that can be selected by name at inference time.
+
+    scheduler_cls: a diffusers scheduler class, which is built with
+        `num_train_timesteps`, `beta_schedule` and `prediction_type`
+        of the model plus `scheduler_kwargs`.
+    num_steps: if set, the sampler always uses this number of steps.
+    """
+    SAMPLERS[name] = (scheduler_cls, scheduler_kwargs, num_steps)
+
+
+register_sampler('dpmsolver++', DPMSolverMultistepScheduler,
+                 algorithm_type='dpmsolver++', solver_order=2)
+register_sampler('dpmsolver++_3', DPMSolverMultistepScheduler,
+                 algorithm_type='dpmsolver++', solver_order=3)
+register_sampler('sde-dpmsolver++', DPMSolverMultistepScheduler,
+                 algorithm_type='sde-dpmsolver++', solver_order=2)
+register_sampler('ddim', DDIMScheduler,
+                 clip_sample=False, set_alpha_to_one=True)
+register_sampler('unipc', UniPCMultistepScheduler)
+register_sampler('euler', EulerDiscreteScheduler)
+# Consistency-style sampling: predict the clean actions from
+# pure noise (t = T - 1) with a single model evaluation
+register_sampler('one_step', DDIMScheduler, num_steps=1,
+                 clip_sample=False, set_alpha_to_one=True,
+                 timestep_spacing='trailing')
+
+
+def build_sampler(name, noise_scheduler_config):
+    """
+    Build the scheduler of the sampler `name` for a model trained with
+    `noise_scheduler_config` (see `model.noise_scheduler` in configs/base.yaml).
+
+    return: (scheduler, fixed number of steps or None)
+    """
+    if name not in SAMPLERS:
+        raise ValueError(
+            f"Unknown sampler: {name}, available: {list(SAMPLERS.keys())}")
+    scheduler_cls, scheduler_kwargs, num_steps = SAMPLERS[name]
+    scheduler = scheduler_cls(
+        num_train_timesteps=noise_scheduler_config['num_train_timesteps'],
+        beta_schedule=noise_scheduler_config['beta_schedule'],
+        prediction_type=noise_scheduler_config['prediction_type'],
+        **scheduler_kwargs,
+    )
+    return scheduler, num_steps
+
+
+def get_solver_state(scheduler):
+    """
+    Snapshot the sampling state of a scheduler, e.g., right after `set_timesteps`.
+    """
+    return {
+        attr: copy.copy(getattr(scheduler, attr))
+        for attr in SOLVER_STATE_ATTRS if hasattr(scheduler, attr)
+    }
+
+
+def new_solver(scheduler, solver_state):
+    """
+    A shallow copy of `scheduler` with its own sampling state, initialized
+    from `solver_state`, that shares the tables of `scheduler`. So several
+    samplings can run at the same time (e.g., in different threads) with
+    the same scheduler.
+    """
+    solver = copy.copy(scheduler)
+    for attr, value in solver_state.items():
+        setattr(solver, attr, copy.copy(value))
+    return solver
@@ -5,11 +5,13 @@
 """
 
 import argparse
+import contextlib
 import sys
 import threading
 import time
 import yaml
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import rospy
@@ -17,21 +19,32 @@ import torch
 from cv_bridge import CvBridge
 from geometry_msgs.msg import Twist
 from nav_msgs.msg import Odometry
-from PIL import Image as PImage
 from sensor_msgs.msg import Image, JointState
 from std_msgs.msg import Header
 import cv2
 
+from models.profiler import LatencyProfiler
 from scripts.agilex_model import create_model
+from scripts.async_controller import AsyncChunkController
+from scripts.sensor_sync import ApproximateTimeSynchronizer
 
 # sys.path.append("./")
 
 CAMERA_NAMES = ['cam_high', 'cam_right_wrist', 'cam_left_wrist']
 
+SENSOR_TOPICS = ['img_front', 'img_left', 'img_right',
+                 'img_front_depth', 'img_left_depth', 'img_right_depth',
+                 'puppet_arm_left', 'puppet_arm_right', 'robot_base']
+
 observation_window = None
 
+# The number of observations appended to the window, which stamps their frames
+num_observations = 0
+
 lang_embeddings = None
 
+jpeg_executor = None
+
 # debug
 preload_images = None
 
@@ -114,12 +127,14 @@ def update_observation_window(args, config, ros_operator):
         return img
     
     global observation_window
+    global num_observations
     if observation_window is None:
         observation_window = deque(maxlen=2)
     
         # Append the first dummy image
         observation_window.append(
             {
+                'stamp': None,
                 'qpos': None,
                 'images':
                     {
@@ -131,15 +146,21 @@ def update_observation_window(args, config, ros_operator):
         )
         
     img_front, img_left, img_right, puppet_arm_left, puppet_arm_right = get_ros_observation(args,ros_operator)
-    img_front = jpeg_mapping(img_front)
-    img_left = jpeg_mapping(img_left)
-    img_right = jpeg_mapping(img_right)
+    if not args.disable_jpeg_mapping:
+        # OpenCV releases the GIL, so the frames are mapped in parallel
+        global jpeg_executor
+        if jpeg_executor is None:
+            jpeg_executor = ThreadPoolExecutor(max_workers=3)
+        img_front, img_left, img_right = jpeg_executor.map(
+            jpeg_mapping, [img_front, img_left, img_right])
     
     qpos = np.concatenate(
             (np.array(puppet_arm_left.position), np.array(puppet_arm_right.position)), axis=0)
     qpos = torch.from_numpy(qpos).float().cuda()
+    num_observations += 1
     observation_window.append(
         {
+            'stamp': num_observations,
             'qpos': qpos,
             'images':
                 {
@@ -152,9 +173,12 @@ def update_observation_window(args, config, ros_operator):
 
 
 # RDT inference
-def inference_fn(args, config, policy, t):
+def inference_fn(args, config, policy, t, window=None):
     global observation_window
     global lang_embeddings
+    # The snapshot of the observation window, default is the latest one
+    if window is None:
+        window = observation_window
     
     # print(f"Start inference_thread_fn: t={t}")
     while True and not rospy.is_shutdown():
@@ -162,13 +186,13 @@ def inference_fn(args, config, policy, t):
 
         # fetch images in sequence [front, right, left]
         image_arrs = [
-            observation_window[-2]['images'][config['camera_names'][0]],
-            observation_window[-2]['images'][config['camera_names'][1]],
-            observation_window[-2]['images'][config['camera_names'][2]],
+            window[-2]['images'][config['camera_names'][0]],
+            window[-2]['images'][config['camera_names'][1]],
+            window[-2]['images'][config['camera_names'][2]],
             
-            observation_window[-1]['images'][config['camera_names'][0]],
-            observation_window[-1]['images'][config['camera_names'][1]],
-            observation_window[-1]['images'][config['camera_names'][2]]
+            window[-1]['images'][config['camera_names'][0]],
+            window[-1]['images'][config['camera_names'][1]],
+            window[-1]['images'][config['camera_names'][2]]
         ]
         
         # fetch debug images in sequence [front, right, left]
@@ -185,14 +209,14 @@ def inference_fn(args, config, policy, t):
         #     image_arrs[i] = cv2.imdecode(np.frombuffer(image_arrs[i], np.uint8), cv2.IMREAD_COLOR)
         # proprio = torch.from_numpy(preload_images['qpos'][t]).float().cuda()
         
-        images = [PImage.fromarray(arr) if arr is not None else None
-                  for arr in image_arrs]
+        # The arrays are preprocessed in batch by the policy
+        images = image_arrs
         
         # for i, pos in enumerate(['f', 'r', 'l'] * 2):
         #     images[i].save(f'{t}-{i}-{pos}.png')
         
         # get last qpos in shape [14, ]
-        proprio = observation_window[-1]['qpos']
+        proprio = window[-1]['qpos']
         # unsqueeze to [1, 14]
         proprio = proprio.unsqueeze(0)
         
@@ -200,7 +224,8 @@ def inference_fn(args, config, policy, t):
         actions = policy.step(
             proprio=proprio,
             images=images,
-            text_embeds=lang_embeddings 
+            text_embeds=lang_embeddings,
+            image_stamps=[window[-2]['stamp']] * 3 + [window[-1]['stamp']] * 3,
         ).squeeze(0).cpu().numpy()
         # print(f"inference_actions: {actions.squeeze()}")
         
@@ -239,26 +264,52 @@ def model_inference(args, config, ros_operator):
         [-0.00133514404296875, 0.00247955322265625, 0.01583099365234375, -0.032616615295410156, -0.00286102294921875, 0.00095367431640625, -0.3397035598754883]
     )
     action = None
+
+    # The model runs in a background thread, so that the next chunk is
+    # predicted while the current one is executed (with `--prefetch_steps`)
+    def infer(snapshot):
+        t, window = snapshot
+        with torch.inference_mode():
+            return inference_fn(args, config, policy, t, window).copy()
+    controller = AsyncChunkController(
+        infer, chunk_size,
+        prefetch_steps=args.prefetch_steps,
+        blend_steps=args.blend_steps)
+
+    # Profile the inference with `--profile_path`
+    profiling = contextlib.nullcontext()
+    profiler = None
+    if args.profile_path is not None:
+        profiler = LatencyProfiler()
+        profiling = profiler.enable(
+            blocks=policy.policy.model.blocks if args.profile_blocks else None)
+        rospy.on_shutdown(lambda: profiler.export_chrome_trace(args.profile_path))
+
     # Inference loop
-    with torch.inference_mode():
+    with torch.inference_mode(), profiling:
         while True and not rospy.is_shutdown():
             # The current time step
             t = 0
             rate = rospy.Rate(args.publish_rate)
-    
-            action_buffer = np.zeros([chunk_size, config['state_dim']])
+            controller.reset()
+            policy.reset_image_embeds()
             
             while t < max_publish_step and not rospy.is_shutdown():
                 # Update observation window
                 update_observation_window(args, config, ros_operator)
+                # Encode the new frames at every step, so that the frames of
+                # both steps of the window are encoded when a chunk is requested
+                latest = observation_window[-1]
+                policy.update_image_embeds(
+                    [latest['images'][name] for name in config['camera_names']], latest['stamp'])
                 
-                # When coming to the end of the action chunk
+                # The observation window is snapshotted when a chunk is requested
+                action = controller.step(t, lambda: (t, list(observation_window)))
                 if t % chunk_size == 0:
-                    # Start inference
-                    action_buffer = inference_fn(args, config, policy, t).copy()
-                
-                raw_action = action_buffer[t % chunk_size]
-                action = raw_action
+                    if args.print_stats:
+                        print(f"Controller stats: {controller.get_stats()}")
+                    if profiler is not None:
+                        print(profiler.format_summary())
                 # Interpolate the original action sequence
                 if args.use_actions_interpolation:
                     # print(f"Time {t}, pre {pre_action}, act {action}")
@@ -283,19 +334,14 @@ def model_inference(args, config, ros_operator):
                 print("Published Step", t)
                 pre_action = action.copy()
 
+            if profiler is not None:
+                profiler.export_chrome_trace(args.profile_path)
+
 
 # ROS operator class
 class RosOperator:
     def __init__(self, args):
-        self.robot_base_deque = None
-        self.puppet_arm_right_deque = None
-        self.puppet_arm_left_deque = None
-        self.img_front_deque = None
-        self.img_right_deque = None
-        self.img_left_deque = None
-        self.img_front_depth_deque = None
-        self.img_right_depth_deque = None
-        self.img_left_depth_deque = None
+        self.synchronizer = None
         self.bridge = None
         self.puppet_arm_left_publisher = None
         self.puppet_arm_right_publisher = None
@@ -308,15 +354,7 @@ class RosOperator:
 
     def init(self):
         self.bridge = CvBridge()
-        self.img_left_deque = deque()
-        self.img_right_deque = deque()
-        self.img_front_deque = deque()
-        self.img_left_depth_deque = deque()
-        self.img_right_depth_deque = deque()
-        self.img_front_depth_deque = deque()
-        self.puppet_arm_left_deque = deque()
-        self.puppet_arm_right_deque = deque()
-        self.robot_base_deque = deque()
+        self.synchronizer = ApproximateTimeSynchronizer(SENSOR_TOPICS, capacity=2000)
         self.puppet_arm_publish_lock = threading.Lock()
         self.puppet_arm_publish_lock.acquire()
 
@@ -345,10 +383,10 @@ class RosOperator:
         left_arm = None
         right_arm = None
         while True and not rospy.is_shutdown():
-            if len(self.puppet_arm_left_deque) != 0:
-                left_arm = list(self.puppet_arm_left_deque[-1].position)
-            if len(self.puppet_arm_right_deque) != 0:
-                right_arm = list(self.puppet_arm_right_deque[-1].position)
+            if self.synchronizer.latest('puppet_arm_left') is not None:
+                left_arm = list(self.synchronizer.latest('puppet_arm_left').position)
+            if self.synchronizer.latest('puppet_arm_right') is not None:
+                right_arm = list(self.synchronizer.latest('puppet_arm_right').position)
             if left_arm is None or right_arm is None:
                 rate.sleep()
                 continue
@@ -396,10 +434,10 @@ class RosOperator:
         right_arm = None
 
         while True and not rospy.is_shutdown():
-            if len(self.puppet_arm_left_deque) != 0:
-                left_arm = list(self.puppet_arm_left_deque[-1].position)
-            if len(self.puppet_arm_right_deque) != 0:
-                right_arm = list(self.puppet_arm_right_deque[-1].position)
+            if self.synchronizer.latest('puppet_arm_left') is not None:
+                left_arm = list(self.synchronizer.latest('puppet_arm_left').position)
+            if self.synchronizer.latest('puppet_arm_right') is not None:
+                right_arm = list(self.synchronizer.latest('puppet_arm_right').position)
             if left_arm is None or right_arm is None:
                 rate.sleep()
                 continue
@@ -434,125 +472,56 @@ class RosOperator:
         self.puppet_arm_publish_thread.start()
 
     def get_frame(self):
-        if len(self.img_left_deque) == 0 or len(self.img_right_deque) == 0 or len(self.img_front_deque) == 0 or \
-                (self.args.use_depth_image and (len(self.img_left_depth_deque) == 0 or len(self.img_right_depth_deque) == 0 or len(self.img_front_depth_deque) == 0)):
-            return False
+        # The frame time is set by the cameras
+        camera_topics = ['img_front', 'img_left', 'img_right']
         if self.args.use_depth_image:
-            frame_time = min([self.img_left_deque[-1].header.stamp.to_sec(), self.img_right_deque[-1].header.stamp.to_sec(), self.img_front_deque[-1].header.stamp.to_sec(),
-                              self.img_left_depth_deque[-1].header.stamp.to_sec(), self.img_right_depth_deque[-1].header.stamp.to_sec(), self.img_front_depth_deque[-1].header.stamp.to_sec()])
-        else:
-            frame_time = min([self.img_left_deque[-1].header.stamp.to_sec(), self.img_right_deque[-1].header.stamp.to_sec(), self.img_front_deque[-1].header.stamp.to_sec()])
-
-        if len(self.img_left_deque) == 0 or self.img_left_deque[-1].header.stamp.to_sec() < frame_time:
-            return False
-        if len(self.img_right_deque) == 0 or self.img_right_deque[-1].header.stamp.to_sec() < frame_time:
-            return False
-        if len(self.img_front_deque) == 0 or self.img_front_deque[-1].header.stamp.to_sec() < frame_time:
-            return False
-        if len(self.puppet_arm_left_deque) == 0 or self.puppet_arm_left_deque[-1].header.stamp.to_sec() < frame_time:
-            return False
-        if len(self.puppet_arm_right_deque) == 0 or self.puppet_arm_right_deque[-1].header.stamp.to_sec() < frame_time:
-            return False
-        if self.args.use_depth_image and (len(self.img_left_depth_deque) == 0 or self.img_left_depth_deque[-1].header.stamp.to_sec() < frame_time):
-            return False
-        if self.args.use_depth_image and (len(self.img_right_depth_deque) == 0 or self.img_right_depth_deque[-1].header.stamp.to_sec() < frame_time):
-            return False
-        if self.args.use_depth_image and (len(self.img_front_depth_deque) == 0 or self.img_front_depth_deque[-1].header.stamp.to_sec() < frame_time):
-            return False
-        if self.args.use_robot_base and (len(self.robot_base_deque) == 0 or self.robot_base_deque[-1].header.stamp.to_sec() < frame_time):
+            camera_topics += ['img_front_depth', 'img_left_depth', 'img_right_depth']
+        topics = camera_topics + ['puppet_arm_left', 'puppet_arm_right']
+        if self.args.use_robot_base:
+            topics.append('robot_base')
+        frame = self.synchronizer.get(topics, ref_topics=camera_topics)
+        if frame is None:
             return False
+        frame = dict(zip(topics, frame))
 
-        while self.img_left_deque[0].header.stamp.to_sec() < frame_time:
-            self.img_left_deque.popleft()
-        img_left = self.bridge.imgmsg_to_cv2(self.img_left_deque.popleft(), 'passthrough')
-
-        while self.img_right_deque[0].header.stamp.to_sec() < frame_time:
-            self.img_right_deque.popleft()
-        img_right = self.bridge.imgmsg_to_cv2(self.img_right_deque.popleft(), 'passthrough')
-
-        while self.img_front_deque[0].header.stamp.to_sec() < frame_time:
-            self.img_front_deque.popleft()
-        img_front = self.bridge.imgmsg_to_cv2(self.img_front_deque.popleft(), 'passthrough')
-
-        while self.puppet_arm_left_deque[0].header.stamp.to_sec() < frame_time:
-            self.puppet_arm_left_deque.popleft()
-        puppet_arm_left = self.puppet_arm_left_deque.popleft()
-
-        while self.puppet_arm_right_deque[0].header.stamp.to_sec() < frame_time:
-            self.puppet_arm_right_deque.popleft()
-        puppet_arm_right = self.puppet_arm_right_deque.popleft()
-
-        img_left_depth = None
+        img_front = self.bridge.imgmsg_to_cv2(frame['img_front'], 'passthrough')
+        img_left = self.bridge.imgmsg_to_cv2(frame['img_left'], 'passthrough')
+        img_right = self.bridge.imgmsg_to_cv2(frame['img_right'], 'passthrough')
+        img_front_depth, img_left_depth, img_right_depth = None, None, None
         if self.args.use_depth_image:
-            while self.img_left_depth_deque[0].header.stamp.to_sec() < frame_time:
-                self.img_left_depth_deque.popleft()
-            img_left_depth = self.bridge.imgmsg_to_cv2(self.img_left_depth_deque.popleft(), 'passthrough')
-
-        img_right_depth = None
-        if self.args.use_depth_image:
-            while self.img_right_depth_deque[0].header.stamp.to_sec() < frame_time:
-                self.img_right_depth_deque.popleft()
-            img_right_depth = self.bridge.imgmsg_to_cv2(self.img_right_depth_deque.popleft(), 'passthrough')
-
-        img_front_depth = None
-        if self.args.use_depth_image:
-            while self.img_front_depth_deque[0].header.stamp.to_sec() < frame_time:
-                self.img_front_depth_deque.popleft()
-            img_front_depth = self.bridge.imgmsg_to_cv2(self.img_front_depth_deque.popleft(), 'passthrough')
-
-        robot_base = None
-        if self.args.use_robot_base:
-            while self.robot_base_deque[0].header.stamp.to_sec() < frame_time:
-                self.robot_base_deque.popleft()
-            robot_base = self.robot_base_deque.popleft()
+            img_front_depth = self.bridge.imgmsg_to_cv2(frame['img_front_depth'], 'passthrough')
+            img_left_depth = self.bridge.imgmsg_to_cv2(frame['img_left_depth'], 'passthrough')
+            img_right_depth = self.bridge.imgmsg_to_cv2(frame['img_right_depth'], 'passthrough')
 
         return (img_front, img_left, img_right, img_front_depth, img_left_depth, img_right_depth,
-                puppet_arm_left, puppet_arm_right, robot_base)
+                frame['puppet_arm_left'], frame['puppet_arm_right'], frame.get('robot_base'))
 
     def img_left_callback(self, msg):
-        if len(self.img_left_deque) >= 2000:
-            self.img_left_deque.popleft()
-        self.img_left_deque.append(msg)
+        self.synchronizer.push('img_left', msg.header.stamp.to_sec(), msg)
 
     def img_right_callback(self, msg):
-        if len(self.img_right_deque) >= 2000:
-            self.img_right_deque.popleft()
-        self.img_right_deque.append(msg)
+        self.synchronizer.push('img_right', msg.header.stamp.to_sec(), msg)
 
     def img_front_callback(self, msg):
-        if len(self.img_front_deque) >= 2000:
-            self.img_front_deque.popleft()
-        self.img_front_deque.append(msg)
+        self.synchronizer.push('img_front', msg.header.stamp.to_sec(), msg)
 
     def img_left_depth_callback(self, msg):
-        if len(self.img_left_depth_deque) >= 2000:
-            self.img_left_depth_deque.popleft()
-        self.img_left_depth_deque.append(msg)
+        self.synchronizer.push('img_left_depth', msg.header.stamp.to_sec(), msg)
 
     def img_right_depth_callback(self, msg):
-        if len(self.img_right_depth_deque) >= 2000:
-            self.img_right_depth_deque.popleft()
-        self.img_right_depth_deque.append(msg)
+        self.synchronizer.push('img_right_depth', msg.header.stamp.to_sec(), msg)
 
     def img_front_depth_callback(self, msg):
-        if len(self.img_front_depth_deque) >= 2000:
-            self.img_front_depth_deque.popleft()
-        self.img_front_depth_deque.append(msg)
+        self.synchronizer.push('img_front_depth', msg.header.stamp.to_sec(), msg)
 
     def puppet_arm_left_callback(self, msg):
-        if len(self.puppet_arm_left_deque) >= 2000:
-            self.puppet_arm_left_deque.popleft()
-        self.puppet_arm_left_deque.append(msg)
+        self.synchronizer.push('puppet_arm_left', msg.header.stamp.to_sec(), msg)
 
     def puppet_arm_right_callback(self, msg):
-        if len(self.puppet_arm_right_deque) >= 2000:
-            self.puppet_arm_right_deque.popleft()
-        self.puppet_arm_right_deque.append(msg)
+        self.synchronizer.push('puppet_arm_right', msg.header.stamp.to_sec(), msg)
 
     def robot_base_callback(self, msg):
-        if len(self.robot_base_deque) >= 2000:
-            self.robot_base_deque.popleft()
-        self.robot_base_deque.append(msg)
+        self.synchronizer.push('robot_base', msg.header.stamp.to_sec(), msg)
 
     def init_ros(self):
         rospy.init_node('joint_state_publisher', anonymous=True)
@@ -618,6 +587,16 @@ def get_arguments():
     parser.add_argument('--chunk_size', action='store', type=int, 
                         help='Action chunk size',
                         default=64, required=False)
+    parser.add_argument('--prefetch_steps', action='store', type=int,
+                        help='Number of steps before the end of an action chunk to start predicting '
+                             'the next one in the background, 0 to wait for the model at every chunk',
+                        default=0, required=False)
+    parser.add_argument('--blend_steps', action='store', type=int,
+                        help='Number of steps to blend the previous action chunk into a new one',
+                        default=0, required=False)
+    parser.add_argument('--print_stats', action='store_true',
+                        help='Whether to print the inference and stall statistics of the controller every chunk',
+                        default=False, required=False)
     parser.add_argument('--arm_steps_length', action='store', type=float, 
                         help='The maximum change allowed for each joint per timestep',
                         default=[0.01, 0.01, 0.01, 0.01, 0.01, 0.01, 0.2], required=False)
@@ -631,6 +610,15 @@ def get_arguments():
     
     parser.add_argument('--disable_puppet_arm', action='store_true',
                         help='Whether to disable the puppet arm. This is useful for safely debugging',default=False)
+    parser.add_argument('--profile_path', type=str, default=None,
+                        help='Path of the Chrome trace of the inference latency (e.g., trace.json). '
+                        'If set, the latency of every stage is also printed every chunk')
+    parser.add_argument('--profile_blocks', action='store_true', default=False,
+                        help='Whether to also profile the attention and FFN of every block, '
+                        'which slows down the inference')
+    parser.add_argument('--disable_jpeg_mapping', action='store_true',
+                        help='Whether to skip the JPEG round trip of the frames. It is faster, '
+                        'but the frames are no longer JPEG-compressed as in training', default=False)
     
     parser.add_argument('--config_path', type=str, default="configs/base.yaml", 
                         help='Path to the config file')
@@ -1,13 +1,15 @@
 import os
+import threading
 
 import numpy as np
 import torch
 from PIL import Image
-from torchvision import transforms
 
 from configs.state_vec import STATE_VEC_IDX_MAPPING
+from models.multimodal_encoder.image_preprocess import BatchImagePreprocessor
 from models.multimodal_encoder.siglip_encoder import SiglipVisionTower
 from models.multimodal_encoder.t5_encoder import T5Embedder
+from models.profiler import profile_region
 from models.rdt_runner import RDTRunner
 
 
@@ -49,6 +51,7 @@ class RoboticDiffusionTransformerModel(object):
         control_frequency=25,
         pretrained=None,
         pretrained_vision_encoder_name_or_path=None,
+        cache_image_embeds=True,
     ):
         self.args = args
         self.dtype = dtype
@@ -58,6 +61,26 @@ class RoboticDiffusionTransformerModel(object):
         # We do not use the text encoder due to limited GPU memory
         # self.text_tokenizer, self.text_model = self.get_text_encoder(pretrained_text_encoder_name_or_path)
         self.image_processor, self.vision_model = self.get_vision_encoder(pretrained_vision_encoder_name_or_path)
+        self.image_preprocessor = BatchImagePreprocessor(
+            self.image_processor,
+            image_size=image_size,
+            image_aspect_ratio=self.args["dataset"].get("image_aspect_ratio", "pad"),
+            auto_adjust_image_brightness=self.args["dataset"].get("auto_adjust_image_brightness", False),
+        )
+        # Used for the missing images
+        self.background_image = self.image_preprocessor.background_image()
+        # The preallocated input buffer of the vision encoder on the host (in pinned
+        # memory if the model is on GPU), and the event of its last copy to the device
+        self.pixel_values = None
+        self.pixel_values_copied = None
+        # Whether to reuse the vision embeddings of the recent frames,
+        # see `_encode_images`
+        self.cache_image_embeds = cache_image_embeds
+        self.num_cameras = self.args["common"]["num_cameras"]
+        self.img_history_size = self.args["common"]["img_history_size"]
+        self.image_embeds_lock = threading.Lock()
+        self.frame_embeds = None
+        self.background_embeds = None
         self.policy = self.get_policy(pretrained)
         
         self.reset()
@@ -125,6 +148,18 @@ class RoboticDiffusionTransformerModel(object):
         # self.text_model = self.text_model.to(device, dtype=weight_dtype)
         self.vision_model = self.vision_model.to(device, dtype=weight_dtype)
 
+        self.reset_image_embeds()
+
+    def reset_image_embeds(self):
+        """
+        Drop the cached vision embeddings, e.g., at the start of an episode.
+        """
+        with self.image_embeds_lock:
+            # Per camera, the (stamp, embeddings) of its last
+            # `img_history_size` frames in the order of the stamps
+            self.frame_embeds = [[] for _ in range(self.num_cameras)]
+            self.background_embeds = None
+
     def load_pretrained_weights(self, pretrained=None):
         if pretrained is None:
             return 
@@ -218,92 +253,212 @@ class RoboticDiffusionTransformerModel(object):
         
         return joints
 
+    def _get_pixel_buffer(self, num_images):
+        shape = (num_images, 3, self.image_preprocessor.height, self.image_preprocessor.width)
+        if self.pixel_values is None or self.pixel_values.shape[0] < num_images:
+            self.pixel_values = torch.empty(
+                shape, dtype=torch.float32,
+                pin_memory=torch.device(self.device).type == 'cuda')
+            self.pixel_values_copied = None
+        elif self.pixel_values_copied is not None:
+            # Do not overwrite the buffer before its last copy is done
+            self.pixel_values_copied.synchronize()
+        return self.pixel_values[:num_images]
+
+    def _preprocess_images(self, images):
+        """
+        Preprocess a list of images into the input tensor of the vision encoder.
+        All the images are processed in batch into a preallocated buffer.
+
+        Args:
+            images: a list of PIL images or (H, W, 3) uint8 arrays
+                (or None for the missing ones)
+
+        Returns:
+            image_tensor (torch.Tensor): ([N, 3, H, W]) on the device
+        """
+        with profile_region("preprocess", num_images=len(images)):
+            valid = [image is not None for image in images]
+            images = [
+                np.asarray(image.convert('RGB')) if isinstance(image, Image.Image)
+                else self.background_image if image is None
+                else image
+                for image in images
+            ]
+            pixel_values = self.image_preprocessor(
+                images, valid, out=self._get_pixel_buffer(len(images)))
+            if not pixel_values.is_pinned():
+                return pixel_values.to(self.device, dtype=self.dtype)
+            image_tensor = pixel_values.to(self.device, non_blocking=True)
+            self.pixel_values_copied = torch.cuda.Event()
+            self.pixel_values_copied.record()
+            return image_tensor.to(self.dtype)
+
+    def _encode_pixel_values(self, pixel_values):
+        with profile_region("vision_encode", num_images=pixel_values.shape[0]):
+            return self.vision_model(pixel_values).detach()
+
+    def _encode_images(self, images, image_stamps=None):
+        """
+        Encode a list of images with the vision encoder.
+
+        With `cache_image_embeds`, every camera keeps the embeddings of its
+        last `img_history_size` frames, keyed by the stamps of the frames
+        (e.g., their capture times), and the embedding of the background
+        image used for the missing frames. Only the frames that are in none
+        of them are encoded. The control loop can encode the new frames of
+        every step with `update_image_embeds`, so that all the frames of a
+        step are already encoded when the next chunk is predicted.
+
+        Args:
+            images: a list of PIL images or (H, W, 3) uint8 arrays
+                (or None for the missing ones), ordered by camera as in `step`
+            image_stamps: optional, the stamps of the images (None for the
+                ones that are not cached), unique per frame of a camera
+
+        Returns:
+            image_embeds (torch.Tensor): ([N, num_patches, hidden_size])
+        """
+        if not self.cache_image_embeds:
+            return self._encode_pixel_values(self._preprocess_images(images))
+
+        with self.image_embeds_lock:
+            # The key of every image: None for the background,
+            # (camera, stamp) for the cached frames and the index for the others
+            keys = []
+            for idx, image in enumerate(images):
+                if image is None:
+                    keys.append(None)
+                elif image_stamps is None or image_stamps[idx] is None:
+                    keys.append(idx)
+                else:
+                    keys.append((idx % self.num_cameras, image_stamps[idx]))
+
+            embeds_of = {}
+            if self.background_embeds is not None:
+                embeds_of[None] = self.background_embeds
+            for key in keys:
+                if isinstance(key, tuple) and key not in embeds_of:
+                    camera, stamp = key
+                    for frame_stamp, embeds in self.frame_embeds[camera]:
+                        if frame_stamp == stamp:
+                            embeds_of[key] = embeds
+
+            missing = list(dict.fromkeys(key for key in keys if key not in embeds_of))
+            if len(missing) > 0:
+                missing_embeds = self._encode_pixel_values(self._preprocess_images(
+                    [images[keys.index(key)] for key in missing]))
+                embeds_of.update(zip(missing, missing_embeds))
+                for key in missing:
+                    if key is None:
+                        self.background_embeds = embeds_of[key]
+                    elif isinstance(key, tuple):
+                        self._add_frame_embeds(*key, embeds_of[key])
+
+            return torch.stack([embeds_of[key] for key in keys], dim=0)
+
+    def _add_frame_embeds(self, camera, stamp, embeds):
+        frames = self.frame_embeds[camera]
+        frames.append((stamp, embeds))
+        frames.sort(key=lambda frame: frame[0])
+        del frames[:-self.img_history_size]
+
     @torch.no_grad()
-    def step(self, proprio, images, text_embeds):
+    def update_image_embeds(self, images, stamp):
+        """
+        Encode the new frames of the cameras (ordered as in `step`) into the
+        cache, if they are not cached yet. Called by the control loop at
+        every step, it keeps the vision encoding out of `step`.
+        """
+        if self.cache_image_embeds:
+            self._encode_images(images, [stamp] * len(images))
+
+    @torch.no_grad()
+    def step(self, proprio, images, text_embeds, image_stamps=None):
         """
         Predict the next action chunk given the 
         proprioceptive states, images, and instruction embeddings.
 
         Args:
             proprio: proprioceptive states
-            images: RGB images, the order should be
+            images: RGB images (PIL images or uint8 arrays), the order should be
                 [ext_{t-1}, right_wrist_{t-1}, left_wrist_{t-1}, 
                 ext_{t}, right_wrist_{t}, left_wrist_{t}]
             text_embeds: instruction embeddings
+            image_stamps: optional, the stamps of the images, with which
+                their vision embeddings are cached (see `_encode_images`)
 
         Returns:
             action: predicted action
         """
+        return self.step_batch(
+            [proprio], [images], [text_embeds],
+            image_stamps_list=None if image_stamps is None else [image_stamps])
+
+    @torch.no_grad()
+    def step_batch(self, proprios, images_list, text_embeds_list, image_stamps_list=None):
+        """
+        Predict the next action chunks of several observations in one batch.
+        The observations may come from different robots and instructions.
+
+        Args:
+            proprios: a list of proprioceptive states, each of shape [1, 14]
+            images_list: a list of RGB image lists, each ordered as in `step`
+            text_embeds_list: a list of instruction embeddings,
+                each of shape [1, L_i, D] or [L_i, D]
+            image_stamps_list: optional, a list of the image stamps as in `step`,
+                only for observations from the same cameras
+
+        Returns:
+            action: predicted actions ([B, N, 14])
+        """
+        with profile_region("step", batch_size=len(proprios)):
+            return self._step_batch(proprios, images_list, text_embeds_list, image_stamps_list)
+
+    def _step_batch(self, proprios, images_list, text_embeds_list, image_stamps_list=None):
         device = self.device
         dtype = self.dtype
+        batch_size = len(proprios)
         
-        # The background image used for padding
-        background_color = np.array([
-            int(x*255) for x in self.image_processor.image_mean
-        ], dtype=np.uint8).reshape(1, 1, 3)
-        background_image = np.ones((
-            self.image_processor.size["height"], 
-            self.image_processor.size["width"], 3), dtype=np.uint8
-        ) * background_color
-        
-        # Preprocess the images by order and encode them
-        image_tensor_list = []
-        for image in images:
-            if image is None:
-                # Replace it with the background image
-                image = Image.fromarray(background_image)
-            
-            if self.image_size is not None:
-                image = transforms.Resize(self.data_args.image_size)(image)
-            
-            if self.args["dataset"].get("auto_adjust_image_brightness", False):
-                pixel_values = list(image.getdata())
-                average_brightness = sum(sum(pixel) for pixel in pixel_values) / (len(pixel_values) * 255.0 * 3)
-                if average_brightness <= 0.15:
-                    image = transforms.ColorJitter(brightness=(1.75,1.75))(image)
-                    
-            if self.args["dataset"].get("image_aspect_ratio", "pad") == 'pad':
-                def expand2square(pil_img, background_color):
-                    width, height = pil_img.size
-                    if width == height:
-                        return pil_img
-                    elif width > height:
-                        result = Image.new(pil_img.mode, (width, width), background_color)
-                        result.paste(pil_img, (0, (width - height) // 2))
-                        return result
-                    else:
-                        result = Image.new(pil_img.mode, (height, height), background_color)
-                        result.paste(pil_img, ((height - width) // 2, 0))
-                        return result
-                image = expand2square(image, tuple(int(x*255) for x in self.image_processor.image_mean))
-            image = self.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
-            image_tensor_list.append(image)
-
-        image_tensor = torch.stack(image_tensor_list, dim=0).to(device, dtype=dtype)
-
-        image_embeds = self.vision_model(image_tensor).detach()
-        image_embeds = image_embeds.reshape(-1, self.vision_model.hidden_size).unsqueeze(0)
+        # Encode the images of all the observations at once
+        image_embeds = self._encode_images(
+            [image for images in images_list for image in images],
+            None if image_stamps_list is None
+            else [stamp for image_stamps in image_stamps_list for stamp in image_stamps])
+        image_embeds = image_embeds.reshape(batch_size, -1, self.vision_model.hidden_size)
 
         # Prepare the proprioception states and the control frequency
-        joints = proprio.to(device).unsqueeze(0)   # (1, 1, 14)
-        states, state_elem_mask = self._format_joint_to_state(joints)    # (1, 1, 128), (1, 128)
+        joints = torch.stack([
+            proprio.to(device) for proprio in proprios], dim=0)   # (B, 1, 14)
+        states, state_elem_mask = self._format_joint_to_state(joints)    # (B, 1, 128), (B, 128)
         states, state_elem_mask = states.to(device, dtype=dtype), state_elem_mask.to(device, dtype=dtype)
-        states = states[:, -1:, :]  # (1, 1, 128)
-        ctrl_freqs = torch.tensor([self.control_frequency]).to(device)
+        states = states[:, -1:, :]  # (B, 1, 128)
+        ctrl_freqs = torch.tensor([self.control_frequency] * batch_size).to(device)
         
-        text_embeds = text_embeds.to(device, dtype=dtype)
+        # Pad the instructions of different lengths
+        text_embeds_list = [
+            text_embeds.reshape(-1, text_embeds.shape[-1]) 
+            for text_embeds in text_embeds_list
+        ]
+        text_embeds = torch.nn.utils.rnn.pad_sequence(
+            text_embeds_list, batch_first=True, padding_value=0
+        ).to(device, dtype=dtype)
+        lang_attn_mask = torch.zeros(
+            text_embeds.shape[:2], dtype=torch.bool, device=device)
+        for i, embeds in enumerate(text_embeds_list):
+            lang_attn_mask[i, :embeds.shape[0]] = True
         
         # Predict the next action chunk given the inputs
-        trajectory = self.policy.predict_action(
-            lang_tokens=text_embeds,
-            lang_attn_mask=torch.ones(
-                text_embeds.shape[:2], dtype=torch.bool,
-                device=text_embeds.device),
-            img_tokens=image_embeds,
-            state_tokens=states,
-            action_mask=state_elem_mask.unsqueeze(1),  
-            ctrl_freqs=ctrl_freqs
-        )
-        trajectory = self._unformat_action_to_joint(trajectory).to(torch.float32)
+        with profile_region("predict_action"):
+            trajectory = self.policy.predict_action(
+                lang_tokens=text_embeds,
+                lang_attn_mask=lang_attn_mask,
+                img_tokens=image_embeds,
+                state_tokens=states,
+                action_mask=state_elem_mask.unsqueeze(1),  
+                ctrl_freqs=ctrl_freqs
+            )
+        with profile_region("unformat"):
+            trajectory = self._unformat_action_to_joint(trajectory).to(torch.float32)
 
         return trajectory
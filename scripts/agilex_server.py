@@ -0,0 +1,412 @@
+"""
+A persistent inference server for RDT.
+
+Robots (clients) send their observations to the server over a Unix socket
+or TCP. The server coalesces the requests that arrive within a short
+latency window into one batch, runs a single `step_batch` on the model,
+and sends each robot its own action chunk.
+
+Each message is framed as
+    [4-byte header length][4-byte payload length][JSON header][npz payload]
+where the header carries the message type and the payload carries arrays.
+"""
+
+import argparse
+import asyncio
+import collections
+import io
+import json
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import yaml
+from PIL import Image as PImage
+
+
+FRAME_HEADER = struct.Struct('!II')
+NUM_IMAGES = 6
+STATE_DIM = 14
+
+
+def pack_message(header, arrays=None):
+    """
+    Pack a JSON header and a dict of numpy arrays into a message.
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    payload = b''
+    if arrays:
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        payload = buf.getvalue()
+    return FRAME_HEADER.pack(len(header_bytes), len(payload)) + header_bytes + payload
+
+
+def unpack_payload(payload):
+    """
+    Unpack the npz payload into a dict of numpy arrays.
+    """
+    if len(payload) == 0:
+        return {}
+    with np.load(io.BytesIO(payload), allow_pickle=False) as data:
+        return {k: data[k] for k in data.files}
+
+
+async def read_message(reader):
+    header_len, payload_len = FRAME_HEADER.unpack(
+        await reader.readexactly(FRAME_HEADER.size))
+    header = json.loads(await reader.readexactly(header_len))
+    arrays = unpack_payload(await reader.readexactly(payload_len))
+    return header, arrays
+
+
+class ServerStats:
+    """
+    Runtime statistics of the server: queue depth,
+    batch size histogram and request latencies.
+    """
+    def __init__(self, max_latency_records=10000):
+        self.queue_depth = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.batch_size_hist = collections.Counter()
+        self.latencies = collections.deque(maxlen=max_latency_records)
+
+    def record_batch(self, batch_size):
+        self.num_batches += 1
+        self.batch_size_hist[batch_size] += 1
+
+    def record_latency(self, latency):
+        self.num_requests += 1
+        self.latencies.append(latency)
+
+    def summary(self):
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies) * 1000.0
+            p50, p99 = np.percentile(latencies, [50, 99]).tolist()
+        else:
+            p50, p99 = None, None
+        return {
+            'queue_depth': self.queue_depth,
+            'num_requests': self.num_requests,
+            'num_batches': self.num_batches,
+            'batch_size_hist': {
+                str(k): v for k, v in sorted(self.batch_size_hist.items())},
+            'latency_p50_ms': p50,
+            'latency_p99_ms': p99,
+        }
+
+
+class DynamicBatcher:
+    """
+    Collect the step requests into batches and run them on the policy.
+
+    A batch is dispatched when it reaches `max_batch_size` or when
+    `max_wait_ms` has passed since its first request arrived.
+    The model runs in a single worker thread so that the event loop
+    keeps accepting requests during inference.
+    """
+    def __init__(self, policy, max_batch_size=8, max_wait_ms=5.0, stats=None):
+        self.policy = policy
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = stats if stats is not None else ServerStats()
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, proprio, images, text_embeds):
+        """
+        Submit a step request and wait for its action chunk.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((time.perf_counter(), proprio, images, text_embeds, future))
+        self.stats.queue_depth = self.queue.qsize()
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        self.stats.queue_depth = self.queue.qsize()
+        return batch
+
+    def _run_batch(self, batch):
+        proprios = [item[1] for item in batch]
+        images_list = [item[2] for item in batch]
+        text_embeds_list = [item[3] for item in batch]
+        with torch.inference_mode():
+            actions = self.policy.step_batch(
+                proprios, images_list, text_embeds_list)
+        return actions.cpu().numpy()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            self.stats.record_batch(len(batch))
+            try:
+                actions = await loop.run_in_executor(
+                    self.executor, self._run_batch, batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    if not batch[0][-1].done():
+                        batch[0][-1].set_exception(e)
+                    continue
+                # Run the requests one by one, so that only
+                # the failing ones get the error
+                actions = []
+                for item in batch:
+                    try:
+                        actions.append((await loop.run_in_executor(
+                            self.executor, self._run_batch, [item]))[0])
+                    except Exception as e:
+                        actions.append(e)
+
+            finish_time = time.perf_counter()
+            for i, item in enumerate(batch):
+                self.stats.record_latency(finish_time - item[0])
+                if item[-1].done():
+                    continue
+                if isinstance(actions[i], Exception):
+                    item[-1].set_exception(actions[i])
+                else:
+                    item[-1].set_result(actions[i])
+
+
+class InferenceServer:
+    """
+    Serve `step` and `stats` requests from the clients.
+    """
+    def __init__(self, policy, max_batch_size=8, max_wait_ms=5.0):
+        self.lang_token_dim = policy.args["model"]["lang_token_dim"]
+        self.max_lang_len = policy.args["dataset"]["tokenizer_max_length"]
+        self.stats = ServerStats()
+        self.batcher = DynamicBatcher(
+            policy, max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms, stats=self.stats)
+        self.server = None
+
+    async def start(self, host=None, port=None, unix_path=None):
+        self.batcher.start()
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(
+                self._handle_client, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(
+                self._handle_client, host=host, port=port)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        await self.batcher.stop()
+
+    async def serve_forever(self, **kwargs):
+        await self.start(**kwargs)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    def _parse_step(self, arrays):
+        """
+        Validate a step request before it is batched, so that
+        a malformed request fails alone instead of its whole batch.
+        """
+        for key in ('proprio', 'text_embeds'):
+            if key not in arrays:
+                raise ValueError(f"Missing '{key}' in the step request.")
+        if arrays['proprio'].size != STATE_DIM:
+            raise ValueError(
+                f"Expected {STATE_DIM} proprioceptive states, got shape {arrays['proprio'].shape}.")
+        text_embeds = arrays['text_embeds']
+        if text_embeds.ndim == 3 and text_embeds.shape[0] == 1:
+            text_embeds = text_embeds[0]
+        if text_embeds.ndim != 2 or text_embeds.shape[-1] != self.lang_token_dim \
+                or not 0 < text_embeds.shape[0] <= self.max_lang_len:
+            raise ValueError(
+                f"Expected instruction embeddings of shape [1, L, {self.lang_token_dim}] "
+                f"or [L, {self.lang_token_dim}] with 0 < L <= {self.max_lang_len}, "
+                f"got {arrays['text_embeds'].shape}.")
+
+        proprio = torch.from_numpy(arrays['proprio']).float().reshape(1, -1)
+        text_embeds = torch.from_numpy(text_embeds).float()
+        images = []
+        for i in range(NUM_IMAGES):
+            key = f'image_{i}'
+            if key not in arrays:
+                images.append(None)
+                continue
+            image = arrays[key]
+            if image.dtype != np.uint8 or image.ndim != 3 or image.shape[-1] != 3 \
+                    or 0 in image.shape:
+                raise ValueError(
+                    f"Expected {key} to be an [H, W, 3] uint8 RGB image, "
+                    f"got {image.dtype} of shape {image.shape}.")
+            images.append(PImage.fromarray(image))
+        return proprio, images, text_embeds
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    header, arrays = await read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                msg_type = header.get('type')
+                try:
+                    if msg_type == 'step':
+                        actions = await self.batcher.submit(*self._parse_step(arrays))
+                        response = pack_message({'type': 'step'}, {'actions': actions})
+                    elif msg_type == 'stats':
+                        response = pack_message({'type': 'stats', 'stats': self.stats.summary()})
+                    else:
+                        raise ValueError(f"Unknown message type: {msg_type}")
+                except Exception as e:
+                    response = pack_message({'type': 'error', 'error': repr(e)})
+                writer.write(response)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+class InferenceClient:
+    """
+    A blocking client for the inference server,
+    which can be used in the robot control loop.
+    """
+    def __init__(self, host=None, port=None, unix_path=None):
+        if unix_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+
+    def close(self):
+        self.sock.close()
+
+    def _recv_exactly(self, size):
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("Connection closed by the server.")
+            buf.extend(chunk)
+        return bytes(buf)
+
+    def _request(self, header, arrays=None):
+        self.sock.sendall(pack_message(header, arrays))
+        header_len, payload_len = FRAME_HEADER.unpack(
+            self._recv_exactly(FRAME_HEADER.size))
+        header = json.loads(self._recv_exactly(header_len))
+        arrays = unpack_payload(self._recv_exactly(payload_len))
+        if header['type'] == 'error':
+            raise RuntimeError(f"Server error: {header['error']}")
+        return header, arrays
+
+    def step(self, proprio, images, text_embeds):
+        """
+        Args:
+            proprio: proprioceptive states of shape [14,] or [1, 14]
+            images: a list of 6 RGB images (numpy arrays or None),
+                ordered as in `RoboticDiffusionTransformerModel.step`
+            text_embeds: instruction embeddings of shape [1, L, D] or [L, D]
+
+        Returns:
+            actions: the predicted action chunk ([N, 14])
+        """
+        if isinstance(proprio, torch.Tensor):
+            proprio = proprio.cpu().numpy()
+        if isinstance(text_embeds, torch.Tensor):
+            text_embeds = text_embeds.float().cpu().numpy()
+        arrays = {'proprio': np.asarray(proprio), 'text_embeds': text_embeds}
+        for i, image in enumerate(images):
+            if image is not None:
+                arrays[f'image_{i}'] = np.asarray(image)
+        _, arrays = self._request({'type': 'step'}, arrays)
+        return arrays['actions']
+
+    def get_stats(self):
+        header, _ = self._request({'type': 'stats'})
+        return header['stats']
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default="configs/base.yaml",
+                        help='Path to the config file')
+    parser.add_argument('--pretrained_model_name_or_path', type=str, required=True,
+                        help='Name or path to the pretrained model')
+    parser.add_argument('--pretrained_vision_encoder_name_or_path', type=str,
+                        default="google/siglip-so400m-patch14-384",
+                        help='Name or path to the vision encoder')
+    parser.add_argument('--ctrl_freq', type=int, default=25,
+                        help='The control frequency of the robot')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The host to listen on (TCP)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='The port to listen on (TCP)')
+    parser.add_argument('--unix_path', type=str, default=None,
+                        help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='The maximum number of requests in one batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help='How long to wait for more requests before running a batch')
+    return parser.parse_args()
+
+
+def main():
+    from scripts.agilex_model import create_model
+
+    args = get_arguments()
+    with open(args.config_path, "r") as fp:
+        config = yaml.safe_load(fp)
+
+    policy = create_model(
+        args=config,
+        dtype=torch.bfloat16,
+        pretrained=args.pretrained_model_name_or_path,
+        pretrained_vision_encoder_name_or_path=args.pretrained_vision_encoder_name_or_path,
+        control_frequency=args.ctrl_freq,
+    )
+
+    server = InferenceServer(
+        policy, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    if args.unix_path is not None:
+        print(f"Serving on unix socket {args.unix_path}")
+    else:
+        print(f"Serving on {args.host}:{args.port}")
+    asyncio.run(server.serve_forever(
+        host=args.host, port=args.port, unix_path=args.unix_path))
+
+
+if __name__ == '__main__':
+    main()
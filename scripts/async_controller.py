@@ -0,0 +1,171 @@
+"""
+A pipelined controller that predicts the next action chunk in the
+background while the current one is being executed.
+
+The controller does not depend on ROS or on the model: it is driven
+step by step by the control loop (e.g., scripts/agilex_inference.py)
+with an `observation_fn` that snapshots the latest observation and an
+`infer_fn` that maps an observation to a (chunk_size, action_dim) chunk.
+
+A chunk predicted from the observation at step `t0` starts at step `t0`,
+so its first actions are already stale when it arrives after the model
+latency and are skipped. The next chunk is requested `prefetch_steps`
+steps before the current one runs out. If the inference takes longer,
+the controller waits for it at the end of the chunk. With
+`prefetch_steps=0`, this is the synchronous loop: the robot waits for
+the model at every chunk boundary. When a new chunk arrives, the
+actions are linearly blended from the previous chunk into it over
+`blend_steps` steps, so that the switch is smooth.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class ActionChunk:
+    def __init__(self, start_step, actions):
+        self.start_step = start_step
+        self.actions = actions
+
+    @property
+    def end_step(self):
+        return self.start_step + len(self.actions)
+
+    def covers(self, t):
+        return self.start_step <= t < self.end_step
+
+    def __getitem__(self, t):
+        return self.actions[t - self.start_step]
+
+
+class AsyncChunkController:
+    def __init__(self, infer_fn, chunk_size, prefetch_steps=0, blend_steps=0,
+                 clock=time.perf_counter):
+        """
+        Args:
+            infer_fn: observation -> (chunk_size, action_dim) array,
+                called in a background thread.
+            chunk_size: number of actions of a chunk that may be executed.
+            prefetch_steps: how many steps before the end of the current chunk
+                the next chunk is requested, in [0, chunk_size).
+            blend_steps: number of steps to blend the previous chunk into a
+                new one, 0 to switch at once.
+            clock: the clock for the statistics.
+        """
+        if not 0 <= prefetch_steps < chunk_size:
+            raise ValueError(f"`prefetch_steps` must be in [0, {chunk_size}).")
+        if blend_steps < 0:
+            raise ValueError("`blend_steps` must be non-negative.")
+        self.infer_fn = infer_fn
+        self.chunk_size = chunk_size
+        self.prefetch_steps = prefetch_steps
+        self.blend_steps = blend_steps
+        self.clock = clock
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.pending = None
+        self.reset()
+
+    def reset(self):
+        """
+        Drop the chunks, e.g., at the start of an episode.
+        """
+        self.wait()
+        self.current = None
+        self.previous = None
+        # The step at which the current chunk became available
+        self.switch_step = 0
+        # The step of the observation of the pending request
+        self.pending = None
+        self.pending_step = None
+        self.stats = {
+            "num_inferences": 0,
+            "num_stalls": 0,
+            "stall_time": 0.0,
+            "inference_times": [],
+        }
+
+    def wait(self):
+        """
+        Wait for the pending request, if any.
+        """
+        if self.pending is not None:
+            try:
+                self.pending.result()
+            except Exception:
+                pass
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+    def _infer(self, observation):
+        time_stmp = self.clock()
+        actions = np.asarray(self.infer_fn(observation))
+        with self.lock:
+            self.stats["inference_times"].append(self.clock() - time_stmp)
+            self.stats["num_inferences"] += 1
+        return actions
+
+    def _request(self, t, observation_fn):
+        self.pending_step = t
+        self.pending = self.executor.submit(self._infer, observation_fn())
+
+    def _collect(self, t, block):
+        if self.pending is None or (not block and not self.pending.done()):
+            return
+        if not self.pending.done():
+            time_stmp = self.clock()
+            self.pending.result()
+            self.stats["num_stalls"] += 1
+            self.stats["stall_time"] += self.clock() - time_stmp
+        actions = self.pending.result()
+        if len(actions) < self.chunk_size:
+            raise ValueError(
+                f"The policy returned {len(actions)} actions, less than the chunk size {self.chunk_size}.")
+        chunk = ActionChunk(self.pending_step, actions[:self.chunk_size])
+        self.pending, self.pending_step = None, None
+        self.previous, self.current = self.current, chunk
+        self.switch_step = t
+
+    def step(self, t, observation_fn):
+        """
+        Get the action of step `t`.
+
+        Args:
+            t: the current step, increasing by one every call.
+            observation_fn: () -> a snapshot of the latest observation,
+                only called when a chunk is requested.
+        """
+        self._collect(t, block=False)
+
+        # The current chunk has run out, wait for the next one
+        # (and request another if it arrived too late for this step)
+        while self.current is None or t >= self.current.end_step:
+            if self.pending is None:
+                self._request(t, observation_fn)
+            self._collect(t, block=True)
+        if self.pending is None and t >= self.current.end_step - self.prefetch_steps:
+            # Predict the next chunk while the current one is executed
+            self._request(t, observation_fn)
+
+        action = self.current[t]
+        blend_step = t - self.switch_step
+        if self.previous is not None and blend_step < self.blend_steps \
+            and self.previous.covers(t):
+            weight = (blend_step + 1) / (self.blend_steps + 1)
+            action = (1 - weight) * self.previous[t] + weight * action
+        return action
+
+    def get_stats(self):
+        with self.lock:
+            inference_times = np.array(self.stats["inference_times"])
+            return {
+                "num_inferences": self.stats["num_inferences"],
+                "num_stalls": self.stats["num_stalls"],
+                "stall_time": self.stats["stall_time"],
+                "mean_inference_time": float(inference_times.mean()) if len(inference_times) else 0.0,
+            }
@@ -0,0 +1,97 @@
+"""
+Benchmark the latency of one `RDTBlock` and one `FusedRDTBlock`
+with the same weights (their parity is tested in tests/test_fused_block.py).
+
+The blocks are randomly initialized, so no checkpoint is needed, e.g.:
+
+    python -m scripts.benchmark_rdt_block --device cpu --dtype float32 \
+        --hidden_size 1024 --num_heads 16
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from models.rdt.blocks import FusedRDTBlock, RDTBlock
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--dtype', type=str, default="float32",
+                        choices=["float32", "float16", "bfloat16"])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--hidden_size', type=int, default=2048)
+    parser.add_argument('--num_heads', type=int, default=32)
+    parser.add_argument('--num_tokens', type=int, default=67,
+                        help='Number of state and action tokens, horizon + 3')
+    parser.add_argument('--cond_len', type=int, default=4374,
+                        help='Number of condition tokens, e.g., the image tokens')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    return parser.parse_args()
+
+
+def build_blocks(args, dtype):
+    torch.manual_seed(0)
+    block = RDTBlock(args.hidden_size, args.num_heads)
+    # Non-trivial norm weights, so that the folding is checked
+    for name, param in block.named_parameters():
+        if name.endswith("bias") or "norm" in name:
+            torch.nn.init.normal_(param, mean=1.0 if "norm" in name else 0.0, std=0.1)
+    fused_block = FusedRDTBlock(args.hidden_size, args.num_heads)
+    fused_block.load_state_dict(block.state_dict())
+    return [b.to(args.device, dtype=dtype).eval() for b in (block, fused_block)]
+
+
+def make_inputs(args, dtype):
+    B = args.batch_size
+    x = torch.randn(B, args.num_tokens, args.hidden_size)
+    c = torch.randn(B, args.cond_len, args.hidden_size)
+    mask = torch.rand(B, args.cond_len) > 0.2
+    mask[:, 0] = True
+    return x.to(args.device, dtype=dtype), c.to(args.device, dtype=dtype), \
+        mask.to(args.device)
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def benchmark(block, kv, x, mask, args):
+    latencies = []
+    for i in range(args.warmup + args.iters):
+        synchronize(args.device)
+        time_stmp = time.perf_counter()
+        block(x, None, mask, kv=kv)
+        synchronize(args.device)
+        if i >= args.warmup:
+            latencies.append(time.perf_counter() - time_stmp)
+    return np.array(latencies) * 1000.0
+
+
+def main():
+    args = get_arguments()
+    dtype = getattr(torch, args.dtype)
+    block, fused_block = build_blocks(args, dtype)
+    x, c, mask = make_inputs(args, dtype)
+
+    with torch.inference_mode():
+        # Benchmark with the precomputed condition keys and values, as in sampling
+        kv = block.cross_attn.project_kv(c)
+        block_mask = mask[:, None, None, :]
+        latencies = {
+            "RDTBlock": benchmark(block, kv, x, block_mask, args),
+            "FusedRDTBlock": benchmark(fused_block, kv, x, block_mask, args),
+        }
+
+    for name, lat in latencies.items():
+        p50, p90 = np.percentile(lat, [50, 90])
+        print(f"{name:>14}: mean {lat.mean():.3f} ms, p50 {p50:.3f} ms, p90 {p90:.3f} ms")
+    print(f"Speedup (p50): {np.median(latencies['RDTBlock']) / np.median(latencies['FusedRDTBlock']):.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Benchmark the latency of `RDTRunner.predict_action` in eager and compiled mode.
+
+The model is randomly initialized from the config, so no checkpoint is needed.
+Use a small model to run it on CPU, e.g.:
+
+    python -m scripts.benchmark_sampler --device cpu --dtype float32 \
+        --hidden_size 256 --depth 4 --num_heads 8 --img_tokens 729
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from models.rdt_runner import RDTRunner
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default="configs/base.yaml",
+                        help='Path to the config file')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--dtype', type=str, default="bfloat16",
+                        choices=["float32", "float16", "bfloat16"])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--lang_len', type=int, default=32,
+                        help='Number of language tokens')
+    parser.add_argument('--img_tokens', type=int, default=None,
+                        help='Number of image tokens. Default is img_history_size * num_cameras * 729')
+    parser.add_argument('--hidden_size', type=int, default=None,
+                        help='Override the hidden size in the config')
+    parser.add_argument('--depth', type=int, default=None,
+                        help='Override the depth in the config')
+    parser.add_argument('--num_heads', type=int, default=None,
+                        help='Override the number of heads in the config')
+    parser.add_argument('--sampler', type=str, default=None,
+                        help='The sampler to benchmark, see models/samplers.py')
+    parser.add_argument('--num_inference_timesteps', type=int, default=None)
+    parser.add_argument('--compile_mode', type=str, default=None,
+                        help='The torch.compile mode. Default is reduce-overhead on CUDA and default on CPU')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    return parser.parse_args()
+
+
+def build_model(args, config, dtype):
+    model_config = copy.deepcopy(config["model"])
+    for key in ("hidden_size", "depth", "num_heads"):
+        if getattr(args, key) is not None:
+            model_config["rdt"][key] = getattr(args, key)
+    img_cond_len = args.img_tokens or (
+        config["common"]["img_history_size"] * config["common"]["num_cameras"] * 729)
+    model = RDTRunner(
+        action_dim=config["common"]["state_dim"],
+        pred_horizon=config["common"]["action_chunk_size"],
+        config=model_config,
+        lang_token_dim=model_config["lang_token_dim"],
+        img_token_dim=model_config["img_token_dim"],
+        state_token_dim=model_config["state_token_dim"],
+        max_lang_cond_len=config["dataset"]["tokenizer_max_length"],
+        img_cond_len=img_cond_len,
+        dtype=dtype,
+    )
+    return model.to(args.device, dtype=dtype).eval(), img_cond_len
+
+
+def make_inputs(args, config, img_cond_len):
+    B = args.batch_size
+    state_dim = config["model"]["state_token_dim"]
+    return dict(
+        lang_tokens=torch.randn(B, args.lang_len, config["model"]["lang_token_dim"]),
+        lang_attn_mask=torch.ones(B, args.lang_len, dtype=torch.bool),
+        img_tokens=torch.randn(B, img_cond_len, config["model"]["img_token_dim"]),
+        state_tokens=torch.randn(B, 1, state_dim),
+        action_mask=torch.ones(B, 1, state_dim),
+        ctrl_freqs=torch.full((B,), 25),
+    )
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def benchmark(model, inputs, args):
+    latencies = []
+    for i in range(args.warmup + args.iters):
+        synchronize(args.device)
+        time_stmp = time.perf_counter()
+        action = model.predict_action(
+            **inputs, sampler=args.sampler,
+            num_inference_timesteps=args.num_inference_timesteps)
+        synchronize(args.device)
+        if i >= args.warmup:
+            latencies.append(time.perf_counter() - time_stmp)
+    latencies = np.array(latencies) * 1000.0
+    return action, latencies
+
+
+def main():
+    args = get_arguments()
+    with open(args.config_path, "r") as fp:
+        config = yaml.safe_load(fp)
+    dtype = getattr(torch, args.dtype)
+
+    model, img_cond_len = build_model(args, config, dtype)
+    inputs = make_inputs(args, config, img_cond_len)
+    inputs = {
+        k: v.to(args.device, dtype=dtype) if v.is_floating_point() else v.to(args.device)
+        for k, v in inputs.items()
+    }
+
+    with torch.inference_mode():
+        torch.manual_seed(0)
+        eager_action, eager_latencies = benchmark(model, inputs, args)
+        model.enable_compiled_sampler(mode=args.compile_mode)
+        time_stmp = time.perf_counter()
+        torch.manual_seed(0)
+        model.predict_action(**inputs, sampler=args.sampler,
+                             num_inference_timesteps=args.num_inference_timesteps)
+        print(f"Compilation (first call): {time.perf_counter() - time_stmp:.1f} s")
+        torch.manual_seed(0)
+        compiled_action, compiled_latencies = benchmark(model, inputs, args)
+
+    for name, latencies in (("eager", eager_latencies), ("compiled", compiled_latencies)):
+        p50, p90 = np.percentile(latencies, [50, 90])
+        print(f"{name:>8}: mean {latencies.mean():.2f} ms, p50 {p50:.2f} ms, p90 {p90:.2f} ms")
+    print(f"Speedup (p50): {np.median(eager_latencies) / np.median(compiled_latencies):.2f}x")
+    max_diff = (eager_action.float() - compiled_action.float()).abs().max().item()
+    print(f"Max abs difference of the last actions: {max_diff:.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Consolidate the precomputed language embeddings (the `lang_embed_*.pt`
+files written by scripts/encode_lang_batch.py) into a language embedding
+store (see data/lang_embed_store.py), so that training with
+`--precomp_lang_embed` reads them from one memory-mapped file with
+`--lang_embed_path`:
+
+    python -m scripts.build_lang_embed_store --root_dir data/datasets \
+        --output_dir data/datasets/lang_embeds
+
+Run it from the same directory as the training, so that the paths of the
+embeddings in the samples are resolved in the same way. Rerun it after
+encoding new instructions.
+"""
+import argparse
+import fnmatch
+import os
+
+from data.lang_embed_store import write_lang_embed_store
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_dir', type=str, default="data/datasets",
+                        help='Directory searched for the lang_embed_*.pt files')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Directory of the language embedding store')
+    return parser.parse_args()
+
+
+def find_lang_embeds(root_dir):
+    paths = []
+    for root, dirs, files in os.walk(root_dir):
+        for filename in fnmatch.filter(files, 'lang_embed_*.pt'):
+            paths.append(os.path.join(root, filename))
+    return sorted(paths)
+
+
+def main():
+    args = get_arguments()
+    paths = find_lang_embeds(args.root_dir)
+    print(f"Found {len(paths)} language embeddings under {args.root_dir}.")
+    num_tokens = write_lang_embed_store(args.output_dir, args.root_dir, paths)
+    print(f"Wrote {num_tokens} tokens into {args.output_dir}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Precompute the vision-encoder embeddings of all the frames of the HDF5
+dataset (see data/hdf5_vla_dataset.py) into an image embedding store
+(see data/image_embed_store.py), so that training can skip the vision
+encoder with `--image_embed_path`:
+
+    python -m scripts.encode_image_embeds --output_dir data/datasets/agilex/image_embeds \
+        --dtype float16 [--num_workers 8 --worker_id 0]
+
+Every worker encodes its own shards and skips the completed ones,
+so an interrupted run can be resumed by running it again.
+"""
+import argparse
+import json
+import os
+
+import h5py
+import numpy as np
+import torch
+import yaml
+
+from data.hdf5_vla_dataset import HDF5VLADataset
+from data.image_embed_store import (BACKGROUND_FILE_NAME, META_FILE_NAME,
+                                    STORE_DTYPES, ImageEmbedShardWriter,
+                                    is_shard_complete)
+from models.multimodal_encoder.image_preprocess import BatchImagePreprocessor
+from models.multimodal_encoder.siglip_encoder import SiglipVisionTower
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default="configs/base.yaml",
+                        help='Path to the config file')
+    parser.add_argument('--vision_encoder', type=str, default="google/siglip-so400m-patch14-384",
+                        help='Name or path of the pretrained vision encoder')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Directory of the image embedding store')
+    parser.add_argument('--image_size', type=int, nargs='+', default=None,
+                        help='Resize the frames to this size (H W) or shorter side '
+                             'before preprocessing, as `image_size` of the dataset')
+    parser.add_argument('--auto_adjust_image_brightness', action='store_true',
+                        help='Brighten the dark frames, as the dataset option of the same name')
+    parser.add_argument('--dtype', type=str, default="float16", choices=STORE_DTYPES,
+                        help='Storage format of the embeddings')
+    parser.add_argument('--episodes_per_shard', type=int, default=16)
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of frames per vision encoder forward pass')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of workers that share the shards, e.g., one per GPU')
+    parser.add_argument('--worker_id', type=int, default=0)
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def encode_frames(vision_encoder, preprocessor, frames):
+    """
+    Encode a list of (H, W, 3) frames into (N, P, D) float32 embeddings,
+    with the same preprocessing as `VLAConsumerDataset`.
+    """
+    frames = preprocessor.adjust(frames, [True] * len(frames))
+    images = torch.stack(list(preprocessor.finalize(frames)), dim=0)
+    return vision_encoder(images.to(dtype=vision_encoder.dtype)).float().cpu().numpy()
+
+
+@torch.no_grad()
+def encode_background(vision_encoder, preprocessor):
+    background_image = preprocessor.background_image()
+    frames = preprocessor.adjust([background_image], [False])
+    images = torch.stack(list(preprocessor.finalize(frames)), dim=0)
+    return vision_encoder(images.to(dtype=vision_encoder.dtype)).float().cpu().numpy()[0]
+
+
+def write_shard(args, hdf5_dataset, vision_encoder, preprocessor, shard_idx, file_paths):
+    num_frames = 0
+    for file_path in file_paths:
+        with h5py.File(file_path, 'r') as f:
+            num_frames += f['observations']['qpos'].shape[0] * len(hdf5_dataset.CAMERA_NAMES)
+    writer = ImageEmbedShardWriter(
+        args.output_dir, shard_idx, num_frames,
+        vision_encoder.num_patches, vision_encoder.hidden_size, args.dtype)
+
+    keys, frames = [], []
+    def flush():
+        if len(frames) > 0:
+            writer.write(keys, encode_frames(vision_encoder, preprocessor, frames))
+            keys.clear()
+            frames.clear()
+
+    for file_path in file_paths:
+        episode = hdf5_dataset.get_episode_key(file_path)
+        for step_id, step_frames in hdf5_dataset.iter_hdf5_file_frames(file_path):
+            for camera, frame in step_frames.items():
+                keys.append((episode, step_id, camera))
+                frames.append(frame)
+                if len(frames) >= args.batch_size:
+                    flush()
+    flush()
+    writer.close()
+    return num_frames
+
+
+def main():
+    args = get_arguments()
+    with open(args.config_path, "r") as fp:
+        config = yaml.safe_load(fp)
+
+    vision_encoder = SiglipVisionTower(vision_tower=args.vision_encoder, args=None)
+    vision_encoder.vision_tower.to(args.device, dtype=torch.float16 if args.device != "cpu" else torch.float32)
+    # The same preprocessing as `VLAConsumerDataset`, which checks
+    # the settings recorded in the metadata
+    image_size = args.image_size
+    if image_size is not None and len(image_size) == 1:
+        image_size = image_size[0]
+    preprocess_settings = {
+        "image_aspect_ratio": config["dataset"]["image_aspect_ratio"],
+        "image_size": image_size,
+        "auto_adjust_image_brightness": args.auto_adjust_image_brightness,
+    }
+    preprocessor = BatchImagePreprocessor(vision_encoder.image_processor, **preprocess_settings)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.worker_id == 0:
+        meta = {
+            "vision_encoder": args.vision_encoder,
+            **preprocess_settings,
+            "dtype": args.dtype,
+            "num_patches": vision_encoder.num_patches,
+            "hidden_size": vision_encoder.hidden_size,
+        }
+        tmp_path = os.path.join(args.output_dir, f"{META_FILE_NAME}.tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file, indent=4)
+        os.replace(tmp_path, os.path.join(args.output_dir, META_FILE_NAME))
+        np.save(os.path.join(args.output_dir, BACKGROUND_FILE_NAME),
+                encode_background(vision_encoder, preprocessor))
+
+    hdf5_dataset = HDF5VLADataset()
+    # Sort the episodes so that all the workers agree on the shards
+    file_paths = sorted(hdf5_dataset.file_paths)
+    num_shards = (len(file_paths) + args.episodes_per_shard - 1) // args.episodes_per_shard
+    shard_idxs = list(range(args.worker_id, num_shards, args.num_workers))
+    print(f"Worker {args.worker_id}: encoding {len(shard_idxs)}/{num_shards} shards "
+          f"of {len(file_paths)} episodes into {args.output_dir}...")
+
+    for i, shard_idx in enumerate(shard_idxs):
+        if is_shard_complete(args.output_dir, shard_idx):
+            print(f"Worker {args.worker_id}: shard {shard_idx} is complete, skipped.")
+            continue
+        shard_file_paths = file_paths[
+            shard_idx * args.episodes_per_shard:(shard_idx + 1) * args.episodes_per_shard]
+        num_frames = write_shard(
+            args, hdf5_dataset, vision_encoder, preprocessor, shard_idx, shard_file_paths)
+        print(f"Worker {args.worker_id}: encoded shard {shard_idx} ({num_frames} frames), "
+              f"{i+1}/{len(shard_idxs)} done.")
+
+
+if __name__ == '__main__':
+    main()
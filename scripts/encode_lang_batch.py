@@ -1,76 +1,283 @@
-import os
+"""
+Encode the instructions of all the tasks under `--target_dir` (every directory
+with an `expanded_instruction_gpt-4-turbo.json`) into a language embedding
+store (see data/lang_embed_store.py), for training with `--precomp_lang_embed`
+and `--lang_embed_path`:
+
+    python -m scripts.encode_lang_batch --target_dir data/datasets/agilex/tfrecords/ \
+        --output_dir data/datasets/agilex/lang_embeds [--batch_size 32 --no_save_pt]
+
+The instructions of all the tasks are gathered and the identical ones are
+encoded once. They are sorted by their token length and batched, so that
+the batches are padded as little as possible. The i-th instruction of a task
+gets the key `<task dir>/lang_embed_<i>.pt` (relative to `--target_dir`), the
+path of the file that the previous version of this script wrote. These files
+are still written when the store is consolidated, so `--precomp_lang_embed`
+also works without `--lang_embed_path`, unless `--no_save_pt` is given.
+
+The embeddings are saved in parts of `--part_size` instructions under
+`<output_dir>/parts/`, so an interrupted run is resumed by running it again.
+The instructions can be split among several processes (e.g., one per GPU) with
+`--num_workers` and `--worker_id`, and the store is consolidated by the process
+that finds all the instructions encoded. `manifest.json` in the store records
+the instruction of every key.
+
+Small T5 models (e.g., google/t5-v1_1-small) also run on CPU with `--device cpu`.
+"""
+import argparse
+import glob
 import json
+import os
+import zlib
 
+import numpy as np
 import torch
 import yaml
 from tqdm import tqdm
 
+from data.lang_embed_store import (STORE_DTYPES, LangEmbedStoreWriter,
+                                   dtype_name, embed_from_numpy,
+                                   embed_to_numpy)
 from models.multimodal_encoder.t5_encoder import T5Embedder
 
 
-GPU = 0
-MODEL_PATH = "google/t5-v1_1-xxl"
-CONFIG_PATH = "configs/base.yaml"
-# Modify the TARGET_DIR to your dataset path
-TARGET_DIR = "data/datasets/agilex/tfrecords/"
+INSTRUCTION_FILE_NAME = "expanded_instruction_gpt-4-turbo.json"
+MANIFEST_FILE_NAME = "manifest.json"
+PARTS_DIR_NAME = "parts"
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, default="configs/base.yaml",
+                        help='Path to the config file')
+    parser.add_argument('--model_path', type=str, default="google/t5-v1_1-xxl",
+                        help='Name or path of the pretrained T5 model')
+    parser.add_argument('--target_dir', type=str, default="data/datasets/agilex/tfrecords/",
+                        help='Directory searched for the instructions of the tasks')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Directory of the language embedding store')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--dtype', type=str, default="bfloat16",
+                        choices=["float32", "float16", "bfloat16"])
+    parser.add_argument('--offload_dir', type=str, default=None,
+                        help='Offload directory of the T5 weights, if the GPU VRAM is less than 24GB')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Number of instructions per encoder forward pass')
+    parser.add_argument('--part_size', type=int, default=1024,
+                        help='Number of instructions saved together, i.e., the resume granularity')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of processes that share the instructions, e.g., one per GPU')
+    parser.add_argument('--worker_id', type=int, default=0)
+    parser.add_argument('--no_save_pt', action='store_false', dest='save_pt',
+                        help='Do not write the lang_embed_<i>.pt file of every instruction, '
+                             'which is then only read from the store with `--lang_embed_path`')
+    return parser.parse_args()
+
+
+def gather_instructions(target_dir):
+    """
+    Return {key: instruction} of all the tasks under `target_dir`.
+    """
+    instructions = {}
+    for root, dirs, files in os.walk(target_dir):
+        if INSTRUCTION_FILE_NAME not in files:
+            continue
+        with open(os.path.join(root, INSTRUCTION_FILE_NAME), 'r') as f_instr:
+            instruction_dict = json.load(f_instr)
+        task_instructions = [instruction_dict['instruction']] + \
+            instruction_dict['simplified_instruction'] + instruction_dict['expanded_instruction']
+        task_dir = os.path.relpath(root, target_dir)
+        for i, instruction in enumerate(task_instructions):
+            instructions[os.path.normpath(os.path.join(task_dir, f"lang_embed_{i}.pt"))] = instruction
+    return instructions
+
+
+def part_paths(output_dir, part_name):
+    part_dir = os.path.join(output_dir, PARTS_DIR_NAME)
+    return os.path.join(part_dir, f"{part_name}.npy"), os.path.join(part_dir, f"{part_name}.json")
+
+
+def load_parts(output_dir):
+    """
+    Return {instruction: (part name, offset, num_tokens)} of the complete parts.
+    """
+    encoded = {}
+    for meta_path in sorted(glob.glob(os.path.join(output_dir, PARTS_DIR_NAME, "*.json"))):
+        part_name = os.path.splitext(os.path.basename(meta_path))[0]
+        with open(meta_path, 'r') as file:
+            part = json.load(file)
+        offset = 0
+        for instruction, num_tokens in zip(part["instructions"], part["num_tokens"]):
+            encoded[instruction] = (part_name, offset, num_tokens)
+            offset += num_tokens
+    return encoded
+
+
+def get_worker_id(instruction, num_workers):
+    # A stable assignment, which does not depend on the other instructions
+    return zlib.crc32(instruction.encode('utf-8')) % num_workers
+
+
+def make_batches(tokenizer, instructions, batch_size):
+    """
+    Sort the instructions by their token length and split them into batches.
+    """
+    lengths = [len(input_ids) for input_ids in tokenizer(
+        instructions, truncation=True, add_special_tokens=True)["input_ids"]]
+    order = sorted(range(len(instructions)), key=lambda i: (lengths[i], instructions[i]))
+    sorted_instructions = [instructions[i] for i in order]
+    return [sorted_instructions[i:i + batch_size]
+            for i in range(0, len(sorted_instructions), batch_size)]
+
+
+@torch.no_grad()
+def encode_batch(tokenizer, text_encoder, instructions, device):
+    """
+    Encode a batch of instructions into a list of (L_i, D) embeddings.
+    """
+    tokenized_res = tokenizer(
+        instructions, return_tensors="pt",
+        padding="longest",
+        truncation=True
+    )
+    tokens = tokenized_res["input_ids"].to(device)
+    attn_mask = tokenized_res["attention_mask"].to(device)
+    text_embeds = text_encoder(
+        input_ids=tokens,
+        attention_mask=attn_mask
+    )["last_hidden_state"].detach().cpu()
+    attn_mask = attn_mask.cpu().bool()
+    return [text_embeds[i][attn_mask[i]] for i in range(len(instructions))]
+
+
+def write_part(output_dir, part_name, instructions, embeds):
+    """
+    Save the embeddings of a part. The json is written last to mark it complete.
+    """
+    npy_path, meta_path = part_paths(output_dir, part_name)
+    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+    np.save(npy_path, embed_to_numpy(torch.cat(embeds, dim=0)))
+    tmp_path = f"{meta_path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump({
+            "instructions": instructions,
+            "num_tokens": [embed.shape[0] for embed in embeds],
+        }, file)
+    os.replace(tmp_path, meta_path)
+
+
+def encode_instructions(tokenizer, text_encoder, instructions, args):
+    """
+    Encode the instructions of this worker that are in no complete part yet.
+    """
+    encoded = load_parts(args.output_dir)
+    todo = sorted(
+        instruction for instruction in set(instructions.values())
+        if instruction not in encoded
+        and get_worker_id(instruction, args.num_workers) == args.worker_id)
+    print(f"Worker {args.worker_id}: {len(todo)} instructions to encode, "
+          f"{len(encoded)} already encoded.")
+    if len(todo) == 0:
+        return
+
+    # Continue the numbering of the parts of this worker
+    part_idx = len(glob.glob(os.path.join(
+        args.output_dir, PARTS_DIR_NAME, f"worker{args.worker_id}_*.npy")))
+    part_instructions, part_embeds = [], []
+    def flush():
+        nonlocal part_idx
+        if len(part_instructions) > 0:
+            write_part(args.output_dir, f"worker{args.worker_id}_{part_idx:05d}",
+                       part_instructions, part_embeds)
+            part_idx += 1
+            part_instructions.clear()
+            part_embeds.clear()
+
+    for batch in tqdm(make_batches(tokenizer, todo, args.batch_size)):
+        part_instructions.extend(batch)
+        part_embeds.extend(encode_batch(tokenizer, text_encoder, batch, args.device))
+        if len(part_instructions) >= args.part_size:
+            flush()
+    flush()
+
+
+def consolidate(instructions, args):
+    """
+    Write the store if all the instructions are encoded.
+    Return whether the store was written.
+    """
+    encoded = load_parts(args.output_dir)
+    missing = set(instructions.values()) - set(encoded)
+    if len(missing) > 0:
+        print(f"{len(missing)} instructions are not encoded yet, "
+              f"the store is written once all the workers are done.")
+        return False
+
+    keys_of = {}
+    for key, instruction in sorted(instructions.items()):
+        keys_of.setdefault(instruction, []).append(key)
+    parts = {}
+    dtype = getattr(torch, args.dtype)
+    def get_part(part_name):
+        if part_name not in parts:
+            part = np.load(part_paths(args.output_dir, part_name)[0], mmap_mode='r')
+            if part.dtype != STORE_DTYPES[args.dtype]:
+                raise ValueError(
+                    f"The part {part_name} was not encoded in {args.dtype}, "
+                    f"remove {os.path.join(args.output_dir, PARTS_DIR_NAME)} to encode again.")
+            parts[part_name] = part
+        return parts[part_name]
+
+    hidden_size = get_part(encoded[next(iter(keys_of))][0]).shape[1]
+    num_tokens = sum(encoded[instruction][2] for instruction in keys_of)
+    writer = LangEmbedStoreWriter(args.output_dir, args.target_dir, dtype, hidden_size, num_tokens)
+    for instruction, keys in keys_of.items():
+        part_name, offset, length = encoded[instruction]
+        embed = embed_from_numpy(get_part(part_name)[offset:offset + length], dtype)
+        writer.write(keys, embed)
+        if args.save_pt:
+            for key in keys:
+                torch.save(embed.clone(), os.path.join(args.target_dir, key))
+    writer.close()
+
+    tmp_path = os.path.join(args.output_dir, f"{MANIFEST_FILE_NAME}.tmp{os.getpid()}")
+    with open(tmp_path, 'w') as file:
+        json.dump({
+            "model": args.model_path,
+            "dtype": dtype_name(dtype),
+            "num_instructions": len(instructions),
+            "num_unique_instructions": len(keys_of),
+            "instructions": instructions,
+        }, file, indent=4)
+    os.replace(tmp_path, os.path.join(args.output_dir, MANIFEST_FILE_NAME))
+    print(f"Wrote {len(instructions)} instructions ({len(keys_of)} unique, "
+          f"{num_tokens} tokens) into {args.output_dir}.")
+    return True
 
-# Note: if your GPU VRAM is less than 24GB, 
-# it is recommended to enable offloading by specifying an offload directory.
-OFFLOAD_DIR = None  # Specify your offload directory here, ensuring the directory exists.
 
 def main():
-    with open(CONFIG_PATH, "r") as fp:
+    args = get_arguments()
+    with open(args.config_path, "r") as fp:
         config = yaml.safe_load(fp)
-    
-    device = torch.device(f"cuda:{GPU}")
+
+    instructions = gather_instructions(args.target_dir)
+    if len(instructions) == 0:
+        raise ValueError(f"No {INSTRUCTION_FILE_NAME} found under {args.target_dir}.")
+    print(f"Found {len(instructions)} instructions "
+          f"({len(set(instructions.values()))} unique) under {args.target_dir}.")
+
     text_embedder = T5Embedder(
-        from_pretrained=MODEL_PATH, 
-        model_max_length=config["dataset"]["tokenizer_max_length"], 
-        device=device,
-        use_offload_folder=OFFLOAD_DIR
+        from_pretrained=args.model_path,
+        model_max_length=config["dataset"]["tokenizer_max_length"],
+        device=torch.device(args.device),
+        torch_dtype=getattr(torch, args.dtype),
+        use_offload_folder=args.offload_dir
     )
     tokenizer, text_encoder = text_embedder.tokenizer, text_embedder.model
-    
-    # Get all the task paths
-    task_paths = []
-    for sub_dir in os.listdir(TARGET_DIR):
-        middle_dir = os.path.join(TARGET_DIR, sub_dir)
-        if os.path.isdir(middle_dir):
-            for task_dir in os.listdir(middle_dir):
-                task_path = os.path.join(middle_dir, task_dir)
-                if os.path.isdir(task_path):
-                    task_paths.append(task_path)
-
-    # For each task, encode the instructions
-    for task_path in tqdm(task_paths):
-        # Load the instructions corresponding to the task from the directory
-        with open(os.path.join(task_path, 'expanded_instruction_gpt-4-turbo.json'), 'r') as f_instr:
-            instruction_dict = json.load(f_instr)
-        instructions = [instruction_dict['instruction']] + instruction_dict['simplified_instruction'] + \
-            instruction_dict['expanded_instruction']
-    
-        # Encode the instructions
-        tokenized_res = tokenizer(
-            instructions, return_tensors="pt",
-            padding="longest",
-            truncation=True
-        )
-        tokens = tokenized_res["input_ids"].to(device)
-        attn_mask = tokenized_res["attention_mask"].to(device)
-        
-        with torch.no_grad():
-            text_embeds = text_encoder(
-                input_ids=tokens,
-                attention_mask=attn_mask
-            )["last_hidden_state"].detach().cpu()
-        
-        attn_mask = attn_mask.cpu().bool()
-
-        # Save the embeddings for training use
-        for i in range(len(instructions)):
-            text_embed = text_embeds[i][attn_mask[i]]
-            save_path = os.path.join(task_path, f"lang_embed_{i}.pt")
-            torch.save(text_embed, save_path)
+
+    encode_instructions(tokenizer, text_encoder, instructions, args)
+    consolidate(instructions, args)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,181 @@
+"""
+Timestamp synchronization of the sensor streams of the robot.
+
+Every topic has a bounded ring buffer of (stamp, message) with the stamps
+in their own preallocated array, so a timestamp is found by a binary
+search over the buffered messages instead of scanning them, and a stalled
+consumer overwrites the oldest messages instead of growing the memory.
+
+The buffers do not depend on ROS: the subscriber callbacks (e.g., in
+scripts/agilex_inference.py) push `msg.header.stamp.to_sec()` with the
+message, and the control loop reads aligned frames with
+`ApproximateTimeSynchronizer.get`.
+
+A buffer has one writer (the callback thread of its topic) and one reader
+(the control loop) and takes no lock: the writer fills a slot before it
+publishes its sequence number, and the reader retries if the writer
+wrapped around the slots it read in the meantime.
+"""
+
+
+class StampedRingBuffer:
+    def __init__(self, capacity=2000):
+        """
+        Args:
+            capacity: the maximum number of buffered messages, at least 2.
+                One slot is kept free for the writer.
+        """
+        if capacity < 2:
+            raise ValueError("`capacity` must be at least 2.")
+        self.capacity = capacity
+        self.stamps = [0.0] * capacity
+        self.msgs = [None] * capacity
+        # The sequence numbers of the next message to write
+        # and of the first message that is not consumed
+        self.write_seq = 0
+        self.read_seq = 0
+        self.num_out_of_order = 0
+
+    def push(self, stamp, msg):
+        """
+        Append a message, dropping it if it is older than the last one.
+        Called by the writer only.
+        """
+        seq = self.write_seq
+        if seq > 0 and stamp < self.stamps[(seq - 1) % self.capacity]:
+            self.num_out_of_order += 1
+            return
+        slot = seq % self.capacity
+        self.stamps[slot] = stamp
+        self.msgs[slot] = msg
+        self.write_seq = seq + 1
+
+    def _window(self):
+        # The sequence numbers [begin, end) that can be read,
+        # the slot of `end` may be being written
+        end = self.write_seq
+        return max(self.read_seq, end - self.capacity + 1), end
+
+    def _is_intact(self, begin):
+        # Whether the writer has not wrapped around `begin` since the window was taken
+        return begin >= self.write_seq - self.capacity + 1
+
+    def __len__(self):
+        begin, end = self._window()
+        return end - begin
+
+    def latest(self):
+        """
+        Return the (stamp, message) last pushed, consumed or not, or None.
+        """
+        while True:
+            end = self.write_seq
+            if end == 0:
+                return None
+            slot = (end - 1) % self.capacity
+            item = (self.stamps[slot], self.msgs[slot])
+            if self._is_intact(end - 1):
+                return item
+
+    def latest_stamp(self):
+        item = self.latest()
+        return None if item is None else item[0]
+
+    def _bisect(self, t, begin, end):
+        # The first sequence number in [begin, end) with a stamp >= t
+        lo, hi = begin, end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.stamps[mid % self.capacity] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def search(self, t):
+        """
+        Return the (seq, stamp, message) of the first message not consumed
+        with a stamp >= t, or None.
+        """
+        while True:
+            begin, end = self._window()
+            seq = self._bisect(t, begin, end)
+            item = None
+            if seq < end:
+                slot = seq % self.capacity
+                item = (seq, self.stamps[slot], self.msgs[slot])
+            if self._is_intact(begin):
+                return item
+
+    def nearest(self, t):
+        """
+        Return the (seq, stamp, message) of the message not consumed
+        with the stamp nearest to t, or None.
+        """
+        while True:
+            begin, end = self._window()
+            seq = self._bisect(t, begin, end)
+            item = None
+            candidates = [s for s in (seq - 1, seq) if begin <= s < end]
+            if len(candidates) > 0:
+                seq = min(candidates, key=lambda s: abs(self.stamps[s % self.capacity] - t))
+                slot = seq % self.capacity
+                item = (seq, self.stamps[slot], self.msgs[slot])
+            if self._is_intact(begin):
+                return item
+
+    def consume(self, seq):
+        """
+        Mark the messages up to and including `seq` as consumed.
+        Called by the reader only.
+        """
+        self.read_seq = max(self.read_seq, seq + 1)
+
+
+class ApproximateTimeSynchronizer:
+    def __init__(self, topics, capacity=2000):
+        self.buffers = {topic: StampedRingBuffer(capacity) for topic in topics}
+
+    def push(self, topic, stamp, msg):
+        self.buffers[topic].push(stamp, msg)
+
+    def latest(self, topic):
+        """
+        Return the message of `topic` last pushed, or None.
+        """
+        item = self.buffers[topic].latest()
+        return None if item is None else item[1]
+
+    def get(self, topics, ref_topics=None):
+        """
+        Get a frame of aligned messages and consume them with the older ones.
+
+        The frame time is the oldest of the latest stamps of `ref_topics`
+        (e.g., the cameras), i.e., the latest time at which all of them
+        have a message. Every topic takes its first message not consumed
+        that is not older than the frame time.
+
+        Args:
+            topics: the topics of the frame.
+            ref_topics: the topics that set the frame time, default `topics`.
+
+        Returns:
+            a tuple of the messages in the order of `topics`, or None if a
+            topic has no message for the frame yet (nothing is consumed).
+        """
+        if ref_topics is None:
+            ref_topics = topics
+        stamps = [self.buffers[topic].latest_stamp() for topic in ref_topics]
+        if any(stamp is None for stamp in stamps):
+            return None
+        frame_time = min(stamps)
+
+        items = []
+        for topic in topics:
+            item = self.buffers[topic].search(frame_time)
+            if item is None:
+                return None
+            items.append(item)
+        for topic, (seq, _, _) in zip(topics, items):
+            self.buffers[topic].consume(seq)
+        return tuple(msg for _, _, msg in items)
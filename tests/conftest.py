@@ -0,0 +1,84 @@
+import copy
+import os
+import sys
+
+import pytest
+import torch
+import yaml
+
+# Run the tests from the repository root, like the scripts
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_tiny_config(**rdt_kwargs):
+    """
+    The base config with a tiny RDT, which runs on CPU in a few seconds.
+    """
+    with open(os.path.join(ROOT_DIR, "configs/base.yaml"), "r") as file:
+        config = yaml.safe_load(file)
+    config = copy.deepcopy(config)
+    config["common"].update(action_chunk_size=16)
+    config["dataset"].update(tokenizer_max_length=32)
+    config["model"].update(lang_token_dim=48, img_token_dim=32)
+    config["model"]["rdt"].update(hidden_size=64, depth=2, num_heads=4)
+    config["model"]["rdt"].update(rdt_kwargs)
+    return config
+
+
+def build_tiny_runner(config, img_cond_len=64, seed=0):
+    from models.rdt_runner import RDTRunner
+
+    torch.manual_seed(seed)
+    return RDTRunner(
+        action_dim=config["common"]["state_dim"],
+        pred_horizon=config["common"]["action_chunk_size"],
+        config=config["model"],
+        lang_token_dim=config["model"]["lang_token_dim"],
+        img_token_dim=config["model"]["img_token_dim"],
+        state_token_dim=config["model"]["state_token_dim"],
+        max_lang_cond_len=config["dataset"]["tokenizer_max_length"],
+        img_cond_len=img_cond_len,
+        dtype=torch.float32,
+    ).float().eval()
+
+
+def make_runner_inputs(config, batch_size=2, img_cond_len=64, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    lang_len = config["dataset"]["tokenizer_max_length"]
+    lang_tokens = torch.randn(
+        batch_size, lang_len, config["model"]["lang_token_dim"], generator=generator)
+    lang_lens = torch.randint(1, lang_len + 1, (batch_size,), generator=generator)
+    lang_attn_mask = torch.arange(lang_len)[None] < lang_lens[:, None]
+    img_tokens = torch.randn(
+        batch_size, img_cond_len, config["model"]["img_token_dim"], generator=generator)
+    state_dim = config["model"]["state_token_dim"]
+    state_tokens = torch.randn(batch_size, 1, state_dim, generator=generator)
+    action_mask = torch.ones(batch_size, 1, state_dim)
+    ctrl_freqs = torch.full((batch_size,), 25)
+    return dict(lang_tokens=lang_tokens, lang_attn_mask=lang_attn_mask,
+                img_tokens=img_tokens, state_tokens=state_tokens,
+                action_mask=action_mask, ctrl_freqs=ctrl_freqs)
+
+
+@pytest.fixture
+def tiny_config():
+    return load_tiny_config()
+
+
+@pytest.fixture(scope="session")
+def tiny_vision_tower_dir(tmp_path_factory):
+    """
+    A randomly initialized tiny SigLIP saved like a pretrained one.
+    """
+    from transformers import (SiglipImageProcessor, SiglipVisionConfig,
+                              SiglipVisionModel)
+
+    path = tmp_path_factory.mktemp("siglip")
+    torch.manual_seed(0)
+    SiglipVisionModel(SiglipVisionConfig(
+        hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+        num_attention_heads=2, image_size=32, patch_size=8,
+    )).save_pretrained(path)
+    SiglipImageProcessor(size={"height": 32, "width": 32}).save_pretrained(path)
+    return str(path)
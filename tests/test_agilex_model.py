@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import torch
+
+from scripts.agilex_model import create_model
+
+
+@pytest.fixture
+def policies(tiny_vision_tower_dir):
+    from conftest import load_tiny_config
+
+    config = load_tiny_config()
+    policies = [create_model(
+        args=config,
+        device="cpu",
+        dtype=torch.float32,
+        pretrained_vision_encoder_name_or_path=tiny_vision_tower_dir,
+        cache_image_embeds=cache_image_embeds,
+    ) for cache_image_embeds in (True, False)]
+    return policies
+
+
+@pytest.fixture
+def num_encoded(policies, monkeypatch):
+    # The number of images encoded by the cached policy
+    counts = [0]
+    policy = policies[0]
+    encode_pixel_values = policy._encode_pixel_values
+    def counting_encode_pixel_values(pixel_values):
+        counts[0] += pixel_values.shape[0]
+        return encode_pixel_values(pixel_values)
+    monkeypatch.setattr(policy, "_encode_pixel_values", counting_encode_pixel_values)
+    def take():
+        count, counts[0] = counts[0], 0
+        return count
+    return take
+
+
+def make_frames(seed):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (24, 40, 3), dtype=np.uint8) for _ in range(3)]
+
+
+def encode_window(policy, frames, stamps):
+    # The frames of the steps t-1 and t, None for the missing ones
+    images = [None] * 3 if frames[0] is None else frames[0]
+    images = images + frames[1]
+    return policy._encode_images(images, [stamps[0]] * 3 + [stamps[1]] * 3)
+
+
+def test_cached_embeddings_across_calls(policies, num_encoded):
+    policy, uncached_policy = policies
+    frames = {stamp: make_frames(stamp) for stamp in range(4)}
+
+    def check(window, expected_num_encoded):
+        images = [frames.get(stamp) for stamp in window]
+        embeds = encode_window(policy, images, window)
+        expected = encode_window(uncached_policy, images, window)
+        torch.testing.assert_close(embeds, expected, atol=1e-5, rtol=1e-4)
+        assert num_encoded() == expected_num_encoded
+
+    # The first step has no frames at t-1: the background is encoded once
+    check((None, 0), 1 + 3)
+    # The frames of the control loop are encoded every step ...
+    for stamp in (1, 2):
+        policy.update_image_embeds(frames[stamp], stamp)
+        assert num_encoded() == 3
+        policy.update_image_embeds(frames[stamp], stamp)
+        assert num_encoded() == 0
+    # ... so a chunk requested later encodes nothing
+    check((1, 2), 0)
+    # Without the control loop, the frames at t are encoded by the call
+    check((2, 3), 3)
+    # Only the last `img_history_size` frames of each camera are kept
+    check((1, 3), 3)
+    # The background embedding stays cached
+    check((None, 3), 0)
+
+
+def test_frames_without_stamps_are_not_cached(policies, num_encoded):
+    policy, _ = policies
+    frames = make_frames(0)
+    for _ in range(2):
+        policy._encode_images([None] * 3 + frames)
+    assert num_encoded() == 1 + 3 + 3
+
+
+def test_reset_drops_the_cache(policies, num_encoded):
+    policy, _ = policies
+    frames = make_frames(0)
+    encode_window(policy, (None, frames), (None, 0))
+    assert num_encoded() == 4
+    policy.reset_image_embeds()
+    encode_window(policy, (None, frames), (None, 0))
+    assert num_encoded() == 4
+    # reset() drops it too
+    policy.reset()
+    encode_window(policy, (None, frames), (None, 0))
+    assert num_encoded() == 4
+
+
+def test_step_with_stamps_matches_uncached(policies):
+    policy, uncached_policy = policies
+    # The output layer of RDT is zero-initialized, so that the
+    # actions would not depend on the images
+    torch.manual_seed(1)
+    with torch.no_grad():
+        for param in policy.policy.model.final_layer.ffn_final.fc2.parameters():
+            param.normal_(std=0.1)
+    uncached_policy.policy.load_state_dict(policy.policy.state_dict())
+    rng = np.random.default_rng(0)
+    proprio = torch.from_numpy(rng.standard_normal((1, 14)).astype(np.float32))
+    text_embeds = torch.from_numpy(rng.standard_normal((1, 5, 48)).astype(np.float32))
+    images = make_frames(1) + make_frames(2)
+    policy.update_image_embeds(images[:3], 1)
+    actions = []
+    for p, stamps in ((policy, [1] * 3 + [2] * 3), (uncached_policy, None)):
+        torch.manual_seed(0)
+        actions.append(p.step(proprio, images, text_embeds, image_stamps=stamps))
+    torch.testing.assert_close(actions[0], actions[1], atol=1e-4, rtol=1e-4)
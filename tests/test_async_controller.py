@@ -0,0 +1,177 @@
+import time
+
+import numpy as np
+import pytest
+
+from scripts.async_controller import AsyncChunkController
+
+
+class SimulatedClock:
+    """
+    The time of the control loop, and of the background inference while it runs.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.background = None
+
+    def __call__(self):
+        return self.now if self.background is None else self.background
+
+    def sleep(self, seconds):
+        if self.background is None:
+            self.now += seconds
+        else:
+            self.background += seconds
+
+
+class SimulatedFuture:
+    def __init__(self, clock, due, result, error):
+        self.clock = clock
+        self.due = due
+        self._result = result
+        self.error = error
+
+    def done(self):
+        return self.clock.now >= self.due
+
+    def result(self):
+        # Waiting for the inference takes the control loop to its end
+        self.clock.now = max(self.clock.now, self.due)
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+
+class SimulatedExecutor:
+    """
+    Run the inference in the simulated background: it starts at the
+    current time and its result is available after the time it took.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+
+    def submit(self, fn, *args):
+        self.clock.background = self.clock.now
+        result, error = None, None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            error = e
+        due, self.clock.background = self.clock.background, None
+        return SimulatedFuture(self.clock, due, result, error)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class FakePolicy:
+    """
+    Predict the chunk of the observation at step t0 as [t0, t0 + 1, ...],
+    plus 100 times the index of the request, so that the action executed
+    at step t tells from which chunk and which index it was taken.
+    """
+    def __init__(self, clock, latency, chunk_size):
+        self.clock = clock
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.observations = []
+
+    def __call__(self, t0):
+        offset = 100.0 * len(self.observations)
+        self.observations.append(t0)
+        self.clock.sleep(self.latency)
+        return (t0 + offset + np.arange(self.chunk_size, dtype=np.float64))[:, None]
+
+
+# Exact in binary, so that the simulated times add up exactly
+STEP_TIME = 0.125
+
+
+def run_controller(chunk_size, latency_steps, num_steps, **kwargs):
+    clock = SimulatedClock()
+    policy = FakePolicy(clock, latency_steps * STEP_TIME, chunk_size)
+    controller = AsyncChunkController(policy, chunk_size, clock=clock, **kwargs)
+    controller.executor = SimulatedExecutor(clock)
+    actions = []
+    for t in range(num_steps):
+        actions.append(controller.step(t, lambda: t)[0])
+        clock.sleep(STEP_TIME)
+    stats = controller.get_stats()
+    controller.close()
+    return np.array(actions), policy.observations, stats
+
+
+def test_synchronous_loop_waits_at_every_chunk():
+    actions, observations, stats = run_controller(
+        chunk_size=4, latency_steps=3, num_steps=12, prefetch_steps=0)
+    assert observations == [0, 4, 8]
+    # The chunk of step t0 starts at t0
+    np.testing.assert_allclose(actions % 100, np.arange(12))
+    assert stats["num_inferences"] == 3
+    assert stats["num_stalls"] == 3
+    assert stats["stall_time"] == pytest.approx(3 * 3 * STEP_TIME)
+    assert stats["mean_inference_time"] == pytest.approx(3 * STEP_TIME)
+
+
+def test_prefetch_hands_off_without_stalls():
+    actions, observations, stats = run_controller(
+        chunk_size=8, latency_steps=3, num_steps=20, prefetch_steps=4)
+    # The next chunk is requested 4 steps before the end of the current one
+    assert observations == [0, 4, 8, 12, 16]
+    # The chunks arrive 3 steps after their request: their stale actions
+    # are skipped and every step takes the action of its own time
+    np.testing.assert_allclose(actions % 100, np.arange(20))
+    np.testing.assert_allclose(actions // 100, [0] * 7 + [1] * 4 + [2] * 4 + [3] * 4 + [4])
+    # Only the first chunk is waited for
+    assert stats["num_stalls"] == 1
+    assert stats["stall_time"] == pytest.approx(3 * STEP_TIME)
+
+
+def test_late_chunk_stalls_until_it_arrives():
+    actions, observations, stats = run_controller(
+        chunk_size=8, latency_steps=5, num_steps=10, prefetch_steps=2)
+    # Requested at step 6, the chunk arrives at step 11 in time,
+    # so step 8 waits 3 steps for it and takes its third action
+    assert observations == [0, 6]
+    np.testing.assert_allclose(actions % 100, np.arange(10))
+    np.testing.assert_allclose(actions // 100, [0] * 8 + [1] * 2)
+    assert stats["num_stalls"] == 2
+    assert stats["stall_time"] == pytest.approx((5 + 3) * STEP_TIME)
+
+
+def test_blend_into_new_chunk():
+    actions, _, _ = run_controller(
+        chunk_size=8, latency_steps=3, num_steps=11, prefetch_steps=4, blend_steps=2)
+    # The second chunk arrives at step 7
+    np.testing.assert_allclose(actions[:7], np.arange(7))
+    np.testing.assert_allclose(actions[7], 7 + 100 * 1 / 3)
+    np.testing.assert_allclose(actions[8:], np.arange(8, 11) + 100)
+    # ... and the first chunk no longer covers step 8
+    actions, _, _ = run_controller(
+        chunk_size=8, latency_steps=3, num_steps=10, prefetch_steps=4, blend_steps=3)
+    np.testing.assert_allclose(actions[7:9], [7 + 100 * 1 / 4, 108])
+
+
+def test_short_chunk_raises():
+    clock = SimulatedClock()
+    controller = AsyncChunkController(
+        lambda t0: np.zeros((2, 1)), chunk_size=4, clock=clock)
+    controller.executor = SimulatedExecutor(clock)
+    with pytest.raises(ValueError):
+        controller.step(0, lambda: 0)
+
+
+def test_background_thread():
+    # The real executor, with an inference that is slower than a step
+    chunk_size = 8
+    def infer(t0):
+        time.sleep(0.005)
+        return (t0 + np.arange(chunk_size, dtype=np.float64))[:, None]
+    controller = AsyncChunkController(infer, chunk_size, prefetch_steps=4, blend_steps=2)
+    for episode in range(2):
+        controller.reset()
+        for t in range(40):
+            assert controller.step(t, lambda: t)[0] == t
+            time.sleep(0.001)
+    assert controller.get_stats()["num_inferences"] >= 40 // chunk_size
+    controller.close()
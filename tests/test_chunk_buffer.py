@@ -0,0 +1,48 @@
+import numpy as np
+
+from data.chunk_buffer import CHUNK_FILE_NAME, ChunkBuffer, is_chunk_buffer
+
+
+def make_sample(value):
+    json_content = {"value": value}
+    arrays = {
+        "step_id": np.array(value, dtype=np.int64),
+        "frames": np.full((2, 4, 4, 3), value % 256, dtype=np.uint8),
+    }
+    return json_content, arrays
+
+
+def test_write_and_read_sample(tmp_path):
+    buffer = ChunkBuffer.create(str(tmp_path), num_slots=4, slot_size=4096)
+    json_content, arrays = make_sample(7)
+    buffer.write_sample(2, json_content, arrays)
+    read_content, read_arrays = buffer.read_sample(2)
+    assert read_content == json_content
+    assert list(read_arrays) == list(arrays)
+    for key, value in arrays.items():
+        assert np.array_equal(read_arrays[key], value)
+        assert read_arrays[key].dtype == value.dtype
+
+
+def test_recreate_does_not_truncate_mapped_file(tmp_path):
+    chunk_dir = str(tmp_path)
+    writer = ChunkBuffer.create(chunk_dir, num_slots=4, slot_size=4096)
+    writer.write_sample(0, *make_sample(1))
+    reader = ChunkBuffer(chunk_dir)
+    assert not reader.is_replaced()
+
+    # A different slot size makes a new file
+    new_writer = ChunkBuffer.create(chunk_dir, num_slots=4, slot_size=8192)
+    new_writer.write_sample(0, *make_sample(2))
+    # The old map still reads the old file instead of faulting
+    assert reader.read_sample(0)[0] == {"value": 1}
+    assert reader.is_replaced()
+    assert ChunkBuffer(chunk_dir).read_sample(0)[0] == {"value": 2}
+    assert [path.name for path in tmp_path.iterdir()] == [CHUNK_FILE_NAME]
+
+
+def test_chunk_format_is_detected_from_the_files(tmp_path):
+    chunk_dir = str(tmp_path)
+    assert not is_chunk_buffer(chunk_dir)
+    ChunkBuffer.create(chunk_dir, num_slots=2, slot_size=4096).close()
+    assert is_chunk_buffer(chunk_dir)
@@ -0,0 +1,95 @@
+import pytest
+import torch
+
+from conftest import build_tiny_runner, load_tiny_config, make_runner_inputs
+
+
+@pytest.fixture
+def runner():
+    torch._dynamo.reset()
+    runner = build_tiny_runner(load_tiny_config())
+    yield runner
+    torch._dynamo.reset()
+
+
+def count_compiled_calls(runner):
+    # The number of denoising steps run by the compiled step
+    counts = [0]
+    compiled_denoise_step = runner.compiled_denoise_step
+    def counting_denoise_step(*args, **kwargs):
+        counts[0] += 1
+        return compiled_denoise_step(*args, **kwargs)
+    runner.compiled_denoise_step = counting_denoise_step
+    def take():
+        count, counts[0] = counts[0], 0
+        return count
+    return take
+
+
+def sample(runner, inputs, seed=0, **kwargs):
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        return runner.predict_action(**inputs, **kwargs)
+
+
+@pytest.mark.parametrize("cache_cond_kv", [True, False])
+def test_compiled_matches_eager(runner, cache_cond_kv):
+    config = load_tiny_config()
+    inputs = make_runner_inputs(config)
+    expected = sample(runner, inputs, cache_cond_kv=cache_cond_kv)
+
+    runner.enable_compiled_sampler()
+    num_compiled = count_compiled_calls(runner)
+    for seed in range(2):
+        actions = sample(runner, inputs, seed=seed, cache_cond_kv=cache_cond_kv)
+        assert num_compiled() == runner.num_inference_timesteps
+        if seed == 0:
+            torch.testing.assert_close(actions, expected, atol=1e-5, rtol=1e-4)
+
+    runner.disable_compiled_sampler()
+    torch.testing.assert_close(
+        sample(runner, inputs, cache_cond_kv=cache_cond_kv), expected, atol=0, rtol=0)
+
+
+def test_other_shapes_fall_back_to_eager(runner):
+    config = load_tiny_config()
+    inputs = make_runner_inputs(config, batch_size=2)
+    other_inputs = make_runner_inputs(config, batch_size=3)
+    expected = sample(runner, other_inputs)
+
+    runner.enable_compiled_sampler()
+    num_compiled = count_compiled_calls(runner)
+    # The shapes of the first call are captured
+    sample(runner, inputs)
+    assert num_compiled() == runner.num_inference_timesteps
+    signature = runner.compiled_signature
+
+    # Another batch size runs the eager step, which gives the eager output
+    actions = sample(runner, other_inputs)
+    assert num_compiled() == 0
+    assert runner.compiled_signature == signature
+    torch.testing.assert_close(actions, expected, atol=0, rtol=0)
+
+    # ... and the captured shapes still run the compiled step
+    sample(runner, inputs)
+    assert num_compiled() == runner.num_inference_timesteps
+
+
+def test_select_denoise_step(runner):
+    tensors = [torch.zeros(2, 16, 128), torch.zeros(2, 1, 64), None]
+    assert runner._select_denoise_step(*tensors) == (runner.denoise_step, False)
+
+    runner.enable_compiled_sampler()
+    assert runner._select_denoise_step(*tensors) == (runner.compiled_denoise_step, True)
+    assert runner._select_denoise_step(*tensors) == (runner.compiled_denoise_step, True)
+    # Another shape, dtype or missing tensor
+    for other in (
+        [torch.zeros(3, 16, 128), torch.zeros(3, 1, 64), None],
+        [torch.zeros(2, 16, 128, dtype=torch.float64), torch.zeros(2, 1, 64), None],
+        [torch.zeros(2, 16, 128), None, None],
+    ):
+        assert runner._select_denoise_step(*other) == (runner.denoise_step, False)
+
+    # Enabling the compiled step again captures new shapes
+    runner.enable_compiled_sampler()
+    assert runner._select_denoise_step(*other) == (runner.compiled_denoise_step, True)
@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from conftest import build_tiny_runner, load_tiny_config, make_runner_inputs
+
+
+@pytest.mark.parametrize("sampler", ["dpmsolver++", "ddim"])
+@pytest.mark.parametrize("pack_lang_cond", [False, True])
+def test_cached_cond_kv_matches_recomputed(sampler, pack_lang_cond):
+    config = load_tiny_config(pack_lang_cond=pack_lang_cond)
+    runner = build_tiny_runner(config)
+    inputs = make_runner_inputs(config)
+
+    outputs = []
+    with torch.no_grad():
+        for cache_cond_kv in (True, False):
+            torch.manual_seed(2)
+            outputs.append(runner.predict_action(
+                **inputs, cache_cond_kv=cache_cond_kv, sampler=sampler))
+    assert torch.equal(outputs[0], outputs[1])
+
+
+def test_cross_attention_with_precomputed_kv():
+    config = load_tiny_config()
+    runner = build_tiny_runner(config)
+    cross_attn = runner.model.blocks[0].cross_attn
+    hidden_size = config["model"]["rdt"]["hidden_size"]
+    generator = torch.Generator().manual_seed(3)
+    x = torch.randn(2, 5, hidden_size, generator=generator)
+    c = torch.randn(2, 7, hidden_size, generator=generator)
+    mask = torch.ones(2, 1, 1, 7, dtype=torch.bool)
+    mask[1, ..., 4:] = False
+
+    with torch.no_grad():
+        expected = cross_attn(x, c, mask)
+        actual = cross_attn(x, c, mask, kv=cross_attn.project_kv(c))
+    assert torch.equal(actual, expected)
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pytest
+from transformers import SiglipImageProcessor
+
+from conftest import ROOT_DIR, load_tiny_config
+from data.chunk_buffer import ChunkBuffer
+from data.dirty_bit import CLEAN, DIRTY, DirtyBitmap
+
+# The image augmentation of the dataset
+pytest.importorskip("imgaug")
+import train.dataset as dataset_module
+from train.dataset import VLAConsumerDataset
+
+
+NUM_CHUNKS = 4
+CHUNK_SIZE = 2
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    # The dataset reads its configs relative to the repository root
+    monkeypatch.chdir(ROOT_DIR)
+    config = load_tiny_config()["dataset"]
+    config.update(buf_path=str(tmp_path), buf_num_chunks=NUM_CHUNKS,
+                  buf_chunk_size=CHUNK_SIZE)
+    return VLAConsumerDataset(
+        config=config, tokenizer=None,
+        image_processor=SiglipImageProcessor(size={"height": 32, "width": 32}),
+        num_cameras=3, img_history_size=2)
+
+
+def write_chunk(chunk_dir, value):
+    os.makedirs(chunk_dir, exist_ok=True)
+    buffer = ChunkBuffer.create(chunk_dir, num_slots=CHUNK_SIZE, slot_size=4096)
+    for slot in range(CHUNK_SIZE):
+        buffer.write_sample(slot, {"value": value}, {"step_id": np.array(value)})
+    buffer.close()
+    return DirtyBitmap.create(chunk_dir, CHUNK_SIZE, state=CLEAN)
+
+
+def test_safe_load_backs_off_until_a_chunk_is_written(dataset, monkeypatch, capsys):
+    # The producer writes a chunk after a few searches
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 8:
+            write_chunk(os.path.join(dataset.buffer_dir, "chunk_2"), 5)
+    monkeypatch.setattr(dataset_module.time, "sleep", sleep)
+
+    content, step_id = dataset._safe_load(0)
+    assert content == {"value": 5} and step_id == 5
+    # One sleep per search of all the chunks, exponentially longer up to the maximum
+    assert sleeps == [min(dataset.SEARCH_BACKOFF_MIN * 2 ** i, dataset.SEARCH_BACKOFF_MAX)
+                      for i in range(8)]
+    assert sleeps[-1] == dataset.SEARCH_BACKOFF_MAX
+
+    # Every missing chunk is reported once, without a traceback
+    output = capsys.readouterr().out
+    assert output.count("Waiting for the chunk") == NUM_CHUNKS
+    assert "Traceback" not in output
+    assert set(dataset.missing_chunk_dirs) == {
+        os.path.join(dataset.buffer_dir, f"chunk_{i}") for i in (0, 1, 3)}
+
+    # The item is released to the producer
+    bitmap = DirtyBitmap(os.path.join(dataset.buffer_dir, "chunk_2"))
+    assert DIRTY in bitmap.bits.tolist()
+
+
+def test_safe_load_does_not_wait_for_a_clean_item(dataset, monkeypatch):
+    for i in range(NUM_CHUNKS):
+        write_chunk(os.path.join(dataset.buffer_dir, f"chunk_{i}"), i)
+    def sleep(seconds):
+        raise AssertionError("Slept with clean items in the buffer")
+    monkeypatch.setattr(dataset_module.time, "sleep", sleep)
+
+    # The search starts from the chunk of the index
+    assert dataset._safe_load(3 * CHUNK_SIZE)[0] == {"value": 3}
+    # ... and moves on to the next chunks when it has no clean item
+    assert dataset._safe_load(3 * CHUNK_SIZE)[0] == {"value": 3}
+    assert dataset._safe_load(3 * CHUNK_SIZE)[0] == {"value": 0}
@@ -0,0 +1,137 @@
+"""
+A stress test of the dirty-bit protocol between the producers and the
+consumers (see data/producer.py and train/dataset.py): several processes
+share one chunk and no sample may be lost or served twice.
+"""
+import json
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+from data.chunk_buffer import ChunkBuffer
+from data.dirty_bit import CLEAN, DIRTY, READING, WRITING, DirtyBitmap
+
+
+CHUNK_SIZE = 16
+NUM_PRODUCERS = 3
+NUM_CONSUMERS = 4
+SAMPLES_PER_PRODUCER = 300
+# Every n-th write of a producer fails and must leave the slot dirty
+FAIL_EVERY = 7
+
+
+def write_sample(buffer, idx, sample_id):
+    buffer.write_sample(idx, {"id": sample_id}, {
+        "step_id": np.array(sample_id, dtype=np.int64),
+        "frames": np.full((2, 8, 8, 3), sample_id % 251, dtype=np.uint8),
+    })
+
+
+def run_producer(chunk_dir, producer_id, result_path):
+    rng = random.Random(producer_id)
+    buffer = ChunkBuffer(chunk_dir, writable=True)
+    bitmap = DirtyBitmap(chunk_dir)
+    written, num_writes = [], 0
+    while len(written) < SAMPLES_PER_PRODUCER:
+        dirty_items = bitmap.get_dirty_item()
+        rng.shuffle(dirty_items)
+        for idx in dirty_items:
+            if not bitmap.compare_and_set(idx, DIRTY, WRITING):
+                continue
+            num_writes += 1
+            sample_id = (producer_id + 1) * 1000000 + num_writes
+            if num_writes % FAIL_EVERY == 0:
+                # A failed write leaves a stale or partial slot
+                saved = False
+            else:
+                write_sample(buffer, idx, sample_id)
+                saved = True
+                written.append(sample_id)
+            bitmap.set(idx, CLEAN if saved else DIRTY)
+            break
+    with open(result_path, "w") as file:
+        json.dump(written, file)
+
+
+def run_consumer(chunk_dir, consumer_id, producers_done, result_path):
+    rng = random.Random(1000 + consumer_id)
+    buffer = ChunkBuffer(chunk_dir)
+    bitmap = DirtyBitmap(chunk_dir)
+    consumed, torn = [], 0
+    while True:
+        # Check the producers before the slots, so that nothing
+        # written after the last look at the slots is missed
+        done = producers_done.is_set()
+        clean_items = bitmap.get_clean_item()
+        if len(clean_items) == 0:
+            if done and not (bitmap.bits == WRITING).any():
+                break
+            continue
+        idx = rng.choice(clean_items)
+        if not bitmap.compare_and_set(idx, CLEAN, READING):
+            continue
+        json_content, arrays = buffer.read_sample(idx)
+        if int(arrays["step_id"]) != json_content["id"] or \
+                not (arrays["frames"] == json_content["id"] % 251).all():
+            torn += 1
+        consumed.append(json_content["id"])
+        bitmap.set(idx, DIRTY)
+    with open(result_path, "w") as file:
+        json.dump({"consumed": consumed, "torn": torn}, file)
+
+
+def test_no_sample_lost_or_served_twice(tmp_path):
+    chunk_dir = str(tmp_path / "chunk_0")
+    buffer = ChunkBuffer.create(chunk_dir, CHUNK_SIZE, 64 * 1024)
+    bitmap = DirtyBitmap.create(chunk_dir, CHUNK_SIZE, WRITING)
+    # Fill up the chunk
+    initial = list(range(CHUNK_SIZE))
+    for idx in initial:
+        write_sample(buffer, idx, idx)
+        bitmap.set(idx, CLEAN)
+
+    ctx = multiprocessing.get_context("fork")
+    producers_done = ctx.Event()
+    producers = [
+        ctx.Process(target=run_producer, args=(
+            chunk_dir, i, str(tmp_path / f"producer_{i}.json")))
+        for i in range(NUM_PRODUCERS)]
+    consumers = [
+        ctx.Process(target=run_consumer, args=(
+            chunk_dir, i, producers_done, str(tmp_path / f"consumer_{i}.json")))
+        for i in range(NUM_CONSUMERS)]
+    for process in producers + consumers:
+        process.start()
+    try:
+        for process in producers:
+            process.join(timeout=120)
+            assert process.exitcode == 0
+        producers_done.set()
+        for process in consumers:
+            process.join(timeout=120)
+            assert process.exitcode == 0
+    finally:
+        for process in producers + consumers:
+            if process.is_alive():
+                process.kill()
+
+    written = list(initial)
+    for i in range(NUM_PRODUCERS):
+        with open(tmp_path / f"producer_{i}.json") as file:
+            written += json.load(file)
+    consumed, torn = [], 0
+    for i in range(NUM_CONSUMERS):
+        with open(tmp_path / f"consumer_{i}.json") as file:
+            result = json.load(file)
+        consumed += result["consumed"]
+        torn += result["torn"]
+
+    assert torn == 0
+    # Never served twice
+    assert len(consumed) == len(set(consumed))
+    # Nothing lost, and nothing that failed to be written served
+    assert sorted(consumed) == sorted(written)
+    assert len(written) == CHUNK_SIZE + NUM_PRODUCERS * SAMPLES_PER_PRODUCER
+    assert (bitmap.bits == DIRTY).all()
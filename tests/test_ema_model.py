@@ -0,0 +1,112 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+
+from models.ema_model import EMAModel
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 16), nn.BatchNorm1d(16), nn.ReLU(), nn.Linear(16, 4))
+    # A frozen parameter is copied rather than averaged
+    model[3].bias.requires_grad_(False)
+    return model
+
+
+def train_step(model, generator):
+    # Change every parameter, the BatchNorm and the frozen ones included
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn(param.shape, generator=generator) * 0.1)
+
+
+def reference_step(ema_model, new_model, decay):
+    """
+    The per-parameter update of `EMAModel.step` that the fused one replaced.
+    """
+    with torch.no_grad():
+        for module, ema_module in zip(new_model.modules(), ema_model.modules()):
+            for param, ema_param in zip(module.parameters(recurse=False),
+                                        ema_module.parameters(recurse=False)):
+                if isinstance(module, _BatchNorm):
+                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                elif not param.requires_grad:
+                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                else:
+                    ema_param.mul_(decay)
+                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - decay)
+
+
+def assert_equal_models(model, expected):
+    for (name, param), expected_param in zip(model.named_parameters(), expected.parameters()):
+        assert torch.equal(param, expected_param), name
+
+
+def run_ema(num_steps, **kwargs):
+    model = make_model()
+    ema = EMAModel(copy.deepcopy(model), power=3 / 4, **kwargs)
+    generator = torch.Generator().manual_seed(1)
+    decays = []
+    for _ in range(num_steps):
+        train_step(model, generator)
+        ema.step(model)
+        decays.append(ema.decay)
+    ema.synchronize()
+    return ema, model, decays
+
+
+def test_update_every_step_matches_per_parameter_update():
+    num_steps = 12
+    ema, model, decays = run_ema(num_steps)
+
+    expected_model = make_model()
+    expected = copy.deepcopy(expected_model)
+    generator = torch.Generator().manual_seed(1)
+    for step in range(num_steps):
+        train_step(expected_model, generator)
+        decay = ema.get_decay(step)
+        assert decays[step] == decay
+        reference_step(expected, expected_model, decay)
+
+    assert_equal_models(ema.averaged_model, expected)
+    # The BatchNorm and frozen parameters are the latest ones
+    assert torch.equal(ema.averaged_model[1].weight, model[1].weight)
+    assert torch.equal(ema.averaged_model[3].bias, model[3].bias)
+    assert not torch.equal(ema.averaged_model[0].weight, model[0].weight)
+
+
+def test_offload_matches():
+    ema, _, _ = run_ema(10)
+    offloaded_ema, _, _ = run_ema(10, offload=True)
+    assert_equal_models(offloaded_ema.averaged_model, ema.averaged_model)
+    assert all(param.device.type == "cpu" for param in offloaded_ema.averaged_model.parameters())
+
+
+@pytest.mark.parametrize("offload", [False, True])
+def test_update_every(offload):
+    update_every = 3
+    num_steps = 10
+    ema, _, decays = run_ema(num_steps, update_every=update_every, offload=offload)
+
+    expected_model = make_model()
+    expected = copy.deepcopy(expected_model)
+    generator = torch.Generator().manual_seed(1)
+    for step in range(num_steps):
+        train_step(expected_model, generator)
+        if step % update_every == 0:
+            # The product of the decays of the steps since the last update
+            decay = 1.0
+            for s in range(step - update_every + 1, step + 1):
+                decay *= ema.get_decay(s)
+            assert decays[step] == decay
+            reference_step(expected, expected_model, decay)
+
+    assert_equal_models(ema.averaged_model, expected)
+
+
+def test_update_every_must_be_positive():
+    with pytest.raises(ValueError):
+        EMAModel(make_model(), update_every=0)
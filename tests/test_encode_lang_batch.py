@@ -0,0 +1,142 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast, T5Config, T5EncoderModel
+
+import scripts.encode_lang_batch as encode_lang_batch
+from data.lang_embed_store import LangEmbedStore
+
+
+TASKS = {
+    "task_a": {
+        "instruction": "pick up the cup",
+        "simplified_instruction": ["pick up the cup", "grab the cup"],
+        "expanded_instruction": ["lift the red cup from the table"],
+    },
+    "task_b": {
+        "instruction": "grab the cup",
+        "simplified_instruction": [],
+        "expanded_instruction": ["open the drawer", "pull the drawer open slowly"],
+    },
+}
+NUM_KEYS = 7
+NUM_UNIQUE = 5
+
+
+@pytest.fixture(scope="module")
+def tiny_t5():
+    words = sorted({word for task in TASKS.values()
+                    for instruction in [task["instruction"]] + task["simplified_instruction"]
+                    + task["expanded_instruction"] for word in instruction.split()})
+    vocab = {"<pad>": 0, "<unk>": 1, **{word: i + 2 for i, word in enumerate(words)}}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend, pad_token="<pad>", unk_token="<unk>")
+
+    torch.manual_seed(0)
+    text_encoder = T5EncoderModel(T5Config(
+        vocab_size=len(vocab), d_model=16, d_kv=4, d_ff=32,
+        num_layers=1, num_heads=2)).eval()
+    return tokenizer, text_encoder
+
+
+@pytest.fixture
+def target_dir(tmp_path):
+    for task, instruction_dict in TASKS.items():
+        task_dir = tmp_path / "tfrecords" / task
+        task_dir.mkdir(parents=True)
+        with open(task_dir / encode_lang_batch.INSTRUCTION_FILE_NAME, 'w') as f:
+            json.dump(instruction_dict, f)
+    return str(tmp_path / "tfrecords")
+
+
+def make_args(target_dir, **kwargs):
+    args = dict(
+        target_dir=target_dir,
+        output_dir=os.path.join(os.path.dirname(target_dir), "lang_embeds"),
+        model_path="tiny-t5", device="cpu", dtype="float32",
+        batch_size=2, part_size=2, num_workers=1, worker_id=0, save_pt=True)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+@pytest.fixture
+def encoded_instructions(monkeypatch):
+    # The instructions passed to the encoder
+    encoded = []
+    encode_batch = encode_lang_batch.encode_batch
+    def counting_encode_batch(tokenizer, text_encoder, instructions, device):
+        encoded.extend(instructions)
+        return encode_batch(tokenizer, text_encoder, instructions, device)
+    monkeypatch.setattr(encode_lang_batch, "encode_batch", counting_encode_batch)
+    return encoded
+
+
+def test_encode_deduplicates_instructions(tiny_t5, target_dir, encoded_instructions):
+    tokenizer, text_encoder = tiny_t5
+    args = make_args(target_dir)
+    instructions = encode_lang_batch.gather_instructions(target_dir)
+    assert len(instructions) == NUM_KEYS
+
+    encode_lang_batch.encode_instructions(tokenizer, text_encoder, instructions, args)
+    assert sorted(encoded_instructions) == sorted(set(instructions.values()))
+    assert encode_lang_batch.consolidate(instructions, args)
+
+    store = LangEmbedStore(args.output_dir)
+    assert len(store) == NUM_KEYS
+    # The keys of identical instructions share their tokens
+    spans = {tuple(store.index[key]) for key in instructions}
+    assert len(spans) == NUM_UNIQUE
+    for key, instruction in instructions.items():
+        expected, = encode_lang_batch.encode_batch(tokenizer, text_encoder, [instruction], "cpu")
+        embed = store.get(key)
+        torch.testing.assert_close(embed, expected, atol=1e-5, rtol=1e-4)
+        # The legacy .pt files are written by default
+        torch.testing.assert_close(torch.load(os.path.join(target_dir, key)), embed)
+
+
+def test_encode_skips_pt_files(tiny_t5, target_dir):
+    tokenizer, text_encoder = tiny_t5
+    args = make_args(target_dir, save_pt=False)
+    instructions = encode_lang_batch.gather_instructions(target_dir)
+    encode_lang_batch.encode_instructions(tokenizer, text_encoder, instructions, args)
+    assert encode_lang_batch.consolidate(instructions, args)
+    assert not any(os.path.exists(os.path.join(target_dir, key)) for key in instructions)
+
+
+def test_encode_resumes(tiny_t5, target_dir, encoded_instructions):
+    tokenizer, text_encoder = tiny_t5
+    instructions = encode_lang_batch.gather_instructions(target_dir)
+
+    # Two workers share the instructions, the store waits for both
+    worker_args = [make_args(target_dir, part_size=1, num_workers=2, worker_id=i)
+                   for i in range(2)]
+    encode_lang_batch.encode_instructions(tokenizer, text_encoder, instructions, worker_args[0])
+    num_first = len(encoded_instructions)
+    assert not encode_lang_batch.consolidate(instructions, worker_args[0])
+    encode_lang_batch.encode_instructions(tokenizer, text_encoder, instructions, worker_args[1])
+    assert len(encoded_instructions) == NUM_UNIQUE
+    assert 0 < num_first < NUM_UNIQUE
+
+    # An interrupted part has no json and is encoded again
+    args = make_args(target_dir, part_size=1)
+    parts_dir = os.path.join(args.output_dir, encode_lang_batch.PARTS_DIR_NAME)
+    meta_name = sorted(name for name in os.listdir(parts_dir) if name.endswith(".json"))[0]
+    with open(os.path.join(parts_dir, meta_name), 'r') as f:
+        lost_instructions = json.load(f)["instructions"]
+    os.remove(os.path.join(parts_dir, meta_name))
+
+    encoded_instructions.clear()
+    encode_lang_batch.encode_instructions(tokenizer, text_encoder, instructions, args)
+    assert encoded_instructions == lost_instructions
+    assert encode_lang_batch.consolidate(instructions, args)
+    assert len(LangEmbedStore(args.output_dir)) == NUM_KEYS
+
+    encoded_instructions.clear()
+    encode_lang_batch.encode_instructions(tokenizer, text_encoder, instructions, args)
+    assert encoded_instructions == []
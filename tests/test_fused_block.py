@@ -0,0 +1,100 @@
+import pytest
+import torch
+from timm.layers import RmsNorm
+
+from models.rdt.blocks import FusedRDTBlock, RDTBlock, rms_scale
+
+
+HIDDEN_SIZE, NUM_HEADS = 64, 4
+
+
+def build_blocks():
+    torch.manual_seed(0)
+    block = RDTBlock(HIDDEN_SIZE, NUM_HEADS)
+    # Non-trivial norm weights, so that the folding is checked
+    for name, param in block.named_parameters():
+        if name.endswith("bias") or "norm" in name:
+            torch.nn.init.normal_(param, mean=1.0 if "norm" in name else 0.0, std=0.1)
+    fused_block = FusedRDTBlock(HIDDEN_SIZE, NUM_HEADS)
+    fused_block.load_state_dict(block.state_dict())
+    return block.eval(), fused_block.eval()
+
+
+def make_inputs(batch_size=2, num_tokens=19, cond_len=37):
+    torch.manual_seed(1)
+    x = torch.randn(batch_size, num_tokens, HIDDEN_SIZE)
+    c = torch.randn(batch_size, cond_len, HIDDEN_SIZE)
+    mask = torch.rand(batch_size, cond_len) > 0.2
+    mask[:, 0] = True
+    return x, c, mask
+
+
+@pytest.mark.parametrize("mask_layout", ["flat", "broadcast"])
+def test_fused_block_forward(mask_layout):
+    block, fused_block = build_blocks()
+    x, c, mask = make_inputs()
+    # Both the (B, L) mask and the (B, 1, 1, L) layout prepared by `RDT`
+    fused_mask = mask if mask_layout == "flat" else mask[:, None, None, :]
+    with torch.no_grad():
+        out = block(x, c, mask)
+        torch.testing.assert_close(fused_block(x, c, fused_mask), out, atol=1e-5, rtol=1e-4)
+        # The folded weights are cached in inference
+        torch.testing.assert_close(fused_block(x, c, fused_mask), out, atol=1e-5, rtol=1e-4)
+        # With the precomputed condition keys and values, as in sampling
+        kv = block.cross_attn.project_kv(c)
+        torch.testing.assert_close(
+            fused_block(x, None, fused_mask, kv=kv), out, atol=1e-5, rtol=1e-4)
+
+
+def test_fused_block_backward():
+    block, fused_block = build_blocks()
+    x, c, mask = make_inputs()
+    grad_out = torch.randn_like(x)
+
+    grads = []
+    for b in (block, fused_block):
+        x_, c_ = x.clone().requires_grad_(), c.clone().requires_grad_()
+        b.zero_grad()
+        (b(x_, c_, mask) * grad_out).sum().backward()
+        grads.append({"x": x_.grad, "c": c_.grad,
+                      **{name: p.grad for name, p in b.named_parameters()}})
+
+    ref_grads, fused_grads = grads
+    assert ref_grads.keys() == fused_grads.keys()
+    for name, grad in ref_grads.items():
+        torch.testing.assert_close(fused_grads[name], grad, atol=1e-4, rtol=1e-3, msg=name)
+
+
+def test_rms_scale_matches_rms_norm():
+    x = torch.randn(3, 5, HIDDEN_SIZE) * 2 + 0.5
+    norm = RmsNorm(HIDDEN_SIZE, eps=1e-6)
+    torch.testing.assert_close(x * rms_scale(x, norm.eps), norm(x), atol=1e-6, rtol=1e-5)
+
+
+def test_folded_weight_cache():
+    block, fused_block = build_blocks()
+    x, c, mask = make_inputs()
+    with torch.no_grad():
+        fused_block(x, c, mask)
+        assert set(fused_block._folded_weights) == {"qkv", "q", "fc1"}
+
+        # An in-place update of the parameters refreshes the cache
+        for b in (block, fused_block):
+            b.norm2.weight.mul_(1.5)
+            b.ffn.fc1.weight.add_(0.1)
+        torch.testing.assert_close(fused_block(x, c, mask), block(x, c, mask),
+                                   atol=1e-5, rtol=1e-4)
+
+        # Moving or casting the block drops the cache
+        block, fused_block = block.double(), fused_block.double()
+        assert fused_block._folded_weights == {}
+        out = fused_block(x.double(), c.double(), mask)
+        assert out.dtype == torch.float64
+        assert all(weight.dtype == torch.float64
+                   for _, weight in fused_block._folded_weights.values())
+        torch.testing.assert_close(out, block(x.double(), c.double(), mask),
+                                   atol=1e-10, rtol=1e-8)
+
+    # ... and so does training
+    fused_block(x.double(), c.double(), mask)
+    assert fused_block._folded_weights == {}
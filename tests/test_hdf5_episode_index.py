@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+from conftest import ROOT_DIR
+from data.hdf5_vla_dataset import (EPISODE_INDEX_FILE_NAME, INSTRUCTION_FILE_NAME,
+                                   HDF5VLADataset)
+
+
+HDF5_DIR = "data/datasets/agilex/rdt_data/"
+
+
+def write_episode(task_dir, name, num_steps=150):
+    os.makedirs(task_dir, exist_ok=True)
+    qpos = np.zeros((num_steps, 14), dtype=np.float32)
+    qpos[10:] = np.linspace(0, 1, num_steps - 10)[:, None]
+    with h5py.File(os.path.join(task_dir, name), 'w') as f:
+        f.create_dataset('observations/qpos', data=qpos)
+
+
+def write_instruction(task_dir, instruction, mtime_ns=None):
+    path = os.path.join(task_dir, INSTRUCTION_FILE_NAME)
+    with open(path, 'w') as f:
+        json.dump({"instruction": instruction, "simplified_instruction": [],
+                   "expanded_instruction": []}, f)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def dataset_dir(tmp_path, monkeypatch):
+    # The dataset reads its directory and config relative to the working directory
+    os.makedirs(tmp_path / "configs")
+    shutil.copy(os.path.join(ROOT_DIR, "configs/base.yaml"), tmp_path / "configs")
+    monkeypatch.chdir(tmp_path)
+    for task in ("task_a", "task_b"):
+        task_dir = os.path.join(HDF5_DIR, task)
+        write_episode(task_dir, "episode_0.hdf5")
+        write_instruction(task_dir, f"do {task}")
+    return tmp_path
+
+
+@pytest.fixture
+def parsed_files(monkeypatch):
+    # The episodes parsed rather than read from the index
+    parsed = []
+    parse_hdf5_file_meta = HDF5VLADataset.parse_hdf5_file_meta
+    def counting_parse_hdf5_file_meta(self, file_path):
+        parsed.append(self.get_episode_key(file_path))
+        return parse_hdf5_file_meta(self, file_path)
+    monkeypatch.setattr(HDF5VLADataset, "parse_hdf5_file_meta", counting_parse_hdf5_file_meta)
+    return parsed
+
+
+def instructions(dataset):
+    return {key: meta["instructions"]["instruction"]
+            for key, meta in dataset.episode_metas.items()}
+
+
+def test_episode_index_is_reused(dataset_dir, parsed_files):
+    dataset = HDF5VLADataset()
+    assert sorted(parsed_files) == ["task_a/episode_0.hdf5", "task_b/episode_0.hdf5"]
+    assert os.path.exists(os.path.join(HDF5_DIR, EPISODE_INDEX_FILE_NAME))
+
+    parsed_files.clear()
+    assert HDF5VLADataset().episode_metas == dataset.episode_metas
+    assert parsed_files == []
+
+
+def test_modified_instructions_are_parsed_again(dataset_dir, parsed_files):
+    task_dir = os.path.join(HDF5_DIR, "task_a")
+    stat = os.stat(os.path.join(task_dir, INSTRUCTION_FILE_NAME))
+    HDF5VLADataset()
+
+    # The same size, a later modification time
+    parsed_files.clear()
+    write_instruction(task_dir, "do task_c", mtime_ns=stat.st_mtime_ns + 10**9)
+    dataset = HDF5VLADataset()
+    assert parsed_files == ["task_a/episode_0.hdf5"]
+    assert instructions(dataset) == {
+        "task_a/episode_0.hdf5": "do task_c", "task_b/episode_0.hdf5": "do task_b"}
+
+    # The same modification time, another size
+    parsed_files.clear()
+    write_instruction(task_dir, "do task_aa", mtime_ns=stat.st_mtime_ns + 10**9)
+    dataset = HDF5VLADataset()
+    assert parsed_files == ["task_a/episode_0.hdf5"]
+    assert instructions(dataset)["task_a/episode_0.hdf5"] == "do task_aa"
+
+
+def test_index_of_older_version_is_rebuilt(dataset_dir, parsed_files):
+    HDF5VLADataset()
+    index_path = os.path.join(HDF5_DIR, EPISODE_INDEX_FILE_NAME)
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    index["version"] = 1
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    parsed_files.clear()
+    HDF5VLADataset()
+    assert len(parsed_files) == 2
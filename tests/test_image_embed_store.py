@@ -0,0 +1,139 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from data.image_embed_store import (BACKGROUND_FILE_NAME, KEYS_FILE_NAME,
+                                    META_FILE_NAME, ImageEmbedShardWriter,
+                                    ImageEmbedStore, is_shard_complete,
+                                    shard_dir_name)
+
+
+NUM_PATCHES = 4
+HIDDEN_SIZE = 8
+CAMERAS = ["cam_high", "cam_left_wrist"]
+
+
+def make_episodes(num_episodes, num_steps, seed=0):
+    # (episode, step, camera) -> (P, D) embedding
+    rng = np.random.default_rng(seed)
+    return {
+        (f"episode_{e}", step, camera):
+            rng.standard_normal((NUM_PATCHES, HIDDEN_SIZE)).astype(np.float32)
+        for e in range(num_episodes) for step in range(num_steps) for camera in CAMERAS
+    }
+
+
+def write_store(store_dir, embeds, dtype, num_shards, batch_size=3, **meta):
+    meta = {
+        "dtype": dtype, "num_patches": NUM_PATCHES, "hidden_size": HIDDEN_SIZE,
+        "image_aspect_ratio": "pad", **meta,
+    }
+    with open(os.path.join(store_dir, META_FILE_NAME), 'w') as file:
+        json.dump(meta, file)
+    np.save(os.path.join(store_dir, BACKGROUND_FILE_NAME),
+            np.ones((NUM_PATCHES, HIDDEN_SIZE), dtype=np.float32))
+
+    keys = list(embeds.keys())
+    for shard_idx, shard_keys in enumerate(np.array_split(np.arange(len(keys)), num_shards)):
+        shard_keys = [keys[i] for i in shard_keys]
+        writer = ImageEmbedShardWriter(
+            store_dir, shard_idx, len(shard_keys), NUM_PATCHES, HIDDEN_SIZE, dtype)
+        for start in range(0, len(shard_keys), batch_size):
+            batch_keys = shard_keys[start:start + batch_size]
+            writer.write(batch_keys, np.stack([embeds[key] for key in batch_keys]))
+        writer.close()
+        assert is_shard_complete(store_dir, shard_idx)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_round_trip(tmp_path, dtype):
+    embeds = make_episodes(num_episodes=3, num_steps=5)
+    write_store(str(tmp_path), embeds, dtype, num_shards=2)
+
+    store = ImageEmbedStore(str(tmp_path))
+    assert store.dtype == dtype
+    assert len(store) == len(embeds)
+    # The frames of both shards are indexed
+    assert {shard_idx for shard_idx, _ in store.index.values()} == {0, 1}
+    torch.testing.assert_close(store.background, torch.ones(NUM_PATCHES, HIDDEN_SIZE))
+    for (episode, step, camera), expected in embeds.items():
+        assert (episode, step, camera) in store
+        embed = store.get(episode, step, camera)
+        assert embed.dtype == torch.float32
+        assert embed.shape == (NUM_PATCHES, HIDDEN_SIZE)
+        expected = torch.from_numpy(expected)
+        if dtype == "float16":
+            torch.testing.assert_close(embed, expected, atol=1e-3, rtol=1e-3)
+        else:
+            # Within half a quantization step of each token
+            step_size = expected.abs().amax(dim=-1, keepdim=True) / 127
+            assert torch.all((embed - expected).abs() <= step_size / 2 + 1e-6)
+
+
+def test_incomplete_shard_is_ignored(tmp_path):
+    embeds = make_episodes(num_episodes=2, num_steps=3)
+    write_store(str(tmp_path), embeds, "float16", num_shards=2)
+    os.remove(os.path.join(tmp_path, shard_dir_name(1), KEYS_FILE_NAME))
+    assert not is_shard_complete(str(tmp_path), 1)
+
+    store = ImageEmbedStore(str(tmp_path))
+    assert 0 < len(store) < len(embeds)
+    assert all(shard_idx == 0 for shard_idx, _ in store.index.values())
+
+
+def test_missing_key(tmp_path):
+    embeds = make_episodes(num_episodes=1, num_steps=2)
+    write_store(str(tmp_path), embeds, "int8", num_shards=1)
+
+    store = ImageEmbedStore(str(tmp_path))
+    assert ("episode_0", 2, CAMERAS[0]) not in store
+    with pytest.raises(KeyError):
+        store.get("episode_0", 2, CAMERAS[0])
+    with pytest.raises(KeyError):
+        store.get("episode_1", 0, CAMERAS[0])
+
+
+def test_writer_checks_the_number_of_frames(tmp_path):
+    frame = np.zeros((1, NUM_PATCHES, HIDDEN_SIZE), dtype=np.float32)
+    writer = ImageEmbedShardWriter(str(tmp_path), 0, 2, NUM_PATCHES, HIDDEN_SIZE, "float16")
+    writer.write([("episode_0", 0, CAMERAS[0])], frame)
+    with pytest.raises(ValueError):
+        writer.close()
+    writer.write([("episode_0", 0, CAMERAS[1])], frame)
+    with pytest.raises(ValueError):
+        writer.write([("episode_0", 1, CAMERAS[0])], frame)
+    with pytest.raises(ValueError):
+        ImageEmbedShardWriter(str(tmp_path), 1, 2, NUM_PATCHES, HIDDEN_SIZE, "float32")
+
+
+def test_check_preprocessing(tmp_path):
+    embeds = make_episodes(num_episodes=1, num_steps=1)
+    write_store(str(tmp_path), embeds, "float16", num_shards=1,
+                image_size=[24, 32], auto_adjust_image_brightness=True)
+
+    store = ImageEmbedStore(str(tmp_path))
+    store.check_preprocessing(
+        image_aspect_ratio="pad", image_size=(24, 32), auto_adjust_image_brightness=True)
+    for settings in (
+        dict(image_aspect_ratio="square"),
+        dict(image_size=None),
+        dict(image_size=24),
+        dict(auto_adjust_image_brightness=False),
+    ):
+        with pytest.raises(ValueError):
+            store.check_preprocessing(**settings)
+
+
+def test_check_preprocessing_of_legacy_store(tmp_path):
+    # The stores written before the settings were recorded used the defaults
+    embeds = make_episodes(num_episodes=1, num_steps=1)
+    write_store(str(tmp_path), embeds, "float16", num_shards=1)
+
+    store = ImageEmbedStore(str(tmp_path))
+    store.check_preprocessing(
+        image_aspect_ratio="pad", image_size=None, auto_adjust_image_brightness=False)
+    with pytest.raises(ValueError):
+        store.check_preprocessing(auto_adjust_image_brightness=True)
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+from transformers import SiglipImageProcessor
+
+from models.multimodal_encoder.image_preprocess import BatchImagePreprocessor
+
+
+# The normalized pixels span [-1, 1], so one uint8 level is 2 / 255.
+# The antialiased resize of torchvision differs from PIL's by up to
+# one level per resize, hence up to three levels with `image_size`.
+ATOL = 3 * 2 / 255 + 1e-6
+MEAN_ATOL = 0.005
+
+
+@pytest.fixture(scope="module")
+def image_processor():
+    return SiglipImageProcessor(size={"height": 32, "width": 32})
+
+
+def reference_preprocess(processor, image, valid, image_size,
+                         image_aspect_ratio, auto_adjust_image_brightness):
+    """
+    The per-image PIL pipeline of `VLAConsumerDataset` that
+    `BatchImagePreprocessor` replaced.
+    """
+    image = Image.fromarray(image)
+    if image_size is not None:
+        image = transforms.Resize(image_size)(image)
+    if valid and auto_adjust_image_brightness:
+        average_brightness = np.asarray(image, dtype=np.float64).mean() / 255.0
+        if average_brightness <= 0.15:
+            image = transforms.ColorJitter(brightness=(1.75, 1.75))(image)
+    if image_aspect_ratio == 'pad':
+        width, height = image.size
+        if width != height:
+            size = max(width, height)
+            result = Image.new(image.mode, (size, size),
+                               tuple(int(x*255) for x in processor.image_mean))
+            result.paste(image, ((size - width) // 2, (size - height) // 2))
+            image = result
+    return processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+
+
+def make_frames(seed=0):
+    # Smooth frames, like camera images, of several shapes, two of them dark
+    rng = np.random.default_rng(seed)
+    frames = []
+    for (height, width), high in (((48, 64), 256), ((48, 64), 60), ((40, 40), 256),
+                                  ((32, 32), 40), ((64, 48), 256)):
+        noise = rng.integers(0, high, (height // 4, width // 4, 3), dtype=np.uint8)
+        frames.append(np.asarray(
+            Image.fromarray(noise).resize((width, height), Image.BILINEAR)))
+    return frames
+
+
+@pytest.mark.parametrize("image_aspect_ratio", ["pad", "square"])
+@pytest.mark.parametrize("auto_adjust_image_brightness", [False, True])
+@pytest.mark.parametrize("image_size", [None, 36, (30, 40)])
+def test_matches_siglip_image_processor(image_processor, image_aspect_ratio,
+                                        auto_adjust_image_brightness, image_size):
+    frames = make_frames()
+    # The invalid (background) frames are never brightened
+    valid = [True, True, True, False, True]
+    preprocessor = BatchImagePreprocessor(
+        image_processor, image_size=image_size, image_aspect_ratio=image_aspect_ratio,
+        auto_adjust_image_brightness=auto_adjust_image_brightness)
+
+    pixel_values = preprocessor(frames, valid)
+    expected = torch.stack([
+        reference_preprocess(image_processor, frame, v, image_size,
+                             image_aspect_ratio, auto_adjust_image_brightness)
+        for frame, v in zip(frames, valid)])
+    assert pixel_values.shape == expected.shape == (len(frames), 3, 32, 32)
+    torch.testing.assert_close(pixel_values, expected, atol=ATOL, rtol=0)
+    assert (pixel_values - expected).abs().mean() < MEAN_ATOL
+
+
+def test_brightness_adjustment(image_processor):
+    frames = make_frames()
+    outputs = [
+        BatchImagePreprocessor(image_processor, auto_adjust_image_brightness=enabled)(
+            frames, [True, True, True, False, True])
+        for enabled in (False, True)]
+    # Only the dark valid frame is brightened
+    changed = [not torch.equal(a, b) for a, b in zip(*outputs)]
+    assert changed == [False, True, False, False, False]
+    assert outputs[1][1].mean() > outputs[0][1].mean()
+
+
+def test_background_image(image_processor):
+    preprocessor = BatchImagePreprocessor(image_processor)
+    background_image = preprocessor.background_image()
+    assert background_image.shape == (32, 32, 3) and background_image.dtype == np.uint8
+    expected = reference_preprocess(
+        image_processor, background_image, False, None, 'pad', False)
+    torch.testing.assert_close(preprocessor([background_image], [False])[0], expected,
+                               atol=ATOL, rtol=0)
+
+
+def test_output_buffer(image_processor):
+    frames = make_frames()
+    preprocessor = BatchImagePreprocessor(image_processor)
+    out = torch.empty(len(frames), 3, 32, 32)
+    pixel_values = preprocessor(frames, out=out)
+    assert pixel_values.data_ptr() == out.data_ptr()
+    torch.testing.assert_close(pixel_values, preprocessor(frames), atol=0, rtol=0)
+    with pytest.raises(ValueError):
+        preprocessor(frames, out=torch.empty(len(frames) + 1, 3, 32, 32))
@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+from models.samplers import SAMPLERS
+from scripts.agilex_model import create_model
+from scripts.agilex_server import InferenceClient, InferenceServer
+
+
+@pytest.fixture(scope="module")
+def tiny_policy(tiny_vision_tower_dir):
+    from conftest import load_tiny_config
+
+    config = load_tiny_config()
+    return create_model(
+        args=config,
+        device="cpu",
+        dtype=torch.float32,
+        pretrained_vision_encoder_name_or_path=tiny_vision_tower_dir,
+    ), config
+
+
+@pytest.fixture
+def server_path(tiny_policy, tmp_path):
+    policy, _ = tiny_policy
+    server = InferenceServer(policy, max_batch_size=4, max_wait_ms=200.0)
+    unix_path = str(tmp_path / "rdt.sock")
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start(unix_path=unix_path))
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(timeout=30)
+    yield unix_path
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result(timeout=30)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=30)
+
+
+def make_observation(seed, lang_len):
+    rng = np.random.default_rng(seed)
+    proprio = rng.standard_normal(14).astype(np.float32)
+    # The frames at t-1 are missing at the start of an episode
+    images = [None] * 3 + [
+        rng.integers(0, 256, (24, 40, 3), dtype=np.uint8) for _ in range(3)]
+    text_embeds = rng.standard_normal((1, lang_len, 48)).astype(np.float32)
+    return proprio, images, text_embeds
+
+
+@pytest.mark.parametrize("sampler", list(SAMPLERS.keys()))
+def test_every_sampler_through_the_server(tiny_policy, server_path, sampler, monkeypatch):
+    policy, config = tiny_policy
+    monkeypatch.setattr(policy.policy, "sampler", sampler)
+    client = InferenceClient(unix_path=server_path)
+    try:
+        actions = client.step(*make_observation(0, lang_len=7))
+    finally:
+        client.close()
+    assert actions.shape == (config["common"]["action_chunk_size"], 14)
+    assert np.isfinite(actions).all()
+
+
+def test_concurrent_clients_are_batched(tiny_policy, server_path, monkeypatch):
+    policy, config = tiny_policy
+    monkeypatch.setattr(policy.policy, "sampler", "ddim")
+    num_clients = 4
+
+    def request(i):
+        client = InferenceClient(unix_path=server_path)
+        try:
+            return client.step(*make_observation(i, lang_len=3 + i))
+        finally:
+            client.close()
+
+    with ThreadPoolExecutor(max_workers=num_clients) as executor:
+        results = list(executor.map(request, range(num_clients)))
+    for actions in results:
+        assert actions.shape == (config["common"]["action_chunk_size"], 14)
+        assert np.isfinite(actions).all()
+
+    client = InferenceClient(unix_path=server_path)
+    try:
+        stats = client.get_stats()
+    finally:
+        client.close()
+    assert stats["num_requests"] == num_clients
+    assert max(int(size) for size in stats["batch_size_hist"]) > 1
+
+
+@pytest.fixture
+def nonzero_output_layer(tiny_policy):
+    """
+    Initialize the zero-initialized output layer of the RDT randomly,
+    so that the actions depend on the observations.
+    """
+    policy, _ = tiny_policy
+    fc2 = policy.policy.model.final_layer.ffn_final.fc2
+    state_dict = {k: v.clone() for k, v in fc2.state_dict().items()}
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for param in fc2.parameters():
+            param.copy_(torch.randn(param.shape, generator=generator) * 0.1)
+    yield
+    fc2.load_state_dict(state_dict)
+
+
+@pytest.fixture
+def row_seeded_noise(tiny_policy, monkeypatch):
+    """
+    Draw the same seeded initial noise for every observation of a batch,
+    so that a batched observation can be compared with a single one.
+    """
+    _, config = tiny_policy
+    noise_shape = (config["common"]["action_chunk_size"], config["common"]["state_dim"])
+    randn = torch.randn
+    def row_seeded_randn(*args, size=None, **kwargs):
+        if size is None or tuple(size[1:]) != noise_shape:
+            return randn(*args, size=size, **kwargs) if size is not None \
+                else randn(*args, **kwargs)
+        noise = randn(noise_shape, generator=torch.Generator().manual_seed(0))
+        return noise.expand(size).to(**kwargs).contiguous()
+    monkeypatch.setattr(torch, "randn", row_seeded_randn)
+
+
+def request_step(server_path, observation):
+    client = InferenceClient(unix_path=server_path)
+    try:
+        return client.step(*observation)
+    except RuntimeError as e:
+        return e
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize("sampler", ["ddim", "dpmsolver++"])
+def test_batched_step_matches_single_step(tiny_policy, server_path, nonzero_output_layer,
+                                          row_seeded_noise, sampler, monkeypatch):
+    policy, _ = tiny_policy
+    monkeypatch.setattr(policy.policy, "sampler", sampler)
+    # Instructions of different lengths are padded in the batch
+    observations = [make_observation(i, lang_len=2 + 3 * i) for i in range(3)]
+    with ThreadPoolExecutor(max_workers=len(observations)) as executor:
+        results = list(executor.map(
+            lambda observation: request_step(server_path, observation), observations))
+
+    for observation, actions in zip(observations, results):
+        proprio, images, text_embeds = observation
+        with torch.inference_mode():
+            expected = policy.step(
+                torch.from_numpy(proprio).reshape(1, -1), images,
+                torch.from_numpy(text_embeds))
+        np.testing.assert_allclose(actions, expected[0].numpy(), atol=1e-4, rtol=1e-4)
+    # ... and the observations are not mixed up
+    assert not np.allclose(results[0], results[1], atol=1e-2)
+
+    client = InferenceClient(unix_path=server_path)
+    try:
+        assert max(int(size) for size in client.get_stats()["batch_size_hist"]) > 1
+    finally:
+        client.close()
+
+
+def test_invalid_request_fails_alone(tiny_policy, server_path):
+    _, config = tiny_policy
+    valid = make_observation(0, lang_len=5)
+    proprio, images, text_embeds = make_observation(1, lang_len=5)
+    invalids = [
+        (proprio[:13], images, text_embeds),
+        (proprio, images, text_embeds[..., :40]),
+        (proprio, images, np.zeros((1, 100, 48), dtype=np.float32)),
+        (proprio, images[:5] + [images[5][..., 0]], text_embeds),
+        (proprio, images[:5] + [images[5].astype(np.float32)], text_embeds),
+    ]
+    observations = [valid] + invalids + [valid]
+    with ThreadPoolExecutor(max_workers=len(observations)) as executor:
+        results = list(executor.map(
+            lambda observation: request_step(server_path, observation), observations))
+
+    for actions in (results[0], results[-1]):
+        assert actions.shape == (config["common"]["action_chunk_size"], 14)
+    for error in results[1:-1]:
+        assert isinstance(error, RuntimeError) and "ValueError" in str(error)
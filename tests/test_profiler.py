@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+
+import pytest
+import torch
+
+import models.profiler as profiler_module
+from conftest import build_tiny_runner, load_tiny_config, make_runner_inputs
+from models.profiler import LatencyProfiler, get_profiler, profile_region
+
+
+def hook_counts(blocks):
+    return [sum(len(module._forward_pre_hooks) + len(module._forward_hooks)
+                for module in block.modules()) for block in blocks]
+
+
+def test_disabled_profiler_is_a_no_op():
+    assert get_profiler() is None
+    region = profile_region("step", batch_size=1)
+    # The same shared null context every time, nothing is timed
+    assert region is profile_region("other")
+    with region:
+        pass
+
+    profiler = LatencyProfiler()
+    with profiler.enable():
+        assert get_profiler() is profiler
+    assert get_profiler() is None
+    with profile_region("after"):
+        pass
+    assert len(profiler.events) == 0
+    assert profiler.summary() == {}
+
+
+def test_nested_regions_in_summary():
+    profiler = LatencyProfiler()
+    with profiler.enable():
+        for _ in range(3):
+            with profile_region("outer"):
+                for i in range(2):
+                    with profile_region("inner", step=i):
+                        time.sleep(0.002)
+
+    summary = profiler.summary()
+    # In the order the names first occur, the inner regions end first
+    assert list(summary) == ["inner", "outer"]
+    assert summary["outer"]["count"] == 3
+    assert summary["inner"]["count"] == 6
+    assert summary["inner"]["p50"] >= 2.0
+    assert summary["outer"]["total"] >= summary["inner"]["total"]
+    for stats in summary.values():
+        assert stats["p50"] <= stats["p90"] <= stats["p99"] <= stats["max"]
+        assert stats["mean"] == pytest.approx(stats["total"] / stats["count"])
+
+    lines = profiler.format_summary().splitlines()
+    assert len(lines) == 3
+    assert lines[1].split()[:2] == ["inner", "6"]
+
+
+def test_chrome_trace(tmp_path):
+    profiler = LatencyProfiler()
+
+    def work(name):
+        with profile_region(name):
+            for i in range(2):
+                with profile_region(f"{name}.step", step=i):
+                    time.sleep(0.001)
+
+    with profiler.enable():
+        work("main")
+        thread = threading.Thread(target=work, args=("worker",))
+        thread.start()
+        thread.join()
+
+    path = tmp_path / "trace.json"
+    profiler.export_chrome_trace(str(path))
+    with open(path, 'r') as file:
+        trace = json.load(file)
+    events = trace["traceEvents"]
+    assert len(events) == 6
+    for event in events:
+        # Complete events, in microseconds
+        assert event["ph"] == "X"
+        assert event["ts"] >= 0 and event["dur"] > 0
+    assert [event["args"] for event in events if event["name"] == "main.step"] == [
+        {"step": 0}, {"step": 1}]
+
+    # Every step is within its region, on the thread of the region
+    for name in ("main", "worker"):
+        parent, = [event for event in events if event["name"] == name]
+        children = [event for event in events if event["name"] == f"{name}.step"]
+        assert len(children) == 2
+        for child in children:
+            assert child["tid"] == parent["tid"]
+            assert parent["ts"] <= child["ts"]
+            assert child["ts"] + child["dur"] <= parent["ts"] + parent["dur"] + 1e-3
+    assert len({event["tid"] for event in events}) == 2
+
+
+def test_max_events_drops_the_oldest():
+    profiler = LatencyProfiler(max_events=4)
+    with profiler.enable():
+        for i in range(6):
+            with profile_region(f"region_{i}"):
+                pass
+    assert list(profiler.summary()) == [f"region_{i}" for i in range(2, 6)]
+    profiler.reset()
+    assert profiler.summary() == {}
+
+
+@pytest.mark.parametrize("fused_blocks", [False, True])
+def test_block_hooks(fused_blocks):
+    config = load_tiny_config(fused_blocks=fused_blocks)
+    runner = build_tiny_runner(config)
+    inputs = make_runner_inputs(config)
+    blocks = runner.model.blocks
+    num_hooks = hook_counts(blocks)
+
+    profiler = LatencyProfiler()
+    with torch.no_grad(), profiler.enable(blocks=blocks):
+        runner.predict_action(**inputs)
+    # The hooks are removed with the profiler
+    assert hook_counts(blocks) == num_hooks
+
+    summary = profiler.summary()
+    num_steps = runner.num_inference_timesteps
+    assert summary["denoise_step"]["count"] == num_steps
+    assert summary["block"]["count"] == num_steps * len(blocks)
+    sublayers = {"block.attn", "block.cross_attn", "block.ffn"}
+    if fused_blocks:
+        assert not sublayers & set(summary)
+    else:
+        for name in sublayers:
+            assert summary[name]["count"] == num_steps * len(blocks)
+
+    # Nothing is timed once disabled
+    profiler.reset()
+    with torch.no_grad():
+        runner.predict_action(**inputs)
+    assert profiler.summary() == {}
+    assert profiler_module._active_profiler is None
@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from conftest import build_tiny_runner, load_tiny_config, make_runner_inputs
+from models.samplers import SAMPLERS, build_sampler
+
+
+def fresh_get_sampler(runner):
+    # Build and set up a new scheduler for every sampling, without the cache
+    def get_sampler(sampler=None, num_inference_timesteps=None, device=None):
+        sampler = sampler if sampler is not None else runner.sampler
+        num_steps = SAMPLERS[sampler][2] or num_inference_timesteps \
+            or runner.num_inference_timesteps
+        scheduler, _ = build_sampler(sampler, runner.noise_scheduler_config)
+        scheduler.set_timesteps(num_steps)
+        return scheduler, scheduler.timesteps.to(device)
+    return get_sampler
+
+
+@pytest.mark.parametrize("sampler", list(SAMPLERS.keys()))
+def test_cached_sampler_matches_fresh_scheduler(sampler, monkeypatch):
+    config = load_tiny_config()
+    runner = build_tiny_runner(config)
+    inputs = make_runner_inputs(config)
+
+    outputs = []
+    with torch.no_grad():
+        # The second call reuses the cached scheduler after it was used
+        for _ in range(2):
+            torch.manual_seed(2)
+            outputs.append(runner.predict_action(**inputs, sampler=sampler))
+        monkeypatch.setattr(runner, "get_sampler", fresh_get_sampler(runner))
+        torch.manual_seed(2)
+        expected = runner.predict_action(**inputs, sampler=sampler)
+    for output in outputs:
+        assert torch.equal(output, expected)
+
+
+@pytest.mark.parametrize("sampler", ["dpmsolver++_3", "unipc", "euler"])
+def test_interleaved_samplings_do_not_share_state(sampler):
+    config = load_tiny_config()
+    runner = build_tiny_runner(config)
+    generator = torch.Generator().manual_seed(0)
+    samples = [torch.randn(2, 4, 3, generator=generator) for _ in range(2)]
+
+    def model_output(sample, i):
+        return torch.sin(sample * (i + 1))
+
+    # Step two samplings in lockstep, as two threads could do
+    solvers = [runner.get_sampler(sampler)[0] for _ in samples]
+    interleaved = list(samples)
+    for i, t in enumerate(solvers[0].timesteps):
+        for j, solver in enumerate(solvers):
+            x = solver.scale_model_input(interleaved[j], t)
+            interleaved[j] = solver.step(model_output(x, i), t, interleaved[j]).prev_sample
+
+    for j, sample in enumerate(samples):
+        solver = runner.get_sampler(sampler)[0]
+        for i, t in enumerate(solver.timesteps):
+            x = solver.scale_model_input(sample, t)
+            sample = solver.step(model_output(x, i), t, sample).prev_sample
+        assert torch.equal(interleaved[j], sample)
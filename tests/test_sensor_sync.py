@@ -0,0 +1,181 @@
+import random
+import threading
+from collections import deque
+
+import pytest
+
+from scripts.sensor_sync import ApproximateTimeSynchronizer, StampedRingBuffer
+
+
+CAMERA_TOPICS = ['img_front', 'img_left', 'img_right']
+TOPICS = CAMERA_TOPICS + ['puppet_arm_left', 'puppet_arm_right']
+
+
+def deque_get_frame(deques, topics, ref_topics):
+    """
+    The frame of the deque-based `RosOperator.get_frame` that the
+    synchronizer replaced.
+    """
+    if any(len(deques[topic]) == 0 for topic in ref_topics):
+        return None
+    frame_time = min(deques[topic][-1][0] for topic in ref_topics)
+    for topic in topics:
+        if len(deques[topic]) == 0 or deques[topic][-1][0] < frame_time:
+            return None
+    frame = []
+    for topic in topics:
+        while deques[topic][0][0] < frame_time:
+            deques[topic].popleft()
+        frame.append(deques[topic].popleft()[1])
+    return tuple(frame)
+
+
+def test_get_matches_deque_get_frame():
+    rng = random.Random(0)
+    synchronizer = ApproximateTimeSynchronizer(TOPICS, capacity=10000)
+    deques = {topic: deque() for topic in TOPICS}
+    clocks = {topic: 0.0 for topic in TOPICS}
+    num_frames = 0
+    for i in range(20000):
+        topic = rng.choice(TOPICS)
+        # The arms publish less often than the cameras
+        clocks[topic] += rng.random() * (0.06 if topic.startswith('puppet') else 0.03)
+        msg = (topic, i)
+        synchronizer.push(topic, clocks[topic], msg)
+        deques[topic].append((clocks[topic], msg))
+        if rng.random() < 0.1:
+            frame = synchronizer.get(TOPICS, ref_topics=CAMERA_TOPICS)
+            assert frame == deque_get_frame(deques, TOPICS, CAMERA_TOPICS)
+            num_frames += frame is not None
+    assert num_frames > 100
+
+
+def test_get_waits_for_missing_messages():
+    synchronizer = ApproximateTimeSynchronizer(TOPICS)
+    for topic in CAMERA_TOPICS:
+        synchronizer.push(topic, 1.0, f"{topic}@1")
+    # No arm message yet
+    assert synchronizer.get(TOPICS, ref_topics=CAMERA_TOPICS) is None
+    assert synchronizer.latest('puppet_arm_left') is None
+
+    # An arm message older than the frame time does not make a frame
+    synchronizer.push('puppet_arm_left', 0.5, "left@0.5")
+    synchronizer.push('puppet_arm_right', 1.2, "right@1.2")
+    assert synchronizer.get(TOPICS, ref_topics=CAMERA_TOPICS) is None
+
+    # Nothing was consumed by the failed attempts
+    synchronizer.push('puppet_arm_left', 1.1, "left@1.1")
+    assert synchronizer.get(TOPICS, ref_topics=CAMERA_TOPICS) == (
+        "img_front@1", "img_left@1", "img_right@1", "left@1.1", "right@1.2")
+    # ... and the frame messages are consumed
+    assert synchronizer.get(TOPICS, ref_topics=CAMERA_TOPICS) is None
+    assert synchronizer.latest('puppet_arm_left') == "left@1.1"
+
+
+def test_frame_time_is_oldest_latest_camera():
+    synchronizer = ApproximateTimeSynchronizer(['a', 'b'])
+    for stamp in (1.0, 2.0, 3.0):
+        synchronizer.push('a', stamp, f"a@{stamp}")
+    synchronizer.push('b', 2.5, "b@2.5")
+    # The frame time is 2.5, 'a' takes its first message not older than it
+    assert synchronizer.get(['a', 'b']) == ("a@3.0", "b@2.5")
+
+
+def test_out_of_order_messages_are_dropped():
+    buffer = StampedRingBuffer(capacity=8)
+    buffer.push(1.0, "a")
+    buffer.push(2.0, "b")
+    buffer.push(1.5, "late")
+    assert buffer.num_out_of_order == 1
+    assert buffer.latest() == (2.0, "b")
+    assert buffer.search(1.2) == (1, 2.0, "b")
+    # Equal stamps are kept
+    buffer.push(2.0, "c")
+    assert buffer.num_out_of_order == 1
+    assert buffer.latest() == (2.0, "c")
+
+
+def test_wrap_around_keeps_newest_messages():
+    buffer = StampedRingBuffer(capacity=4)
+    for i in range(10):
+        buffer.push(float(i), i)
+    # One slot is kept free for the writer, so the last 3 messages are readable
+    assert buffer.search(0.0) == (7, 7.0, 7)
+    assert buffer.search(8.5) == (9, 9.0, 9)
+    assert buffer.search(9.5) is None
+    assert buffer.latest() == (9.0, 9)
+
+    buffer.consume(8)
+    assert buffer.search(0.0) == (9, 9.0, 9)
+    for i in range(10, 13):
+        buffer.push(float(i), i)
+    # Consumed messages are never returned again
+    assert buffer.search(0.0) == (10, 10.0, 10)
+
+
+def test_nearest():
+    buffer = StampedRingBuffer(capacity=8)
+    assert buffer.nearest(1.0) is None
+    assert len(buffer) == 0
+    for stamp in (1.0, 2.0, 4.0):
+        buffer.push(stamp, f"m@{stamp}")
+    assert len(buffer) == 3
+    assert buffer.nearest(0.0) == (0, 1.0, "m@1.0")
+    assert buffer.nearest(1.4) == (0, 1.0, "m@1.0")
+    assert buffer.nearest(2.9) == (1, 2.0, "m@2.0")
+    assert buffer.nearest(3.5) == (2, 4.0, "m@4.0")
+    assert buffer.nearest(9.0) == (2, 4.0, "m@4.0")
+    # The earlier message wins a tie
+    assert buffer.nearest(3.0) == (1, 2.0, "m@2.0")
+
+    # Consumed messages are never returned
+    buffer.consume(1)
+    assert len(buffer) == 1
+    assert buffer.nearest(0.0) == (2, 4.0, "m@4.0")
+    buffer.consume(2)
+    assert buffer.nearest(4.0) is None
+
+
+def test_nearest_after_wrap_around():
+    buffer = StampedRingBuffer(capacity=4)
+    for i in range(10):
+        buffer.push(float(i), i)
+    assert len(buffer) == 3
+    # Only the last 3 messages are readable
+    assert buffer.nearest(0.0) == (7, 7.0, 7)
+    assert buffer.nearest(8.4) == (8, 8.0, 8)
+    assert buffer.nearest(8.6) == (9, 9.0, 9)
+
+
+def test_capacity_must_be_at_least_two():
+    with pytest.raises(ValueError):
+        StampedRingBuffer(capacity=1)
+
+
+def test_concurrent_writer_never_tears_reads():
+    # The message of every stamp is the stamp itself
+    buffer = StampedRingBuffer(capacity=16)
+    stop = threading.Event()
+    def write():
+        i = 0
+        while not stop.is_set():
+            buffer.push(float(i), i)
+            i += 1
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for k in range(20000):
+            item = buffer.search(float(k))
+            if item is not None:
+                seq, stamp, msg = item
+                assert seq == stamp == msg and stamp >= k
+            item = buffer.nearest(float(k))
+            if item is not None:
+                seq, stamp, msg = item
+                assert seq == stamp == msg
+            latest = buffer.latest()
+            if latest is not None:
+                assert latest[0] == latest[1]
+    finally:
+        stop.set()
+        writer.join()
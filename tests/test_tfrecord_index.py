@@ -0,0 +1,32 @@
+import json
+import os
+
+from data.tfrecord_index import INDEX_FILE_NAME, INDEX_VERSION, load_index, save_index
+
+
+def test_load_index_derives_starts_of_version_1(tmp_path):
+    # Written before the episodes had a "start"
+    episodes = [
+        {"name": "b.hdf5", "shard": "shard-00000.tfrecord", "offset": 300,
+         "num_records": 5, "instruction_dir": ""},
+        {"name": "a.hdf5", "shard": "shard-00000.tfrecord", "offset": 0,
+         "num_records": 3, "instruction_dir": ""},
+        {"name": "c.hdf5", "shard": "shard-00001.tfrecord", "offset": 0,
+         "num_records": 4, "instruction_dir": ""},
+    ]
+    with open(os.path.join(tmp_path, INDEX_FILE_NAME), 'w') as f:
+        json.dump({"version": 1, "shards": {}, "episodes": episodes}, f)
+
+    index = load_index(tmp_path)
+    assert index["version"] == INDEX_VERSION
+    starts = {episode["name"]: episode["start"] for episode in index["episodes"]}
+    assert starts == {"a.hdf5": 0, "b.hdf5": 3, "c.hdf5": 0}
+    assert all("offset" not in episode for episode in index["episodes"])
+
+
+def test_save_and_load_index(tmp_path):
+    episodes = [{"name": "a.hdf5", "shard": "shard-00000.tfrecord", "start": 0,
+                 "num_records": 3, "instruction_dir": ""}]
+    save_index(tmp_path, {"shard-00000.tfrecord": {"num_records": 3, "num_bytes": 64}}, episodes)
+    assert load_index(tmp_path)["episodes"] == episodes
+    assert load_index(os.path.join(tmp_path, "missing")) is None
@@ -13,72 +13,26 @@ from torchvision import transforms
 from PIL import Image
 import transformers
 
+from data.chunk_buffer import ChunkBuffer, is_chunk_buffer
+from data.dirty_bit import CLEAN, DIRTY, READING, DirtyBitmap
 from data.filelock import FileLock
 from data.hdf5_vla_dataset import HDF5VLADataset
+from data.image_embed_store import ImageEmbedStore
+from data.jpeg_frames import decode_jpeg, is_packed, unpack_jpeg_frames
+from data.lang_embed_store import LangEmbedCache, LangEmbedStore
+from models.multimodal_encoder.image_preprocess import BatchImagePreprocessor
 from train.image_corrupt import image_corrupt
 
 
-def get_clean_item(chunk_dir):
-    """
-    Get indexes of clean items in a chunk.
-    """
-    dirty_bit = read_dirty_bit(chunk_dir)
-    return np.where(1 - dirty_bit)[0].tolist()
-
-
-def save_dirty_bit(chunk_dir, dirty_bit):
-    """
-    Save the dirty bit to the chunk directory.
-    """
-    time_stmp = time.time()
-    while time.time() - time_stmp < 10.0:
-        try:
-            file_path = os.path.join(chunk_dir, "dirty_bit")
-            lock = FileLock(file_path)
-            lock.acquire_write_lock()
-            with open(file_path, 'wb') as file:
-                file.write(dirty_bit.tobytes())
-            lock.release_lock()
-            return
-        except KeyboardInterrupt:
-            lock.release_lock()
-            raise KeyboardInterrupt
-        except BaseException:
-            lock.release_lock()
-            continue
-    raise RuntimeError("Failed to save dirty bit.")
-
-
-def read_dirty_bit(chunk_dir):
-    """
-    Read the dirty bit from the chunk directory.
-    """
-    # If error occurs, retry
-    time_stmp = time.time()
-    while time.time() - time_stmp < 10.0:
-        try:
-            file_path = os.path.join(chunk_dir, "dirty_bit")
-            lock = FileLock(file_path)
-            lock.acquire_read_lock()
-            with open(file_path, 'rb') as file:
-                dirty_bit = np.frombuffer(file.read(), dtype=np.uint8).copy()
-            lock.release_lock()
-            assert len(dirty_bit) > 0
-            return dirty_bit
-        except KeyboardInterrupt:
-            lock.release_lock()
-            raise KeyboardInterrupt
-        except BaseException:
-            lock.release_lock()
-            continue
-    raise RuntimeError("Failed to read dirty bit.")
-
-
 class VLAConsumerDataset(Dataset):
     """A vision-languange-action Dataset for supervised training.
     This dataset will load data from the buffer directory.
     """
-    
+    # The exponential backoff (in seconds) between the searches
+    # of the buffer that found no clean item
+    SEARCH_BACKOFF_MIN = 0.01
+    SEARCH_BACKOFF_MAX = 1.0
+
     def __init__(
         self, 
         config,
@@ -94,7 +48,9 @@ class VLAConsumerDataset(Dataset):
         cam_ext_mask_prob=-1.0,
         state_noise_snr=None,
         use_hdf5=False,
-        use_precomp_lang_embed=False
+        use_precomp_lang_embed=False,
+        lang_embed_path=None,
+        image_embed_path=None
     ):
         super(VLAConsumerDataset, self).__init__()
         
@@ -115,6 +71,13 @@ class VLAConsumerDataset(Dataset):
         self.buffer_dir = config["buf_path"]
         self.num_chunks = config["buf_num_chunks"]
         self.chunk_size = config["buf_chunk_size"]
+        # The chunk files opened by this worker (mmap format only),
+        # the format of each chunk is detected from its files
+        self.chunk_buffers = {}
+        # The dirty bits mapped by this worker
+        self.dirty_bitmaps = {}
+        # The chunks reported missing by this worker
+        self.missing_chunk_dirs = set()
         self.tokenizer_max_length = config["tokenizer_max_length"]
         self.image_aspect_ratio = config["image_aspect_ratio"]
         self.state_noise_snr = state_noise_snr
@@ -127,8 +90,31 @@ class VLAConsumerDataset(Dataset):
         if use_hdf5:
             self.hdf5_dataset = HDF5VLADataset()
         self.use_precomp_lang_embed = use_precomp_lang_embed
+        self.lang_embed_cache = None
         if use_precomp_lang_embed:
             self.empty_lang_embed = torch.load("data/empty_lang_embed.pt")
+            # Read the embeddings from the consolidated store if given,
+            # otherwise from their .pt files
+            self.lang_embed_cache = LangEmbedCache(
+                LangEmbedStore(lang_embed_path) if lang_embed_path is not None else None)
+        elif lang_embed_path is not None:
+            raise ValueError(
+                "The language embedding store is only used with precomputed language embeddings.")
+        # Read the precomputed image embeddings instead of the pixels
+        self.image_embed_store = None
+        if image_embed_path is not None:
+            if not use_hdf5:
+                raise ValueError(
+                    "Precomputed image embeddings are only supported with HDF5 datasets, "
+                    "since the buffer samples do not record their episodes.")
+            if image_aug:
+                raise ValueError(
+                    "Precomputed image embeddings cannot be used with image augmentation.")
+            self.image_embed_store = ImageEmbedStore(image_embed_path)
+            self.image_embed_store.check_preprocessing(
+                image_aspect_ratio=self.image_aspect_ratio,
+                image_size=image_size,
+                auto_adjust_image_brightness=auto_adjust_image_brightness)
         
         # Load dataset stat
         with open("configs/dataset_stat.json", 'r') as f:
@@ -139,6 +125,12 @@ class VLAConsumerDataset(Dataset):
         self.image_size = image_size
         self.auto_adjust_image_brightness = auto_adjust_image_brightness
         self.image_aug = image_aug
+        self.image_preprocessor = BatchImagePreprocessor(
+            image_processor,
+            image_size=image_size,
+            image_aspect_ratio=self.image_aspect_ratio,
+            auto_adjust_image_brightness=auto_adjust_image_brightness,
+        )
         
         self.last_content = None
         self.last_meta = None
@@ -187,45 +179,72 @@ class VLAConsumerDataset(Dataset):
                 continue
         raise RuntimeError("Failed to load sample.")
 
+    def _load_data_from_mmap_chunk(self, chunk_dir, chunk_item_idx):
+        if chunk_dir in self.chunk_buffers and self.chunk_buffers[chunk_dir].is_replaced():
+            self.chunk_buffers.pop(chunk_dir).close()
+        if chunk_dir not in self.chunk_buffers:
+            self.chunk_buffers[chunk_dir] = ChunkBuffer(chunk_dir)
+        # Copy the arrays out of the slot since the producer may
+        # overwrite it as soon as the dirty bit is set
+        json_content, arrays = self.chunk_buffers[chunk_dir].read_sample(
+            chunk_item_idx, copy=True)
+        return json_content, tuple(arrays.values())
+
     def __len__(self) -> int:
         if self.use_hdf5:
             return len(self.hdf5_dataset)
         else:
             return self.num_chunks * self.chunk_size
 
+    def _get_dirty_bitmap(self, chunk_dir):
+        if chunk_dir not in self.dirty_bitmaps:
+            self.dirty_bitmaps[chunk_dir] = DirtyBitmap(chunk_dir)
+        return self.dirty_bitmaps[chunk_dir]
+
     def _safe_load(self, index):
-        read_chunk_item_indices = []
+        read_chunk_item_index = None
         # Start searching from a random chunk
         read_chunk_idx = index // self.chunk_size
-        while len(read_chunk_item_indices) == 0:
+        # Wait before searching the chunks again if none of them has a
+        # clean item, e.g., before the producer has written them
+        num_searched, backoff = 0, self.SEARCH_BACKOFF_MIN
+        while read_chunk_item_index is None:
             read_chunk_dir = os.path.join(self.buffer_dir, f"chunk_{read_chunk_idx}")
             try:
-                read_chunk_item_indices = get_clean_item(read_chunk_dir)
+                dirty_bitmap = self._get_dirty_bitmap(read_chunk_dir)
+                self.missing_chunk_dirs.discard(read_chunk_dir)
+                read_chunk_item_indices = dirty_bitmap.get_clean_item()
+                # Claim a clean item so that no one else reads
+                # or replaces it while we are loading it
+                if len(read_chunk_item_indices) > 0:
+                    random_item_index = index % len(read_chunk_item_indices)
+                    item_index = read_chunk_item_indices[random_item_index]
+                    if dirty_bitmap.compare_and_set(item_index, CLEAN, READING):
+                        read_chunk_item_index = item_index
+                        break
+            except FileNotFoundError as e:
+                # Not written yet by the producer, report it once
+                if read_chunk_dir not in self.missing_chunk_dirs:
+                    self.missing_chunk_dirs.add(read_chunk_dir)
+                    print(f"Waiting for the chunk {read_chunk_dir}: {e}")
             except BaseException as e:
                 # Print the error info
                 print("Error catched when searching a clean chunk:", e)
                 traceback.print_exc()
-                read_chunk_item_indices = []
             read_chunk_idx = (read_chunk_idx + 1) % self.num_chunks
-        
-        # read_chunk_item_index = random.choice(read_chunk_item_indices)
-        # read_chunk_item_index = read_chunk_item_indices.pop()
-        random_item_index = index % len(read_chunk_item_indices)
-        read_chunk_item_index = read_chunk_item_indices[random_item_index]
-        
-        # Modify the dirty bit
-        try:
-            dirty_bit = read_dirty_bit(read_chunk_dir)
-            dirty_bit[read_chunk_item_index] = 1
-            save_dirty_bit(read_chunk_dir, dirty_bit)
-        except BaseException as e:
-            # Print the error info
-            print("Error catched when modifying the dirty bit:", e)
-            traceback.print_exc()
+            num_searched += 1
+            if num_searched % self.num_chunks == 0:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.SEARCH_BACKOFF_MAX)
         
         # load the sample
         try:
-            content, meta = self._load_data_from_chunk(read_chunk_dir, read_chunk_item_index)
+            if is_chunk_buffer(read_chunk_dir):
+                content, meta = self._load_data_from_mmap_chunk(
+                    read_chunk_dir, read_chunk_item_index)
+            else:
+                content, meta = self._load_data_from_chunk(
+                    read_chunk_dir, read_chunk_item_index)
             self.last_content, self.last_meta = content, meta
         except BaseException as e:
             # Print the error info
@@ -233,9 +252,83 @@ class VLAConsumerDataset(Dataset):
             traceback.print_exc()
             
             # If failed to load the data, return the last loaded data for robustness
+            if self.last_meta is None:
+                # Nothing loaded yet, let the caller retry another sample
+                raise
             content, meta = self.last_content, self.last_meta
+        finally:
+            # Mark the item as dirty so that the producer can replace it
+            dirty_bitmap.set(read_chunk_item_index, DIRTY)
 
         return (content, *meta)
+
+    def _get_image_embeds(self, content, image_metas, mask_probs):
+        """
+        Look up the precomputed embeddings of the frames,
+        in the same order and with the same masking as the images.
+        """
+        camera_names = self.hdf5_dataset.CAMERA_NAMES
+        step_id = int(content['step_id'])
+        image_embeds = []
+        for i in range(self.img_history_size):
+            # The history is padded with the first frame of the episode
+            frame_step_id = max(step_id - self.img_history_size + 1 + i, 0)
+            for j in range(self.num_cameras):
+                _, image_mask = image_metas[j]
+                if image_mask[i] and (random.random() > mask_probs[j]):
+                    image_embeds.append(self.image_embed_store.get(
+                        content['episode'], frame_step_id, camera_names[j]))
+                else:
+                    image_embeds.append(self.image_embed_store.background)
+        return torch.stack(image_embeds, dim=0)
+
+    def _get_images(self, image_metas, mask_probs):
+        """
+        Preprocess the frames of all the cameras.
+        """
+        # We replace the invalid images with the background image
+        # and also randomly mask images by the background image
+        background_image = self.image_preprocessor.background_image()
+        # The JPEG-encoded frames (see data/jpeg_frames.py) are only
+        # decoded if they are used, at the smallest size that is needed
+        image_metas = [
+            (unpack_jpeg_frames(images) if is_packed(images) else images, image_mask)
+            for images, image_mask in image_metas
+        ]
+        rearranged_images = []
+        for i in range(self.img_history_size):
+            for j in range(self.num_cameras):
+                images, image_mask = image_metas[j]
+                image, valid = images[i], image_mask[i]
+                if valid and (math.prod(image.shape) > 0) and \
+                    (random.random() > mask_probs[j]):
+                    if image.ndim == 1:
+                        image = decode_jpeg(image, self.image_preprocessor.min_frame_size)
+                    rearranged_images.append((image, True))
+                else:
+                    rearranged_images.append((background_image.copy(), False))
+
+        # Resize and brighten all the frames at once
+        images = [image for image, _ in rearranged_images]
+        valids = [valid for _, valid in rearranged_images]
+        images = self.image_preprocessor.adjust(images, valids)
+
+        # Only apply image augmentation to 50% of the images
+        for i, valid in enumerate(valids):
+            if valid and self.image_aug and (random.random() > 0.5):
+                image = Image.fromarray(images[i])
+                aug_type = random.choice([
+                    "corrput_only", "color_only", "both"])
+                if aug_type != "corrput_only":
+                    image = transforms.ColorJitter(
+                        brightness=0.3, contrast=0.4, saturation=0.5, hue=0.03)(image)
+                if aug_type != "color_only":
+                    image = image_corrupt(image)
+                images[i] = np.asarray(image)
+
+        # Pad, resize and normalize all the frames at once
+        preprocessed_images = self.image_preprocessor.finalize(images)
+        return list(preprocessed_images)
     
     def __getitem__(self, index):
         # For robustness, we will try to load the data until we succeed
@@ -243,7 +336,8 @@ class VLAConsumerDataset(Dataset):
             data_dict = None
             try:
                 if self.use_hdf5:
-                    res = self.hdf5_dataset.get_item()
+                    res = self.hdf5_dataset.get_item(
+                        load_images=self.image_embed_store is None)
                     content = res['meta']
                     states = res['state']
                     actions = res['actions']
@@ -283,77 +377,20 @@ class VLAConsumerDataset(Dataset):
                 # Stat for the episode that the step belongs to 
                 data_dict["state_norm"] = state_norm
                 
-                # We replace the invalid images with the background image
-                # and also randomly mask images by the background image
-                background_color = np.array([
-                    int(x*255) for x in self.image_processor.image_mean
-                ], dtype=np.uint8).reshape(1, 1, 3)
-                background_image = np.ones((
-                    self.image_processor.size["height"], 
-                    self.image_processor.size["width"], 3), dtype=np.uint8
-                ) * background_color
-                
                 image_metas = list(self.pairwise(image_metas))
                 mask_probs = [self.cond_mask_prob] * self.num_cameras
                 if self.cam_ext_mask_prob >= 0.0:
                     mask_probs[0] = self.cam_ext_mask_prob
-                rearranged_images = []
-                for i in range(self.img_history_size):
-                    for j in range(self.num_cameras):
-                        images, image_mask = image_metas[j]
-                        image, valid = images[i], image_mask[i]
-                        if valid and (math.prod(image.shape) > 0) and \
-                            (random.random() > mask_probs[j]):
-                            rearranged_images.append((image, True))
-                        else:
-                            rearranged_images.append((background_image.copy(), False))
-                
-                preprocessed_images = []
-                processor = self.image_processor
-                for image, valid in rearranged_images:
-                    image = Image.fromarray(image)
-                    if self.image_size is not None:
-                        image = transforms.Resize(self.image_size)(image) # (1008, 336)
-                    # assert image.height == 336, "We haven't prepare for training with images of different resolutions."
-                    
-                    if valid and self.auto_adjust_image_brightness:
-                        pixel_values = list(image.getdata())
-                        average_brightness = sum(sum(pixel) for pixel in pixel_values) / (len(pixel_values) * 255.0 * 3)
-                        if average_brightness <= 0.15:
-                            image = transforms.ColorJitter(brightness=(1.75,1.75))(image)
-                    
-                    # Only apply image augmentation to 50% of the images
-                    if valid and self.image_aug and (random.random() > 0.5):
-                        aug_type = random.choice([
-                            "corrput_only", "color_only", "both"])
-                        if aug_type != "corrput_only":
-                            image = transforms.ColorJitter(
-                                brightness=0.3, contrast=0.4, saturation=0.5, hue=0.03)(image)
-                        if aug_type != "color_only":
-                            image = image_corrupt(image)
-                    
-                    if self.image_aspect_ratio == 'pad':
-                        def expand2square(pil_img, background_color):
-                            width, height = pil_img.size
-                            if width == height:
-                                return pil_img
-                            elif width > height:
-                                result = Image.new(pil_img.mode, (width, width), background_color)
-                                result.paste(pil_img, (0, (width - height) // 2))
-                                return result
-                            else:
-                                result = Image.new(pil_img.mode, (height, height), background_color)
-                                result.paste(pil_img, ((height - width) // 2, 0))
-                                return result
-                        image = expand2square(image, tuple(int(x*255) for x in processor.image_mean))
-                    image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
-                    preprocessed_images.append(image)
-                data_dict["images"] = preprocessed_images
+                if self.image_embed_store is not None:
+                    data_dict["image_embeds"] = self._get_image_embeds(
+                        content, image_metas, mask_probs)
+                else:
+                    data_dict["images"] = self._get_images(image_metas, mask_probs)
 
                 if self.use_precomp_lang_embed:
                     if content["instruction"][-1] == ".":
                         content["instruction"] = content["instruction"][:-1]
-                    data_dict["lang_embed"] = torch.load(content["instruction"]) \
+                    data_dict["lang_embed"] = self.lang_embed_cache.load(content["instruction"]) \
                         if random.random() > self.cond_mask_prob else self.empty_lang_embed
                 else:
                     instruction = content["instruction"] \
@@ -427,7 +464,10 @@ class DataCollatorForVLAConsumerDataset(object):
                 lang_embeds.append(instance["lang_embed"])
                 lang_embed_lens.append(instance["lang_embed"].shape[0])
             
-            batch["images"].append(torch.stack(instance["images"], dim=0))
+            if "image_embeds" in instance:
+                batch["images"].append(instance["image_embeds"])
+            else:
+                batch["images"].append(torch.stack(instance["images"], dim=0))
             batch["data_indices"].append(instance["data_idx"])
             batch["ctrl_freqs"].append(instance["ctrl_freq"])
         
@@ -438,6 +478,9 @@ class DataCollatorForVLAConsumerDataset(object):
         ]
         for key in keys_to_stack:
             batch[key] = torch.stack(batch[key], dim=0)
+        # Precomputed embeddings are (B, N, P, D) instead of (B, N, C, H, W) pixels
+        if "image_embeds" in instances[0]:
+            batch["image_embeds"] = batch.pop("images")
         
         batch["ctrl_freqs"] = torch.tensor(batch["ctrl_freqs"])
     
@@ -24,15 +24,19 @@ def log_sample_res(
         data_indices = batch["data_indices"]
         ctrl_freqs = batch["ctrl_freqs"]
         state_norm = batch["state_norm"].to(dtype=weight_dtype)
-        images = batch["images"].to(dtype=weight_dtype)
         states = batch["states"].to(dtype=weight_dtype)
         # We only use the last state as input
         states = states[:, -1:, :]
         actions = batch["actions"].to(dtype=weight_dtype)
         state_elem_mask = batch["state_elem_mask"].to(dtype=weight_dtype)
             
-        batch_size, _, C, H, W = images.shape
-        image_embeds = vision_encoder(images.reshape(-1, C, H, W)).detach()
+        batch_size = states.shape[0]
+        if "image_embeds" in batch:
+            image_embeds = batch["image_embeds"].to(dtype=weight_dtype)
+        else:
+            images = batch["images"].to(dtype=weight_dtype)
+            _, _, C, H, W = images.shape
+            image_embeds = vision_encoder(images.reshape(-1, C, H, W)).detach()
         image_embeds = image_embeds.reshape((batch_size, -1, vision_encoder.hidden_size))
         
         lang_attn_mask = batch["lang_attn_mask"]
@@ -185,7 +185,9 @@ def train(args, logger):
         inv_gamma=config["model"]["ema"]["inv_gamma"],
         power=config["model"]["ema"]["power"],
         min_value=config["model"]["ema"]["min_value"],
-        max_value=config["model"]["ema"]["max_value"]
+        max_value=config["model"]["ema"]["max_value"],
+        update_every=config["model"]["ema"].get("update_every", 1),
+        offload=config["model"]["ema"].get("offload", False)
     )
 
     # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
@@ -236,6 +238,13 @@ def train(args, logger):
         eps=args.adam_epsilon,
     )
     
+    # Precomputed image embeddings cannot reflect the image augmentation,
+    # so the training set falls back to encoding the images on the fly
+    train_image_embed_path = args.image_embed_path
+    if args.image_embed_path is not None and args.image_aug:
+        logger.info("Image augmentation is enabled, encoding the training images on the fly.")
+        train_image_embed_path = None
+    
     # Dataset and DataLoaders creation:                                                           
     train_dataset = VLAConsumerDataset(
         config=config["dataset"],
@@ -250,6 +259,8 @@ def train(args, logger):
         state_noise_snr=args.state_noise_snr,
         use_hdf5=args.load_from_hdf5,
         use_precomp_lang_embed=args.precomp_lang_embed,
+        lang_embed_path=args.lang_embed_path,
+        image_embed_path=train_image_embed_path,
     )
     sample_dataset = VLAConsumerDataset(
         config=config["dataset"],
@@ -264,7 +275,15 @@ def train(args, logger):
         state_noise_snr=None,
         use_hdf5=args.load_from_hdf5,
         use_precomp_lang_embed=args.precomp_lang_embed,
+        lang_embed_path=args.lang_embed_path,
+        image_embed_path=args.image_embed_path,
     )                              
+    if args.image_embed_path is not None:
+        image_embed_store = sample_dataset.image_embed_store
+        if (image_embed_store.num_patches, image_embed_store.hidden_size) != \
+            (vision_encoder.num_patches, vision_encoder.hidden_size):
+            raise ValueError(
+                f"The image embeddings in {args.image_embed_path} do not match the vision encoder.")
     
     data_collator = DataCollatorForVLAConsumerDataset(tokenizer)                                                        
     
@@ -308,12 +327,14 @@ def train(args, logger):
         rdt, optimizer, train_dataloader, sample_dataloader, lr_scheduler                   
     )
 
-    ema_rdt.to(accelerator.device, dtype=weight_dtype)                                                                             
+    # The offloaded EMA weights stay on CPU
+    ema_rdt.to("cpu" if ema_model.offload else accelerator.device, dtype=weight_dtype)                                                                             
 
     if text_encoder is not None:
         text_encoder.to(accelerator.device, dtype=weight_dtype)
     
-    if vision_encoder is not None:
+    # The vision encoder is not used if all the image embeddings are precomputed
+    if vision_encoder is not None and train_image_embed_path is None:
         vision_encoder.vision_tower.to(accelerator.device, dtype=weight_dtype)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
@@ -402,7 +423,6 @@ def train(args, logger):
         # Forward and backward...
         for batch in train_dataloader:
             with accelerator.accumulate(rdt):
-                images = batch["images"].to(dtype=weight_dtype)
                 states = batch["states"].to(dtype=weight_dtype) # (B, T, D_a)
                 # We only use the last state as input
                 states = states[:, -1:, :]
@@ -411,9 +431,15 @@ def train(args, logger):
                 ctrl_freqs = batch["ctrl_freqs"]
                     
                 with torch.no_grad():
-                    batch_size, _, C, H, W = images.shape
-                    image_embeds = vision_encoder(images.reshape(-1, C, H, W)).detach()
-                    image_embeds = image_embeds.reshape((batch_size, -1, vision_encoder.hidden_size))
+                    if "image_embeds" in batch:
+                        image_embeds = batch["image_embeds"].to(dtype=weight_dtype)
+                        image_embeds = image_embeds.reshape(
+                            (image_embeds.shape[0], -1, vision_encoder.hidden_size))
+                    else:
+                        images = batch["images"].to(dtype=weight_dtype)
+                        batch_size, _, C, H, W = images.shape
+                        image_embeds = vision_encoder(images.reshape(-1, C, H, W)).detach()
+                        image_embeds = image_embeds.reshape((batch_size, -1, vision_encoder.hidden_size))
 
                     lang_attn_mask = batch["lang_attn_mask"]
                     text_embeds = batch["lang_embeds"].to(dtype=weight_dtype) \
@@ -453,6 +479,7 @@ def train(args, logger):
                     save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
                     accelerator.save_state(save_path)
                     ema_save_path = os.path.join(save_path, f"ema")
+                    ema_model.synchronize()
                     accelerator.save_model(ema_rdt, ema_save_path)
                     logger.info(f"Saved state to {save_path}")
 
@@ -485,6 +512,7 @@ def train(args, logger):
     if accelerator.is_main_process:
         accelerator.unwrap_model(rdt).save_pretrained(args.output_dir)
         ema_save_path = os.path.join(args.output_dir, f"ema")
+        ema_model.synchronize()
         accelerator.save_model(ema_rdt, ema_save_path)
         
         logger.info(f"Saved Model to {args.output_dir}")